@@ -0,0 +1,126 @@
+""" Registration of many moving images towards the same static image
+
+The static side of a registration (the scale space of the static image and,
+for affine registration, its resampling and sampling at each level) is
+computed once by the registration's `set_static` method and shared by the
+registrations of all the moving images, which may run in forked worker
+processes.
+"""
+from collections import deque
+from multiprocessing import cpu_count
+from warnings import warn
+
+from dipy.io.pickles import save_pickle
+from dipy.utils.parallel import fork_context
+
+# Registrations prepared by register_batch, with the arguments shared by all
+# the moving images, inherited by its forked workers
+_shared_registrations = {}
+
+
+def _register_one(task):
+    """Registers one moving image with a shared, prepared registration"""
+    key, moving, moving_grid2world, moving_kwargs, out_file = task
+    registration, kwargs = _shared_registrations[key]
+    kwargs = dict(kwargs, **moving_kwargs)
+    mapping = registration.optimize(None, moving,
+                                    moving_grid2world=moving_grid2world,
+                                    **kwargs)
+    if out_file is None:
+        return mapping
+    save_pickle(out_file, mapping)
+    return out_file
+
+
+def register_batch(registration, static, moving_images,
+                   static_grid2world=None, moving_grid2worlds=None,
+                   image_kwargs=None, out_files=None, num_processes=1,
+                   **kwargs):
+    """ Registers each of several moving images towards the same static image
+
+    Parameters
+    ----------
+    registration : AffineRegistration or SymmetricDiffeomorphicRegistration
+        The registration run for each moving image. Its static side is
+        precomputed once, with ``registration.set_static``.
+    static : array, shape (S, R, C) or (R, C)
+        The static image, or template, all the moving images are registered
+        to.
+    moving_images : iterable of arrays
+        The moving images. They are read lazily: at most
+        ``2 * num_processes`` of them are waiting to be registered at any
+        time, so they may be loaded from files by a generator.
+    static_grid2world : array, shape (dim+1, dim+1), optional
+        The voxel-to-space transformation of the static image. Default: the
+        identity.
+    moving_grid2worlds : sequence of arrays, optional
+        The voxel-to-space transformation of each moving image. Default: the
+        identity.
+    image_kwargs : sequence of dict, optional
+        Extra arguments of ``registration.optimize`` for each moving image,
+        for instance its ``starting_affine`` (affine registration) or its
+        ``prealign`` (diffeomorphic registration). They are sent to the
+        worker processes, so they must be picklable.
+    out_files : sequence of str, optional
+        If given, the transform of each moving image is pickled to its file
+        (see `dipy.io.pickles.load_pickle`) by the process that computed
+        it, and the file names are returned instead of the transforms, so
+        that they are never all held in memory.
+    num_processes : int, optional
+        Number of worker processes. 1 (default) registers the images one
+        after the other in the calling process; 0 or None uses one process
+        per CPU. Each process holds one registration at a time. Processes
+        need to be forked, with a warning and a single process otherwise.
+    kwargs : dict, optional
+        Extra arguments of ``registration.optimize`` shared by all the moving
+        images, for instance ``transform`` and ``params0`` for affine
+        registration. They are inherited by the worker processes, so they
+        do not need to be picklable.
+
+    Returns
+    -------
+    mappings : list
+        The AffineMap or DiffeomorphicMap of each moving image, or the file
+        it was saved to if `out_files` is given, in the order of
+        `moving_images`.
+    """
+    if not num_processes:
+        num_processes = cpu_count()
+    if num_processes > 1 and fork_context() is None:
+        warn("Processes cannot be forked, registering with one process.")
+        num_processes = 1
+
+    registration.set_static(static, static_grid2world)
+    key = id(registration)
+
+    def tasks():
+        for i, moving in enumerate(moving_images):
+            yield (key, moving,
+                   None if moving_grid2worlds is None else
+                   moving_grid2worlds[i],
+                   {} if image_kwargs is None else image_kwargs[i],
+                   None if out_files is None else out_files[i])
+
+    _shared_registrations[key] = (registration, kwargs)
+    try:
+        if num_processes < 2:
+            return [_register_one(task) for task in tasks()]
+        pool = fork_context().Pool(num_processes)
+    finally:
+        # The workers have their own copy by now
+        del _shared_registrations[key]
+
+    mappings = []
+    pending = deque()
+    try:
+        for task in tasks():
+            if len(pending) >= 2 * num_processes:
+                mappings.append(pending.popleft().get())
+            pending.append(pool.apply_async(_register_one, (task,)))
+        while pending:
+            mappings.append(pending.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return mappings
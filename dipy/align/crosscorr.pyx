@@ -4,6 +4,9 @@ import numpy as np
 from fused_types cimport floating
 cimport cython
 cimport numpy as cnp
+from cython.parallel import prange
+
+from omp_threads cimport determine_num_threads
 
 
 cdef inline int _int_max(int a, int b) nogil:
@@ -146,6 +149,9 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         the moving volume (notice that both images must already be in a common
         reference domain, i.e. the same S, R, C)
     radius : the radius of the neighborhood (cube of (2 * radius + 1)^3 voxels)
+    num_threads : int, optional
+        the number of threads computing slabs of slices of the factors. If
+        None (default), all the available cores are used.
 
     Returns
     -------
@@ -158,6 +164,11 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         factors[:,:,:,3] : sum of sq. values of static along the neighborhood
         factors[:,:,:,4] : sum of sq. values of moving along the neighborhood
 
+    Notes
+    -----
+    Each slab of slices restarts the recursive sums of the windows `radius`
+    slices before its first slice, so that the slabs are independent.
+
     References
     ----------
     .. [Ocegueda2016]_ Ocegueda, O., Dalmau, O., Garyfallidis, E., Descoteaux,
@@ -171,123 +182,157 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
     .. [Avants2011]_ Avants, B. B., Tustison, N., & Song, G. (2011). Advanced
         Normalization Tools ( ANTS ), 1-35.
     """
+    cdef:
+        cnp.npy_intp ns = static.shape[0]
+        cnp.npy_intp nr = static.shape[1]
+        cnp.npy_intp nc = static.shape[2]
+        cnp.npy_intp slab, nslabs
+        floating[:, :, :, :] factors = np.zeros((ns, nr, nc, 5),
+                                                dtype=np.asarray(static).dtype)
+        double[:, :, :, :] temp
+
+    nslabs = max(min(determine_num_threads(num_threads), ns), 1)
+    # Two slices of sums of windows for each slab
+    temp = np.zeros((2 * nslabs, nr, nc, 5), dtype=np.float64)
+    with nogil:
+        for slab in prange(nslabs, num_threads=nslabs, schedule='static'):
+            _precompute_cc_factors_slab_3d(static, moving, radius, temp,
+                                           2 * slab, slab * ns / nslabs,
+                                           (slab + 1) * ns / nslabs, factors)
+    return factors
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _precompute_cc_factors_slab_3d(floating[:, :, :] static,
+                                         floating[:, :, :] moving,
+                                         cnp.npy_intp radius,
+                                         double[:, :, :, :] temp,
+                                         cnp.npy_intp t0,
+                                         cnp.npy_intp first,
+                                         cnp.npy_intp last,
+                                         floating[:, :, :, :] factors) nogil:
+    r"""CC factors of the slices `first` to `last` (excluded)
+
+    The sums of the windows are computed recursively from slice
+    ``max(first - radius, 0)``, in the slices `t0` and ``t0 + 1`` of
+    `temp`, and the factors of the slices ``first <= s < last`` are written
+    to `factors`. See `precompute_cc_factors_3d`.
+    """
     cdef:
         cnp.npy_intp ns = static.shape[0]
         cnp.npy_intp nr = static.shape[1]
         cnp.npy_intp nc = static.shape[2]
         cnp.npy_intp side = 2 * radius + 1
+        cnp.npy_intp start = _int_max(0, first - radius)
         cnp.npy_intp firstc, lastc, firstr, lastr, firsts, lasts
         cnp.npy_intp s, r, c, it, sides, sider, sidec
         double cnt
-        cnp.npy_intp ssss, sss, ss, rr, cc, prev_ss, prev_rr, prev_cc
+        cnp.npy_intp sss, ss, rr, cc, prev_ss, prev_rr, prev_cc
         double Imean, Jmean, IJprods, Isq, Jsq
-        double[:, :, :, :] temp = np.zeros((2, nr, nc, 5), dtype=np.float64)
-        floating[:, :, :, :] factors = np.zeros((ns, nr, nc, 5),
-                                                dtype=np.asarray(static).dtype)
-
-    with nogil:
-        sss = 1
-        for s in range(ns+radius):
-            ss = _wrap(s - radius, ns)
-            sss = 1 - sss
-            firsts = _int_max(0, ss - radius)
-            lasts = _int_min(ns - 1, ss + radius)
-            sides = (lasts - firsts + 1)
-            for r in range(nr+radius):
-                rr = _wrap(r - radius, nr)
-                firstr = _int_max(0, rr - radius)
-                lastr = _int_min(nr - 1, rr + radius)
-                sider = (lastr - firstr + 1)
-                for c in range(nc+radius):
-                    cc = _wrap(c - radius, nc)
-                    # New corner
-                    _update_factors(temp, moving, static,
-                                    sss, rr, cc, s, r, c, 0)
 
-                    # Add signed sub-volumes
-                    if s > 0:
-                        prev_ss = 1 - sss
+    sss = t0 + 1
+    for s in range(start, last + radius):
+        ss = _wrap(s - radius, ns)
+        sss = 2 * t0 + 1 - sss
+        firsts = _int_max(0, ss - radius)
+        lasts = _int_min(ns - 1, ss + radius)
+        sides = (lasts - firsts + 1)
+        for r in range(nr+radius):
+            rr = _wrap(r - radius, nr)
+            firstr = _int_max(0, rr - radius)
+            lastr = _int_min(nr - 1, rr + radius)
+            sider = (lastr - firstr + 1)
+            for c in range(nc+radius):
+                cc = _wrap(c - radius, nc)
+                # New corner
+                _update_factors(temp, moving, static,
+                                sss, rr, cc, s, r, c, 0)
+
+                # Add signed sub-volumes
+                if s > start:
+                    prev_ss = 2 * t0 + 1 - sss
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += temp[prev_ss, rr, cc, it]
+                    if r > 0:
+                        prev_rr = _wrap(rr-1, nr)
                         for it in range(5):
-                            temp[sss, rr, cc, it] += temp[prev_ss, rr, cc, it]
-                        if r > 0:
-                            prev_rr = _wrap(rr-1, nr)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, prev_rr, cc, it]
-                            if c > 0:
-                                prev_cc = _wrap(cc-1, nc)
-                                for it in range(5):
-                                    temp[sss, rr, cc, it] += \
-                                        temp[prev_ss, prev_rr, prev_cc, it]
+                            temp[sss, rr, cc, it] -= \
+                                temp[prev_ss, prev_rr, cc, it]
                         if c > 0:
                             prev_cc = _wrap(cc-1, nc)
                             for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, rr, prev_cc, it]
-                    if(r > 0):
-                        prev_rr = _wrap(rr-1, nr)
+                                temp[sss, rr, cc, it] += \
+                                    temp[prev_ss, prev_rr, prev_cc, it]
+                    if c > 0:
+                        prev_cc = _wrap(cc-1, nc)
                         for it in range(5):
-                            temp[sss, rr, cc, it] += \
-                                temp[sss, prev_rr, cc, it]
-                        if(c > 0):
-                            prev_cc = _wrap(cc-1, nc)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[sss, prev_rr, prev_cc, it]
+                            temp[sss, rr, cc, it] -= \
+                                temp[prev_ss, rr, prev_cc, it]
+                if(r > 0):
+                    prev_rr = _wrap(rr-1, nr)
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += \
+                            temp[sss, prev_rr, cc, it]
                     if(c > 0):
                         prev_cc = _wrap(cc-1, nc)
                         for it in range(5):
-                            temp[sss, rr, cc, it] += temp[sss, rr, prev_cc, it]
-
-                    # Add signed corners
-                    if s >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s-side, r, c, -1)
-                        if r >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r-side, c, 1)
-                            if c >= side:
-                                _update_factors(temp, moving, static, sss, rr,
-                                                cc, s-side, r-side, c-side, -1)
-                        if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r, c-side, 1)
+                            temp[sss, rr, cc, it] -= \
+                                temp[sss, prev_rr, prev_cc, it]
+                if(c > 0):
+                    prev_cc = _wrap(cc-1, nc)
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += temp[sss, rr, prev_cc, it]
+
+                # Add signed corners
+                if s - side >= start:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s-side, r, c, -1)
                     if r >= side:
                         _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r-side, c, -1)
+                                        sss, rr, cc, s-side, r-side, c, 1)
                         if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s, r-side, c-side, 1)
-
+                            _update_factors(temp, moving, static, sss, rr,
+                                            cc, s-side, r-side, c-side, -1)
                     if c >= side:
                         _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r, c-side, -1)
-                    # Compute final factors
-                    if s >= radius and r >= radius and c >= radius:
-                        firstc = _int_max(0, cc - radius)
-                        lastc = _int_min(nc - 1, cc + radius)
-                        sidec = (lastc - firstc + 1)
-                        cnt = sides*sider*sidec
-                        Imean = temp[sss, rr, cc, SI] / cnt
-                        Jmean = temp[sss, rr, cc, SJ] / cnt
-                        IJprods = (temp[sss, rr, cc, SIJ] -
-                                   Jmean * temp[sss, rr, cc, SI] -
-                                   Imean * temp[sss, rr, cc, SJ] +
-                                   cnt * Jmean * Imean)
-                        Isq = (temp[sss, rr, cc, SI2] -
-                               Imean * temp[sss, rr, cc, SI] -
-                               Imean * temp[sss, rr, cc, SI] +
-                               cnt * Imean * Imean)
-                        Jsq = (temp[sss, rr, cc, SJ2] -
-                               Jmean * temp[sss, rr, cc, SJ] -
-                               Jmean * temp[sss, rr, cc, SJ] +
-                               cnt * Jmean * Jmean)
-                        factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
-                        factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
-                        factors[ss, rr, cc, 2] = IJprods
-                        factors[ss, rr, cc, 3] = Isq
-                        factors[ss, rr, cc, 4] = Jsq
-    return factors
+                                        sss, rr, cc, s-side, r, c-side, 1)
+                if r >= side:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s, r-side, c, -1)
+                    if c >= side:
+                        _update_factors(temp, moving, static,
+                                        sss, rr, cc, s, r-side, c-side, 1)
+
+                if c >= side:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s, r, c-side, -1)
+                # Compute final factors
+                if s >= first + radius and r >= radius and c >= radius:
+                    firstc = _int_max(0, cc - radius)
+                    lastc = _int_min(nc - 1, cc + radius)
+                    sidec = (lastc - firstc + 1)
+                    cnt = sides*sider*sidec
+                    Imean = temp[sss, rr, cc, SI] / cnt
+                    Jmean = temp[sss, rr, cc, SJ] / cnt
+                    IJprods = (temp[sss, rr, cc, SIJ] -
+                               Jmean * temp[sss, rr, cc, SI] -
+                               Imean * temp[sss, rr, cc, SJ] +
+                               cnt * Jmean * Imean)
+                    Isq = (temp[sss, rr, cc, SI2] -
+                           Imean * temp[sss, rr, cc, SI] -
+                           Imean * temp[sss, rr, cc, SI] +
+                           cnt * Imean * Imean)
+                    Jsq = (temp[sss, rr, cc, SJ2] -
+                           Jmean * temp[sss, rr, cc, SJ] -
+                           Jmean * temp[sss, rr, cc, SJ] +
+                           cnt * Jmean * Jmean)
+                    factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
+                    factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
+                    factors[ss, rr, cc, 2] = IJprods
+                    factors[ss, rr, cc, 3] = Isq
+                    factors[ss, rr, cc, 4] = Jsq
 
 
 @cython.boundscheck(False)
@@ -354,7 +399,7 @@ def precompute_cc_factors_3d_test(floating[:, :, :] static,
 @cython.cdivision(True)
 def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                                floating[:, :, :, :] factors,
-                               cnp.npy_intp radius):
+                               cnp.npy_intp radius, num_threads=None):
     r"""Gradient of the CC Metric w.r.t. the forward transformation
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -372,6 +417,9 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        the number of threads computing the slices of the gradient. If None
+        (default), all the available cores are used.
 
     Returns
     -------
@@ -393,13 +441,15 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         cnp.npy_intp ns = grad_static.shape[0]
         cnp.npy_intp nr = grad_static.shape[1]
         cnp.npy_intp nc = grad_static.shape[2]
-        double energy = 0
+        int threads = determine_num_threads(num_threads)
+        double[:] energies = np.zeros(ns, dtype=np.float64)
         cnp.npy_intp s, r, c
         double Ii, Ji, sfm, sff, smm, localCorrelation, temp
         floating[:, :, :, :] out =\
             np.zeros((ns, nr, nc, 3), dtype=np.asarray(grad_static).dtype)
     with nogil:
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, num_threads=threads,
+                        schedule='static'):
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -413,12 +463,13 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                     if(sff * smm > 1e-5):
                         localCorrelation = sfm * sfm / (sff * smm)
                     if(localCorrelation < 1):  # avoid bad values...
-                        energy -= localCorrelation
+                        energies[s] -= localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ji - sfm / sff * Ii)
                     out[s, r, c, 0] -= temp * grad_static[s, r, c, 0]
                     out[s, r, c, 1] -= temp * grad_static[s, r, c, 1]
                     out[s, r, c, 2] -= temp * grad_static[s, r, c, 2]
-    return np.asarray(out), energy
+    # The energies of the slices are added in order, whatever the threads
+    return np.asarray(out), float(np.sum(energies))
 
 
 @cython.boundscheck(False)
@@ -426,7 +477,7 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
 @cython.cdivision(True)
 def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                                 floating[:, :, :, :] factors,
-                                cnp.npy_intp radius):
+                                cnp.npy_intp radius, num_threads=None):
     r"""Gradient of the CC Metric w.r.t. the backward transformation
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -444,6 +495,9 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        the number of threads computing the slices of the gradient. If None
+        (default), all the available cores are used.
 
     Returns
     -------
@@ -467,13 +521,14 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         cnp.npy_intp nr = grad_moving.shape[1]
         cnp.npy_intp nc = grad_moving.shape[2]
         cnp.npy_intp s, r, c
-        double energy = 0
+        int threads = determine_num_threads(num_threads)
+        double[:] energies = np.zeros(ns, dtype=np.float64)
         double Ii, Ji, sfm, sff, smm, localCorrelation, temp
         floating[:, :, :, :] out = np.zeros((ns, nr, nc, 3), dtype=ftype)
 
     with nogil:
-
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, num_threads=threads,
+                        schedule='static'):
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -487,12 +542,13 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                     if(sff * smm > 1e-5):
                         localCorrelation = sfm * sfm / (sff * smm)
                     if(localCorrelation < 1):  # avoid bad values...
-                        energy -= localCorrelation
+                        energies[s] -= localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ii - sfm / smm * Ji)
                     out[s, r, c, 0] -= temp * grad_moving[s, r, c, 0]
                     out[s, r, c, 1] -= temp * grad_moving[s, r, c, 1]
                     out[s, r, c, 2] -= temp * grad_moving[s, r, c, 2]
-    return np.asarray(out), energy
+    # The energies of the slices are added in order, whatever the threads
+    return np.asarray(out), float(np.sum(energies))
 
 
 @cython.boundscheck(False)
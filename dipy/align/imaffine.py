@@ -362,9 +362,46 @@ class AffineMap(object):
         return np.array(transformed)
 
 
+def _sample_static(k, static, static_grid2world):
+    r""" Samples a static image at one of every `k` voxels
+
+    Parameters
+    ----------
+    k : int
+        the sampling rate, see `sample_domain_regular`
+    static : array, shape (S, R, C) or (R, C)
+        static image
+    static_grid2world : array (dim+1, dim+1), or None
+        the grid-to-space transform of the static image. If None, the
+        identity.
+
+    Returns
+    -------
+    samples : array, shape (ns, dim+1)
+        the homogeneous coordinates of the sampling points in physical space
+    static_vals : array, shape (ns,)
+        the intensities of `static` at the sampling points
+    """
+    dim = len(static.shape)
+    if static_grid2world is None:
+        static_grid2world = np.eye(dim + 1)
+    shape = np.array(static.shape, dtype=np.int32)
+    samples = np.array(sample_domain_regular(k, shape, static_grid2world))
+    # Add a column of ones (homogeneous coordinates)
+    samples = np.hstack((samples, np.ones(samples.shape[0])[:, None]))
+    static_p = npl.inv(static_grid2world).dot(samples.T).T[..., :dim]
+    if dim == 2:
+        static_vals, inside = vf.interpolate_scalar_2d(
+            np.asarray(static, dtype=np.float64), static_p)
+    else:
+        static_vals, inside = vf.interpolate_scalar_3d(
+            np.asarray(static, dtype=np.float64), static_p)
+    return samples, np.array(static_vals, dtype=np.float64)
+
+
 class MutualInformationMetric(object):
 
-    def __init__(self, nbins=32, sampling_proportion=None):
+    def __init__(self, nbins=32, sampling_proportion=None, num_threads=None):
         r""" Initializes an instance of the Mutual Information metric
 
         This class implements the methods required by Optimizer to drive the
@@ -384,6 +421,10 @@ class MutualInformationMetric(object):
             then sparse sampling is used, where `sampling_proportion`
             specifies the proportion of voxels to be used. The default is
             None.
+        num_threads : int, optional
+            the number of threads used to update the joint histogram and
+            its gradient. If None (default), all the available cores are
+            used.
 
         Notes
         -----
@@ -395,13 +436,14 @@ class MutualInformationMetric(object):
         coordinates. When using dense sampling, this random displacement is
         not applied.
         """
-        self.histogram = ParzenJointHistogram(nbins)
+        self.histogram = ParzenJointHistogram(nbins, num_threads)
         self.sampling_proportion = sampling_proportion
         self.metric_val = None
         self.metric_grad = None
 
     def setup(self, transform, static, moving, static_grid2world=None,
-              moving_grid2world=None, starting_affine=None):
+              moving_grid2world=None, starting_affine=None,
+              static_sampling=None):
         r""" Prepares the metric to compute intensity densities and gradients
 
         The histograms will be setup to compute probability densities of
@@ -432,6 +474,10 @@ class MutualInformationMetric(object):
             instead of manually transforming the moving image to reduce
             interpolation artifacts. The default is None, implying no
             pre-alignment is performed.
+        static_sampling : tuple, optional
+            the sampling of `static` returned by `sample_static`, if it was
+            already computed. The default is None, implying the static image
+            is sampled here.
         """
         n = transform.get_number_of_parameters()
         self.metric_grad = np.zeros(n, dtype=np.float64)
@@ -465,35 +511,97 @@ class MutualInformationMetric(object):
         else:
             self.interp_method = vf.interpolate_scalar_3d
 
+        if static_sampling is None:
+            static_sampling = self.sample_static(self.static,
+                                                 static_grid2world)
+        self._set_samples(static_sampling)
+        self.histogram.setup(self.static, self.moving)
+
+    def sample_static(self, static, static_grid2world=None):
+        r""" Sampling points of the static image and intensities at them
+
+        They only depend on the static image, so they may be computed once
+        and given to `setup` when the same static image is registered with
+        several moving images.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            static image
+        static_grid2world : array (dim+1, dim+1), optional
+            the grid-to-space transform of the static image. The default is
+            None, implying the transform is the identity.
+
+        Returns
+        -------
+        static_sampling : tuple, or None
+            the homogeneous coordinates of the sampling points in physical
+            space, array of shape (ns, dim+1), and the intensities of the
+            static image at those points, array of shape (ns,). None if the
+            metric is dense.
+        """
         if self.sampling_proportion is None:
+            return None
+        k = int(np.ceil(1.0 / self.sampling_proportion))
+        return _sample_static(k, static, static_grid2world)
+
+    def _set_samples(self, static_sampling):
+        r""" Sets the sampling points of the metric
+
+        The points are mapped by the pre-aligning matrix once, as they do not
+        depend on the transform parameters.
+
+        Parameters
+        ----------
+        static_sampling : tuple, or None
+            the sampling points and static intensities returned by
+            `sample_static`. If None, no points are set (dense sampling).
+        """
+        if static_sampling is None:
             self.samples = None
+            self.samples_prealigned = None
+            self.static_vals = None
             self.ns = 0
+            return
+        self.samples, self.static_vals = static_sampling
+        self.ns = self.samples.shape[0]
+        if self.starting_affine is None:
+            self.samples_prealigned = self.samples
         else:
-            k = int(np.ceil(1.0 / self.sampling_proportion))
-            shape = np.array(static.shape, dtype=np.int32)
-            self.samples = sample_domain_regular(k, shape, static_grid2world)
-            self.samples = np.array(self.samples)
-            self.ns = self.samples.shape[0]
-            # Add a column of ones (homogeneous coordinates)
-            self.samples = np.hstack((self.samples, np.ones(self.ns)[:, None]))
-            if self.starting_affine is None:
-                self.samples_prealigned = self.samples
-            else:
-                self.samples_prealigned =\
-                    self.starting_affine.dot(self.samples.T).T
-            # Sample the static image
-            static_p = self.static_world2grid.dot(self.samples.T).T
-            static_p = static_p[..., :self.dim]
-            self.static_vals, inside = self.interp_method(static, static_p)
-            self.static_vals = np.array(self.static_vals, dtype=np.float64)
-        self.histogram.setup(self.static, self.moving)
+            self.samples_prealigned =\
+                self.starting_affine.dot(self.samples.T).T
+
+    def get_sample_pool(self):
+        r""" Physical points the mini-batches of the metric are drawn from
+
+        These are the sampling points of a sparse metric or, if the metric is
+        dense, all the voxels of the static image (slightly perturbed, as the
+        sparse samples are), sampled at the first call after `setup`.
 
-    def _update_histogram(self):
+        Returns
+        -------
+        samples_prealigned : array, shape (ns, dim+1)
+            the homogeneous coordinates of the points, mapped by the
+            pre-aligning matrix
+        """
+        if self.samples is None:
+            self._set_samples(_sample_static(1, self.static,
+                                             self.static_grid2world))
+        return self.samples_prealigned
+
+    def _update_histogram(self, batch=None):
         r""" Updates the histogram according to the current affine transform
 
         The current affine transform is given by `self.affine_map`, which
         must be set before calling this method.
 
+        Parameters
+        ----------
+        batch : array of int, optional
+            the indices of the sampling points the histogram is computed
+            from. If None (default), all the sampling points are used, or all
+            the voxels if the metric is dense.
+
         Returns
         -------
         static_values: array, shape(n,) if sparse sampling is being used,
@@ -517,22 +625,27 @@ class MutualInformationMetric(object):
         """
         static_values = None
         moving_values = None
-        if self.sampling_proportion is None:  # Dense case
+        if self.sampling_proportion is None and batch is None:  # Dense case
             static_values = self.static
             moving_values = self.affine_map.transform(self.moving)
             self.histogram.update_pdfs_dense(static_values, moving_values)
         else:  # Sparse case
+            samples = self.samples
+            static_values = self.static_vals
+            if batch is not None:
+                samples = samples[batch]
+                static_values = static_values[batch]
             sp_to_moving = self.moving_world2grid.dot(self.affine_map.affine)
-            pts = sp_to_moving.dot(self.samples.T).T  # Points on moving grid
+            pts = sp_to_moving.dot(samples.T).T  # Points on moving grid
             pts = pts[..., :self.dim]
             self.moving_vals, inside = self.interp_method(self.moving, pts)
             self.moving_vals = np.array(self.moving_vals)
-            static_values = self.static_vals
             moving_values = self.moving_vals
             self.histogram.update_pdfs_sparse(static_values, moving_values)
         return static_values, moving_values
 
-    def _update_mutual_information(self, params, update_gradient=True):
+    def _update_mutual_information(self, params, update_gradient=True,
+                                   batch=None):
         r""" Updates marginal and joint distributions and the joint gradient
 
         The distributions are updated according to the static and transformed
@@ -552,6 +665,10 @@ class MutualInformationMetric(object):
             if True, the gradient of the joint PDF will also be computed,
             otherwise, only the marginal and joint PDFs will be computed.
             The default is True.
+        batch : array of int, optional
+            the indices of the points of the sample pool (see
+            `get_sample_pool`) the distributions are estimated from. If None
+            (default), the sampling of the metric is used.
         """
         # Get the matrix associated with the `params` parameter vector
         current_affine = self.transform.param_to_matrix(params)
@@ -563,14 +680,15 @@ class MutualInformationMetric(object):
         self.affine_map.set_affine(current_affine)
 
         # Update the histogram with the current joint intensities
-        static_values, moving_values = self._update_histogram()
+        static_values, moving_values = self._update_histogram(batch)
 
         H = self.histogram  # Shortcut to `self.histogram`
         grad = None  # Buffer to write the MI gradient into (if needed)
+        joint_grad = None  # Gradient of the joint PDF (if needed)
         if update_gradient:
             grad = self.metric_grad
             # Compute the gradient of the joint PDF w.r.t. parameters
-            if self.sampling_proportion is None:  # Dense case
+            if self.sampling_proportion is None and batch is None:  # Dense
                 # Compute the gradient of moving img. at physical points
                 # associated with the >>static image's grid<< cells
                 # The image gradient must be eval. at current moved points
@@ -589,20 +707,26 @@ class MutualInformationMetric(object):
                     static2prealigned,
                     mgrad)
             else:  # Sparse case
+                samples = self.samples
+                prealigned = self.samples_prealigned
+                if batch is not None:
+                    samples = samples[batch]
+                    prealigned = prealigned[batch]
                 # Compute the gradient of moving at the sampling points
                 # which are already given in physical space coordinates
-                pts = current_affine.dot(self.samples.T).T  # Moved points
+                pts = current_affine.dot(samples.T).T  # Moved points
                 mgrad, inside = vf.sparse_gradient(self.moving,
                                                    self.moving_world2grid,
                                                    self.moving_spacing,
                                                    pts)
                 # The Jacobian must be evaluated at the pre-aligned points
-                pts = self.samples_prealigned[..., :self.dim]
+                pts = prealigned[..., :self.dim]
                 H.update_gradient_sparse(params, self.transform, static_values,
                                          moving_values, pts, mgrad)
+            joint_grad = H.joint_grad
 
         # Call the cythonized MI computation with self.histogram fields
-        self.metric_val = compute_parzen_mi(H.joint, H.joint_grad,
+        self.metric_val = compute_parzen_mi(H.joint, joint_grad,
                                             H.smarginal, H.mmarginal,
                                             grad)
 
@@ -678,6 +802,35 @@ class MutualInformationMetric(object):
             return np.inf, 0 * self.metric_grad
         return -1 * self.metric_val, -1 * self.metric_grad
 
+    def distance_and_gradient_batch(self, params, batch):
+        r""" Metric and gradient estimated from a subset of the sample pool
+
+        Parameters
+        ----------
+        params : array, shape (n,)
+            the parameter vector of the transform currently used by the metric
+            (the transform name is provided when self.setup is called), n is
+            the number of parameters of the transform
+        batch : array of int
+            the indices of the points of the sample pool (see
+            `get_sample_pool`) the joint distribution is estimated from
+
+        Returns
+        -------
+        neg_mi : float
+            the negative mutual information of the sampled intensities after
+            transforming the moving image by the currently set transform
+            with `params` parameters
+        neg_mi_grad : array, shape (n,)
+            the gradient of the negative Mutual Information
+        """
+        self.get_sample_pool()
+        try:
+            self._update_mutual_information(params, True, batch)
+        except AffineInversionError:
+            return np.inf, 0 * self.metric_grad
+        return -1 * self.metric_val, -1 * self.metric_grad
+
 
 class AffineRegistration(object):
 
@@ -714,7 +867,11 @@ class AffineRegistration(object):
             optimization method to be used. If Scipy version < 0.12, then
             only L-BFGS-B is available. Otherwise, `method` can be any
             gradient-based method available in `dipy.core.Optimize`: CG, BFGS,
-            Newton-CG, dogleg or trust-ncg.
+            Newton-CG, dogleg or trust-ncg. If `method` is 'SGD', the metric
+            is minimized by stochastic gradient descent: each iteration
+            estimates the metric gradient from a random mini-batch of its
+            sample pool (see `MutualInformationMetric.get_sample_pool`) and
+            takes a preconditioned step of decreasing length [Klein09].
             The default is 'L-BFGS-B'.
         ss_sigma_factor : float, optional
             If None, this parameter is not used and an isotropic scale
@@ -729,7 +886,21 @@ class AffineRegistration(object):
             image $i=0$ is never smoothed). The default is None.
         options : dict, optional
             extra optimization options. The default is None, implying
-            no extra options are passed to the optimizer.
+            no extra options are passed to the optimizer. With the 'SGD'
+            method, the options are:
+            'batch_size' : the number of samples of each mini-batch
+                (default 2000),
+            'max_shift' : the largest mean displacement of the sampling
+                points, in physical units, by an iteration (default: the
+                mean voxel size of the static image at the current level),
+            'seed' : the seed of the random mini-batches (default 1234).
+
+        References
+        ----------
+        [Klein09] Klein, S., Pluim, J. P., Staring, M., & Viergever, M. A.
+                  Adaptive stochastic gradient descent optimisation for
+                  image registration. International Journal of Computer
+                  Vision, 81(3), 227-239, 2009.
         """
         self.metric = metric
 
@@ -758,6 +929,10 @@ class AffineRegistration(object):
             self.sigmas = sigmas
 
         self.verbosity = verbosity
+        self.static = None
+        self.static_grid2world = None
+        self.static_ss = None
+        self.static_levels = None
 
     # Separately add a string that tells about the verbosity kwarg. This needs
     # to be separate, because it is set as a module-wide option in __init__:
@@ -848,36 +1023,88 @@ class AffineRegistration(object):
         else:
             raise ValueError('Invalid starting_affine matrix')
         # Extract information from affine matrices to create the scale space
-        static_direction, static_spacing = \
-            get_direction_and_spacings(static_grid2world, self.dim)
         moving_direction, moving_spacing = \
             get_direction_and_spacings(moving_grid2world, self.dim)
 
-        static = ((static.astype(np.float64) - static.min()) /
-                  (static.max() - static.min()))
         moving = ((moving.astype(np.float64) - moving.min()) /
                   (moving.max() - moving.min()))
 
-        # Build the scale space of the input images
+        # Build the scale space of the moving image (the static one was built
+        # by `set_static`)
         if self.use_isotropic:
             self.moving_ss = IsotropicScaleSpace(moving, self.factors,
                                                  self.sigmas,
                                                  moving_grid2world,
                                                  moving_spacing, False)
+        else:
+            self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
+                                        moving_spacing, self.ss_sigma_factor,
+                                        False)
+
+    def set_static(self, static, static_grid2world=None):
+        r""" Precomputes the static side of the registration
+
+        Builds the scale space of the static image, resamples each of its
+        levels to the grid the metric is evaluated on and, if the metric
+        provides a `sample_static` method, samples it there. `optimize`
+        does it for a static image it is given, for that registration only,
+        and reuses the static image and precomputations kept here when it is
+        given None, so that registering several moving images to the same
+        static image does them only once.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            the image to be used as reference during optimization.
+        static_grid2world : array, shape (dim+1, dim+1), optional
+            the voxel-to-space transformation associated with the static
+            image. The default is None, implying the transform is the
+            identity.
+        """
+        self.static = static
+        self.static_grid2world = static_grid2world
+        dim = len(static.shape)
+        static_direction, static_spacing = \
+            get_direction_and_spacings(static_grid2world, dim)
 
+        static = ((static.astype(np.float64) - static.min()) /
+                  (static.max() - static.min()))
+
+        # Build the scale space of the static image
+        if self.use_isotropic:
             self.static_ss = IsotropicScaleSpace(static, self.factors,
                                                  self.sigmas,
                                                  static_grid2world,
                                                  static_spacing, False)
         else:
-            self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
-                                        moving_spacing, self.ss_sigma_factor,
-                                        False)
-
             self.static_ss = ScaleSpace(static, self.levels, static_grid2world,
                                         static_spacing, self.ss_sigma_factor,
                                         False)
 
+        original_static_shape = self.static_ss.get_image(0).shape
+        original_static_grid2world = self.static_ss.get_affine(0)
+        sample_static = getattr(self.metric, 'sample_static', None)
+        self.static_levels = []
+        for level in range(self.levels):
+            # Resample the smooth static image to the shape of this level
+            smooth_static = self.static_ss.get_image(level)
+            current_static_shape = self.static_ss.get_domain_shape(level)
+            current_static_grid2world = self.static_ss.get_affine(level)
+
+            current_affine_map = AffineMap(None,
+                                           current_static_shape,
+                                           current_static_grid2world,
+                                           original_static_shape,
+                                           original_static_grid2world)
+            current_static = current_affine_map.transform(smooth_static)
+            static_sampling = None
+            if sample_static is not None:
+                static_sampling = sample_static(current_static,
+                                                current_static_grid2world)
+            self.static_levels.append((current_static,
+                                       current_static_grid2world,
+                                       static_sampling))
+
     def optimize(self, static, moving, transform, params0,
                  static_grid2world=None, moving_grid2world=None,
                  starting_affine=None):
@@ -885,8 +1112,10 @@ class AffineRegistration(object):
 
         Parameters
         ----------
-        static : array, shape (S, R, C) or (R, C)
-            the image to be used as reference during optimization.
+        static : array, shape (S, R, C) or (R, C), or None
+            the image to be used as reference during optimization. If None,
+            the static image given to `set_static` is used, with its
+            precomputed scale space, and `static_grid2world` is ignored.
         moving : array, shape (S', R', C') or (R', C')
             the image to be used as "moving" during optimization. It is
             necessary to pre-align the moving image to ensure its domain
@@ -925,6 +1154,30 @@ class AffineRegistration(object):
         affine_map : instance of AffineMap
             the affine resulting affine transformation
         '''
+        # The static side prepared by set_static, if any, is kept, that of
+        # a static image given here is not
+        prepared = (self.static, self.static_grid2world, self.static_ss,
+                    self.static_levels)
+        if static is None:
+            if self.static is None:
+                raise ValueError('No static image was given or set with '
+                                 'set_static')
+            static, static_grid2world = self.static, self.static_grid2world
+        else:
+            self.set_static(static, static_grid2world)
+        try:
+            return self._optimize(static, moving, transform, params0,
+                                  static_grid2world, moving_grid2world,
+                                  starting_affine)
+        finally:
+            (self.static, self.static_grid2world, self.static_ss,
+             self.static_levels) = prepared
+
+    def _optimize(self, static, moving, transform, params0,
+                  static_grid2world, moving_grid2world, starting_affine):
+        r""" Runs the multi-resolution optimization of `optimize` with the
+        static side prepared by `set_static`
+        """
         self._init_optimizer(static, moving, transform, params0,
                              static_grid2world, moving_grid2world,
                              starting_affine)
@@ -947,17 +1200,9 @@ class AffineRegistration(object):
             if self.verbosity >= VerbosityLevels.STATUS:
                 print('Optimizing level %d [max iter: %d]' % (level, max_iter))
 
-            # Resample the smooth static image to the shape of this level
-            smooth_static = self.static_ss.get_image(level)
-            current_static_shape = self.static_ss.get_domain_shape(level)
-            current_static_grid2world = self.static_ss.get_affine(level)
-
-            current_affine_map = AffineMap(None,
-                                           current_static_shape,
-                                           current_static_grid2world,
-                                           original_static_shape,
-                                           original_static_grid2world)
-            current_static = current_affine_map.transform(smooth_static)
+            # The static image resampled to the shape of this level
+            current_static, current_static_grid2world, static_sampling = \
+                self.static_levels[level]
 
             # The moving image is full resolution
             current_moving_grid2world = original_moving_grid2world
@@ -965,32 +1210,23 @@ class AffineRegistration(object):
             current_moving = self.moving_ss.get_image(level)
 
             # Prepare the metric for iterations at this resolution
-            self.metric.setup(transform, current_static, current_moving,
-                              current_static_grid2world,
-                              current_moving_grid2world, self.starting_affine)
+            if static_sampling is None:
+                self.metric.setup(transform, current_static, current_moving,
+                                  current_static_grid2world,
+                                  current_moving_grid2world,
+                                  self.starting_affine)
+            else:
+                self.metric.setup(transform, current_static, current_moving,
+                                  current_static_grid2world,
+                                  current_moving_grid2world,
+                                  self.starting_affine, static_sampling)
 
             # Optimize this level
-            if self.options is None:
-                self.options = {'gtol': 1e-4,
-                                'disp': False}
-
-            if self.method == 'L-BFGS-B':
-                self.options['maxfun'] = max_iter
-            else:
-                self.options['maxiter'] = max_iter
-
-            if SCIPY_LESS_0_12:
-                # Older versions don't expect value and gradient from
-                # the same function
-                opt = Optimizer(self.metric.distance, self.params0,
-                                method=self.method, jac=self.metric.gradient,
-                                options=self.options)
+            if self.method == 'SGD':
+                params = self._optimize_sgd(max_iter,
+                                            current_static_grid2world)
             else:
-                opt = Optimizer(self.metric.distance_and_gradient,
-                                self.params0,
-                                method=self.method, jac=True,
-                                options=self.options)
-            params = opt.xopt
+                params = self._optimize_scipy(max_iter)
 
             # Update starting_affine matrix with optimal parameters
             T = self.transform.param_to_matrix(params)
@@ -1002,6 +1238,118 @@ class AffineRegistration(object):
         affine_map.set_affine(self.starting_affine)
         return affine_map
 
+    def _optimize_scipy(self, max_iter):
+        r""" Minimizes the metric of the current level with `Optimizer`
+
+        Parameters
+        ----------
+        max_iter : int
+            the maximum number of iterations (or function evaluations, for
+            L-BFGS-B)
+
+        Returns
+        -------
+        params : array, shape (n,)
+            the optimal parameters found
+        """
+        if self.options is None:
+            self.options = {'gtol': 1e-4,
+                            'disp': False}
+
+        if self.method == 'L-BFGS-B':
+            self.options['maxfun'] = max_iter
+        else:
+            self.options['maxiter'] = max_iter
+
+        if SCIPY_LESS_0_12:
+            # Older versions don't expect value and gradient from
+            # the same function
+            opt = Optimizer(self.metric.distance, self.params0,
+                            method=self.method, jac=self.metric.gradient,
+                            options=self.options)
+        else:
+            opt = Optimizer(self.metric.distance_and_gradient,
+                            self.params0,
+                            method=self.method, jac=True,
+                            options=self.options)
+        return opt.xopt
+
+    def _optimize_sgd(self, max_iter, static_grid2world):
+        r""" Minimizes the metric of the current level by mini-batch SGD
+
+        At iteration t, the gradient g of the metric estimated from a random
+        mini-batch of the sample pool gives the step -a_t * g / s, where s
+        holds the mean squared norm of the columns of the transform Jacobian
+        over the pool, so that all parameters move the sampling points
+        alike. The gain a_t = a / (t + A) ** alpha decreases as in
+        [Klein09], with `a` chosen so that the first step moves the points by
+        `max_shift` on average, and no step moves them further.
+
+        Parameters
+        ----------
+        max_iter : int
+            the number of iterations
+        static_grid2world : array, shape (dim+1, dim+1)
+            the grid-to-space transform of the static image at this level
+
+        Returns
+        -------
+        params : array, shape (n,)
+            the parameters after the last iteration
+        """
+        options = {} if self.options is None else self.options
+        batch_size = options.get('batch_size', 2000)
+        max_shift = options.get('max_shift', None)
+        if max_shift is None:
+            spacing = get_direction_and_spacings(static_grid2world,
+                                                 self.dim)[1]
+            max_shift = spacing.mean()
+        rng = np.random.RandomState(options.get('seed', 1234))
+        alpha = 0.602
+        A = 20.0
+        fmin = -0.8
+        fmax = 1.0
+
+        pool = self.metric.get_sample_pool()
+        ns = pool.shape[0]
+        params = np.array(self.params0, dtype=np.float64)
+
+        # The preconditioner is computed at the starting parameters
+        probes = rng.choice(ns, min(ns, 1000), replace=False)
+        scales = np.zeros(self.nparams)
+        for x in pool[probes, :self.dim]:
+            J = self.transform.jacobian(params, x)
+            scales += (J ** 2).sum(0)
+        scales /= len(probes)
+        scales[scales <= 0] = 1.0
+
+        gain = None
+        time = 0.0
+        previous = None
+        for it in range(max_iter):
+            batch = rng.randint(0, ns, min(batch_size, ns))
+            neg_mi, grad = self.metric.distance_and_gradient_batch(params,
+                                                                   batch)
+            direction = grad / scales
+            shift = np.sqrt((scales * direction ** 2).sum())
+            if not np.isfinite(neg_mi) or shift == 0:
+                continue
+            if gain is None:
+                gain = max_shift * A ** alpha / shift
+                omega = 0.1 * shift ** 2
+            elif previous is not None:
+                # Opposite consecutive gradients mean that the steps jump
+                # over the minimum: let the gain decrease faster
+                x = -direction.dot(scales * previous) / omega
+                time = max(0.0, time + fmin + (fmax - fmin) /
+                           (1.0 - (fmax / fmin) * np.exp(-x)))
+            step = gain / (time + A) ** alpha
+            params -= min(step, max_shift / shift) * direction
+            previous = direction
+            if self.verbosity >= VerbosityLevels.DEBUG:
+                print('Iteration %d: %f' % (it, -neg_mi))
+        return params
+
 
 def align_centers_of_mass(static, static_grid2world,
                           moving, moving_grid2world):
@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import abc
+from functools import partial
 from dipy.utils.six import with_metaclass
 import numpy as np
 import numpy.linalg as npl
@@ -108,7 +109,9 @@ class DiffeomorphicMap(object):
                  domain_grid2world=None,
                  codomain_shape=None,
                  codomain_grid2world=None,
-                 prealign=None):
+                 prealign=None,
+                 num_threads=None,
+                 dtype=floating):
         r""" DiffeomorphicMap
 
         Implements a diffeomorphic transformation on the physical space. The
@@ -148,10 +151,20 @@ class DiffeomorphicMap(object):
         prealign : array, shape (dim+1, dim+1)
             the linear transformation to be applied to align input images to
             the reference space before warping under the deformation field.
+        num_threads : int, optional
+            the number of threads used by the 3D kernels warping images and
+            composing the displacement fields. If None (default), all the
+            available cores are used.
+        dtype : data-type, optional
+            the floating point type of the displacement fields allocated by
+            this map. Images are cast to the type of the fields to be warped.
+            Default: dipy.align.floating (float32)
 
         """
 
         self.dim = dim
+        self.num_threads = num_threads
+        self.dtype = np.dtype(dtype)
 
         if(disp_shape is None):
             raise ValueError("Invalid displacement field discretization")
@@ -254,9 +267,9 @@ class DiffeomorphicMap(object):
         Creates a zero displacement field (the identity transformation).
         """
         self.forward = np.zeros(tuple(self.disp_shape) + (self.dim,),
-                                dtype=floating)
+                                dtype=self.dtype)
         self.backward = np.zeros(tuple(self.disp_shape) + (self.dim,),
-                                 dtype=floating)
+                                 dtype=self.dtype)
 
     def _get_warping_function(self, interpolation):
         r"""Appropriate warping function for the given interpolation type
@@ -271,9 +284,33 @@ class DiffeomorphicMap(object):
                 return vfu.warp_2d_nn
         else:
             if interpolation == 'linear':
-                return vfu.warp_3d
+                return partial(vfu.warp_3d, num_threads=self.num_threads)
             else:
-                return vfu.warp_3d_nn
+                return partial(vfu.warp_3d_nn, num_threads=self.num_threads)
+
+    def _cast_image(self, image, field, interpolation):
+        r"""Converts an image to the types supported by the warping functions
+
+        Images interpolated linearly take the floating point type of the
+        displacement field driving the warp.
+        """
+        if interpolation == 'nearest':
+            if image.dtype is np.dtype('float64') and \
+                    field.dtype == np.float32:
+                image = image.astype(np.float32)
+            elif image.dtype is np.dtype('int64'):
+                image = image.astype(np.int32)
+        else:
+            image = np.asarray(image, dtype=field.dtype)
+        return image
+
+    def _get_composition_function(self):
+        r"""Appropriate composition function for the data dimension
+        """
+        if self.dim == 2:
+            return vfu.compose_vector_fields_2d
+        return partial(vfu.compose_vector_fields_3d,
+                       num_threads=self.num_threads)
 
     def _warp_forward(self, image, interpolation='linear',
                       image_world2grid=None, out_shape=None,
@@ -372,13 +409,7 @@ class DiffeomorphicMap(object):
         affine_disp = W
 
         # Convert the data to required types to use the cythonized functions
-        if interpolation == 'nearest':
-            if image.dtype is np.dtype('float64') and floating is np.float32:
-                image = image.astype(floating)
-            elif image.dtype is np.dtype('int64'):
-                image = image.astype(np.int32)
-        else:
-            image = np.asarray(image, dtype=floating)
+        image = self._cast_image(image, self.forward, interpolation)
 
         warp_f = self._get_warping_function(interpolation)
 
@@ -483,13 +514,7 @@ class DiffeomorphicMap(object):
         # prior to adding to the transformed input point
         affine_disp = mult_aff(W, Pinv)
 
-        if interpolation == 'nearest':
-            if image.dtype is np.dtype('float64') and floating is np.float32:
-                image = image.astype(floating)
-            elif image.dtype is np.dtype('int64'):
-                image = image.astype(np.int32)
-        else:
-            image = np.asarray(image, dtype=floating)
+        image = self._cast_image(image, self.backward, interpolation)
 
         warp_f = self._get_warping_function(interpolation)
 
@@ -608,7 +633,9 @@ class DiffeomorphicMap(object):
                                self.domain_grid2world,
                                self.codomain_shape,
                                self.codomain_grid2world,
-                               self.prealign)
+                               self.prealign,
+                               self.num_threads,
+                               self.dtype)
         inv.forward = self.forward
         inv.backward = self.backward
         inv.is_inverse = True
@@ -676,10 +703,7 @@ class DiffeomorphicMap(object):
 
         """
         Dinv = self.disp_world2grid
-        if self.dim == 2:
-            compose_f = vfu.compose_vector_fields_2d
-        else:
-            compose_f = vfu.compose_vector_fields_3d
+        compose_f = self._get_composition_function()
 
         residual, stats = compose_f(self.backward, self.forward,
                                     None, Dinv, 1.0, None)
@@ -705,7 +729,9 @@ class DiffeomorphicMap(object):
                                    self.domain_grid2world,
                                    self.codomain_shape,
                                    self.codomain_grid2world,
-                                   self.prealign)
+                                   self.prealign,
+                                   self.num_threads,
+                                   self.dtype)
         new_map.forward = self.forward
         new_map.backward = self.backward
         new_map.is_inverse = self.is_inverse
@@ -752,11 +778,7 @@ class DiffeomorphicMap(object):
         d2_inv = phi.get_backward_field()
 
         premult_disp = self.disp_world2grid
-
-        if self.dim == 2:
-            compose_f = vfu.compose_vector_fields_2d
-        else:
-            compose_f = vfu.compose_vector_fields_3d
+        compose_f = self._get_composition_function()
 
         forward, stats = compose_f(d1, d2, None, premult_disp, 1.0, None)
         backward, stats, = compose_f(d2_inv, d1_inv, None, premult_disp, 1.0,
@@ -824,7 +846,9 @@ class DiffeomorphicMap(object):
                                       None,
                                       self.codomain_shape,
                                       None,
-                                      None)
+                                      None,
+                                      self.num_threads,
+                                      self.dtype)
         simplified.forward = new_forward
         simplified.backward = new_backward
         return simplified
@@ -890,7 +914,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                  opt_tol=1e-5,
                  inv_iter=20,
                  inv_tol=1e-3,
-                 callback=None):
+                 callback=None,
+                 num_threads=None,
+                 dtype=floating):
         r""" Symmetric Diffeomorphic Registration (SyN) Algorithm
 
         Performs the multi-resolution optimization algorithm for non-linear
@@ -924,6 +950,17 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             a function receiving a SymmetricDiffeomorphicRegistration object
             to be called after each iteration (this optimizer will call this
             function passing self as parameter)
+        num_threads : int, optional
+            the number of threads used to invert, compose and warp 3D
+            displacement fields, by slabs of slices, and by the maps this
+            registration creates. The metric has its own setting. If None
+            (default), all the available cores are used.
+        dtype : data-type, optional
+            the floating point type of the whole registration: the scale
+            spaces of the images, the displacement fields and their inverses,
+            the gradients and the steps of the metric. float32 (the default,
+            dipy.align.floating) halves the memory and bandwidth used by the
+            registration of large volumes; float64 may be used as a reference.
         """
         super(SymmetricDiffeomorphicRegistration, self).__init__(metric)
         if level_iters is None:
@@ -943,8 +980,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         self.full_energy_profile = []
         self.verbosity = VerbosityLevels.STATUS
         self.callback = callback
+        self.num_threads = num_threads
+        self.dtype = np.dtype(dtype)
         self.moving_ss = None
         self.static_ss = None
+        self.static = None
+        self.static_grid2world = None
         self.static_direction = None
         self.moving_direction = None
         self.mask0 = metric.mask0
@@ -1010,8 +1051,11 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             self.invert_vector_field = vfu.invert_vector_field_fixed_point_2d
             self.compose = vfu.compose_vector_fields_2d
         else:
-            self.invert_vector_field = vfu.invert_vector_field_fixed_point_3d
-            self.compose = vfu.compose_vector_fields_3d
+            self.invert_vector_field = partial(
+                vfu.invert_vector_field_fixed_point_3d,
+                num_threads=self.num_threads)
+            self.compose = partial(vfu.compose_vector_fields_3d,
+                                   num_threads=self.num_threads)
 
     def _init_optimizer(self, static, moving,
                         static_grid2world, moving_grid2world, prealign):
@@ -1067,15 +1111,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
 
         self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
                                     moving_spacing, self.ss_sigma_factor,
-                                    self.mask0)
-
-        if self.verbosity >= VerbosityLevels.STATUS:
-            print('Creating scale space from the static image. Levels: %d. '
-                  'Sigma factor: %f.' % (self.levels, self.ss_sigma_factor))
+                                    self.mask0, self.dtype)
 
-        self.static_ss = ScaleSpace(static, self.levels, static_grid2world,
-                                    static_spacing, self.ss_sigma_factor,
-                                    self.mask0)
+        # The scale space of the static image was built by `set_static`
 
         if self.verbosity >= VerbosityLevels.DEBUG:
             print('Moving scale space:')
@@ -1109,7 +1147,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                                               domain_grid2world,
                                               codomain_shape,
                                               codomain_grid2world,
-                                              None)
+                                              None,
+                                              self.num_threads,
+                                              self.dtype)
         self.static_to_ref.allocate()
 
         # The backward model transforms points from the moving image
@@ -1131,7 +1171,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                                               domain_grid2world,
                                               codomain_shape,
                                               codomain_grid2world,
-                                              prealign_inv)
+                                              prealign_inv,
+                                              self.num_threads,
+                                              self.dtype)
         self.moving_to_ref.allocate()
 
     def _end_optimizer(self):
@@ -1140,6 +1182,37 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         del self.moving_ss
         del self.static_ss
 
+    def set_static(self, static, static_grid2world=None):
+        r"""Precomputes the static side of the registration
+
+        Builds the scale space of the static image. `optimize` does it for
+        a static image it is given, for that registration only, and reuses
+        the static image and scale space kept here when it is given None, so
+        that registering several moving images to the same static image
+        builds it only once.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            the image to be used as reference during optimization.
+        static_grid2world : array, shape (dim+1, dim+1), optional
+            the voxel-to-space transformation associated to the static image.
+            The default is None, implying the transform is the identity.
+        """
+        self.static = static
+        self.static_grid2world = static_grid2world
+        static_direction, static_spacing = \
+            get_direction_and_spacings(static_grid2world, self.dim)
+
+        if self.verbosity >= VerbosityLevels.STATUS:
+            print('Creating scale space from the static image. Levels: %d. '
+                  'Sigma factor: %f.' % (self.levels, self.ss_sigma_factor))
+
+        self.static_ss = ScaleSpace(static.astype(self.dtype), self.levels,
+                                    static_grid2world, static_spacing,
+                                    self.ss_sigma_factor, self.mask0,
+                                    self.dtype)
+
     def _iterate(self):
         r"""Performs one symmetric iteration
 
@@ -1171,6 +1244,8 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             self.static_ss.get_affine_inv(self.current_level)
         current_disp_spacing = \
             self.static_ss.get_spacing(self.current_level)
+        # Keep the normalization of the steps in the registration's precision
+        step_spacing = np.asarray(current_disp_spacing, dtype=self.dtype)
 
         # Warp the input images (smoothed to the current scale) to the common
         # (reference) space at the current resolution
@@ -1217,7 +1292,7 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             fw_step[:, :, -1, ...] = 0
 
         # Normalize the forward step
-        nrm = np.sqrt(np.sum((fw_step/current_disp_spacing)**2, -1)).max()
+        nrm = np.sqrt(np.sum((fw_step/step_spacing)**2, -1)).max()
         if nrm > 0:
             fw_step /= nrm
 
@@ -1240,7 +1315,7 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             bw_step[:, :, 0, ...] = 0
 
         # Normalize the backward step
-        nrm = np.sqrt(np.sum((bw_step/current_disp_spacing) ** 2, -1)).max()
+        nrm = np.sqrt(np.sum((bw_step/step_spacing) ** 2, -1)).max()
         if nrm > 0:
             bw_step /= nrm
 
@@ -1423,10 +1498,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
 
         Parameters
         ----------
-        static : array, shape (S, R, C) or (R, C)
+        static : array, shape (S, R, C) or (R, C), or None
             the image to be used as reference during optimization. The
             displacement fields will have the same discretization as the static
-            image.
+            image. If None, the static image given to `set_static` is used,
+            with its precomputed scale space, and `static_grid2world` is
+            ignored.
         moving : array, shape (S, R, C) or (R, C)
             the image to be used as "moving" during optimization. Since the
             deformation fields' discretization is the same as the static image,
@@ -1456,10 +1533,24 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         if self.verbosity >= VerbosityLevels.DEBUG:
             print("Pre-align:", prealign)
 
-        self._init_optimizer(static.astype(floating), moving.astype(floating),
-                             static_grid2world, moving_grid2world, prealign)
-        self._optimize()
-        self._end_optimizer()
+        # The static side prepared by set_static, if any, is kept, that of
+        # a static image given here is not
+        prepared = (self.static, self.static_grid2world, self.static_ss)
+        if static is None:
+            if self.static is None:
+                raise ValueError('No static image was given or set with '
+                                 'set_static')
+            static, static_grid2world = self.static, self.static_grid2world
+        else:
+            self.set_static(static, static_grid2world)
+        try:
+            self._init_optimizer(static, moving.astype(self.dtype),
+                                 static_grid2world, moving_grid2world,
+                                 prealign)
+            self._optimize()
+            self._end_optimizer()
+        finally:
+            self.static, self.static_grid2world, self.static_ss = prepared
         self.static_to_ref.forward = np.array(self.static_to_ref.forward)
         self.static_to_ref.backward = np.array(self.static_to_ref.backward)
         return self.static_to_ref
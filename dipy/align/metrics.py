@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import abc
+from functools import partial
 import numpy as np
 import scipy as sp
 from scipy import gradient, ndimage
@@ -10,7 +11,6 @@ from dipy.align import vector_fields as vfu
 from dipy.align import sumsqdiff as ssd
 from dipy.align import crosscorr as cc
 from dipy.align import expectmax as em
-from dipy.align import floating
 
 
 class SimilarityMetric(with_metaclass(abc.ABCMeta, object)):
@@ -197,7 +197,7 @@ class SimilarityMetric(with_metaclass(abc.ABCMeta, object)):
 
 class CCMetric(SimilarityMetric):
 
-    def __init__(self, dim, sigma_diff=2.0, radius=4):
+    def __init__(self, dim, sigma_diff=2.0, radius=4, num_threads=None):
         r"""Normalized Cross-Correlation Similarity metric.
 
         Parameters
@@ -209,10 +209,15 @@ class CCMetric(SimilarityMetric):
         radius : int
             the radius of the squared (cubic) neighborhood at each voxel to be
             considered to compute the cross correlation
+        num_threads : int, optional
+            the number of threads computing the cross correlation factors and
+            the steps of 3D images, by slabs of slices. If None (default), all
+            the available cores are used.
         """
         super(CCMetric, self).__init__(dim)
         self.sigma_diff = sigma_diff
         self.radius = radius
+        self.num_threads = num_threads
         self._connect_functions()
 
     def _connect_functions(self):
@@ -228,9 +233,12 @@ class CCMetric(SimilarityMetric):
             self.compute_backward_step = cc.compute_cc_backward_step_2d
             self.reorient_vector_field = vfu.reorient_vector_field_2d
         elif self.dim == 3:
-            self.precompute_factors = cc.precompute_cc_factors_3d
-            self.compute_forward_step = cc.compute_cc_forward_step_3d
-            self.compute_backward_step = cc.compute_cc_backward_step_3d
+            self.precompute_factors = partial(cc.precompute_cc_factors_3d,
+                                              num_threads=self.num_threads)
+            self.compute_forward_step = partial(
+                cc.compute_cc_forward_step_3d, num_threads=self.num_threads)
+            self.compute_backward_step = partial(
+                cc.compute_cc_backward_step_3d, num_threads=self.num_threads)
             self.reorient_vector_field = vfu.reorient_vector_field_3d
         else:
             raise ValueError('CC Metric not defined for dim. %d' % (self.dim))
@@ -250,7 +258,8 @@ class CCMetric(SimilarityMetric):
         self.factors = np.array(self.factors)
 
         self.gradient_moving = np.empty(
-            shape=(self.moving_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.moving_image.shape)+(self.dim,),
+            dtype=self.moving_image.dtype)
         for i, grad in enumerate(sp.gradient(self.moving_image)):
             self.gradient_moving[..., i] = grad
 
@@ -262,7 +271,8 @@ class CCMetric(SimilarityMetric):
                                        self.moving_direction)
 
         self.gradient_static = np.empty(
-            shape=(self.static_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.static_image.shape)+(self.dim,),
+            dtype=self.static_image.dtype)
         for i, grad in enumerate(sp.gradient(self.static_image)):
             self.gradient_static[..., i] = grad
 
@@ -424,7 +434,8 @@ class EMMetric(SimilarityMetric):
         self.staticq_means_field = self.staticq_means[staticq]
 
         self.gradient_moving = np.empty(
-            shape=(self.moving_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.moving_image.shape)+(self.dim,),
+            dtype=self.moving_image.dtype)
 
         for i, grad in enumerate(sp.gradient(self.moving_image)):
             self.gradient_moving[..., i] = grad
@@ -437,7 +448,8 @@ class EMMetric(SimilarityMetric):
                                        self.moving_direction)
 
         self.gradient_static = np.empty(
-            shape=(self.static_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.static_image.shape)+(self.dim,),
+            dtype=self.static_image.dtype)
 
         for i, grad in enumerate(sp.gradient(self.static_image)):
             self.gradient_static[..., i] = grad
@@ -539,7 +551,7 @@ class EMMetric(SimilarityMetric):
             sigma_sq_field = self.movingq_sigma_sq_field
 
         displacement = np.zeros(shape=(reference_shape)+(self.dim,),
-                                dtype=floating)
+                                dtype=gradient.dtype)
 
         if self.dim == 2:
             self.energy = v_cycle_2d(self.levels_below,
@@ -727,7 +739,8 @@ class SSDMetric(SimilarityMetric):
         computation of the forward and backward steps.
         """
         self.gradient_moving = np.empty(
-            shape=(self.moving_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.moving_image.shape)+(self.dim,),
+            dtype=self.moving_image.dtype)
         for i, grad in enumerate(gradient(self.moving_image)):
             self.gradient_moving[..., i] = grad
 
@@ -739,7 +752,8 @@ class SSDMetric(SimilarityMetric):
                                        self.moving_direction)
 
         self.gradient_static = np.empty(
-            shape=(self.static_image.shape)+(self.dim,), dtype=floating)
+            shape=(self.static_image.shape)+(self.dim,),
+            dtype=self.static_image.dtype)
         for i, grad in enumerate(gradient(self.static_image)):
             self.gradient_static[..., i] = grad
 
@@ -797,7 +811,7 @@ class SSDMetric(SimilarityMetric):
             delta_field = self.moving_image - self.static_image
 
         displacement = np.zeros(shape=(reference_shape)+(self.dim,),
-                                dtype=floating)
+                                dtype=gradient.dtype)
 
         if self.dim == 2:
             self.energy = v_cycle_2d(self.levels_below, self.inner_iter,
@@ -954,7 +968,7 @@ def v_cycle_2d(n, k, delta_field, sigma_sq_field, gradient_field, target,
     shape = np.array(displacement.shape).astype(np.int32)
     half_shape = ((shape[0] + 1) // 2, (shape[1] + 1) // 2, 2)
     sub_displacement = np.zeros(shape=half_shape,
-                                dtype=floating)
+                                dtype=displacement.dtype)
     sublambda_param = lambda_param*0.25
     v_cycle_2d(n-1, k, subdelta_field, subsigma_sq_field, subgradient_field,
                sub_residual, sublambda_param, sub_displacement, depth+1)
@@ -1050,7 +1064,7 @@ def v_cycle_3d(n, k, delta_field, sigma_sq_field, gradient_field, target,
     shape = np.array(displacement.shape).astype(np.int32)
     sub_displacement = np.zeros(
         shape=((shape[0]+1)//2, (shape[1]+1)//2, (shape[2]+1)//2, 3),
-        dtype=floating)
+        dtype=displacement.dtype)
     sublambda_param = lambda_param*0.25
     v_cycle_3d(n-1, k, subdelta_field, subsigma_sq_field, subgradient_field,
                sub_residual, sublambda_param, sub_displacement, depth+1)
@@ -7,9 +7,12 @@ import numpy as np
 cimport numpy as cnp
 cimport cython
 import numpy.random as random
+from cython.parallel import prange
 from .fused_types cimport floating
 from . import vector_fields as vf
 
+from omp_threads cimport determine_num_threads
+
 from dipy.align.vector_fields cimport(_apply_affine_3d_x0,
                                       _apply_affine_3d_x1,
                                       _apply_affine_3d_x2,
@@ -23,8 +26,9 @@ cdef extern from "dpy_math.h" nogil:
     double sin(double)
     double log(double)
 
+
 class ParzenJointHistogram(object):
-    def __init__(self, nbins):
+    def __init__(self, nbins, num_threads=None):
         r""" Computes joint histogram and derivatives with Parzen windows
 
         Base class to compute joint and marginal probability density
@@ -45,6 +49,10 @@ class ParzenJointHistogram(object):
         nbins : int
             the number of bins of the joint and marginal probability density
             functions (the actual number of bins of the joint PDF is nbins**2)
+        num_threads : int, optional
+            the number of threads accumulating the histograms and their
+            gradients, each into private buffers. If None (default), all the
+            available cores are used.
 
         References
         ----------
@@ -68,6 +76,7 @@ class ParzenJointHistogram(object):
         to the joint and marginal distributions.
         """
         self.nbins = nbins
+        self.num_threads = num_threads
         # Since the kernel used to compute the Parzen histogram covers more
         # than one bin, we need to add extra bins to both sides of the
         # histogram to account for the contributions of the minimum and maximum
@@ -210,12 +219,14 @@ class ParzenJointHistogram(object):
             _compute_pdfs_dense_2d(static, moving, smask, mmask, self.smin,
                                    self.sdelta, self.mmin, self.mdelta,
                                    self.nbins, self.padding, self.joint,
-                                   self.smarginal, self.mmarginal)
+                                   self.smarginal, self.mmarginal,
+                                   determine_num_threads(self.num_threads))
         elif dim == 3:
             _compute_pdfs_dense_3d(static, moving, smask, mmask, self.smin,
                                    self.sdelta, self.mmin, self.mdelta,
                                    self.nbins, self.padding, self.joint,
-                                   self.smarginal, self.mmarginal)
+                                   self.smarginal, self.mmarginal,
+                                   determine_num_threads(self.num_threads))
 
     def update_pdfs_sparse(self, sval, mval):
         r''' Computes the Probability Density Functions from a set of samples
@@ -244,7 +255,8 @@ class ParzenJointHistogram(object):
         energy = _compute_pdfs_sparse(sval, mval, self.smin, self.sdelta,
                                       self.mmin, self.mdelta, self.nbins,
                                       self.padding, self.joint,
-                                      self.smarginal, self.mmarginal)
+                                      self.smarginal, self.mmarginal,
+                                      determine_num_threads(self.num_threads))
 
     def update_gradient_dense(self, theta, transform, static, moving,
                               grid2world, mgradient, smask=None, mmask=None):
@@ -314,12 +326,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_dense_2d[cython.double](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_dense_2d[cython.float](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             else:
                 raise ValueError('Grad. field dtype must be floating point')
 
@@ -328,12 +342,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_dense_3d[cython.double](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_dense_3d[cython.float](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             else:
                 raise ValueError('Grad. field dtype must be floating point')
 
@@ -393,12 +409,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_sparse_2d[cython.double](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_sparse_2d[cython.float](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             else:
                 raise ValueError('Gradients dtype must be floating point')
 
@@ -407,12 +425,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_sparse_3d[cython.double](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_sparse_3d[cython.float](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad,
+                    determine_num_threads(self.num_threads))
             else:
                 raise ValueError('Gradients dtype must be floating point')
         else:
@@ -576,7 +596,8 @@ cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
                             double smin, double sdelta,
                             double mmin, double mdelta,
                             int nbins, int padding, double[:, :] joint,
-                            double[:] smarginal, double[:] mmarginal):
+                            double[:] smarginal, double[:] mmarginal,
+                            int num_threads=1):
     r''' Joint Probability Density Function of intensities of two 2D images
 
     Parameters
@@ -612,39 +633,34 @@ cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int, optional
+        the number of chunks of rows processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp nrows = static.shape[0]
-        cnp.npy_intp ncols = static.shape[1]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp i, j, r, c
-        double rn, cn
-        double val, spline_arg, sum
+        cnp.npy_intp nchunks = max(min(num_threads, nrows), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp i, j
+        double sum
+        double[:, :, :] joints = np.zeros((nchunks, nbins, nbins))
+        double[:, :] smarginals = np.zeros((nchunks, nbins))
+        double[:] sums = np.zeros(nchunks)
+        cnp.npy_intp[:] counts = np.zeros(nchunks, dtype=np.intp)
 
-    joint[...] = 0
-    sum = 0
-    valid_points = 0
     with nogil:
-        smarginal[:] = 0
-        for i in range(nrows):
-            for j in range(ncols):
-                if smask is not None and smask[i, j] == 0:
-                    continue
-                if mmask is not None and mmask[i, j] == 0:
-                    continue
-                valid_points += 1
-                rn = _bin_normalize(static[i, j], smin, sdelta)
-                r = _bin_index(rn, nbins, padding)
-                cn = _bin_normalize(moving[i, j], mmin, mdelta)
-                c = _bin_index(cn, nbins, padding)
-                spline_arg = (c - 2) - cn
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            counts[chunk] = _compute_pdfs_dense_2d_rows(
+                static, moving, smask, mmask, chunk * nrows / nchunks,
+                (chunk + 1) * nrows / nchunks, smin, sdelta, mmin, mdelta,
+                nbins, padding, joints[chunk], smarginals[chunk],
+                &sums[chunk])
+    np.sum(joints, 0, out=np.asarray(joint))
+    np.sum(smarginals, 0, out=np.asarray(smarginal))
+    sum = np.sum(sums)
+    valid_points = np.sum(counts)
 
-                smarginal[r] += 1
-                for offset in range(-2, 3):
-                    val = _cubic_spline(spline_arg)
-                    joint[r, c + offset] += val
-                    sum += val
-                    spline_arg += 1.0
+    with nogil:
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -659,12 +675,64 @@ cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
                     mmarginal[j] += joint[i, j]
 
 
+cdef cnp.npy_intp _compute_pdfs_dense_2d_rows(double[:, :] static,
+                                              double[:, :] moving,
+                                              int[:, :] smask,
+                                              int[:, :] mmask,
+                                              cnp.npy_intp first,
+                                              cnp.npy_intp last,
+                                              double smin, double sdelta,
+                                              double mmin, double mdelta,
+                                              int nbins, int padding,
+                                              double[:, :] joint,
+                                              double[:] smarginal,
+                                              double *sum) nogil:
+    r''' Unnormalized histograms of the rows `first` to `last` (excluded)
+
+    The histograms are accumulated into `joint` and `smarginal`, and the
+    total weight of the joint histogram into `sum`.
+
+    Returns
+    -------
+    valid_points : int
+        the number of pixels inside the masks
+    '''
+    cdef:
+        cnp.npy_intp ncols = static.shape[1]
+        cnp.npy_intp offset, valid_points = 0
+        cnp.npy_intp i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for i in range(first, last):
+        for j in range(ncols):
+            if smask is not None and smask[i, j] == 0:
+                continue
+            if mmask is not None and mmask[i, j] == 0:
+                continue
+            valid_points += 1
+            rn = _bin_normalize(static[i, j], smin, sdelta)
+            r = _bin_index(rn, nbins, padding)
+            cn = _bin_normalize(moving[i, j], mmin, mdelta)
+            c = _bin_index(cn, nbins, padding)
+            spline_arg = (c - 2) - cn
+
+            smarginal[r] += 1
+            for offset in range(-2, 3):
+                val = _cubic_spline(spline_arg)
+                joint[r, c + offset] += val
+                sum[0] += val
+                spline_arg += 1.0
+    return valid_points
+
+
 cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
                             int[:, :, :] smask, int[:, :, :] mmask,
                             double smin, double sdelta,
                             double mmin, double mdelta,
                             int nbins, int padding, double[:, :] joint,
-                            double[:] smarginal, double[:] mmarginal):
+                            double[:] smarginal, double[:] mmarginal,
+                            int num_threads=1):
     r''' Joint Probability Density Function of intensities of two 3D images
 
     Parameters
@@ -700,42 +768,34 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int, optional
+        the number of chunks of slices processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp nslices = static.shape[0]
-        cnp.npy_intp nrows = static.shape[1]
-        cnp.npy_intp ncols = static.shape[2]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp k, i, j, r, c
-        double rn, cn
-        double val, spline_arg, sum
+        cnp.npy_intp nchunks = max(min(num_threads, nslices), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp i, j
+        double sum
+        double[:, :, :] joints = np.zeros((nchunks, nbins, nbins))
+        double[:, :] smarginals = np.zeros((nchunks, nbins))
+        double[:] sums = np.zeros(nchunks)
+        cnp.npy_intp[:] counts = np.zeros(nchunks, dtype=np.intp)
 
-    joint[...] = 0
-    sum = 0
     with nogil:
-        valid_points = 0
-        smarginal[:] = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
-
-                    smarginal[r] += 1
-                    for offset in range(-2, 3):
-                        val = _cubic_spline(spline_arg)
-                        joint[r, c + offset] += val
-                        sum += val
-                        spline_arg += 1.0
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            counts[chunk] = _compute_pdfs_dense_3d_slices(
+                static, moving, smask, mmask, chunk * nslices / nchunks,
+                (chunk + 1) * nslices / nchunks, smin, sdelta, mmin, mdelta,
+                nbins, padding, joints[chunk], smarginals[chunk],
+                &sums[chunk])
+    np.sum(joints, 0, out=np.asarray(joint))
+    np.sum(smarginals, 0, out=np.asarray(smarginal))
+    sum = np.sum(sums)
+    valid_points = np.sum(counts)
 
+    with nogil:
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -750,10 +810,64 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
                     mmarginal[j] += joint[i, j]
 
 
+cdef cnp.npy_intp _compute_pdfs_dense_3d_slices(double[:, :, :] static,
+                                                double[:, :, :] moving,
+                                                int[:, :, :] smask,
+                                                int[:, :, :] mmask,
+                                                cnp.npy_intp first,
+                                                cnp.npy_intp last,
+                                                double smin, double sdelta,
+                                                double mmin, double mdelta,
+                                                int nbins, int padding,
+                                                double[:, :] joint,
+                                                double[:] smarginal,
+                                                double *sum) nogil:
+    r''' Unnormalized histograms of the slices `first` to `last` (excluded)
+
+    The histograms are accumulated into `joint` and `smarginal`, and the
+    total weight of the joint histogram into `sum`.
+
+    Returns
+    -------
+    valid_points : int
+        the number of voxels inside the masks
+    '''
+    cdef:
+        cnp.npy_intp nrows = static.shape[1]
+        cnp.npy_intp ncols = static.shape[2]
+        cnp.npy_intp offset, valid_points = 0
+        cnp.npy_intp k, i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for k in range(first, last):
+        for i in range(nrows):
+            for j in range(ncols):
+                if smask is not None and smask[k, i, j] == 0:
+                    continue
+                if mmask is not None and mmask[k, i, j] == 0:
+                    continue
+                valid_points += 1
+                rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                smarginal[r] += 1
+                for offset in range(-2, 3):
+                    val = _cubic_spline(spline_arg)
+                    joint[r, c + offset] += val
+                    sum[0] += val
+                    spline_arg += 1.0
+    return valid_points
+
+
 cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
                           double sdelta, double mmin, double mdelta,
                           int nbins, int padding, double[:, :] joint,
-                          double[:] smarginal, double[:] mmarginal):
+                          double[:] smarginal, double[:] mmarginal,
+                          int num_threads=1):
     r''' Probability Density Functions of paired intensities
 
     Parameters
@@ -783,35 +897,32 @@ cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int, optional
+        the number of chunks of samples processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp n = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp i, r, c
-        double rn, cn
-        double val, spline_arg, sum
-
-    joint[...] = 0
-    sum = 0
+        cnp.npy_intp nchunks = max(min(num_threads, n), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp i, j
+        double sum
+        double[:, :, :] joints = np.zeros((nchunks, nbins, nbins))
+        double[:, :] smarginals = np.zeros((nchunks, nbins))
+        double[:] sums = np.zeros(nchunks)
 
     with nogil:
-        valid_points = 0
-        smarginal[:] = 0
-        for i in range(n):
-            valid_points += 1
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            smarginal[r] += 1
-            for offset in range(-2, 3):
-                val = _cubic_spline(spline_arg)
-                joint[r, c + offset] += val
-                sum += val
-                spline_arg += 1.0
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            _compute_pdfs_sparse_chunk(
+                sval, mval, chunk * n / nchunks, (chunk + 1) * n / nchunks,
+                smin, sdelta, mmin, mdelta, nbins, padding, joints[chunk],
+                smarginals[chunk], &sums[chunk])
+    np.sum(joints, 0, out=np.asarray(joint))
+    np.sum(smarginals, 0, out=np.asarray(smarginal))
+    sum = np.sum(sums)
+    valid_points = n
 
+    with nogil:
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -826,13 +937,45 @@ cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
                     mmarginal[j] += joint[i, j]
 
 
+cdef void _compute_pdfs_sparse_chunk(double[:] sval, double[:] mval,
+                                     cnp.npy_intp first, cnp.npy_intp last,
+                                     double smin, double sdelta, double mmin,
+                                     double mdelta, int nbins, int padding,
+                                     double[:, :] joint, double[:] smarginal,
+                                     double *sum) nogil:
+    r''' Unnormalized histograms of the samples `first` to `last` (excluded)
+
+    The histograms are accumulated into `joint` and `smarginal`, and the
+    total weight of the joint histogram into `sum`.
+    '''
+    cdef:
+        cnp.npy_intp offset, i, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for i in range(first, last):
+        rn = _bin_normalize(sval[i], smin, sdelta)
+        r = _bin_index(rn, nbins, padding)
+        cn = _bin_normalize(mval[i], mmin, mdelta)
+        c = _bin_index(cn, nbins, padding)
+        spline_arg = (c - 2) - cn
+
+        smarginal[r] += 1
+        for offset in range(-2, 3):
+            val = _cubic_spline(spline_arg)
+            joint[r, c + offset] += val
+            sum[0] += val
+            spline_arg += 1.0
+
+
 cdef _joint_pdf_gradient_dense_2d(double[:] theta, Transform transform,
                                   double[:, :] static, double[:, :] moving,
                                   double[:, :] grid2world,
                                   floating[:, :, :] mgradient, int[:, :] smask,
                                   int[:, :] mmask, double smin, double sdelta,
                                   double mmin, double mdelta, int nbins,
-                                  int padding, double[:, :, :] grad_pdf):
+                                  int padding, double[:, :, :] grad_pdf,
+                                  int num_threads=1):
     r''' Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -878,59 +1021,101 @@ cdef _joint_pdf_gradient_dense_2d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int, optional
+        the number of chunks of rows processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp nrows = static.shape[0]
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp nchunks = max(min(num_threads, nrows), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp k, i, j
+        double norm_factor
+        double[:, :, :, :] grad_pdfs = np.zeros((nchunks, nbins, nbins, n))
+        double[:, :, :] J = np.empty(shape=(nchunks, 2, n), dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(nchunks, n), dtype=np.float64)
+        double[:, :] x = np.empty(shape=(nchunks, 2), dtype=np.float64)
+        cnp.npy_intp[:] counts = np.zeros(nchunks, dtype=np.intp)
+
+    with nogil:
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            counts[chunk] = _joint_pdf_gradient_dense_2d_rows(
+                theta, transform, static, moving, grid2world, mgradient,
+                smask, mmask, chunk * nrows / nchunks,
+                (chunk + 1) * nrows / nchunks, smin, sdelta, mmin, mdelta,
+                nbins, padding, grad_pdfs[chunk], J[chunk], prod[chunk],
+                x[chunk])
+    np.sum(grad_pdfs, 0, out=np.asarray(grad_pdf))
+    valid_points = np.sum(counts)
+
+    with nogil:
+        norm_factor = valid_points * mdelta
+        if norm_factor > 0:
+            for i in range(nbins):
+                for j in range(nbins):
+                    for k in range(n):
+                        grad_pdf[i, j, k] /= norm_factor
+
+
+cdef cnp.npy_intp _joint_pdf_gradient_dense_2d_rows(
+        double[:] theta, Transform transform, double[:, :] static,
+        double[:, :] moving, double[:, :] grid2world,
+        floating[:, :, :] mgradient, int[:, :] smask, int[:, :] mmask,
+        cnp.npy_intp first, cnp.npy_intp last, double smin, double sdelta,
+        double mmin, double mdelta, int nbins, int padding,
+        double[:, :, :] grad_pdf, double[:, :] J, double[:] prod,
+        double[:] x) nogil:
+    r''' Unnormalized gradient of the rows `first` to `last` (excluded)
+
+    The gradient is accumulated into `grad_pdf`; `J`, `prod` and `x` are the
+    buffers of the Jacobian, of its product with the moving gradient and of
+    the physical point.
+
+    Returns
+    -------
+    valid_points : int
+        the number of pixels inside the masks
+    '''
+    cdef:
         cnp.npy_intp ncols = static.shape[1]
         cnp.npy_intp n = theta.shape[0]
-        cnp.npy_intp offset, valid_points
+        cnp.npy_intp offset, valid_points = 0
         int constant_jacobian = 0
         cnp.npy_intp k, i, j, r, c
         double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(2, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-        double[:] x = np.empty(shape=(2,), dtype=np.float64)
+        double val, spline_arg
 
-    grad_pdf[...] = 0
-    with nogil:
-        valid_points = 0
-        for i in range(nrows):
-            for j in range(ncols):
-                if smask is not None and smask[i, j] == 0:
-                    continue
-                if mmask is not None and mmask[i, j] == 0:
-                    continue
-
-                valid_points += 1
-                x[0] = _apply_affine_2d_x0(i, j, 1, grid2world)
-                x[1] = _apply_affine_2d_x1(i, j, 1, grid2world)
+    for i in range(first, last):
+        for j in range(ncols):
+            if smask is not None and smask[i, j] == 0:
+                continue
+            if mmask is not None and mmask[i, j] == 0:
+                continue
 
-                if constant_jacobian == 0:
-                    constant_jacobian = transform._jacobian(theta, x, J)
+            valid_points += 1
+            x[0] = _apply_affine_2d_x0(i, j, 1, grid2world)
+            x[1] = _apply_affine_2d_x1(i, j, 1, grid2world)
 
-                for k in range(n):
-                    prod[k] = (J[0, k] * mgradient[i, j, 0] +
-                               J[1, k] * mgradient[i, j, 1])
+            if constant_jacobian == 0:
+                constant_jacobian = transform._jacobian(theta, x, J)
 
-                rn = _bin_normalize(static[i, j], smin, sdelta)
-                r = _bin_index(rn, nbins, padding)
-                cn = _bin_normalize(moving[i, j], mmin, mdelta)
-                c = _bin_index(cn, nbins, padding)
-                spline_arg = (c - 2) - cn
+            for k in range(n):
+                prod[k] = (J[0, k] * mgradient[i, j, 0] +
+                           J[1, k] * mgradient[i, j, 1])
 
-                for offset in range(-2, 3):
-                    val = _cubic_spline_derivative(spline_arg)
-                    for k in range(n):
-                        grad_pdf[r, c + offset, k] -= val * prod[k]
-                    spline_arg += 1.0
+            rn = _bin_normalize(static[i, j], smin, sdelta)
+            r = _bin_index(rn, nbins, padding)
+            cn = _bin_normalize(moving[i, j], mmin, mdelta)
+            c = _bin_index(cn, nbins, padding)
+            spline_arg = (c - 2) - cn
 
-        norm_factor = valid_points * mdelta
-        if norm_factor > 0:
-            for i in range(nbins):
-                for j in range(nbins):
-                    for k in range(n):
-                        grad_pdf[i, j, k] /= norm_factor
+            for offset in range(-2, 3):
+                val = _cubic_spline_derivative(spline_arg)
+                for k in range(n):
+                    grad_pdf[r, c + offset, k] -= val * prod[k]
+                spline_arg += 1.0
+    return valid_points
 
 
 cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
@@ -942,7 +1127,8 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
                                   int[:, :, :] mmask, double smin,
                                   double sdelta, double mmin, double mdelta,
                                   int nbins, int padding,
-                                  double[:, :, :] grad_pdf):
+                                  double[:, :, :] grad_pdf,
+                                  int num_threads=1):
     r''' Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -988,56 +1174,35 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int, optional
+        the number of chunks of slices processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp nslices = static.shape[0]
-        cnp.npy_intp nrows = static.shape[1]
-        cnp.npy_intp ncols = static.shape[2]
         cnp.npy_intp n = theta.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
-        cnp.npy_intp l, k, i, j, r, c
-        double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-        double[:] x = np.empty(shape=(3,), dtype=np.float64)
+        cnp.npy_intp nchunks = max(min(num_threads, nslices), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp k, i, j
+        double norm_factor
+        double[:, :, :, :] grad_pdfs = np.zeros((nchunks, nbins, nbins, n))
+        double[:, :, :] J = np.empty(shape=(nchunks, 3, n), dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(nchunks, n), dtype=np.float64)
+        double[:, :] x = np.empty(shape=(nchunks, 3), dtype=np.float64)
+        cnp.npy_intp[:] counts = np.zeros(nchunks, dtype=np.intp)
 
-    grad_pdf[...] = 0
     with nogil:
-        valid_points = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    x[0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
-                    x[1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
-                    x[2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
-
-                    if constant_jacobian == 0:
-                        constant_jacobian = transform._jacobian(theta, x, J)
-
-                    for l in range(n):
-                        prod[l] = (J[0, l] * mgradient[k, i, j, 0] +
-                                   J[1, l] * mgradient[k, i, j, 1] +
-                                   J[2, l] * mgradient[k, i, j, 2])
-
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
-
-                    for offset in range(-2, 3):
-                        val = _cubic_spline_derivative(spline_arg)
-                        for l in range(n):
-                            grad_pdf[r, c + offset, l] -= val * prod[l]
-                        spline_arg += 1.0
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            counts[chunk] = _joint_pdf_gradient_dense_3d_slices(
+                theta, transform, static, moving, grid2world, mgradient,
+                smask, mmask, chunk * nslices / nchunks,
+                (chunk + 1) * nslices / nchunks, smin, sdelta, mmin, mdelta,
+                nbins, padding, grad_pdfs[chunk], J[chunk], prod[chunk],
+                x[chunk])
+    np.sum(grad_pdfs, 0, out=np.asarray(grad_pdf))
+    valid_points = np.sum(counts)
 
+    with nogil:
         norm_factor = valid_points * mdelta
         if norm_factor > 0:
             for i in range(nbins):
@@ -1046,13 +1211,77 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
                         grad_pdf[i, j, k] /= norm_factor
 
 
+cdef cnp.npy_intp _joint_pdf_gradient_dense_3d_slices(
+        double[:] theta, Transform transform, double[:, :, :] static,
+        double[:, :, :] moving, double[:, :] grid2world,
+        floating[:, :, :, :] mgradient, int[:, :, :] smask,
+        int[:, :, :] mmask, cnp.npy_intp first, cnp.npy_intp last,
+        double smin, double sdelta, double mmin, double mdelta, int nbins,
+        int padding, double[:, :, :] grad_pdf, double[:, :] J,
+        double[:] prod, double[:] x) nogil:
+    r''' Unnormalized gradient of the slices `first` to `last` (excluded)
+
+    The gradient is accumulated into `grad_pdf`; `J`, `prod` and `x` are the
+    buffers of the Jacobian, of its product with the moving gradient and of
+    the physical point.
+
+    Returns
+    -------
+    valid_points : int
+        the number of voxels inside the masks
+    '''
+    cdef:
+        cnp.npy_intp nrows = static.shape[1]
+        cnp.npy_intp ncols = static.shape[2]
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp offset, valid_points = 0
+        int constant_jacobian = 0
+        cnp.npy_intp l, k, i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for k in range(first, last):
+        for i in range(nrows):
+            for j in range(ncols):
+                if smask is not None and smask[k, i, j] == 0:
+                    continue
+                if mmask is not None and mmask[k, i, j] == 0:
+                    continue
+                valid_points += 1
+                x[0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
+                x[1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
+                x[2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
+
+                if constant_jacobian == 0:
+                    constant_jacobian = transform._jacobian(theta, x, J)
+
+                for l in range(n):
+                    prod[l] = (J[0, l] * mgradient[k, i, j, 0] +
+                               J[1, l] * mgradient[k, i, j, 1] +
+                               J[2, l] * mgradient[k, i, j, 2])
+
+                rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                for offset in range(-2, 3):
+                    val = _cubic_spline_derivative(spline_arg)
+                    for l in range(n):
+                        grad_pdf[r, c + offset, l] -= val * prod[l]
+                    spline_arg += 1.0
+    return valid_points
+
+
 cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
                                    double[:] sval, double[:] mval,
                                    double[:, :] sample_points,
                                    floating[:, :] mgradient, double smin,
                                    double sdelta, double mmin,
                                    double mdelta, int nbins, int padding,
-                                   double[:, :, :] grad_pdf):
+                                   double[:, :, :] grad_pdf,
+                                   int num_threads=1):
     r''' Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -1091,43 +1320,32 @@ cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int, optional
+        the number of chunks of samples processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp n = theta.shape[0]
         cnp.npy_intp m = sval.shape[0]
-        cnp.npy_intp offset
-        int constant_jacobian = 0
-        cnp.npy_intp i, j, r, c, valid_points
-        double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(2, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
+        cnp.npy_intp nchunks = max(min(num_threads, m), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp k, i, j
+        double norm_factor
+        double[:, :, :, :] grad_pdfs = np.zeros((nchunks, nbins, nbins, n))
+        double[:, :, :] J = np.empty(shape=(nchunks, 2, n), dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(nchunks, n), dtype=np.float64)
 
-    grad_pdf[...] = 0
     with nogil:
-        valid_points = 0
-        for i in range(m):
-            valid_points += 1
-            if constant_jacobian == 0:
-                constant_jacobian = transform._jacobian(theta,
-                                                        sample_points[i], J)
-
-            for j in range(n):
-                prod[j] = (J[0, j] * mgradient[i, 0] +
-                           J[1, j] * mgradient[i, 1])
-
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            for offset in range(-2, 3):
-                val = _cubic_spline_derivative(spline_arg)
-                for j in range(n):
-                    grad_pdf[r, c + offset, j] -= val * prod[j]
-                spline_arg += 1.0
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            _joint_pdf_gradient_sparse_2d_chunk(
+                theta, transform, sval, mval, sample_points, mgradient,
+                chunk * m / nchunks, (chunk + 1) * m / nchunks, smin, sdelta,
+                mmin, mdelta, nbins, padding, grad_pdfs[chunk], J[chunk],
+                prod[chunk])
+    np.sum(grad_pdfs, 0, out=np.asarray(grad_pdf))
+    valid_points = m
 
+    with nogil:
         norm_factor = valid_points * mdelta
         if norm_factor > 0:
             for i in range(nbins):
@@ -1136,13 +1354,55 @@ cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
                         grad_pdf[i, j, k] /= norm_factor
 
 
+cdef void _joint_pdf_gradient_sparse_2d_chunk(
+        double[:] theta, Transform transform, double[:] sval, double[:] mval,
+        double[:, :] sample_points, floating[:, :] mgradient,
+        cnp.npy_intp first, cnp.npy_intp last, double smin, double sdelta,
+        double mmin, double mdelta, int nbins, int padding,
+        double[:, :, :] grad_pdf, double[:, :] J, double[:] prod) nogil:
+    r''' Unnormalized gradient of the samples `first` to `last` (excluded)
+
+    The gradient is accumulated into `grad_pdf`; `J` and `prod` are the
+    buffers of the Jacobian and of its product with the moving gradient.
+    '''
+    cdef:
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp offset
+        int constant_jacobian = 0
+        cnp.npy_intp i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for i in range(first, last):
+        if constant_jacobian == 0:
+            constant_jacobian = transform._jacobian(theta,
+                                                    sample_points[i], J)
+
+        for j in range(n):
+            prod[j] = (J[0, j] * mgradient[i, 0] +
+                   J[1, j] * mgradient[i, 1])
+
+        rn = _bin_normalize(sval[i], smin, sdelta)
+        r = _bin_index(rn, nbins, padding)
+        cn = _bin_normalize(mval[i], mmin, mdelta)
+        c = _bin_index(cn, nbins, padding)
+        spline_arg = (c - 2) - cn
+
+        for offset in range(-2, 3):
+            val = _cubic_spline_derivative(spline_arg)
+            for j in range(n):
+                grad_pdf[r, c + offset, j] -= val * prod[j]
+            spline_arg += 1.0
+
+
 cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
                                    double[:] sval, double[:] mval,
                                    double[:, :] sample_points,
                                    floating[:, :] mgradient, double smin,
                                    double sdelta, double mmin,
                                    double mdelta, int nbins, int padding,
-                                   double[:, :, :] grad_pdf):
+                                   double[:, :, :] grad_pdf,
+                                   int num_threads=1):
     r''' Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -1181,45 +1441,32 @@ cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int, optional
+        the number of chunks of samples processed in parallel, each into its
+        own buffers, which are then added in the order of the chunks.
     '''
     cdef:
         cnp.npy_intp n = theta.shape[0]
         cnp.npy_intp m = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
-        cnp.npy_intp i, j, r, c
-        double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
+        cnp.npy_intp nchunks = max(min(num_threads, m), 1)
+        cnp.npy_intp valid_points, chunk
+        cnp.npy_intp k, i, j
+        double norm_factor
+        double[:, :, :, :] grad_pdfs = np.zeros((nchunks, nbins, nbins, n))
+        double[:, :, :] J = np.empty(shape=(nchunks, 3, n), dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(nchunks, n), dtype=np.float64)
 
-    grad_pdf[...] = 0
     with nogil:
-        valid_points = 0
-        for i in range(m):
-            valid_points += 1
-
-            if constant_jacobian == 0:
-                constant_jacobian = transform._jacobian(theta,
-                                                        sample_points[i], J)
-
-            for j in range(n):
-                prod[j] = (J[0, j] * mgradient[i, 0] +
-                           J[1, j] * mgradient[i, 1] +
-                           J[2, j] * mgradient[i, 2])
-
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            for offset in range(-2, 3):
-                val = _cubic_spline_derivative(spline_arg)
-                for j in range(n):
-                    grad_pdf[r, c + offset, j] -= val * prod[j]
-                spline_arg += 1.0
+        for chunk in prange(nchunks, num_threads=nchunks, schedule='static'):
+            _joint_pdf_gradient_sparse_3d_chunk(
+                theta, transform, sval, mval, sample_points, mgradient,
+                chunk * m / nchunks, (chunk + 1) * m / nchunks, smin, sdelta,
+                mmin, mdelta, nbins, padding, grad_pdfs[chunk], J[chunk],
+                prod[chunk])
+    np.sum(grad_pdfs, 0, out=np.asarray(grad_pdf))
+    valid_points = m
 
+    with nogil:
         norm_factor = valid_points * mdelta
         if norm_factor > 0:
             for i in range(nbins):
@@ -1228,10 +1475,52 @@ cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
                         grad_pdf[i, j, k] /= norm_factor
 
 
+cdef void _joint_pdf_gradient_sparse_3d_chunk(
+        double[:] theta, Transform transform, double[:] sval, double[:] mval,
+        double[:, :] sample_points, floating[:, :] mgradient,
+        cnp.npy_intp first, cnp.npy_intp last, double smin, double sdelta,
+        double mmin, double mdelta, int nbins, int padding,
+        double[:, :, :] grad_pdf, double[:, :] J, double[:] prod) nogil:
+    r''' Unnormalized gradient of the samples `first` to `last` (excluded)
+
+    The gradient is accumulated into `grad_pdf`; `J` and `prod` are the
+    buffers of the Jacobian and of its product with the moving gradient.
+    '''
+    cdef:
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp offset
+        int constant_jacobian = 0
+        cnp.npy_intp i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for i in range(first, last):
+        if constant_jacobian == 0:
+            constant_jacobian = transform._jacobian(theta,
+                                                    sample_points[i], J)
+
+        for j in range(n):
+            prod[j] = (J[0, j] * mgradient[i, 0] +
+                   J[1, j] * mgradient[i, 1] +
+                   J[2, j] * mgradient[i, 2])
+
+        rn = _bin_normalize(sval[i], smin, sdelta)
+        r = _bin_index(rn, nbins, padding)
+        cn = _bin_normalize(mval[i], mmin, mdelta)
+        c = _bin_index(cn, nbins, padding)
+        spline_arg = (c - 2) - cn
+
+        for offset in range(-2, 3):
+            val = _cubic_spline_derivative(spline_arg)
+            for j in range(n):
+                grad_pdf[r, c + offset, j] -= val * prod[j]
+            spline_arg += 1.0
+
+
 def compute_parzen_mi(double[:, :] joint,
                       double[:, :, :] joint_gradient,
                       double[:] smarginal, double[:] mmarginal,
-                      double[:] mi_gradient):
+                      double[:] mi_gradient=None):
     r""" Computes the mutual information and its gradient (if requested)
 
     Parameters
@@ -1240,23 +1529,29 @@ def compute_parzen_mi(double[:, :] joint,
         the joint intensity distribution
     joint_gradient : array, shape (nbins, nbins, n)
         the gradient of the joint distribution w.r.t. the transformation
-        parameters
+        parameters. It is not used, and may be None, if `mi_gradient` is None
     smarginal : array, shape (nbins,)
         the marginal intensity distribution of the static image
     mmarginal : array, shape (nbins,)
         the marginal intensity distribution of the moving image
-    mi_gradient : array, shape (n,)
+    mi_gradient : array, shape (n,), optional
         the buffer in which to write the gradient of the mutual information.
-        If None, the gradient is not computed
+        If None (default), the gradient is not computed, so the gradient of
+        the joint distribution (the derivatives of its B-spline kernel) does
+        not need to be computed when only the value is needed
     """
     cdef:
         double epsilon = 2.2204460492503131e-016
         double metric_value
         cnp.npy_intp nrows = joint.shape[0]
         cnp.npy_intp ncols = joint.shape[1]
-        cnp.npy_intp n = joint_gradient.shape[2]
+        cnp.npy_intp n = 0
+        int update_gradient = mi_gradient is not None
+    if update_gradient:
+        n = joint_gradient.shape[2]
     with nogil:
-        mi_gradient[:] = 0
+        if update_gradient:
+            mi_gradient[:] = 0
         metric_value = 0
         for i in range(nrows):
             for j in range(ncols):
@@ -1265,7 +1560,7 @@ def compute_parzen_mi(double[:, :] joint,
 
                 factor = log(joint[i, j] / mmarginal[j])
 
-                if mi_gradient is not None:
+                if update_gradient:
                     for k in range(n):
                         mi_gradient[k] += joint_gradient[i, j, k] * factor
 
@@ -9,7 +9,8 @@ class ScaleSpace(object):
                  image_grid2world=None,
                  input_spacing=None,
                  sigma_factor=0.2,
-                 mask0=False):
+                 mask0=False,
+                 dtype=floating):
         r""" ScaleSpace
 
         Computes the Scale Space representation of an image. The scale space is
@@ -40,6 +41,9 @@ class ScaleSpace(object):
         mask0 : Boolean, optional
             if True, all smoothed images will be zero at all voxels that are
             zero in the input image. The default is False.
+        dtype : data-type, optional
+            the floating point type of the smoothed images. The default is
+            dipy.align.floating (float32).
 
         """
         self.dim = len(image.shape)
@@ -55,7 +59,7 @@ class ScaleSpace(object):
 
         # The properties are saved in separate lists. Insert input image
         # properties at the first level of the scale space
-        self.images = [img.astype(floating)]
+        self.images = [img.astype(dtype)]
         self.domain_shapes = [input_size.astype(np.int32)]
         if input_spacing is None:
             input_spacing = np.ones((self.dim,), dtype=np.int32)
@@ -102,7 +106,7 @@ class ScaleSpace(object):
                 filtered *= mask
 
             # Add current level to the scale space
-            self.images.append(filtered.astype(floating))
+            self.images.append(filtered.astype(dtype))
             self.domain_shapes.append(output_size)
             self.spacings.append(output_spacing)
             self.scalings.append(scaling)
@@ -314,7 +318,8 @@ class IsotropicScaleSpace(ScaleSpace):
     def __init__(self, image, factors, sigmas,
                  image_grid2world=None,
                  input_spacing=None,
-                 mask0=False):
+                 mask0=False,
+                 dtype=floating):
         r""" IsotropicScaleSpace
 
         Computes the Scale Space representation of an image using isotropic
@@ -345,6 +350,9 @@ class IsotropicScaleSpace(ScaleSpace):
         mask0 : Boolean, optional
             if True, all smoothed images will be zero at all voxels that are
             zero in the input image. The default is False.
+        dtype : data-type, optional
+            the floating point type of the smoothed images. The default is
+            dipy.align.floating (float32).
         """
         self.dim = len(image.shape)
         self.num_levels = len(factors)
@@ -362,7 +370,7 @@ class IsotropicScaleSpace(ScaleSpace):
 
         # The properties are saved in separate lists. Insert input image
         # properties at the first level of the scale space
-        self.images = [img.astype(floating)]
+        self.images = [img.astype(dtype)]
         self.domain_shapes = [input_size.astype(np.int32)]
         if input_spacing is None:
             input_spacing = np.ones((self.dim,), dtype=np.int32)
@@ -415,7 +423,7 @@ class IsotropicScaleSpace(ScaleSpace):
                 filtered *= mask
 
             # Add current level to the scale space
-            self.images.append(filtered.astype(floating))
+            self.images.append(filtered.astype(dtype))
             self.domain_shapes.append(output_size)
             self.spacings.append(new_spacing)
             self.scalings.append(shrink_factors)
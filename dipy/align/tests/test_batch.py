@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+from numpy.testing import (assert_,
+                           assert_array_almost_equal,
+                           assert_equal,
+                           assert_raises)
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from dipy.data import get_data
+from dipy.io.pickles import load_pickle
+from dipy.align import imaffine
+from dipy.align import imwarp
+from dipy.align import metrics
+from dipy.align import VerbosityLevels
+from dipy.align.batch import register_batch
+from dipy.align.transforms import regtransforms
+from dipy.align.tests.test_parzenhist import setup_random_transform
+from dipy.align.tests.test_imwarp import get_warped_stacked_image
+
+
+def test_register_batch_affine():
+    # Rotated and translated copies of the same image are registered to it
+    transform = regtransforms[('RIGID', 2)]
+    moving_images = []
+    for factor in [0.05, 0.1, 0.15]:
+        moving, template, static_g2w, moving_g2w, smask, mmask, M = \
+            setup_random_transform(transform, factor, 1, 1.0)
+        moving_images.append(moving)
+    metric = imaffine.MutualInformationMetric(32, 0.5)
+    affreg = imaffine.AffineRegistration(metric, [100, 50], [1, 0], [2, 1],
+                                         verbosity=VerbosityLevels.NONE)
+
+    expected = [affreg.optimize(template, moving, transform, None).affine
+                for moving in moving_images]
+    # A static image given to optimize is not kept
+    assert_(affreg.static is None)
+    assert_(affreg.static_levels is None)
+    for num_processes in [1, 2]:
+        mappings = register_batch(affreg, template, iter(moving_images),
+                                  num_processes=num_processes,
+                                  transform=transform, params0=None)
+        assert_equal(len(mappings), len(moving_images))
+        for mapping, affine in zip(mappings, expected):
+            assert_array_almost_equal(mapping.affine, affine)
+
+    # The static image of the batch is kept by the registration, even
+    # through the registration of another static image
+    affreg.optimize(moving_images[1], moving_images[0], transform, None)
+    mapping = affreg.optimize(None, moving_images[0], transform, None)
+    assert_array_almost_equal(mapping.affine, expected[0])
+
+    # Per image arguments, and transforms saved to files
+    image_kwargs = [{'starting_affine': 'mass'}] * len(moving_images)
+    expected = [affreg.optimize(template, moving, transform, None,
+                                starting_affine='mass').affine
+                for moving in moving_images]
+    with InTemporaryDirectory():
+        out_files = ['affine%d.pkl' % i for i in range(len(moving_images))]
+        fnames = register_batch(affreg, template, moving_images,
+                                image_kwargs=image_kwargs,
+                                out_files=out_files, num_processes=2,
+                                transform=transform, params0=None)
+        assert_equal(fnames, out_files)
+        for fname, affine in zip(fnames, expected):
+            assert_array_almost_equal(load_pickle(fname).affine, affine)
+            os.remove(fname)
+
+    # A registration without static image
+    affreg = imaffine.AffineRegistration(metric, [100, 50], [1, 0], [2, 1])
+    assert_raises(ValueError, affreg.optimize, None, moving_images[0],
+                  transform, None)
+
+
+def test_register_batch_syn():
+    # Images warped under different fields are registered to the original
+    image = np.load(get_data('t1_coronal_slice'))
+    moving_images = []
+    for b in [0.05, 0.1]:
+        template, moving = get_warped_stacked_image(image, 1, b, 4)
+        moving_images.append(moving)
+    metric = metrics.CCMetric(2, 3.0, 4)
+    sdr = imwarp.SymmetricDiffeomorphicRegistration(metric, [10, 5])
+    sdr.verbosity = VerbosityLevels.NONE
+
+    expected = [sdr.optimize(template, moving) for moving in moving_images]
+    assert_(sdr.static_ss is None)
+    mappings = register_batch(sdr, template, moving_images, num_processes=2)
+    for mapping, expected_mapping in zip(mappings, expected):
+        assert_array_almost_equal(mapping.forward, expected_mapping.forward)
+        assert_array_almost_equal(mapping.backward,
+                                  expected_mapping.backward)
+        warped = mapping.transform(moving_images[0])
+        assert_equal(warped.shape, template.shape)
+    # The scale space of the batch's static image is kept
+    assert_(sdr.static_ss is not None)
+
+    assert_raises(ValueError,
+                  imwarp.SymmetricDiffeomorphicRegistration(metric).optimize,
+                  None, moving_images[0])
@@ -1,5 +1,7 @@
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import (assert_array_almost_equal,
+                           assert_array_equal,
+                           assert_equal)
 from dipy.align import floating
 from dipy.align import crosscorr as cc
 
@@ -214,8 +216,34 @@ def test_compute_cc_steps_3d():
         assert_array_almost_equal(actual, expected)
 
 
+def test_cc_threads_3d():
+    r"""
+    Computes the cross-correlation factors and steps with slabs of slices
+    processed by several threads.
+    """
+    np.random.seed(3271)
+    a = np.random.ranf((15, 12, 10)).astype(floating)
+    b = np.random.ranf((15, 12, 10)).astype(floating)
+    grad = np.random.ranf((15, 12, 10, 3)).astype(floating)
+    for radius in [1, 2, 4]:
+        expected = np.asarray(cc.precompute_cc_factors_3d_test(a, b, radius))
+        for num_threads in [1, 2, 3, 7, 20]:
+            factors = np.asarray(cc.precompute_cc_factors_3d(
+                a, b, radius, num_threads=num_threads))
+            assert_array_almost_equal(factors, expected, decimal=5)
+        for step in [cc.compute_cc_forward_step_3d,
+                     cc.compute_cc_backward_step_3d]:
+            out, energy = step(grad, factors, radius, num_threads=1)
+            for num_threads in [2, 5]:
+                out_t, energy_t = step(grad, factors, radius,
+                                       num_threads=num_threads)
+                assert_array_equal(out_t, out)
+                assert_equal(energy_t, energy)
+
+
 if __name__ == '__main__':
     test_cc_factors_2d()
     test_cc_factors_3d()
     test_compute_cc_steps_2d()
     test_compute_cc_steps_3d()
+    test_cc_threads_3d()
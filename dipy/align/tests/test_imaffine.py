@@ -338,6 +338,60 @@ def test_mi_gradient():
         assert(nprod >= 0.99)
 
 
+def test_mi_batch():
+    # The metric estimated from all the points of the sample pool of a dense
+    # metric is the metric sampling every voxel
+    transform = regtransforms[('RIGID', 2)]
+    theta = np.array([0.05, 1.2, -0.7])
+    static, moving, static_g2w, moving_g2w, smask, mmask, M = \
+        setup_random_transform(transform, 0.1, 1, 2.0)
+    dense = imaffine.MutualInformationMetric(32)
+    dense.setup(transform, static, moving)
+    sparse = imaffine.MutualInformationMetric(32, 1.0)
+    sparse.setup(transform, static, moving)
+    pool = dense.get_sample_pool()
+    assert_array_equal(pool, sparse.samples_prealigned)
+
+    batch = np.arange(pool.shape[0])
+    actual_val, actual_grad = dense.distance_and_gradient_batch(theta, batch)
+    expected_val, expected_grad = sparse.distance_and_gradient(theta)
+    assert_almost_equal(actual_val, expected_val)
+    assert_array_almost_equal(actual_grad, expected_grad)
+
+    # A batch may repeat points
+    batch = np.repeat(batch[::3], 2)
+    actual_val, actual_grad = dense.distance_and_gradient_batch(theta, batch)
+    sparse.samples = sparse.samples[::3]
+    sparse.samples_prealigned = sparse.samples_prealigned[::3]
+    sparse.static_vals = sparse.static_vals[::3]
+    expected_val, expected_grad = sparse.distance_and_gradient(theta)
+    assert_almost_equal(actual_val, expected_val)
+    assert_array_almost_equal(actual_grad, expected_grad)
+
+
+def test_affreg_sgd():
+    # Affine registration by mini-batch stochastic gradient descent
+    for ttype in [('RIGID', 2), ('AFFINE', 2), ('SCALING', 3)]:
+        dim = ttype[1]
+        nslices = 1 if dim == 2 else 45
+        factor = factors[ttype][0]
+        transform = regtransforms[ttype]
+        static, moving, static_grid2world, moving_grid2world, smask, mmask, \
+            T = setup_random_transform(transform, factor, nslices, 1.0)
+        start_sad = np.abs(static - moving).sum()
+        metric = imaffine.MutualInformationMetric(32)
+        affreg = imaffine.AffineRegistration(metric, [300, 300, 300],
+                                             [3, 1, 0], [4, 2, 1], 'SGD',
+                                             options={'batch_size': 2000})
+        affine_map = affreg.optimize(static, moving, transform, None,
+                                     static_grid2world, moving_grid2world)
+        transformed = affine_map.transform(moving)
+        end_sad = np.abs(static - transformed).sum()
+        reduction = 1 - end_sad / start_sad
+        print("%s>>%f" % (ttype, reduction))
+        assert(reduction > 0.9)
+
+
 def create_affine_transforms(
         dim, translations, rotations, scales, rot_axis=None):
     r""" Creates a list of affine transforms with all combinations of params
@@ -774,6 +774,65 @@ def test_cc_3d():
     assert(reduced > 0.9)
 
 
+def test_cc_3d_threads():
+    r''' Test 3D SyN with CC metric using several threads
+
+    The number of threads given to the optimizer and to the metric is passed
+    on to the maps it creates, and only affects the rounding errors of the
+    registration.
+    '''
+    fname = get_data('t1_coronal_slice')
+    image = np.load(fname)[::2, ::2]
+    moving, static = get_warped_stacked_image(image, 9, 0.1, 4)
+
+    mappings = []
+    for num_threads in [1, 3]:
+        metric = metrics.CCMetric(3, 2.0, 2, num_threads=num_threads)
+        optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+            metric, [5, 5], num_threads=num_threads)
+        mapping = optimizer.optimize(static, moving, None, None, None)
+        assert_equal(mapping.num_threads, num_threads)
+        assert_equal(mapping.inverse().num_threads, num_threads)
+        mappings.append(mapping)
+
+    assert_array_almost_equal(mappings[1].forward, mappings[0].forward,
+                              decimal=4)
+    assert_array_almost_equal(mappings[1].transform(moving),
+                              mappings[0].transform(moving), decimal=4)
+
+
+def test_cc_3d_float32():
+    r''' Test 3D SyN with CC metric in single precision
+
+    The registration in float32 keeps all its fields in float32 and must be
+    as accurate as the registration in float64.
+    '''
+    fname = get_data('t1_coronal_slice')
+    image = np.load(fname)[::2, ::2]
+    moving, static = get_warped_stacked_image(image, 9, 0.1, 4)
+    starting_energy = np.sum((static - moving)**2)
+
+    results = {}
+    for dtype in [np.float32, np.float64]:
+        metric = metrics.CCMetric(3, 2.0, 2)
+        optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+            metric, [10, 5], dtype=dtype)
+        mapping = optimizer.optimize(static, moving, None, None, None)
+        for field in [mapping.forward, mapping.backward]:
+            assert_equal(field.dtype, dtype)
+        warped = mapping.transform(moving)
+        assert_equal(warped.dtype, dtype)
+        assert_equal(mapping.inverse().transform(static).dtype, dtype)
+        reduced = 1.0 - np.sum((static - warped)**2) / starting_energy
+        results[dtype] = (mapping.forward, warped, reduced)
+
+    forward32, warped32, reduced32 = results[np.float32]
+    forward64, warped64, reduced64 = results[np.float64]
+    assert(np.abs(forward32 - forward64).max() < 1e-3)
+    assert(np.abs(warped32 - warped64).max() < 1e-3)
+    assert(abs(reduced32 - reduced64) < 1e-5)
+
+
 def test_em_3d_gauss_newton():
     r''' Test 3D SyN with EM metric, Gauss-Newton optimizer
 
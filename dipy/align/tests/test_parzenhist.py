@@ -7,6 +7,7 @@ from dipy.data import get_data
 from dipy.align import vector_fields as vf
 from dipy.align.transforms import regtransforms
 from dipy.align.parzenhist import (ParzenJointHistogram,
+                                   compute_parzen_mi,
                                    cubic_spline,
                                    cubic_spline_derivative,
                                    sample_domain_regular)
@@ -513,6 +514,65 @@ def test_joint_pdf_gradients_sparse():
         assert(std_cosine < 0.15)
 
 
+def test_parzen_threads():
+    # Histograms and gradients accumulated in parallel, each from a chunk of
+    # the voxels or samples, add up to those of all the voxels or samples
+    for ttype in [('RIGID', 2), ('AFFINE', 3)]:
+        dim = ttype[1]
+        nslices = 1 if dim == 2 else 10
+        transform = regtransforms[ttype]
+        theta = transform.get_identity_parameters()
+        static, moving, static_g2w, moving_g2w, smask, mmask, M = \
+            setup_random_transform(transform, factors[ttype], nslices, 5.0)
+        mgrad, inside = vf.gradient(moving.astype(np.float32),
+                                    np.linalg.inv(moving_g2w),
+                                    np.ones(dim, dtype=np.float64),
+                                    static.shape, static_g2w)
+        sval = static.reshape(-1)
+        mval = moving.reshape(-1)
+        points = np.array([static_g2w.dot(index + (1,))[:dim]
+                           for index in ndindex(static.shape)])
+        sparse_mgrad = mgrad.reshape(-1, dim)
+
+        expected = ParzenJointHistogram(32, num_threads=1)
+        expected.setup(static, moving, smask, mmask)
+        for num_threads in [1, 3, 7]:
+            actual = ParzenJointHistogram(32, num_threads=num_threads)
+            actual.setup(static, moving, smask, mmask)
+            for parzen_hist in [expected, actual]:
+                parzen_hist.update_pdfs_dense(static, moving)
+                parzen_hist.update_gradient_dense(theta, transform, static,
+                                                  moving, static_g2w, mgrad)
+            assert_array_almost_equal(actual.joint, expected.joint, 12)
+            assert_array_almost_equal(actual.smarginal, expected.smarginal,
+                                      12)
+            assert_array_almost_equal(actual.mmarginal, expected.mmarginal,
+                                      12)
+            assert_array_almost_equal(actual.joint_grad, expected.joint_grad,
+                                      10)
+
+            for parzen_hist in [expected, actual]:
+                parzen_hist.update_pdfs_sparse(sval, mval)
+                parzen_hist.update_gradient_sparse(theta, transform, sval,
+                                                   mval, points, sparse_mgrad)
+            assert_array_almost_equal(actual.joint, expected.joint, 12)
+            assert_array_almost_equal(actual.smarginal, expected.smarginal,
+                                      12)
+            assert_array_almost_equal(actual.mmarginal, expected.mmarginal,
+                                      12)
+            assert_array_almost_equal(actual.joint_grad, expected.joint_grad,
+                                      10)
+
+        # The value of the MI does not need the gradient of the joint PDF
+        mi_grad = np.empty_like(theta)
+        expected_mi = compute_parzen_mi(expected.joint, expected.joint_grad,
+                                        expected.smarginal,
+                                        expected.mmarginal, mi_grad)
+        actual_mi = compute_parzen_mi(expected.joint, None,
+                                      expected.smarginal, expected.mmarginal)
+        assert_almost_equal(actual_mi, expected_mi)
+
+
 def test_sample_domain_regular():
     # Test 2D sampling
     shape = np.array((10, 10), dtype=np.int32)
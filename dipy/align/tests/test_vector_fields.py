@@ -1318,6 +1318,43 @@ def test_invert_vector_field_3d():
                   d, invalid, spacing, 40, 1e-7, None)
 
 
+def test_threads_3d():
+    r"""
+    Composes, inverts and warps with slabs of slices processed by several
+    threads, which must not change the results
+    """
+    shape = (13, 16, 11)
+    d, dinv = vfu.create_harmonic_fields_3d(shape[0], shape[1], shape[2],
+                                            0.2, 4)
+    d = np.asarray(d).astype(floating)
+    dinv = np.asarray(dinv).astype(floating)
+    grid2world = np.diag([1.5, 1.0, 2.0, 1.0])
+    grid2world[:3, 3] = [-3.0, 2.0, 1.0]
+    world2grid = np.linalg.inv(grid2world)
+    spacing = np.array([1.5, 1.0, 2.0])
+    np.random.seed(8547)
+    volume = np.random.ranf(shape).astype(floating)
+    labels = np.random.randint(0, 5, shape).astype(np.int32)
+    affine_idx_in = np.eye(4)
+    affine_idx_in[:3, 3] = [0.5, -0.25, 0.0]
+
+    def run(num_threads):
+        comp, stats = vfu.compose_vector_fields_3d(
+            d, dinv, None, world2grid, 1.0, None, num_threads=num_threads)
+        inv = vfu.invert_vector_field_fixed_point_3d(
+            d, world2grid, spacing, 10, 1e-7, num_threads=num_threads)
+        warped = vfu.warp_3d(volume, d, affine_idx_in, None, world2grid,
+                             None, num_threads=num_threads)
+        warped_nn = vfu.warp_3d_nn(labels, d, affine_idx_in, None,
+                                   world2grid, None, num_threads=num_threads)
+        return comp, stats, inv, warped, warped_nn
+
+    expected = run(1)
+    for num_threads in [2, 3, 20]:
+        for actual, desired in zip(run(num_threads), expected):
+            assert_array_equal(actual, desired)
+
+
 def test_resample_vector_field_2d():
     r"""
     Expand a vector field by 2, then subsample by 2, the resulting
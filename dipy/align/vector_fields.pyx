@@ -6,8 +6,12 @@
 import numpy as np
 cimport numpy as cnp
 cimport cython
+from cython.parallel import prange
+from libc.stdlib cimport malloc, free
 from .fused_types cimport floating, number
 
+from omp_threads cimport determine_num_threads
+
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double)
@@ -925,7 +929,8 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                                     double[:, :] premult_disp,
                                     double t,
                                     floating[:, :, :, :] comp,
-                                    double[:] stats) nogil:
+                                    double[:] stats,
+                                    int num_threads) nogil:
     r"""Computes the composition of two 3D displacement fields
 
     Computes the composition of the two 3-D displacements d1 and d2. The
@@ -966,6 +971,8 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
     stats : array, shape (3,)
         on output, this array will contain three statistics of the vector norms
         of the composition (maximum, mean, standard_deviation)
+    num_threads : int
+        the number of threads composing the slices of d1
 
     Returns
     -------
@@ -985,86 +992,122 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
     updated values from d1 are no longer used (this is done to save memory and
     time). However, using the same array for d2 and comp may not be the
     intended operation (see comment below).
+
+    The statistics are reduced from those of each slice, in order, so they do
+    not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp ns1 = d1.shape[0]
+        cnp.npy_intp k
+        double cnt = 0
+        double maxNorm = 0
+        double meanNorm = 0
+        double stdNorm = 0
+        double *slice_stats = <double *>malloc(4 * ns1 * sizeof(double))
+    for k in prange(ns1, num_threads=num_threads, schedule='static'):
+        _compose_slice_3d[floating](d1, d2, premult_index, premult_disp, t,
+                                    comp, k, &slice_stats[4 * k])
+    for k in range(ns1):
+        if maxNorm < slice_stats[4 * k]:
+            maxNorm = slice_stats[4 * k]
+        meanNorm += slice_stats[4 * k + 1]
+        stdNorm += slice_stats[4 * k + 2]
+        cnt += slice_stats[4 * k + 3]
+    free(slice_stats)
+    meanNorm /= cnt
+    stats[0] = sqrt(maxNorm)
+    stats[1] = sqrt(meanNorm)
+    stats[2] = sqrt(stdNorm / cnt - meanNorm * meanNorm)
+
+
+cdef void _compose_slice_3d(floating[:, :, :, :] d1,
+                            floating[:, :, :, :] d2,
+                            double[:, :] premult_index,
+                            double[:, :] premult_disp,
+                            double t,
+                            floating[:, :, :, :] comp,
+                            cnp.npy_intp k,
+                            double *stats) nogil:
+    r"""Composition of the slice k of two 3D displacement fields
+
+    See `_compose_vector_fields_3d`. On output, `stats` contains the maximum,
+    the sum and the sum of squares of the squared norms of the composition in
+    the slice, and the number of its vectors inside the domain of d2.
+    """
+    cdef:
         cnp.npy_intp nr1 = d1.shape[1]
         cnp.npy_intp nc1 = d1.shape[2]
-        cnp.npy_intp ns2 = d2.shape[0]
-        cnp.npy_intp nr2 = d2.shape[1]
-        cnp.npy_intp nc2 = d2.shape[2]
         int inside, cnt = 0
         double maxNorm = 0
         double meanNorm = 0
         double stdNorm = 0
         double nn
-        cnp.npy_intp i, j, k
+        cnp.npy_intp i, j
         double di, dj, dk, dii, djj, dkk, diii, djjj, dkkk
-    for k in range(ns1):
-        for i in range(nr1):
-            for j in range(nc1):
+    for i in range(nr1):
+        for j in range(nc1):
 
-                # This is the only place we access d1[k, i, j]
-                dkk = d1[k, i, j, 0]
-                dii = d1[k, i, j, 1]
-                djj = d1[k, i, j, 2]
+            # This is the only place we access d1[k, i, j]
+            dkk = d1[k, i, j, 0]
+            dii = d1[k, i, j, 1]
+            djj = d1[k, i, j, 2]
 
-                if premult_disp is None:
-                    dk = dkk
-                    di = dii
-                    dj = djj
-                else:
-                    dk = _apply_affine_3d_x0(dkk, dii, djj, 0, premult_disp)
-                    di = _apply_affine_3d_x1(dkk, dii, djj, 0, premult_disp)
-                    dj = _apply_affine_3d_x2(dkk, dii, djj, 0, premult_disp)
-
-                if premult_index is None:
-                    dkkk = k
-                    diii = i
-                    djjj = j
-                else:
-                    dkkk = _apply_affine_3d_x0(k, i, j, 1, premult_index)
-                    diii = _apply_affine_3d_x1(k, i, j, 1, premult_index)
-                    djjj = _apply_affine_3d_x2(k, i, j, 1, premult_index)
-
-                dkkk += dk
-                diii += di
-                djjj += dj
-
-                # If d1 and comp are the same array, this will correctly update
-                # d1[k,i,j], which will never be accessed again
-                # If d2 and comp are the same array, then (dkkk, diii, djjj)
-                # may be in the neighborhood of a previously updated vector
-                # from d2, which may be problematic
-                inside = _interpolate_vector_3d[floating](d2, dkkk, diii, djjj,
-                                                          &comp[k, i, j, 0])
-
-                if inside == 1:
-                    comp[k, i, j, 0] = t * comp[k, i, j, 0] + dkk
-                    comp[k, i, j, 1] = t * comp[k, i, j, 1] + dii
-                    comp[k, i, j, 2] = t * comp[k, i, j, 2] + djj
-                    nn = (comp[k, i, j, 0] ** 2 + comp[k, i, j, 1] ** 2 +
-                          comp[k, i, j, 2]**2)
-                    meanNorm += nn
-                    stdNorm += nn * nn
-                    cnt += 1
-                    if(maxNorm < nn):
-                        maxNorm = nn
-                else:
-                    comp[k, i, j, 0] = 0
-                    comp[k, i, j, 1] = 0
-                    comp[k, i, j, 2] = 0
-    meanNorm /= cnt
-    stats[0] = sqrt(maxNorm)
-    stats[1] = sqrt(meanNorm)
-    stats[2] = sqrt(stdNorm / cnt - meanNorm * meanNorm)
+            if premult_disp is None:
+                dk = dkk
+                di = dii
+                dj = djj
+            else:
+                dk = _apply_affine_3d_x0(dkk, dii, djj, 0, premult_disp)
+                di = _apply_affine_3d_x1(dkk, dii, djj, 0, premult_disp)
+                dj = _apply_affine_3d_x2(dkk, dii, djj, 0, premult_disp)
+
+            if premult_index is None:
+                dkkk = k
+                diii = i
+                djjj = j
+            else:
+                dkkk = _apply_affine_3d_x0(k, i, j, 1, premult_index)
+                diii = _apply_affine_3d_x1(k, i, j, 1, premult_index)
+                djjj = _apply_affine_3d_x2(k, i, j, 1, premult_index)
+
+            dkkk += dk
+            diii += di
+            djjj += dj
+
+            # If d1 and comp are the same array, this will correctly update
+            # d1[k,i,j], which will never be accessed again
+            # If d2 and comp are the same array, then (dkkk, diii, djjj)
+            # may be in the neighborhood of a previously updated vector
+            # from d2, which may be problematic
+            inside = _interpolate_vector_3d[floating](d2, dkkk, diii, djjj,
+                                                      &comp[k, i, j, 0])
+
+            if inside == 1:
+                comp[k, i, j, 0] = t * comp[k, i, j, 0] + dkk
+                comp[k, i, j, 1] = t * comp[k, i, j, 1] + dii
+                comp[k, i, j, 2] = t * comp[k, i, j, 2] + djj
+                nn = (comp[k, i, j, 0] ** 2 + comp[k, i, j, 1] ** 2 +
+                      comp[k, i, j, 2]**2)
+                meanNorm += nn
+                stdNorm += nn * nn
+                cnt += 1
+                if(maxNorm < nn):
+                    maxNorm = nn
+            else:
+                comp[k, i, j, 0] = 0
+                comp[k, i, j, 1] = 0
+                comp[k, i, j, 2] = 0
+    stats[0] = maxNorm
+    stats[1] = meanNorm
+    stats[2] = stdNorm
+    stats[3] = cnt
 
 
 def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
                              double[:, :] premult_index,
                              double[:, :] premult_disp,
                              double time_scaling,
-                             floating[:, :, :, :] comp):
+                             floating[:, :, :, :] comp, num_threads=None):
     r"""Computes the composition of two 3D displacement fields
 
     Computes the composition of the two 3-D displacements d1 and d2. The
@@ -1103,6 +1146,9 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     comp : array, shape (S, R, C, 3), same dimension as d1
         the buffer to write the composition to. If None, the buffer will be
         created internally
+    num_threads : int, optional
+        the number of threads composing the slices of d1. If None (default),
+        all the available cores are used.
 
     Returns
     -------
@@ -1129,7 +1175,8 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
         raise ValueError("Invalid displacement pre-multiplication matrix")
 
     _compose_vector_fields_3d[floating](d1, d2, premult_index, premult_disp,
-                                        time_scaling, comp, stats)
+                                        time_scaling, comp, stats,
+                                        determine_num_threads(num_threads))
     return np.asarray(comp), np.asarray(stats)
 
 
@@ -1241,7 +1288,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
                                        double[:, :] d_world2grid,
                                        double[:] spacing,
                                        int max_iter, double tol,
-                                       floating[:, :, :, :] start=None):
+                                       floating[:, :, :, :] start=None,
+                                       num_threads=None):
     r"""Computes the inverse of a 3D displacement fields
 
     Computes the inverse of the given 3-D displacement field d using the
@@ -1269,6 +1317,9 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         an approximation to the inverse displacement field (if no approximation
         is available, None can be provided and the start displacement field
         will be zero)
+    num_threads : int, optional
+        the number of threads updating the slices of the inverse. If None
+        (default), all the available cores are used.
 
     Returns
     -------
@@ -1288,6 +1339,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         cnp.npy_intp nr = d.shape[1]
         cnp.npy_intp nc = d.shape[2]
         int iter_count, current
+        int threads = determine_num_threads(num_threads)
+        cnp.npy_intp k, i, j
         double dkk, dii, djj, dk, di, dj
         double difmag, mag, maxlen, step_factor
         double epsilon = 0.5
@@ -1299,6 +1352,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         double[:] stats = np.zeros(shape=(2,), dtype=np.float64)
         double[:] substats = np.zeros(shape=(3,), dtype=np.float64)
         double[:, :, :] norms = np.zeros(shape=(ns, nr, nc), dtype=np.float64)
+        double[:] slice_error = np.zeros(shape=(ns,), dtype=np.float64)
+        double[:] slice_difmag = np.zeros(shape=(ns,), dtype=np.float64)
         floating[:, :, :, :] p = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
         floating[:, :, :, :] q = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
 
@@ -1317,21 +1372,27 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
             else:
                 epsilon = 0.5
             _compose_vector_fields_3d[floating](p, d, None, d_world2grid,
-                                                1.0, q, substats)
-            difmag = 0
-            error = 0
-            for k in range(ns):
+                                                1.0, q, substats, threads)
+            for k in prange(ns, num_threads=threads, schedule='static'):
+                slice_error[k] = 0
+                slice_difmag[k] = 0
                 for i in range(nr):
                     for j in range(nc):
                         mag = sqrt((q[k, i, j, 0]/ss) ** 2 +
                                    (q[k, i, j, 1]/sr) ** 2 +
                                    (q[k, i, j, 2]/sc) ** 2)
                         norms[k, i, j] = mag
-                        error += mag
-                        if(difmag < mag):
-                            difmag = mag
-            maxlen = difmag*epsilon
+                        slice_error[k] += mag
+                        if(slice_difmag[k] < mag):
+                            slice_difmag[k] = mag
+            difmag = 0
+            error = 0
             for k in range(ns):
+                error += slice_error[k]
+                if(difmag < slice_difmag[k]):
+                    difmag = slice_difmag[k]
+            maxlen = difmag*epsilon
+            for k in prange(ns, num_threads=threads, schedule='static'):
                 for i in range(nr):
                     for j in range(nc):
                         if norms[k, i, j] > maxlen:
@@ -1861,7 +1922,7 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
             double[:, :] affine_idx_in=None,
             double[:, :] affine_idx_out=None,
             double[:, :] affine_disp=None,
-            int[:] out_shape=None):
+            int[:] out_shape=None, num_threads=None):
     r"""Warps a 3D volume using trilinear interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -1899,6 +1960,9 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        the number of threads warping the slices of the sampling grid. If None
+        (default), all the available cores are used.
 
     Returns
     -------
@@ -1914,6 +1978,7 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
         cnp.npy_intp ncVol = volume.shape[2]
         cnp.npy_intp i, j, k
         int inside
+        int threads = determine_num_threads(num_threads)
         double dkk, dii, djj, dk, di, dj
 
     if not is_valid_affine(affine_idx_in, 3):
@@ -1934,11 +1999,11 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef floating[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                              dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype = np.asarray(d1).dtype)
+    cdef floating[:, :] tmp = np.zeros(shape=(nslices, 3),
+                                       dtype=np.asarray(d1).dtype)
 
     with nogil:
-
-        for k in range(nslices):
+        for k in prange(nslices, num_threads=threads, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -1952,11 +2017,11 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
                             k, i, j, 1, affine_idx_in)
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
-                        inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
-                        dkk = tmp[0]
-                        dii = tmp[1]
-                        djj = tmp[2]
+                        inside = _interpolate_vector_3d[floating](
+                            d1, dk, di, dj, &tmp[k, 0])
+                        dkk = tmp[k, 0]
+                        dii = tmp[k, 1]
+                        djj = tmp[k, 2]
 
                     if affine_disp is not None:
                         dk = _apply_affine_3d_x0(
@@ -2058,7 +2123,7 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                double[:, :] affine_idx_in=None,
                double[:, :] affine_idx_out=None,
                double[:, :] affine_disp=None,
-               int[:] out_shape=None):
+               int[:] out_shape=None, num_threads=None):
     r"""Warps a 3D volume using using nearest-neighbor interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -2096,6 +2161,9 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        the number of threads warping the slices of the sampling grid. If None
+        (default), all the available cores are used.
 
     Returns
     -------
@@ -2111,6 +2179,7 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
         cnp.npy_intp ncVol = volume.shape[2]
         cnp.npy_intp i, j, k
         int inside
+        int threads = determine_num_threads(num_threads)
         double dkk, dii, djj, dk, di, dj
 
     if not is_valid_affine(affine_idx_in, 3):
@@ -2131,11 +2200,11 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef number[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                            dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype = np.asarray(d1).dtype)
+    cdef floating[:, :] tmp = np.zeros(shape=(nslices, 3),
+                                       dtype=np.asarray(d1).dtype)
 
     with nogil:
-
-        for k in range(nslices):
+        for k in prange(nslices, num_threads=threads, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -2149,11 +2218,11 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                             k, i, j, 1, affine_idx_in)
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
-                        inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
-                        dkk = tmp[0]
-                        dii = tmp[1]
-                        djj = tmp[2]
+                        inside = _interpolate_vector_3d[floating](
+                            d1, dk, di, dj, &tmp[k, 0])
+                        dkk = tmp[k, 0]
+                        dii = tmp[k, 1]
+                        djj = tmp[k, 2]
 
                     if affine_disp is not None:
                         dk = _apply_affine_3d_x0(
@@ -5,11 +5,14 @@ Scipy < 0.12. All optimizers are available for scipy >= 0.12.
 """
 import abc
 from distutils.version import LooseVersion
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import scipy
 import scipy.sparse as sps
 import scipy.optimize as opt
 from dipy.utils.six import with_metaclass
+from dipy.utils.arrfuncs import cholesky_solve
 
 SCIPY_LESS_0_12 = LooseVersion(scipy.version.short_version) < '0.12'
 
@@ -294,13 +297,84 @@ def spdot(A, B):
         return np.dot(A, B)
 
 
+class _ColumnBlocks(object):
+    """Products of a matrix and of its transpose with vectors, computed by
+    blocks of columns in a pool of threads
+
+    The blocks of a csc matrix share its buffers. The vectors are cast to
+    the data type of the matrix, so that scipy does not cast a copy of a
+    float32 matrix to float64 at every product.
+    """
+    def __init__(self, X, block_size=None, num_threads=1):
+        n = X.shape[1]
+        if block_size is None:
+            block_size = n
+        block_size = max(int(block_size), 1)
+        self.bounds = [(start, min(start + block_size, n))
+                       for start in range(0, n, block_size)]
+        if sps.isspmatrix_csc(X):
+            self.blocks = [sps.csc_matrix((X.data[X.indptr[start]:
+                                                  X.indptr[stop]],
+                                           X.indices[X.indptr[start]:
+                                                     X.indptr[stop]],
+                                           X.indptr[start:stop + 1] -
+                                           X.indptr[start]),
+                                          shape=(X.shape[0], stop - start),
+                                          copy=False)
+                           for start, stop in self.bounds]
+        else:
+            self.blocks = [X[:, start:stop] for start, stop in self.bounds]
+        self.shape = X.shape
+        self.dtype = X.dtype
+        if num_threads is None:
+            num_threads = cpu_count()
+        self.pool = None
+        if num_threads > 1 and len(self.blocks) > 1:
+            self.pool = ThreadPool(num_threads)
+
+    def _map(self, func):
+        if self.pool is None:
+            return [func(i) for i in range(len(self.blocks))]
+        return self.pool.map(func, range(len(self.blocks)))
+
+    def dot(self, h):
+        """The product of the matrix with `h`"""
+        h = np.asarray(h, dtype=self.dtype)
+
+        def block_dot(i):
+            start, stop = self.bounds[i]
+            return spdot(self.blocks[i], h[start:stop])
+        products = self._map(block_dot)
+        if len(products) == 1:
+            return products[0]
+        return np.sum(products, 0)
+
+    def rdot(self, r):
+        """The product of the transpose of the matrix with `r`"""
+        r = np.asarray(r, dtype=self.dtype)
+        out = np.empty(self.shape[1], dtype=self.dtype)
+
+        def block_rdot(i):
+            start, stop = self.bounds[i]
+            out[start:stop] = spdot(self.blocks[i].T, r)
+        self._map(block_rdot)
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
 def sparse_nnls(y, X,
                 momentum=1,
                 step_size=0.01,
                 non_neg=True,
                 check_error_iter=10,
                 max_error_checks=10,
-                converge_on_sse=0.99):
+                converge_on_sse=0.99,
+                block_size=None,
+                num_threads=1):
     """
 
     Solve y=Xh for h, using gradient descent, with X a sparse matrix
@@ -335,6 +409,15 @@ def sparse_nnls(y, X,
       a percentage improvement in SSE that is required each time to say
       that things are still going well.
 
+    block_size : int (default: None)
+        The products with X and its transpose are computed by blocks of this
+        number of columns of X, which share the buffers of X if it is a csc
+        matrix. None for a single block.
+
+    num_threads : int (default: 1)
+        Number of threads computing the products of the blocks, None for one
+        per CPU.
+
     Returns
     -------
     h_best : The best estimate of the parameters.
@@ -352,45 +435,206 @@ def sparse_nnls(y, X,
     count_bad = 0  # Number of times estimation error has gone up.
     error_checks = 0  # How many error checks have we done so far
 
-    while 1:
-        if iteration > 1:
-            # The sum of squared error given the current parameter setting:
-            sse = np.sum((y - spdot(X, h)) ** 2)
-            # The gradient is (Kay 2008 supplemental page 27):
-            gradient = spdot(X.T, spdot(X, h) - y)
-            gradient += momentum * gradient
-            # Normalize to unit-length
-            unit_length_gradient = (gradient /
-                                    np.sqrt(np.dot(gradient, gradient)))
-            # Update the parameters in the direction of the gradient:
-            h -= step_size * unit_length_gradient
-            if non_neg:
-                # Set negative values to 0:
-                h[h < 0] = 0
-
-        # Every once in a while check whether it's converged:
-        if np.mod(iteration, check_error_iter):
-            # This calculates the sum of squared residuals at this point:
-            sse = np.sum((y - spdot(X, h)) ** 2)
-            # Did we do better this time around?
-            if sse < ss_residuals_min:
-                # Update your expectations about the minimum error:
-                ss_residuals_min = sse
-                h_best = h  # This holds the best params we have so far
-                # Are we generally (over iterations) converging on
-                # sufficient improvement in r-squared?
-                if sse < converge_on_sse * sse_best:
-                    sse_best = sse
-                    count_bad = 0
+    X = _ColumnBlocks(X, block_size, num_threads)
+    # The prediction of the current parameters, computed once per iteration:
+    Xh = X.dot(h)
+    try:
+        while 1:
+            if iteration > 1:
+                # The gradient is (Kay 2008 supplemental page 27):
+                gradient = X.rdot(Xh - y).astype(float)
+                gradient += momentum * gradient
+                # Normalize to unit-length
+                unit_length_gradient = (gradient /
+                                        np.sqrt(np.dot(gradient, gradient)))
+                # Update the parameters in the direction of the gradient:
+                h -= step_size * unit_length_gradient
+                if non_neg:
+                    # Set negative values to 0:
+                    h[h < 0] = 0
+                Xh = X.dot(h)
+
+            # Every once in a while check whether it's converged:
+            if np.mod(iteration, check_error_iter):
+                # This calculates the sum of squared residuals at this point:
+                sse = np.sum((y - Xh) ** 2)
+                # Did we do better this time around?
+                if sse < ss_residuals_min:
+                    # Update your expectations about the minimum error:
+                    ss_residuals_min = sse
+                    h_best = h  # This holds the best params we have so far
+                    # Are we generally (over iterations) converging on
+                    # sufficient improvement in r-squared?
+                    if sse < converge_on_sse * sse_best:
+                        sse_best = sse
+                        count_bad = 0
+                    else:
+                        count_bad += 1
                 else:
                     count_bad += 1
-            else:
-                count_bad += 1
 
-            if count_bad >= max_error_checks:
-                return h_best
-            error_checks += 1
-        iteration += 1
+                if count_bad >= max_error_checks:
+                    return h_best
+                error_checks += 1
+            iteration += 1
+    finally:
+        X.close()
+
+
+def _forward_difference_jacobian(func, x, index, residuals):
+    """Jacobians of `func` by forward differences, for all problems at once
+    """
+    eps = np.sqrt(np.finfo(float).eps)
+    jacobian = np.empty(residuals.shape + (x.shape[-1], ))
+    for j in range(x.shape[-1]):
+        h = eps * np.abs(x[:, j])
+        h[h == 0] = eps
+        x_h = x.copy()
+        x_h[:, j] += h
+        jacobian[..., j] = (func(x_h, index) - residuals) / h[:, None]
+    return jacobian
+
+
+def levenberg_marquardt(func, x0, jac=None, xtol=1.49012e-08,
+                        ftol=1.49012e-08, max_iter=200, damping=1e-3):
+    """Solve many independent non-linear least squares problems at once
+
+    Each iteration of the Levenberg-Marquardt algorithm is done for all the
+    problems that have not converged yet with a few array operations: the
+    damped normal equations of all the problems are solved together by a
+    batched Cholesky factorization. Problems leave the iterations as soon
+    as they converge.
+
+    Parameters
+    ----------
+    func : callable ``func(x, index)``
+        Residuals of the problems `index` (array of int, shape (n, )) at the
+        parameters `x` (array, shape (n, p)), as an array of shape (n, m).
+    x0 : array, shape (N, p)
+        Starting parameters of the N problems.
+    jac : callable ``jac(x, index)``, optional
+        Jacobians of the residuals, array of shape (n, m, p). By default,
+        they are estimated by forward differences.
+    xtol : float, optional
+        Relative error desired in the (scaled) parameters of each problem.
+    ftol : float, optional
+        Relative error desired in the sum of squares of each problem.
+    max_iter : int, optional
+        Maximum number of iterations.
+    damping : float, optional
+        Initial damping of the Gauss-Newton steps, relative to the diagonal
+        of the normal matrices.
+
+    Returns
+    -------
+    x : array, shape (N, p)
+        Parameters minimizing the sum of squared residuals of each problem.
+    converged : array of bool, shape (N, )
+        Whether each problem met the convergence criteria within
+        `max_iter` iterations.
+
+    Notes
+    -----
+    The criteria and the scaling of the parameters by the norms of the
+    columns of the Jacobian follow MINPACK's ``lmder``, used by
+    `scipy.optimize.leastsq` [1]_.
+
+    References
+    ----------
+    .. [1] More, J.J., 1978. The Levenberg-Marquardt algorithm:
+       implementation and theory. Numerical Analysis, Lecture Notes in
+       Mathematics 630, 105-116.
+
+    Examples
+    --------
+    Fit ``y = a * exp(b * t)`` to two sets of data:
+
+    >>> t = np.linspace(0, 1, 10)
+    >>> y = np.array([[2.], [3.]]) * np.exp(np.array([[-1.], [1.]]) * t)
+    >>> def residuals(x, index):
+    ...     return y[index] - x[:, :1] * np.exp(x[:, 1:] * t)
+    >>> x, converged = levenberg_marquardt(residuals, np.ones((2, 2)))
+    >>> np.round(x, 6)
+    array([[ 2., -1.],
+           [ 3.,  1.]])
+    >>> converged
+    array([ True,  True])
+    """
+    x = np.array(x0, dtype=float, ndmin=2)
+    n_problems, n_params = x.shape
+    if jac is None:
+        def jacobian(x, index, residuals):
+            return _forward_difference_jacobian(func, x, index, residuals)
+    else:
+        def jacobian(x, index, residuals):
+            return jac(x, index)
+
+    converged = np.zeros(n_problems, dtype=bool)
+    active = np.arange(n_problems)
+    residuals = func(x, active)
+    cost = (residuals ** 2).sum(-1)
+    J = jacobian(x, active, residuals)
+    lam = np.empty(n_problems)
+    lam.fill(damping)
+    nu = np.empty(n_problems)
+    nu.fill(2.)
+    scale = np.zeros((n_problems, n_params))
+    diag_index = np.arange(n_params)
+    for iteration in range(max_iter):
+        if len(active) == 0:
+            break
+        JtJ = np.einsum('...ji,...jk->...ik', J, J)
+        gradient = np.einsum('...ji,...j->...i', J, residuals)
+        # Parameters are scaled by the largest norms of the columns of the
+        # Jacobian seen so far
+        diag = JtJ[:, diag_index, diag_index]
+        this_scale = np.maximum(scale[active], diag)
+        this_scale = np.maximum(this_scale, np.finfo(float).eps *
+                                this_scale.max(-1)[:, None])
+        scale[active] = this_scale
+        JtJ[:, diag_index, diag_index] += lam[active, None] * this_scale
+        with np.errstate(invalid='ignore', over='ignore'):
+            delta = -cholesky_solve(JtJ, gradient)
+            x_try = x[active] + delta
+            residuals_try = func(x_try, active)
+            cost_try = (residuals_try ** 2).sum(-1)
+            reduction = cost - cost_try
+            predicted = (lam[active] * (this_scale * delta ** 2).sum(-1) -
+                         (delta * gradient).sum(-1))
+            rho = reduction / predicted
+        better = cost_try < cost
+
+        # Convergence criteria
+        step = np.sqrt((this_scale * delta ** 2).sum(-1))
+        size = np.sqrt((this_scale * x_try ** 2).sum(-1))
+        with np.errstate(invalid='ignore'):
+            done = ((step <= xtol * size) |
+                    ((np.abs(reduction) <= ftol * cost) &
+                     (predicted <= ftol * cost) & (rho <= 2)))
+        done |= cost == 0
+        converged[active[done]] = True
+        # Problems that cannot improve anymore are given up
+        done |= ~np.isfinite(delta).all(-1) | (lam[active] > 1e16)
+
+        # Damping update of Nielsen (1999)
+        improved = active[better]
+        x[improved] = x_try[better]
+        lam[improved] *= np.maximum(1. / 3, 1 - (2 * rho[better] - 1) ** 3)
+        nu[improved] = 2
+        lam[active[~better]] *= nu[active[~better]]
+        nu[active[~better]] *= 2
+
+        keep = ~done
+        update = better[keep]
+        active = active[keep]
+        residuals = np.where(better[:, None], residuals_try,
+                             residuals)[keep]
+        cost = np.where(better, cost_try, cost)[keep]
+        J = J[keep]
+        if update.any():
+            J[update] = jacobian(x[active[update]], active[update],
+                                 residuals[update])
+    return x, converged
 
 
 class SKLearnLinearSolver(with_metaclass(abc.ABCMeta, object)):
@@ -2,7 +2,9 @@ import numpy as np
 import scipy.sparse as sps
 
 import numpy.testing as npt
-from dipy.core.optimize import Optimizer, SCIPY_LESS_0_12, sparse_nnls, spdot
+from dipy.core.optimize import (Optimizer, SCIPY_LESS_0_12, sparse_nnls,
+                                spdot, levenberg_marquardt)
+from scipy.optimize import leastsq
 import dipy.core.optimize as opt
 
 
@@ -163,6 +165,55 @@ def test_sparse_nnls():
     # We should be able to get back the right answer for this simple case
     npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
+    # By blocks of columns, in threads, with a float32 matrix:
+    for X_blocks in [X, sps.csc_matrix(X),
+                     sps.csc_matrix(X, dtype=np.float32)]:
+        for num_threads in [1, 2]:
+            beta_hat_blocks = sparse_nnls(y, X_blocks, block_size=3,
+                                          num_threads=num_threads)
+            npt.assert_array_almost_equal(beta_hat, beta_hat_blocks,
+                                          decimal=4)
+
+
+
+def test_levenberg_marquardt():
+    # Fit y = a * exp(b * t) + c to many sets of noisy data
+    rng = np.random.RandomState(2017)
+    t = np.linspace(0, 2, 25)
+    params = np.column_stack((rng.uniform(1, 3, 50), rng.uniform(-2, -0.5, 50),
+                              rng.uniform(-1, 1, 50)))
+
+    def model(x):
+        return x[..., :1] * np.exp(x[..., 1:2] * t) + x[..., 2:]
+
+    y = model(params) + 0.05 * rng.randn(50, len(t))
+
+    def residuals(x, index):
+        return y[index] - model(x)
+
+    def jacobian(x, index):
+        e = np.exp(x[:, 1:2] * t)
+        return -np.concatenate([e[..., None], (x[:, :1] * t * e)[..., None],
+                                np.ones_like(e)[..., None]], axis=-1)
+
+    x0 = np.tile([1., -1., 0.], (50, 1))
+    for jac in [jacobian, None]:
+        x, converged = levenberg_marquardt(residuals, x0, jac)
+        npt.assert_equal(x.shape, (50, 3))
+        npt.assert_(converged.all())
+        for i in range(50):
+            expected = leastsq(lambda p: residuals(p[None], [i])[0], x0[i])[0]
+            npt.assert_array_almost_equal(x[i], expected, decimal=4)
+
+    # Problems that do not converge within max_iter are flagged
+    x, converged = levenberg_marquardt(residuals, x0, jacobian, max_iter=2)
+    npt.assert_(not converged.all())
+
+    # Each problem is solved independently of the others
+    x, converged = levenberg_marquardt(residuals, x0, jacobian)
+    x_half, converged = levenberg_marquardt(
+        lambda x, index: residuals(x, index + 25), x0[25:], jacobian)
+    npt.assert_array_equal(x_half, x[25:])
 
 
 if __name__ == '__main__':
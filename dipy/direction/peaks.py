@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import mmap
 from multiprocessing import cpu_count, Pool
 from itertools import repeat
 from os import path
@@ -16,9 +17,9 @@ from dipy.reconst.recspeed import (local_maxima, remove_similar_vertices,
                                    search_descending)
 from dipy.core.sphere import HemiSphere, Sphere
 from dipy.data import default_sphere
-from dipy.core.ndindex import ndindex
 from dipy.reconst.shm import sh_to_sf_matrix
 from dipy.reconst.peak_direction_getter import PeaksAndMetricsDirectionGetter
+from dipy.utils.parallel import fork_context
 
 
 def peak_directions_nl(sphere_eval, relative_peak_threshold=.25,
@@ -332,11 +333,192 @@ def _peaks_from_model_parallel_sub(args):
                             parallel=False, nbr_processes=None)
 
 
+# Arguments of the zero-copy workers, set before the pool forks so that the
+# workers inherit them instead of receiving pickled copies
+_shared_args = {}
+
+
+def _shared_empty(shape, dtype, memmap_dir=None, name=None):
+    """Uninitialized array in memory shared with forked processes
+
+    The array is backed by an anonymous shared memory map, or by an .npy
+    file memory map in `memmap_dir` if given.
+    """
+    if memmap_dir is not None:
+        return np.lib.format.open_memmap(path.join(memmap_dir, name + '.npy'),
+                                         mode='w+', dtype=dtype, shape=shape)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buf, dtype, count).reshape(shape)
+
+
+def _peaks_arrays(n, npeaks, sphere, return_sh, sh_order, return_odf,
+                  empty=None):
+    """Allocate the outputs of peaks_from_model for `n` voxels
+
+    `empty` is called as ``empty(shape, dtype, name)`` and returns an
+    uninitialized array, ``np.empty`` is used by default.
+    """
+    if empty is None:
+        def empty(shape, dtype, name):
+            return np.empty(shape, dtype)
+    out = {'gfa': empty((n,), np.float64, 'gfa'),
+           'qa': empty((n, npeaks), np.float64, 'qa'),
+           'peak_dirs': empty((n, npeaks, 3), np.float64, 'peak_dirs'),
+           'peak_values': empty((n, npeaks), np.float64, 'peak_values'),
+           'peak_indices': empty((n, npeaks), np.int_, 'peak_indices')}
+    if return_sh:
+        n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
+        out['shm_coeff'] = empty((n, n_shm_coeff), np.float64, 'shm_coeff')
+    if return_odf:
+        out['odf'] = empty((n, len(sphere.vertices)), np.float64, 'odf')
+    for name, arr in out.items():
+        arr.fill(-1 if name == 'peak_indices' else 0)
+    return out
+
+
+def _peaks_from_voxels(model, data, mask, sphere, relative_peak_threshold,
+                       min_separation_angle, gfa_thr, normalize_peaks, npeaks,
+                       invB, out):
+    """Fit the model and find the peaks of each voxel in a 2D array
+
+    The results are written in place in the arrays of the dict `out`, which
+    have the voxels of `data` along their first axis. The qa is not
+    normalized, the maximum odf value found is returned to do so.
+    """
+    global_max = -np.inf
+    for idx in range(data.shape[0]):
+        if mask is not None and not mask[idx]:
+            continue
+
+        odf = model.fit(data[idx]).odf(sphere)
+
+        if 'shm_coeff' in out:
+            out['shm_coeff'][idx] = np.dot(odf, invB)
+
+        if 'odf' in out:
+            out['odf'][idx] = odf
+
+        out['gfa'][idx] = gfa(odf)
+        if out['gfa'][idx] < gfa_thr:
+            global_max = max(global_max, odf.max())
+            continue
+
+        # Get peaks of odf
+        direction, pk, ind = peak_directions(odf, sphere,
+                                             relative_peak_threshold,
+                                             min_separation_angle)
+
+        # Calculate peak metrics
+        if pk.shape[0] != 0:
+            global_max = max(global_max, pk[0])
+
+            n = min(npeaks, pk.shape[0])
+            out['qa'][idx][:n] = pk[:n] - odf.min()
+
+            out['peak_dirs'][idx][:n] = direction[:n]
+            out['peak_indices'][idx][:n] = ind[:n]
+            out['peak_values'][idx][:n] = pk[:n]
+
+            if normalize_peaks:
+                out['peak_values'][idx][:n] /= pk[0]
+                out['peak_dirs'][idx] *= out['peak_values'][idx][:, None]
+    return global_max
+
+
+def _peaks_and_metrics(out, shape, sphere, B):
+    """PeaksAndMetrics holding the arrays of `out` reshaped to the volume"""
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    npeaks = out['qa'].shape[-1]
+    pam.peak_dirs = out['peak_dirs'].reshape(shape + (npeaks, 3))
+    pam.peak_values = out['peak_values'].reshape(shape + (npeaks,))
+    pam.peak_indices = out['peak_indices'].reshape(shape + (npeaks,))
+    pam.gfa = out['gfa'].reshape(shape)
+    pam.qa = out['qa'].reshape(shape + (npeaks,))
+    if 'shm_coeff' in out:
+        pam.shm_coeff = out['shm_coeff'].reshape(
+            shape + out['shm_coeff'].shape[-1:])
+        pam.B = B
+    else:
+        pam.shm_coeff = None
+        pam.B = None
+    if 'odf' in out:
+        pam.odf = out['odf'].reshape(shape + out['odf'].shape[-1:])
+    else:
+        pam.odf = None
+    return pam
+
+
+def _peaks_from_model_shared_sub(args):
+    key, (start_pos, end_pos) = args
+    (model, data, mask, sphere, relative_peak_threshold, min_separation_angle,
+     gfa_thr, normalize_peaks, npeaks, invB, out) = _shared_args[key]
+    if mask is not None:
+        mask = mask[start_pos:end_pos]
+    chunk_out = dict((name, arr[start_pos:end_pos])
+                     for name, arr in out.items())
+    return _peaks_from_voxels(model, data[start_pos:end_pos], mask, sphere,
+                              relative_peak_threshold, min_separation_angle,
+                              gfa_thr, normalize_peaks, npeaks, invB,
+                              chunk_out)
+
+
+def _peaks_from_model_shared(model, data, sphere, relative_peak_threshold,
+                             min_separation_angle, mask, return_odf,
+                             return_sh, gfa_thr, normalize_peaks, sh_order,
+                             npeaks, B, invB, nbr_processes, memmap_dir):
+    """Zero-copy version of _peaks_from_model_parallel
+
+    The input and output arrays are shared with forked workers, which write
+    their chunk of the outputs in place.
+    """
+    shape = data.shape[:-1]
+    if mask is not None and mask.shape != shape:
+        raise ValueError("Mask is not the same shape as data.")
+    # Views as long as data is contiguous, which memory maps usually are
+    data = np.reshape(data, (-1, data.shape[-1]))
+    if mask is not None:
+        mask = np.reshape(mask, -1)
+    n = data.shape[0]
+
+    def empty(shape, dtype, name):
+        return _shared_empty(shape, dtype, memmap_dir, name)
+    out = _peaks_arrays(n, npeaks, sphere, return_sh, sh_order, return_odf,
+                        empty)
+    if n == 0:
+        return _peaks_and_metrics(out, shape, sphere, B)
+
+    nbr_chunks = nbr_processes ** 2
+    chunk_size = int(np.ceil(n / nbr_chunks))
+    indices = list(zip(np.arange(0, n, chunk_size),
+                       np.arange(0, n, chunk_size) + chunk_size))
+
+    key = id(out)
+    _shared_args[key] = (model, data, mask, sphere, relative_peak_threshold,
+                         min_separation_angle, gfa_thr, normalize_peaks,
+                         npeaks, invB, out)
+    try:
+        pool = fork_context().Pool(nbr_processes)
+        try:
+            global_max = max(pool.map(_peaks_from_model_shared_sub,
+                                      zip(repeat(key), indices)))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        del _shared_args[key]
+
+    out['qa'] /= global_max
+    return _peaks_and_metrics(out, shape, sphere, B)
+
+
 def peaks_from_model(model, data, sphere, relative_peak_threshold,
                      min_separation_angle, mask=None, return_odf=False,
                      return_sh=True, gfa_thr=0, normalize_peaks=False,
                      sh_order=8, sh_basis_type=None, npeaks=5, B=None,
-                     invB=None, parallel=False, nbr_processes=None):
+                     invB=None, parallel=False, nbr_processes=None,
+                     zero_copy=False, memmap_dir=None):
     """Fits the model to data and computes peaks and metrics
 
     Parameters
@@ -386,6 +568,20 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
     nbr_processes: int
         If `parallel` is True, the number of subprocesses to use
         (default multiprocessing.cpu_count()).
+    zero_copy : bool
+        If True and `parallel` is True, the subprocesses are forked and share
+        the data and the output arrays with this process, instead of reading
+        the data from a temporary file and sending back their results. Each
+        subprocess writes its part of the outputs in place, and the qa is
+        normalized over the whole volume as in the serial case. Passing the
+        data as a memory map (``np.load(..., mmap_mode='r')``) avoids
+        loading it at all. Falls back to the temporary files where
+        processes cannot be forked (default False).
+    memmap_dir : str, optional
+        With `zero_copy`, directory in which the output arrays are created
+        as .npy memory maps (``gfa.npy``, ``peak_dirs.npy``, ...), so that
+        they do not have to fit in memory. By default they are held in
+        anonymous shared memory.
 
     Returns
     -------
@@ -403,6 +599,18 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         # Otherwise, a call to np.linalg.pinv is made in a subprocess and
         # makes it timeout on some system.
         # see https://github.com/nipy/dipy/issues/253 for details
+        if zero_copy:
+            if nbr_processes is None:
+                nbr_processes = cpu_count()
+            if nbr_processes > 0 and fork_context() is not None:
+                return _peaks_from_model_shared(model, data, sphere,
+                                                relative_peak_threshold,
+                                                min_separation_angle, mask,
+                                                return_odf, return_sh,
+                                                gfa_thr, normalize_peaks,
+                                                sh_order, npeaks, B, invB,
+                                                nbr_processes, memmap_dir)
+            warn("Processes cannot be forked, zero_copy is ignored.")
         return _peaks_from_model_parallel(model,
                                           data, sphere,
                                           relative_peak_threshold,
@@ -425,82 +633,15 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         if mask.shape != shape:
             raise ValueError("Mask is not the same shape as data.")
 
-    gfa_array = np.zeros(shape)
-    qa_array = np.zeros((shape + (npeaks,)))
-
-    peak_dirs = np.zeros((shape + (npeaks, 3)))
-    peak_values = np.zeros((shape + (npeaks,)))
-    peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
-    peak_indices.fill(-1)
-
-    if return_sh:
-        n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-        shm_coeff = np.zeros((shape + (n_shm_coeff,)))
-
-    if return_odf:
-        odf_array = np.zeros((shape + (len(sphere.vertices),)))
-
-    global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-
-        odf = model.fit(data[idx]).odf(sphere)
-
-        if return_sh:
-            shm_coeff[idx] = np.dot(odf, invB)
-
-        if return_odf:
-            odf_array[idx] = odf
-
-        gfa_array[idx] = gfa(odf)
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf.max())
-            continue
-
-        # Get peaks of odf
-        direction, pk, ind = peak_directions(odf, sphere,
-                                             relative_peak_threshold,
-                                             min_separation_angle)
-
-        # Calculate peak metrics
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
-
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf.min()
-
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
-
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
-
-    qa_array /= global_max
-
-    pam = PeaksAndMetrics()
-    pam.sphere = sphere
-    pam.peak_dirs = peak_dirs
-    pam.peak_values = peak_values
-    pam.peak_indices = peak_indices
-    pam.gfa = gfa_array
-    pam.qa = qa_array
-
-    if return_sh:
-        pam.shm_coeff = shm_coeff
-        pam.B = B
-    else:
-        pam.shm_coeff = None
-        pam.B = None
-
-    if return_odf:
-        pam.odf = odf_array
-    else:
-        pam.odf = None
-
-    return pam
+    out = _peaks_arrays(int(np.prod(shape)), npeaks, sphere, return_sh,
+                        sh_order, return_odf)
+    data = np.reshape(data, (-1, data.shape[-1]))
+    global_max = _peaks_from_voxels(model, data, mask.reshape(-1), sphere,
+                                    relative_peak_threshold,
+                                    min_separation_angle, gfa_thr,
+                                    normalize_peaks, npeaks, invB, out)
+    out['qa'] /= global_max
+    return _peaks_and_metrics(out, shape, sphere, B)
 
 
 def gfa(samples):
@@ -15,6 +15,9 @@ from dipy.data import get_data, get_sphere
 from dipy.core.gradients import gradient_table, GradientTable
 from dipy.core.sphere_stats import angular_similarity
 from dipy.core.sphere import HemiSphere
+from dipy.reconst.shm import CsaOdfModel
+from nibabel.tmpdirs import InTemporaryDirectory
+import os
 
 
 def test_peak_directions_nl():
@@ -552,6 +555,59 @@ def test_peaksFromModelParallel():
         assert_array_almost_equal(pam.odf, pam_single.odf)
 
 
+def test_peaksFromModelZeroCopy():
+    _, fbvals, fbvecs = get_data('small_64D')
+    gtab = gradient_table(np.load(fbvals), np.load(fbvecs))
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    np.random.seed(1)
+    data = np.empty((3, 4, 2, len(gtab.bvals)))
+    for ijk in np.ndindex(*data.shape[:-1]):
+        angles = [(0, 0), (np.random.uniform(30, 90), 0)]
+        data[ijk], _ = multi_tensor(gtab, mevals, 100, angles=angles,
+                                    fractions=[50, 50], snr=50)
+    mask = np.random.rand(*data.shape[:-1]) > 0.2
+    model = CsaOdfModel(gtab, 4)
+
+    pam_single = peaks_from_model(model, data, _sphere, .5, 45, mask,
+                                  return_odf=True, return_sh=True)
+    pam_shared = peaks_from_model(model, data, _sphere, .5, 45, mask,
+                                  return_odf=True, return_sh=True,
+                                  parallel=True, nbr_processes=2,
+                                  zero_copy=True)
+    with InTemporaryDirectory() as tmpdir:
+        pam_memmap = peaks_from_model(model, data, _sphere, .5, 45, mask,
+                                      return_odf=True, return_sh=True,
+                                      parallel=True, nbr_processes=3,
+                                      zero_copy=True, memmap_dir=tmpdir)
+        assert_array_equal(np.load(os.path.join(tmpdir, 'gfa.npy')).reshape(
+            mask.shape), pam_memmap.gfa)
+        pams = [pam_shared, pam_memmap]
+        for pam in pams:
+            for name in ['gfa', 'qa', 'peak_values', 'peak_indices',
+                         'peak_dirs', 'shm_coeff', 'odf']:
+                arr = getattr(pam, name)
+                arr_single = getattr(pam_single, name)
+                assert_equal(arr.dtype, arr_single.dtype)
+                assert_equal(arr.shape, arr_single.shape)
+                assert_array_almost_equal(arr, arr_single)
+        del pams, pam_memmap
+
+    # No voxel in the mask, or no voxel at all
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    for data, mask in [(data, mask), (data[:0], mask[:0])]:
+        pam_single = peaks_from_model(model, data, _sphere, .5, 45, mask)
+        pam_shared = peaks_from_model(model, data, _sphere, .5, 45, mask,
+                                      parallel=True, nbr_processes=2,
+                                      zero_copy=True)
+        for name in ['gfa', 'qa', 'peak_values', 'peak_indices',
+                     'peak_dirs']:
+            arr = getattr(pam_shared, name)
+            arr_single = getattr(pam_single, name)
+            assert_equal(arr.shape, arr_single.shape)
+            assert_array_equal(arr, arr_single)
+
+
 def test_peaks_shm_coeff():
 
     SNR = 100
@@ -82,7 +82,7 @@ under the GPL license.
 NUMPY_MIN_VERSION='1.7.1'
 SCIPY_MIN_VERSION='0.9'
 CYTHON_MIN_VERSION='0.18'
-NIBABEL_MIN_VERSION='1.2.0'
+NIBABEL_MIN_VERSION='2.0.0'
 
 # Main setup parameters
 NAME                = 'dipy'
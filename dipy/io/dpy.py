@@ -10,6 +10,8 @@
 
 import numpy as np
 
+from dipy.tracking.arraysequence import ArraySequence
+
 # Conditional import machinery for pytables
 from dipy.utils.optpkg import optional_package
 
@@ -17,12 +19,12 @@ from dipy.utils.optpkg import optional_package
 tables, have_tables, setup_module = optional_package('tables')
 
 # Make sure not to carry across setup module from * import
-__all__ = ['Dpy']
+__all__ = ['Dpy', 'DpyTracks']
 
 
 class Dpy(object):
 
-    def __init__(self, fname, mode='r', compression=0):
+    def __init__(self, fname, mode='r', compression=0, chunk_size=None):
         ''' Advanced storage system for tractography based on HDF5
 
         Parameters
@@ -33,6 +35,11 @@ class Dpy(object):
          'r+' read and write only if file already exists
          'a'  read and write even if file doesn't exist (not used yet)
         compression : 0 no compression to 9 maximum compression
+        chunk_size : int, optional
+            Number of points per HDF5 chunk of the tracks, when writing.
+            Small chunks speed up the random access to a few tracks, large
+            ones the reading of whole tractographies. By default PyTables
+            chooses it from the expected number of points.
 
         Examples
         ----------
@@ -53,6 +60,9 @@ class Dpy(object):
         >>> A=dpr.read_track()
         >>> B=dpr.read_track()
         >>> T=dpr.read_tracksi([0,1,2,0,0,2])
+        >>> tracks = dpr.lazy_tracks()
+        >>> len(tracks), tracks[2][0, 0]
+        (3, 3.0)
         >>> dpr.close()
         >>> os.remove(fname) #delete file from disk
 
@@ -62,8 +72,10 @@ class Dpy(object):
         self.f = tables.openFile(fname, mode=self.mode)
         self.N = 5 * 10**9
         self.compression = compression
+        self._all_offsets = None
 
         if self.mode == 'w':
+            chunkshape = None if chunk_size is None else (chunk_size, 3)
             self.streamlines = self.f.createGroup(self.f.root, 'streamlines')
             # create a version number
             self.version = self.f.createArray(self.f.root, 'version',
@@ -75,7 +87,8 @@ class Dpy(object):
                                               (0, 3),
                                               "scalar Float32 earray",
                                               tables.Filters(self.compression),
-                                              expectedrows=self.N)
+                                              expectedrows=self.N,
+                                              chunkshape=chunkshape)
             self.offsets = self.f.createEArray(self.f.root.streamlines,
                                                'offsets',
                                                tables.Int64Atom(), (0,),
@@ -103,13 +116,45 @@ class Dpy(object):
         self.curr_pos += track.shape[0]
         self.offsets.append(np.array([self.curr_pos]).astype(np.int64))
 
-    def write_tracks(self, T):
+    def write_tracks(self, T, batch_size=10000):
         ''' write many tracks together
+
+        Parameters
+        ----------
+        T : sequence of arrays of shape (N, 3) or ArraySequence
+            Tracks to append to the file.
+        batch_size : int, optional
+            Number of tracks appended to the file with a single write. The
+            tracks of an `ArraySequence` are written straight from its
+            buffer.
         '''
+        if isinstance(T, ArraySequence):
+            if len(T) == 0:
+                return
+            if T.dtype != np.float32 or not T.is_compact():
+                T = T.astype(np.float32)
+            self._append(T.data, T.lengths)
+            return
+        batch = []
         for track in T:
-            self.tracks.append(track.astype(np.float32))
-            self.curr_pos += track.shape[0]
-            self.offsets.append(np.array([self.curr_pos]).astype(np.int64))
+            batch.append(track)
+            if len(batch) == batch_size:
+                self._append_batch(batch)
+                batch = []
+        if batch:
+            self._append_batch(batch)
+
+    def _append_batch(self, batch):
+        self._append(np.concatenate(batch).astype(np.float32),
+                     [track.shape[0] for track in batch])
+
+    def _append(self, points, lengths):
+        ''' append packed tracks with one write per array
+        '''
+        self.tracks.append(points)
+        ends = self.curr_pos + np.cumsum(lengths, dtype=np.int64)
+        self.offsets.append(ends)
+        self.curr_pos = int(ends[-1])
 
     def read_track(self):
         ''' read one track each time
@@ -118,30 +163,110 @@ class Dpy(object):
         self.offs_pos += 1
         return self.tracks[off0:off1]
 
+    def _offsets(self):
+        ''' offsets of all the tracks, read once and kept in memory
+        '''
+        if self._all_offsets is None:
+            self._all_offsets = self.offsets[:]
+        return self._all_offsets
+
     def read_tracksi(self, indices):
         ''' read tracks with specific indices
+
+        The tracks are read in the order of the file and the tracks which
+        follow each other in the file are read together, with one HDF5 read
+        per contiguous run of tracks.
+
+        Parameters
+        ----------
+        indices : sequence of int
+            Indices of the tracks, in any order, possibly repeated.
+
+        Returns
+        -------
+        T : list of arrays
+            The tracks, in the order of `indices`.
         '''
-        T = []
-        for i in indices:
-            # print(self.offsets[i:i+2])
-            off0, off1 = self.offsets[i:i + 2]
-            T.append(self.tracks[off0:off1])
-        return T
+        indices = np.asarray(indices, dtype=np.intp).ravel()
+        if len(indices) == 0:
+            return []
+        offsets = self._offsets()
+        indices[indices < 0] += len(offsets) - 1
+        if indices.min() < 0 or indices.max() >= len(offsets) - 1:
+            raise IndexError('track index out of range')
+        unique = np.unique(indices)
+        # Runs of consecutive indices are contiguous in the file
+        breaks = np.flatnonzero(np.diff(unique) != 1) + 1
+        run_starts = np.concatenate([[0], breaks])
+        run_ends = np.concatenate([breaks, [len(unique)]])
+        tracks = {}
+        for r0, r1 in zip(run_starts, run_ends):
+            first, last = unique[r0], unique[r1 - 1]
+            base = offsets[first]
+            points = self.tracks[base:offsets[last + 1]]
+            for i in unique[r0:r1]:
+                tracks[i] = points[offsets[i] - base:offsets[i + 1] - base]
+        return [tracks[i] for i in indices]
 
     def read_tracks(self):
         ''' read the entire tractography
         '''
-        I = self.offsets[:]
+        I = self._offsets()
         TR = self.tracks[:]
-        T = []
-        for i in range(len(I) - 1):
-            off0, off1 = I[i:i + 2]
-            T.append(TR[off0:off1])
-        return T
+        return [TR[I[i]:I[i + 1]] for i in range(len(I) - 1)]
+
+    def lazy_tracks(self):
+        ''' view of the tractography reading the tracks only when accessed
+
+        Returns
+        -------
+        tracks : DpyTracks
+            Sequence of the tracks of the file, valid until it is closed.
+        '''
+        return DpyTracks(self)
 
     def close(self):
         self.f.close()
 
 
+class DpyTracks(object):
+    ''' Sequence of the tracks of a Dpy file, read on demand
+
+    Only the offsets of the tracks are kept in memory. Indexing with an
+    integer reads one track, indexing with a slice or an array of indices
+    reads the selected tracks with `Dpy.read_tracksi`, so that a random
+    subset of a large tractography can be loaded without reading the rest.
+
+    Parameters
+    ----------
+    dpy : Dpy
+        File opened for reading.
+    batch_size : int, optional
+        Number of tracks read together when iterating.
+    '''
+    def __init__(self, dpy, batch_size=10000):
+        self.dpy = dpy
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.dpy._offsets()) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.dpy.read_tracksi(np.arange(len(self))[index])
+        if np.ndim(index) == 0:
+            return self.dpy.read_tracksi([index])[0]
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        return self.dpy.read_tracksi(index)
+
+    def __iter__(self):
+        for start in range(0, len(self), self.batch_size):
+            stop = min(start + self.batch_size, len(self))
+            for track in self.dpy.read_tracksi(np.arange(start, stop)):
+                yield track
+
+
 if __name__ == '__main__':
     pass
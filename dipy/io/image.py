@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import numpy as np
 import nibabel as nib
 
 
@@ -21,3 +22,75 @@ def load_nifti(fname, return_img=False, return_voxsize=False):
 def save_nifti(fname, data, affine, hdr=None):
     result_img = nib.Nifti1Image(data, affine, header=hdr)
     result_img.to_filename(fname)
+
+
+def iter_nifti_slabs(img, nb_slices):
+    """ Read an image by slabs of consecutive slices along its third axis
+
+    Only the slab being read is held in memory: it is read through the array
+    proxy of the image, which reads the part of the file holding the slab.
+
+    Parameters
+    ----------
+    img : str or nibabel image
+        The image, or its file name, of at least 3 dimensions.
+    nb_slices : int
+        Number of slices of the slabs. The last slab may be thinner.
+
+    Returns
+    -------
+    slabs : generator of (slice, ndarray)
+        The slice of the third axis covered by each slab and the data of the
+        slab.
+
+    Notes
+    -----
+    The slabs are read with the array proxy of the image, available from
+    nibabel 2.0. Slabs are read quickly from uncompressed files. Reading
+    them from a compressed (.nii.gz) file decompresses the file up to the
+    slab.
+    """
+    if not hasattr(img, 'dataobj'):
+        img = nib.load(img)
+    nb_slices = max(int(nb_slices), 1)
+    for start in range(0, img.shape[2], nb_slices):
+        slab = slice(start, min(start + nb_slices, img.shape[2]))
+        yield slab, np.asanyarray(img.dataobj[:, :, slab])
+
+
+def nifti_memmap(fname, shape, dtype, affine):
+    """ Create an uncompressed NIfTI file and map its data to memory
+
+    The volume can then be written piece by piece, for instance slab by slab,
+    without being held in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the file, ending with '.nii'.
+    shape : tuple
+        Shape of the volume.
+    dtype : dtype
+        Data type of the volume.
+    affine : array (4, 4)
+        Affine of the volume.
+
+    Returns
+    -------
+    data : np.memmap
+        The volume, filled with zeros.
+    """
+    dtype = np.dtype(dtype)
+    img = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype), affine)
+    img.update_header()
+    hdr = img.header
+    hdr.set_data_shape(shape)
+    with open(fname, 'wb') as f:
+        # Writing the header sets its data offset, after any extension
+        hdr.write_to(f)
+        offset = hdr.get_data_offset()
+        # Extend the file to its full size, the data is filled with zeros
+        f.seek(offset + int(np.prod(shape)) * dtype.itemsize - 1)
+        f.write(b'\x00')
+    return np.memmap(fname, dtype=hdr.get_data_dtype(), mode='r+',
+                     offset=offset, shape=tuple(shape), order='F')
@@ -0,0 +1,226 @@
+""" Streaming writers for tractography files
+
+The writers consume streamlines one at a time, for instance straight from
+a `LocalTracking` generator, and keep at most `chunk_size` of them in
+memory: each full chunk is moved to the space of the file with a single
+matrix product and written with a single call.
+
+>>> from nibabel.tmpdirs import InTemporaryDirectory
+>>> streamlines = [np.array([[0, 0, 0], [1, 1, 1.]]), np.ones((3, 3))]
+>>> with InTemporaryDirectory():
+...     with TckWriter('tracks.tck', chunk_size=1) as writer:
+...         nb_streamlines = writer.write_streamlines(streamlines)
+...     print(nb_streamlines, writer.nb_points)
+2 5
+"""
+from __future__ import division, print_function, absolute_import
+
+import time
+
+import numpy as np
+import nibabel as nib
+
+from dipy.tracking.arraysequence import ArraySequence
+
+
+class StreamlineWriter(object):
+    """ Base class of the chunked streamline writers
+
+    Parameters
+    ----------
+    filename : str
+        File to create.
+    affine : array (4, 4), optional
+        Transformation applied to the points before they are written.
+        Identity by default.
+    chunk_size : int, optional
+        Number of streamlines buffered between two writes to the file.
+
+    Notes
+    -----
+    Sub classes implement `_write_header`, `_write_chunk` and
+    `_write_footer`. The header is written again when the writer is closed,
+    once the number of streamlines is known.
+    """
+    def __init__(self, filename, affine=None, chunk_size=10000):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.filename = filename
+        self.affine = np.eye(4) if affine is None else np.asarray(affine)
+        self.chunk_size = chunk_size
+        self.nb_streamlines = 0
+        self.nb_points = 0
+        self._buffer = ArraySequence()
+        self._file = open(filename, 'wb')
+        self._start = time.time()
+        self._end = None
+        self._write_header()
+
+    @property
+    def elapsed(self):
+        """ Time spent since the file was opened, until it was closed """
+        end = time.time() if self._end is None else self._end
+        return end - self._start
+
+    @property
+    def throughput(self):
+        """ Number of streamlines written per second """
+        elapsed = self.elapsed
+        return self.nb_streamlines / elapsed if elapsed > 0 else 0.
+
+    def write(self, streamline):
+        """ Add one streamline, of shape (N, 3), to the file """
+        self._buffer.append(streamline)
+        self.nb_streamlines += 1
+        self.nb_points += len(streamline)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def write_streamlines(self, streamlines):
+        """ Add all the streamlines of an iterable to the file
+
+        Parameters
+        ----------
+        streamlines : iterable of arrays of shape (N, 3)
+            The streamlines, a `LocalTracking` object for instance. They are
+            consumed one chunk at a time.
+
+        Returns
+        -------
+        nb_streamlines : int
+            Number of streamlines added to the file so far.
+        """
+        for streamline in streamlines:
+            self.write(streamline)
+        return self.nb_streamlines
+
+    def flush(self):
+        """ Write the buffered streamlines to the file """
+        if len(self._buffer) == 0:
+            return
+        lin_T = self.affine[:3, :3].T
+        offset = self.affine[:3, 3]
+        points = (np.dot(self._buffer.data, lin_T) + offset).astype('<f4')
+        self._write_chunk(points, self._buffer.lengths)
+        self._buffer = ArraySequence()
+
+    def close(self):
+        """ Flush the buffer and complete the header of the file """
+        if self._file.closed:
+            return
+        self.flush()
+        self._write_footer()
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+        self._end = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_header(self):
+        raise NotImplementedError("To be implemented in sub classes")
+
+    def _write_chunk(self, points, lengths):
+        raise NotImplementedError("To be implemented in sub classes")
+
+    def _write_footer(self):
+        pass
+
+
+class TrkWriter(StreamlineWriter):
+    """ Write streamlines to a TrackVis file, chunk by chunk
+
+    Parameters
+    ----------
+    filename : str
+        File to create.
+    vox_to_ras : array (4, 4)
+        Affine of the reference image. The streamlines are expected in the
+        world space of this affine, like for `save_trk`.
+    shape : tuple of 3 ints
+        Shape of the reference image.
+    chunk_size : int, optional
+        Number of streamlines buffered between two writes to the file.
+    """
+    def __init__(self, filename, vox_to_ras, shape, chunk_size=10000):
+        vox_to_ras = np.asarray(vox_to_ras, dtype=float)
+        self.zooms = np.sqrt((vox_to_ras * vox_to_ras).sum(0))
+        vox_to_trk = np.diag(self.zooms)
+        vox_to_trk[3, 3] = 1
+        vox_to_trk[:3, 3] = self.zooms[:3] / 2.
+        self.vox_to_ras = vox_to_ras
+        self.shape = shape
+        affine = np.dot(vox_to_trk, np.linalg.inv(vox_to_ras))
+        StreamlineWriter.__init__(self, filename, affine, chunk_size)
+
+    def _write_header(self):
+        hdr = nib.trackvis.empty_header()
+        hdr['dim'] = self.shape
+        hdr['voxel_order'] = "".join(nib.orientations.aff2axcodes(
+            self.vox_to_ras))
+        hdr['voxel_size'] = self.zooms[:3]
+        hdr['vox_to_ras'] = self.vox_to_ras
+        hdr['n_count'] = self.nb_streamlines
+        self._file.write(hdr.tostring())
+
+    def _write_chunk(self, points, lengths):
+        # Each record is the number of points followed by their coordinates
+        nb_streamlines = len(lengths)
+        record = np.empty(nb_streamlines + points.size, dtype='<f4')
+        starts = np.zeros(nb_streamlines, dtype=np.intp)
+        np.cumsum(3 * lengths[:-1] + 1, out=starts[1:])
+        record.view('<i4')[starts] = lengths
+        first = np.repeat(starts + 1 - 3 * (np.cumsum(lengths) - lengths),
+                          lengths)
+        index = first + 3 * np.arange(len(points))
+        record[index[:, None] + np.arange(3)] = points
+        self._file.write(record.tostring())
+
+
+class TckWriter(StreamlineWriter):
+    """ Write streamlines to a MRtrix tracks file, chunk by chunk
+
+    Parameters
+    ----------
+    filename : str
+        File to create.
+    affine : array (4, 4), optional
+        Transformation from the space of the streamlines to the world space
+        of the file, for instance a voxel to world affine. Identity by
+        default.
+    chunk_size : int, optional
+        Number of streamlines buffered between two writes to the file.
+    """
+    header_template = ("mrtrix tracks\ncount: %010d\ndatatype: Float32LE\n"
+                       "file: . %d\nEND\n")
+
+    def _write_header(self):
+        # The count has a fixed width so that the header can be rewritten
+        # with the final count without moving the points.
+        size = len(self.header_template % (0, 0)) - 1
+        digits = 1
+        while len(str(size + digits)) > digits:
+            digits += 1
+        size += digits
+        header = self.header_template % (self.nb_streamlines, size)
+        self._file.write(header.encode('ascii'))
+
+    def _write_chunk(self, points, lengths):
+        # Streamlines are separated by a point of NaNs
+        nb_streamlines = len(lengths)
+        record = np.empty((len(points) + nb_streamlines, 3), dtype='<f4')
+        ends = np.cumsum(lengths)
+        record[ends + np.arange(nb_streamlines)] = np.nan
+        index = np.arange(len(points)) + np.repeat(np.arange(nb_streamlines),
+                                                   lengths)
+        record[index] = points
+        self._file.write(record.tostring())
+
+    def _write_footer(self):
+        footer = np.empty(3, dtype='<f4')
+        footer.fill(np.inf)
+        self._file.write(footer.tostring())
@@ -4,6 +4,7 @@ import numpy as np
 from nibabel.tmpdirs import InTemporaryDirectory
 
 from dipy.io.dpy import Dpy, have_tables
+from dipy.tracking.arraysequence import ArraySequence
 
 
 from nose.tools import assert_true, assert_false, \
@@ -38,3 +39,36 @@ def test_dpy():
         dpr.close()
         assert_array_equal(A, T[0])
         assert_array_equal(C, T[5])
+
+
+@iftables
+def test_dpy_bulk():
+    rng = np.random.RandomState(42)
+    tracks = [rng.rand(rng.randint(1, 10), 3).astype('f4')
+              for i in range(50)]
+    with InTemporaryDirectory():
+        dpw = Dpy('test.dpy', 'w', chunk_size=16)
+        dpw.write_tracks(tracks[:30], batch_size=7)
+        dpw.write_tracks(ArraySequence(tracks[30:])[::-1])
+        dpw.close()
+        expected = tracks[:30] + tracks[30:][::-1]
+
+        dpr = Dpy('test.dpy', 'r')
+        for T, E in zip(dpr.read_tracks(), expected):
+            assert_array_equal(T, E)
+        indices = [10, 3, 4, 5, 49, 3, -1]
+        for T, i in zip(dpr.read_tracksi(indices), indices):
+            assert_array_equal(T, expected[i])
+        assert_equal(dpr.read_tracksi([]), [])
+        assert_raises(IndexError, dpr.read_tracksi, [50])
+
+        lazy = dpr.lazy_tracks()
+        assert_equal(len(lazy), 50)
+        assert_array_equal(lazy[7], expected[7])
+        for T, E in zip(lazy[::7], expected[::7]):
+            assert_array_equal(T, E)
+        mask = np.zeros(50, dtype=bool)
+        mask[[1, 20]] = True
+        assert_equal(len(lazy[mask]), 2)
+        assert_equal(len(list(lazy)), 50)
+        dpr.close()
@@ -0,0 +1,36 @@
+""" Testing the reading and writing of images """
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import nibabel as nib
+from nibabel.tmpdirs import InTemporaryDirectory
+from numpy.testing import assert_array_equal, assert_equal, run_module_suite
+
+from dipy.io.image import iter_nifti_slabs, nifti_memmap
+
+
+def test_nifti_slabs():
+    data = np.random.rand(4, 5, 7, 3).astype(np.float32)
+    affine = np.diag([2., 3, 4, 1])
+    with InTemporaryDirectory():
+        volume = nifti_memmap('volume.nii', data.shape, np.float32, affine)
+        assert_array_equal(volume, 0)
+        volume[:, :, 2:5] = data[:, :, 2:5]
+        volume.flush()
+        del volume
+        img = nib.load('volume.nii')
+        assert_array_equal(img.affine, affine)
+        expected = np.zeros_like(data)
+        expected[:, :, 2:5] = data[:, :, 2:5]
+        assert_array_equal(img.get_data(), expected)
+
+        slabs = list(iter_nifti_slabs('volume.nii', 3))
+        assert_equal([slab for slab, _ in slabs],
+                     [slice(0, 3), slice(3, 6), slice(6, 7)])
+        assert_array_equal(np.concatenate([d for _, d in slabs], axis=2),
+                           expected)
+        del img, slabs
+
+
+if __name__ == '__main__':
+    run_module_suite()
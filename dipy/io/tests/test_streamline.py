@@ -0,0 +1,82 @@
+import numpy as np
+import numpy.testing as npt
+import nibabel as nib
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+from dipy.io.trackvis import save_trk
+from dipy.io.streamline import TrkWriter, TckWriter
+
+
+def _streamlines(nb_streamlines=25):
+    rng = np.random.RandomState(1234)
+    for i in range(nb_streamlines):
+        yield rng.rand(rng.randint(1, 15), 3) * 20
+
+
+def read_tck(filename):
+    """ Parse a tracks file written by `TckWriter` """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    header = content[:content.index(b'END\n')].decode('ascii').split('\n')
+    fields = dict(line.split(': ') for line in header[1:] if line)
+    offset = int(fields['file'].split()[1])
+    points = np.frombuffer(content[offset:], dtype='<f4').reshape((-1, 3))
+    npt.assert_array_equal(points[-1], np.inf)
+    ends = np.flatnonzero(np.isnan(points[:, 0]))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    streamlines = [points[s:e] for s, e in zip(starts, ends)]
+    return streamlines, int(fields['count'])
+
+
+def test_trk_writer():
+    vox_to_ras = np.diag([2., 3., 1.5, 1.])
+    vox_to_ras[:3, 3] = [-10, 5, 2]
+    shape = (10, 11, 12)
+    streamlines = list(_streamlines())
+    with InTemporaryDirectory():
+        save_trk('reference.trk', streamlines, vox_to_ras, shape)
+        expected, _ = nib.trackvis.read('reference.trk')
+        for chunk_size in [1, 4, 100]:
+            with TrkWriter('streamed.trk', vox_to_ras, shape,
+                           chunk_size=chunk_size) as writer:
+                nb = writer.write_streamlines(_streamlines())
+            assert_equal(nb, len(streamlines))
+            assert_equal(writer.nb_points, sum(len(s) for s in streamlines))
+            assert_true(writer.throughput > 0)
+
+            result, hdr = nib.trackvis.read('streamed.trk')
+            assert_equal(hdr['n_count'], len(streamlines))
+            npt.assert_array_equal(hdr['dim'], shape)
+            npt.assert_array_almost_equal(hdr['vox_to_ras'], vox_to_ras)
+            assert_equal(len(result), len(expected))
+            for (points, _, _), (expected_points, _, _) in zip(result,
+                                                               expected):
+                npt.assert_array_almost_equal(points, expected_points, 4)
+
+
+def test_tck_writer():
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = 1
+    streamlines = list(_streamlines())
+    with InTemporaryDirectory():
+        for chunk_size in [1, 7, 100]:
+            writer = TckWriter('tracks.tck', affine, chunk_size=chunk_size)
+            for s in _streamlines():
+                writer.write(s)
+            writer.close()
+            result, count = read_tck('tracks.tck')
+            assert_equal(count, len(streamlines))
+            assert_equal(len(result), len(streamlines))
+            for points, s in zip(result, streamlines):
+                npt.assert_array_almost_equal(points, 2 * s + 1, 4)
+
+        # Empty files are valid
+        TckWriter('empty.tck').close()
+        assert_equal(read_tck('empty.tck'), ([], 0))
+        assert_raises(ValueError, TckWriter, 'tracks.tck', chunk_size=0)
+
+
+if __name__ == '__main__':
+    npt.run_module_suite()
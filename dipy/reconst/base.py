@@ -7,6 +7,11 @@ is used to represent the abstract properties of the model, that are independent
 of the specifics of the data . These properties are reused whenver fitting a
 particular set of data (different voxels, for example).
 
+Models whose fit can be computed for many voxels at once should decorate
+their fit method with ``dipy.reconst.multi_voxel.batch_voxel_fit``, which
+hands them all the voxels in the mask as a single 2D array, rather than
+with ``multi_voxel_fit``, which fits one voxel at a time.
+
 
 """
 
@@ -27,6 +32,17 @@ class ReconstModel(object):
     def fit(self, data, mask=None,**kwargs):
         return ReconstFit(self, data)
 
+    def parallel_fit(self, data, mask=None, num_workers=None,
+                     chunk_size=10000, use_processes=False):
+        """Fit the model in chunks of voxels, using a pool of workers
+
+        See ``dipy.reconst.multi_voxel.parallel_fit`` for the parameters.
+        """
+        from dipy.reconst.multi_voxel import parallel_fit
+        return parallel_fit(self, data, mask, num_workers=num_workers,
+                            chunk_size=chunk_size,
+                            use_processes=use_processes)
+
 class ReconstFit(object):
     """ Abstract class which holds the fit result of ReconstModel
 
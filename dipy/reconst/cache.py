@@ -1,4 +1,18 @@
+import errno
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
 from dipy.core.onetime import auto_attr
+from dipy.core.sphere import Sphere
+from dipy.core.gradients import GradientTable
+
 
 class Cache(object):
     """Cache values based on a key object (such as a sphere or gradient table).
@@ -22,8 +36,30 @@ class Cache(object):
                 M = self._compute_basis_matrix(sphere)
                 self.model.cache_set('odf_basis_matrix', key=sphere, value=M)
 
+    Values are kept in a dictionary of the model instance. A second level,
+    shared by all the models of a class and by other processes, can be
+    plugged in by setting ``cache_backend`` to a `CacheBackend`, such as a
+    `DiskCache`::
+
+        Cache.cache_backend = DiskCache('/tmp/dipy_cache', max_size=2**30)
+
+    The backend is looked up whenever a value is not found in the
+    dictionary, with a key hashing the class and constructor arguments of
+    the model, the tag and the key object, so that models built with the
+    same gradient table, sphere and parameters share their values.
+
     """
 
+    #: Optional `CacheBackend` holding values across models and processes
+    cache_backend = None
+
+    def __new__(cls, *args, **kwargs):
+        # Keep the constructor arguments, which identify the model in the
+        # keys of the backend
+        self = super(Cache, cls).__new__(cls)
+        self._cache_init_args = (args, kwargs)
+        return self
+
     # We use this method instead of __init__ to construct the cache, so
     # that the class can be used as a mixin, without having to worry about
     # calling the super-class constructor
@@ -63,6 +99,10 @@ class Cache(object):
 
         """
         self._cache[(tag, key)] = value
+        if self.cache_backend is not None:
+            backend_key = self._backend_key(tag, key)
+            if backend_key is not None:
+                self.cache_backend.set(backend_key, value)
 
     def cache_get(self, tag, key, default=None):
         """Retrieve a value from the cache.
@@ -83,10 +123,286 @@ class Cache(object):
             `default` if no cached entry is found.
 
         """
-        return self._cache.get((tag, key), default)
+        value = self._cache.get((tag, key), default)
+        if value is default and self.cache_backend is not None:
+            backend_key = self._backend_key(tag, key)
+            if backend_key is None:
+                return value
+            value = self.cache_backend.get(backend_key, default)
+            if value is not default:
+                self._cache[(tag, key)] = value
+        return value
+
+    def _backend_key(self, tag, key):
+        """Hash of the class and constructor arguments of the model, `tag`
+        and `key`
+
+        Default values are filled in, so that arguments passed by position,
+        by name or left to their default give the same hash. None if they
+        cannot be hashed by content, in which case the backend is not used.
+        """
+        args, kwargs = self._cache_init_args
+        init = type(self).__init__
+        if inspect.isfunction(init) or inspect.ismethod(init):
+            params = inspect.getcallargs(init, self, *args, **kwargs)
+            params = dict((name, value) for name, value in params.items()
+                          if value is not self)
+        else:
+            params = (args, kwargs)
+        return content_hash((type(self).__module__, type(self).__name__,
+                             params, tag, key))
 
     def cache_clear(self):
         """Clear the cache.
 
         """
         self._cache = {}
+
+
+class _NoContentHash(Exception):
+    """Raised for objects only identified by their id, whose hash would
+    differ between processes"""
+
+
+def _update_hash(h, obj, seen):
+    """Feed the content of `obj` to the hash object `h`"""
+    def update(text):
+        h.update(text.encode('utf-8'))
+
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        update('ndarray%s%s' % (obj.dtype.str, obj.shape))
+        h.update(np.ascontiguousarray(obj).data)
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str,
+                                         bytes, np.generic)):
+        update('%s%r' % (type(obj).__name__, obj))
+    elif isinstance(obj, slice):
+        update('slice')
+        _update_hash(h, (obj.start, obj.stop, obj.step), seen)
+    elif id(obj) in seen:
+        update('cycle')
+    elif isinstance(obj, (tuple, list, np.ndarray)):
+        seen.add(id(obj))
+        update('%s%d' % (type(obj).__name__, len(obj)))
+        if isinstance(obj, np.ndarray):
+            update(str(obj.shape))
+            obj = obj.ravel()
+        for item in obj:
+            _update_hash(h, item, seen)
+    elif isinstance(obj, dict):
+        seen.add(id(obj))
+        update('dict%d' % len(obj))
+        for k in sorted(obj, key=repr):
+            _update_hash(h, k, seen)
+            _update_hash(h, obj[k], seen)
+    elif isinstance(obj, Sphere):
+        # Lazily computed attributes like the faces do not matter
+        update(type(obj).__name__)
+        _update_hash(h, obj.vertices, seen)
+    elif isinstance(obj, GradientTable):
+        update(type(obj).__name__)
+        _update_hash(h, (obj.bvals, obj.bvecs, obj.big_delta,
+                         obj.small_delta, obj.b0_threshold), seen)
+    elif isinstance(obj, type) or callable(obj) and hasattr(obj, '__name__'):
+        # Classes and functions are identified by their name
+        update('%s.%s' % (getattr(obj, '__module__', ''), obj.__name__))
+    elif hasattr(obj, '__dict__'):
+        seen.add(id(obj))
+        update('%s.%s' % (type(obj).__module__, type(obj).__name__))
+        _update_hash(h, obj.__dict__, seen)
+    else:
+        # Unknown objects are only equal to themselves
+        raise _NoContentHash(type(obj).__name__)
+
+
+def content_hash(obj):
+    """Hash the content of an object, to be used as a persistent cache key
+
+    Arrays are hashed through their dtype, shape and data, spheres through
+    their vertices, gradient tables through their b-values, b-vectors and
+    timings and other objects through their attributes, so that equal
+    objects created in different processes have the same hash.
+
+    Parameters
+    ----------
+    obj : object
+        Nested tuples, lists and dicts of arrays, numbers, strings and other
+        objects.
+
+    Returns
+    -------
+    digest : str or None
+        Hexadecimal SHA-1 digest of the content of `obj`, or None if `obj`
+        holds objects without content to hash, which are only equal to
+        themselves.
+
+    Examples
+    --------
+    >>> content_hash((np.arange(3), 'matrix')) == content_hash(
+    ...     (np.arange(3), 'matrix'))
+    True
+    >>> content_hash(np.arange(3)) == content_hash(np.arange(3.))
+    False
+    """
+    h = hashlib.sha1()
+    try:
+        _update_hash(h, obj, set())
+    except _NoContentHash:
+        return None
+    return h.hexdigest()
+
+
+class CacheBackend(object):
+    """Interface of the stores plugged into `Cache.cache_backend`
+
+    Backends map content hashes, as returned by `content_hash`, to values.
+    They must be safe to use from several threads, and count their hits and
+    misses.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Retrieve the value stored for `key`, or `default`"""
+        raise NotImplementedError("To be implemented in sub classes")
+
+    def set(self, key, value):
+        """Store `value` for `key`"""
+        raise NotImplementedError("To be implemented in sub classes")
+
+    def clear(self):
+        """Remove all the stored values"""
+        raise NotImplementedError("To be implemented in sub classes")
+
+
+class DiskCache(CacheBackend):
+    """Persistent cache storing each value as a pickle file in a directory
+
+    Several processes can share the same directory: files are written
+    atomically and, whenever a value is stored, the least recently used
+    files of the directory, whichever process wrote them, are removed until
+    their total size is under `max_size`.
+
+    Parameters
+    ----------
+    directory : str
+        Where the values are stored. Created if it does not exist.
+    max_size : int, optional
+        Maximum total size of the values stored in `directory`, in bytes.
+        Unbounded by default.
+
+    Examples
+    --------
+    >>> from nibabel.tmpdirs import InTemporaryDirectory
+    >>> with InTemporaryDirectory() as tmpdir:
+    ...     cache = DiskCache(tmpdir, max_size=10 ** 6)
+    ...     key = content_hash(('matrix', 5))
+    ...     cache.set(key, np.eye(5))
+    ...     print(cache.get(key).shape, cache.hits, cache.misses)
+    (5, 5) 1 0
+    """
+    suffix = '.pkl'
+
+    def __init__(self, directory, max_size=None):
+        CacheBackend.__init__(self)
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Sizes of the files, from the least to the most recently used
+        self._sizes = OrderedDict()
+        self._scan()
+
+    @property
+    def size(self):
+        """Total size of the stored values, in bytes"""
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _scan(self):
+        """Read the sizes and order of use of the files in the directory,
+        including those written by other processes"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                # Evicted by another process
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        files.sort()
+        self._sizes = OrderedDict((name, size) for _, name, size in files)
+
+    def _touch(self, name, size):
+        """Mark a file as the most recently used one"""
+        self._sizes.pop(name, None)
+        self._sizes[name] = size
+
+    def get(self, key, default=None):
+        name = key + self.suffix
+        try:
+            with open(self._path(name), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                value = pickle.load(f)
+            # The modification time orders the files between processes
+            os.utime(self._path(name), None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            # Missing, evicted by another process or partially written
+            with self._lock:
+                self._sizes.pop(name, None)
+                self.misses += 1
+            return default
+        with self._lock:
+            self._touch(name, size)
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        name = key + self.suffix
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=2)
+        size = os.path.getsize(tmp_path)
+        if self.max_size is not None and size > self.max_size:
+            os.remove(tmp_path)
+            return
+        # Renaming is atomic, readers never see a partial file
+        os.rename(tmp_path, self._path(name))
+        with self._lock:
+            self._touch(name, size)
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files until under max_size"""
+        if self.max_size is None:
+            return
+        # Other processes sharing the directory may have added files
+        self._scan()
+        total = self.size
+        while total > self.max_size:
+            name, size = self._sizes.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for name in self._sizes:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+            self._sizes.clear()
@@ -1,4 +1,5 @@
 from __future__ import division, print_function, absolute_import
+import time
 import warnings
 
 import numpy as np
@@ -6,23 +7,25 @@ from scipy.integrate import quad
 from scipy.special import lpn, gamma
 import scipy.linalg as la
 import scipy.linalg.lapack as ll
+import scipy.sparse as sps
 
 from dipy.data import small_sphere, get_sphere, default_sphere
 
 from dipy.core.geometry import cart2sphere
-from dipy.core.ndindex import ndindex
 from dipy.sims.voxel import single_tensor
+from dipy.utils.arrfuncs import cholesky_solve
+from dipy.utils.parallel import map_chunks
 from dipy.utils.six.moves import range
 
 from dipy.reconst.multi_voxel import multi_voxel_fit
-from dipy.reconst.dti import TensorModel, fractional_anisotropy
+from dipy.reconst.dti import (TensorModel, fractional_anisotropy,
+                              fit_chunk_size)
 from dipy.reconst.shm import (sph_harm_ind_list, real_sph_harm,
                               sph_harm_lookup, lazy_index, SphHarmFit,
                               real_sym_sh_basis, sh_to_rh, forward_sdeconv_mat,
                               SphHarmModel)
 
 from dipy.direction.peaks import peaks_from_model
-from dipy.core.geometry import vec2vec_rotmat
 
 
 class AxSymShResponse(object):
@@ -170,14 +173,61 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
         self.sh_order = sh_order
         self.tau = tau
         self._X = X = self.R.diagonal() * self.B_dwi
-        self._P = np.dot(X.T, X)
+        # Shared by all the voxels fitted with the model
+        self._P, self._P_chol = _csd_normal_matrix(X)
+        self._reg_products = _reg_products(self.B_reg)
 
-    @multi_voxel_fit
-    def fit(self, data):
-        dwi_data = data[self._where_dwi]
-        shm_coeff, _ = csdeconv(dwi_data, self._X, self.B_reg, self.tau,
-                                P=self._P)
-        return SphHarmFit(self, shm_coeff, None)
+    def fit(self, data, mask=None, num_workers=1):
+        """Fit the model to the voxels of data, many voxels at a time
+
+        Parameters
+        ----------
+        data : array (..., K)
+            Diffusion signal, with the gradients along the last axis.
+        mask : array, dtype=bool, optional
+            Only the voxels where `mask` is True are fitted, the
+            coefficients of the others are zero.
+        num_workers : int, optional
+            Number of threads fitting chunks of voxels at the same time, each
+            using up to ``dipy.reconst.dti.FIT_MEMORY_BUDGET`` bytes. By
+            default a single thread is used, None uses one per CPU.
+
+        Returns
+        -------
+        fit : SphHarmFit
+            The fit of all the voxels, its coefficients held in a single
+            array of shape ``data.shape[:-1] + (n_coeff,)``.
+
+        See Also
+        --------
+        csdeconv_batch
+        """
+        data = np.asarray(data)
+        if data.ndim == 1:
+            shm_coeff, _ = csdeconv(data[self._where_dwi], self._X,
+                                    self.B_reg, self.tau, P=self._P)
+            return SphHarmFit(self, shm_coeff, None)
+
+        shm_coeff = np.zeros(data.shape[:-1] + (len(self.n),))
+        signal = data.reshape((-1, data.shape[-1]))
+        coeff = shm_coeff.reshape((-1, len(self.n)))
+        if mask is None:
+            index = np.arange(len(signal))
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != data.shape[:-1]:
+                raise ValueError("mask and data shape do not match")
+            index = np.flatnonzero(mask)
+
+        def fit_chunk(chunk):
+            z = np.dot(signal[chunk][:, self._where_dwi], self._X)
+            coeff[chunk] = _csdeconv_batch(z, self.B_reg, self.tau, 50,
+                                           self._P, self._P_chol,
+                                           self._reg_products)[0]
+
+        # Each chunk holds the normal matrices of its voxels
+        map_chunks(fit_chunk, index, fit_chunk_size(self.B_reg), num_workers)
+        return SphHarmFit(self, shm_coeff, mask)
 
 
     def predict(self, sh_coeff, gtab=None, S0=1.):
@@ -578,6 +628,157 @@ def csdeconv(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
     return fodf_sh, num_it
 
 
+def _csd_normal_matrix(X, P=None):
+    """``dot(X.T, X)``, regularized if needed, and its Cholesky factor"""
+    if P is None:
+        P = np.dot(X.T, X)
+    try:
+        L = la.cholesky(P)
+    except la.LinAlgError:
+        P = P + 1e-5 * np.eye(P.shape[0])
+        L = la.cholesky(P)
+    return P, L
+
+
+def _reg_products(B_reg):
+    """Upper triangles of the outer products of the rows of B_reg, the
+    terms of H^T H"""
+    upper = np.triu_indices(B_reg.shape[1])
+    # C order, which the sparse products read without a copy
+    return np.ascontiguousarray(B_reg[:, upper[0]] * B_reg[:, upper[1]])
+
+
+def csdeconv_batch(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
+    r""" Constrained-regularized spherical deconvolution of many voxels
+
+    Same as `csdeconv`, but all the voxels are deconvolved together.
+
+    Parameters
+    ----------
+    dwsignal : array (..., M)
+        Diffusion weighted signals to be deconvolved, one voxel per row.
+    X : array (M, B)
+        Prediction matrix which estimates diffusion weighted signals from FOD
+        coefficients.
+    B_reg : array (N, B)
+        SH basis matrix which maps FOD coefficients to FOD values on the
+        surface of the sphere. B_reg should be scaled to account for lambda.
+    tau : float
+        Threshold controlling the amplitude below which the corresponding fODF
+        is assumed to be zero, see `csdeconv`.
+    convergence : int
+        Maximum number of iterations to allow the deconvolution to converge.
+    P : ndarray
+        Precomputed ``dot(X.T, X)``.
+
+    Returns
+    -------
+    fodf_sh : ndarray (..., B)
+         Spherical harmonics coefficients of the constrained-regularized fiber
+         ODFs.
+    num_it : ndarray (...)
+         Number of iterations in the constrained-regularization used for
+         the convergence of each voxel.
+
+    Notes
+    -----
+    The Cholesky factorization of $P = X^TX$, which gives the first estimate
+    of the FODs, is computed once for all the voxels. In the iterations, the
+    matrices $Q = P + H_{n-1}^TH_{n-1}$ of all the voxels are first formed by
+    a single matrix product between their sets of negative directions and
+    the outer products of the rows of $B_{reg}$, then updated with the terms
+    of the few directions whose sign changed, and are solved together. A
+    voxel whose set of negative directions did not change has converged and
+    is not solved again.
+
+    The result of each voxel does not depend on the other voxels.
+    """
+    P, L = _csd_normal_matrix(X, P)
+    dwsignal = np.asarray(dwsignal)
+    z = np.dot(dwsignal.reshape((-1, dwsignal.shape[-1])), X)
+    fodf_sh, num_it = _csdeconv_batch(z, B_reg, tau, convergence, P, L,
+                                      _reg_products(B_reg))
+    shape = dwsignal.shape[:-1]
+    return fodf_sh.reshape(shape + (X.shape[1],)), num_it.reshape(shape)
+
+
+def _csdeconv_batch(z, B_reg, tau, convergence, P, L, products):
+    """CSD of the voxels whose ``dot(X.T, dwsignal)`` are the rows of `z`
+
+    `L` is the upper Cholesky factor of `P` and `products` the output of
+    `_reg_products` for `B_reg`.
+    """
+    fodf_sh = la.cho_solve((L, False), z.T).T
+    num_it = np.zeros(len(z), dtype=int)
+    # The first FODs only use SH orders up to 4, unless they are all above
+    # the threshold in which case the full-order FODs are used
+    fodf = np.dot(fodf_sh[:, :15], B_reg[:, :15].T)
+    threshold = B_reg[0, 0] * fodf_sh[:, :1] * tau
+    small = fodf < threshold
+    smooth = ~small.any(-1)
+    small[smooth] = np.dot(fodf_sh[smooth], B_reg.T) < threshold[smooth]
+
+    # Voxels whose FOD has no value below the threshold are done
+    active = np.flatnonzero(small.any(-1))
+    num_it, active = _constrained_iterations(fodf_sh, z, active,
+                                             small[active], threshold, B_reg,
+                                             P, products, convergence)
+    if len(active):
+        msg = 'maximum number of iterations exceeded - failed to converge'
+        warnings.warn(msg)
+    return fodf_sh, num_it
+
+
+def _constrained_iterations(fodf_sh, z, active, small, threshold, B_reg, P,
+                            products, convergence):
+    """Constrained-regularized iterations of many voxels at once
+
+    Solves ``(P + H^T H) f = z`` for the `active` rows of `fodf_sh` and `z`,
+    H being made of the regularization terms of the directions where the
+    FOD ``dot(f, B_reg.T)`` is below `threshold`, until these directions do
+    not change. The directions of the first iteration are the rows of
+    `small`, one per active voxel, and `products` holds the upper triangles
+    of the terms of H^T H of each direction. `fodf_sh` is updated in place.
+
+    Returns
+    -------
+    num_it : ndarray
+        Number of times each voxel was solved.
+    active : ndarray
+        The voxels that did not converge.
+    """
+    num_it = np.zeros(len(z), dtype=int)
+    # Upper triangles of the Q matrices of the active voxels, and where to
+    # find each element of a full Q in them
+    n = P.shape[0]
+    upper = np.triu_indices(n)
+    Q_upper = P[upper] + np.dot(small.astype(P.dtype), products)
+    where_upper = np.empty((n, n), dtype=np.intp)
+    where_upper[upper] = where_upper.T[upper] = np.arange(len(upper[0]))
+    for it in range(1, convergence + 1):
+        if len(active) == 0:
+            break
+        Q = Q_upper[:, where_upper]
+        fodf_sh[active] = cholesky_solve(Q, z[active])
+        num_it[active] = it
+
+        # Only the voxels whose negative directions changed carry on
+        new_small = np.dot(fodf_sh[active], B_reg.T) < threshold[active]
+        flipped = new_small != small
+        changed = flipped.any(-1)
+        active = active[changed]
+        small = new_small[changed]
+        # Few directions change sign, their terms are added to or removed
+        # from Q with a sparse product
+        rows, cols = flipped[changed].nonzero()
+        signs = np.where(small[rows, cols], 1., -1.)
+        starts = np.searchsorted(rows, np.arange(len(active) + 1))
+        update = sps.csr_matrix((signs, cols, starts),
+                                shape=(len(active), len(B_reg)))
+        Q_upper = Q_upper[changed] + update.dot(products)
+    return num_it, active
+
+
 def odf_deconv(odf_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
     r""" ODF constrained-regularized spherical deconvolution using
     the Sharpening Deconvolution Transform (SDT) [1]_, [2]_.
@@ -676,8 +877,96 @@ def odf_deconv(odf_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
     return fodf_sh, num_it
 
 
+def odf_deconv_batch(odfs_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
+    r""" ODF constrained-regularized spherical deconvolution of many voxels
+
+    Same as `odf_deconv`, but all the ODFs are deconvolved together.
+
+    Parameters
+    ----------
+    odfs_sh : ndarray (..., ``(sh_order + 1)*(sh_order + 2)/2``)
+         SH coefficients of the ODFs to be deconvolved, one voxel per row.
+    R : ndarray (``(sh_order + 1)(sh_order + 2)/2``, ``(sh_order + 1)(sh_order + 2)/2``)
+         SDT matrix in SH basis
+    B_reg : ndarray (N, ``(sh_order + 1)(sh_order + 2)/2``)
+         SH basis matrix used for deconvolution
+    lambda_ : float
+         lambda parameter in minimization equation (default 1.0)
+    tau : float
+         threshold (tau *max(fODF)) controlling the amplitude below
+         which the corresponding fODF is assumed to be zero.
+    r2_term : bool
+         True if ODF is computed from model that uses the $r^2$ term in the
+         integral, see `odf_deconv`.
+
+    Returns
+    -------
+    fodf_sh : ndarray (..., ``(sh_order + 1)(sh_order + 2)/2``)
+         Spherical harmonics coefficients of the constrained-regularized fiber
+         ODFs
+    num_it : ndarray (...)
+         Number of iterations in the constrained-regularization used for
+         the convergence of each voxel
+
+    Notes
+    -----
+    The least squares problems of `odf_deconv` are solved through their
+    normal equations, $(R^TR + \lambda^2 H^TH) f = R^T odf$, whose matrices
+    are formed and updated for all the voxels at once as in
+    `csdeconv_batch`.
+    """
+    odfs_sh = np.asarray(odfs_sh)
+    n = R.shape[1]
+    fodf_sh, num_it = _odf_deconv_batch(odfs_sh.reshape((-1, n)), R,
+                                        np.linalg.pinv(R), B_reg, tau, 50,
+                                        np.dot(R.T, R),
+                                        _reg_products(lambda_ * B_reg))
+    shape = odfs_sh.shape[:-1]
+    return fodf_sh.reshape(shape + (n,)), num_it.reshape(shape)
+
+
+def _odf_deconv_batch(odf_sh, R, R_pinv, B_reg, tau, convergence, P,
+                      products):
+    """SDT of the ODFs in the rows of `odf_sh`
+
+    `R_pinv` is the pseudo-inverse of `R`, `P` is ``dot(R.T, R)`` and
+    `products` the output of `_reg_products` for ``lambda_ * B_reg``.
+    """
+    fodf_sh = np.zeros(odf_sh.shape)
+    num_it = np.zeros(len(odf_sh), dtype=int)
+    # ODFs with NaNs, as made by a null normalization, are left to zero
+    valid = np.flatnonzero(~np.isnan(odf_sh).any(-1))
+    odf_sh = odf_sh[valid]
+
+    # The initial fODF estimates are the ODFs truncated at SH order 4,
+    # normalized (``~r2_term`` is true in odf_deconv whatever r2_term)
+    fodf = np.dot(odf_sh, R_pinv.T)
+    fodf[:, 15:] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fodf /= np.sqrt((np.dot(fodf, B_reg.T) ** 2).sum(-1))[:, None]
+    amplitudes = np.dot(fodf, B_reg.T)
+    threshold = tau * amplitudes.max(-1)[:, None]
+
+    # Unlike CSD, the first iteration solves every voxel
+    active = np.arange(len(fodf))
+    with np.errstate(invalid='ignore'):
+        it, active = _constrained_iterations(fodf, np.dot(odf_sh, R), active,
+                                             amplitudes < threshold,
+                                             threshold, B_reg, P, products,
+                                             convergence)
+    if len(active):
+        warnings.warn('maximum number of iterations exceeded - failed to '
+                      'converge')
+    fodf_sh[valid] = fodf
+    # odf_deconv counts the iteration finding that the directions did not
+    # change
+    num_it[valid] = np.minimum(it + 1, convergence)
+    return fodf_sh, num_it
+
+
 def odf_sh_to_sharp(odfs_sh, sphere, basis=None, ratio=3 / 15., sh_order=8,
-                    lambda_=1., tau=0.1, r2_term=False):
+                    lambda_=1., tau=0.1, r2_term=False, mask=None,
+                    num_workers=1, memory_budget=None):
     r""" Sharpen odfs using the sharpening deconvolution transform [2]_
 
     This function can be used to sharpen any smooth ODF spherical function. In
@@ -714,12 +1003,25 @@ def odf_sh_to_sharp(odfs_sh, sphere, basis=None, ratio=3 / 15., sh_order=8,
          response function has be derived.  For example, models such as DSI,
          GQI, SHORE, CSA, Tensor, Multi-tensor ODFs, should now be deconvolved
          with the r2_term=True.
+    mask : ndarray, dtype=bool, optional
+        Only the odfs where `mask` is True are sharpened, the coefficients
+        of the others are zero.
+    num_workers : int, optional
+        Number of threads sharpening chunks of voxels at the same time. By
+        default a single thread is used, None uses one per CPU.
+    memory_budget : int, optional
+        Memory used by each thread for the voxels of its chunk, in bytes.
+        Default: ``dipy.reconst.dti.FIT_MEMORY_BUDGET``.
 
     Returns
     -------
     fodf_sh : ndarray
         sharpened odf expressed as spherical harmonics coefficients
 
+    See Also
+    --------
+    odf_deconv_batch
+
     References
     ----------
     .. [1] Tuch, D. MRM 2004. Q-Ball Imaging.
@@ -739,13 +1041,29 @@ def odf_sh_to_sharp(odfs_sh, sphere, basis=None, ratio=3 / 15., sh_order=8,
     # SH coefficients and number of mapped directions
     lambda_ = lambda_ * R.shape[0] * R[0, 0] / B_reg.shape[0]
 
+    odfs_sh = np.asarray(odfs_sh)
     fodf_sh = np.zeros(odfs_sh.shape)
-
-    for index in ndindex(odfs_sh.shape[:-1]):
-        fodf_sh[index], num_it = odf_deconv(odfs_sh[index], R, B_reg,
-                                            lambda_=lambda_, tau=tau,
-                                            r2_term=r2_term)
-
+    odfs = odfs_sh.reshape((-1, odfs_sh.shape[-1]))
+    fodfs = fodf_sh.reshape(odfs.shape)
+    if mask is None:
+        index = np.arange(len(odfs))
+    else:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != odfs_sh.shape[:-1]:
+            raise ValueError("mask and odfs_sh shape do not match")
+        index = np.flatnonzero(mask)
+
+    # The same matrices are used by all the chunks
+    R_pinv = np.linalg.pinv(R)
+    P = np.dot(R.T, R)
+    products = _reg_products(lambda_ * B_reg)
+
+    def sharpen_chunk(chunk):
+        fodfs[chunk] = _odf_deconv_batch(odfs[chunk], R, R_pinv, B_reg, tau,
+                                         50, P, products)[0]
+
+    map_chunks(sharpen_chunk, index, fit_chunk_size(B_reg, memory_budget),
+                num_workers)
     return fodf_sh
 
 
@@ -896,7 +1214,7 @@ def _get_response(S0s, lambdas):
 def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
                        init_fa=0.08, init_trace=0.0021, iter=8,
                        convergence=0.001, parallel=True, nbr_processes=None,
-                       sphere=default_sphere):
+                       sphere=default_sphere, return_timing=False):
     """ Recursive calibration of response function using peak threshold
 
     Parameters
@@ -923,18 +1241,24 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
         convergence criterion, maximum relative change of SH
         coefficients. Default: 0.001.
     parallel : bool, optional
-        Whether to use parallelization in peak-finding during the calibration
-        procedure. Default: True
+        Whether to fit the CSD models of the calibration procedure with
+        several threads, and find the peaks of their fODFs with several
+        processes. Default: True
     nbr_processes: int
-        If `parallel` is True, the number of subprocesses to use
+        If `parallel` is True, the number of threads and processes to use
         (default multiprocessing.cpu_count()).
     sphere : Sphere, optional.
         The sphere used for peak finding. Default: default_sphere.
+    return_timing : bool, optional
+        If True, the duration of each iteration is also returned.
 
     Returns
     -------
     response : ndarray
         response function in SH coefficients
+    timing : list of float
+        The duration of each iteration, in seconds. Only returned if
+        `return_timing` is True.
 
     Notes
     -----
@@ -962,40 +1286,42 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
 
     n = np.arange(0, sh_order + 1, 2)
     where_dwi = lazy_index(~gtab.b0s_mask)
+    gradients = gtab.gradients[where_dwi]
+    gradients = gradients / np.sqrt((gradients ** 2).sum(-1))[:, None]
     response_p = np.ones(len(n))
+    num_workers = nbr_processes if parallel else 1
 
+    timing = []
     for num_it in range(iter):
-        r_sh_all = np.zeros(len(n))
+        start = time.time()
         csd_model = ConstrainedSphericalDeconvModel(gtab, res_obj,
                                                     sh_order=sh_order)
-
-        csd_peaks = peaks_from_model(model=csd_model,
-                                     data=data,
+        # All the remaining voxels are fitted at once, as the response, and
+        # so their fODFs, changed since the previous iteration
+        csd_fit = csd_model.fit(data, num_workers=num_workers)
+        csd_peaks = peaks_from_model(model=_FittedShModel(csd_model),
+                                     data=csd_fit.shm_coeff,
                                      sphere=sphere,
                                      relative_peak_threshold=peak_thr,
                                      min_separation_angle=25,
+                                     return_sh=False,
+                                     npeaks=2,
                                      parallel=parallel,
-                                     nbr_processes=nbr_processes)
+                                     nbr_processes=nbr_processes,
+                                     zero_copy=True)
 
-        dirs = csd_peaks.peak_dirs
         vals = csd_peaks.peak_values
-        single_peak_mask = (vals[:, 1] / vals[:, 0]) < peak_thr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            single_peak_mask = (vals[:, 1] / vals[:, 0]) < peak_thr
         data = data[single_peak_mask]
-        dirs = dirs[single_peak_mask]
-
-        for num_vox in range(data.shape[0]):
-            rotmat = vec2vec_rotmat(dirs[num_vox, 0], np.array([0, 0, 1]))
-
-            rot_gradients = np.dot(rotmat, gtab.gradients.T).T
+        dirs = csd_peaks.peak_dirs[single_peak_mask, 0]
 
-            x, y, z = rot_gradients[where_dwi].T
-            r, theta, phi = cart2sphere(x, y, z)
-            # for the gradient sphere
-            B_dwi = real_sph_harm(0, n, theta[:, None], phi[:, None])
-            r_sh_all += np.linalg.lstsq(B_dwi, data[num_vox, where_dwi])[0]
-
-        response = r_sh_all / data.shape[0]
+        # Mean of the SH coefficients of the signals in the frames of their
+        # fiber directions
+        response = _axially_symmetric_sh(data[:, where_dwi], dirs, gradients,
+                                         n).mean(0)
         res_obj = AxSymShResponse(data[:, gtab.b0s_mask].mean(), response)
+        timing.append(time.time() - start)
 
         change = abs((response_p - response) / response_p)
         if all(change < convergence):
@@ -1003,9 +1329,40 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
 
         response_p = response
 
+    if return_timing:
+        return res_obj, timing
     return res_obj
 
 
+class _FittedShModel(object):
+    """Model whose data are the SH coefficients of already fitted fODFs, to
+    find their peaks with `peaks_from_model`"""
+    def __init__(self, model):
+        self.model = model
+
+    def fit(self, shm_coeff):
+        return SphHarmFit(self.model, shm_coeff, None)
+
+
+def _axially_symmetric_sh(signal, dirs, gradients, n, step=10000):
+    """Least squares fit of the signals with the spherical harmonics of
+    order 0 and degrees `n` about the directions `dirs`
+
+    The gradients are unit vectors, the signal of each voxel is fitted in the
+    frame where its direction is the z axis, in which the harmonics only
+    depend on the polar angle of the gradients.
+    """
+    r_sh = np.empty((len(signal), len(n)))
+    for start in range(0, len(signal), step):
+        stop = start + step
+        cos_theta = np.clip(np.dot(dirs[start:stop], gradients.T), -1, 1)
+        B = real_sph_harm(0, n, np.arccos(cos_theta)[..., None], 0)
+        BtB = np.einsum('vgi,vgj->vij', B, B)
+        Bty = np.einsum('vgi,vg->vi', B, signal[start:stop])
+        r_sh[start:stop] = cholesky_solve(BtB, Bty)
+    return r_sh
+
+
 def fa_trace_to_lambdas(fa=0.08, trace=0.0021):
     lambda1 = (trace / 3.) * (1 + 2 * fa / (3 - 2 * fa ** 2) ** (1 / 2.))
     lambda2 = (trace / 3.) * (1 - fa / (3 - 2 * fa ** 2) ** (1 / 2.))
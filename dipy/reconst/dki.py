@@ -6,13 +6,13 @@ import numpy as np
 from dipy.reconst.dti import (TensorFit, mean_diffusivity, axial_diffusivity,
                               radial_diffusivity, from_lower_triangular,
                               lower_triangular, decompose_tensor,
-                              _min_positive_signal)
+                              _min_positive_signal, fit_chunk_size,
+                              wls_solve)
 
 from dipy.reconst.utils import dki_design_matrix as design_matrix
 from dipy.utils.six.moves import range
 from ..core.onetime import auto_attr
 from .base import ReconstModel
-from dipy.core.ndindex import ndindex
 
 
 def _positive_evals(L1, L2, L3, er=2e-7):
@@ -76,27 +76,30 @@ def carlson_rf(x, y, z, errtol=3e-4):
     .. [1] Carlson, B.C., 1994. Numerical computation of real or complex
            elliptic integrals. arXiv:math/9409227 [math.CA]
     """
-    xn = x.copy()
-    yn = y.copy()
-    zn = z.copy()
+    xn = np.array(x)
+    yn = np.array(y)
+    zn = np.array(z)
     An = (xn + yn + zn) / 3.0
     Q = (3.*errtol) ** (-1/6.) * np.max(np.abs([An - xn, An - yn, An - zn]),
                                         axis=0)
-    # Convergence has to be done voxel by voxel
-    index = ndindex(x.shape)
-    for v in index:
-        n = 0
+    # All the elements are iterated together, those that have converged are
+    # dropped from the active set. Since they all start together, the
+    # elements still active after n iterations have all done n iterations.
+    active = np.flatnonzero(Q > abs(An))
+    n = 0
+    flat = [xn.reshape(-1), yn.reshape(-1), zn.reshape(-1), An.reshape(-1)]
+    Q = Q.reshape(-1)
+    while active.size:
+        xa, ya, za, Aa = [arr[active] for arr in flat]
+        xnroot = np.sqrt(xa)
+        ynroot = np.sqrt(ya)
+        znroot = np.sqrt(za)
+        lamda = xnroot*(ynroot + znroot) + ynroot*znroot
+        n = n + 1
+        for arr, val in zip(flat, (xa, ya, za, Aa)):
+            arr[active] = (val+lamda) * 0.250
         # Convergence condition
-        while 4.**(-n) * Q[v] > abs(An[v]):
-            xnroot = np.sqrt(xn[v])
-            ynroot = np.sqrt(yn[v])
-            znroot = np.sqrt(zn[v])
-            lamda = xnroot*(ynroot + znroot) + ynroot*znroot
-            n = n + 1
-            xn[v] = (xn[v]+lamda) * 0.250
-            yn[v] = (yn[v]+lamda) * 0.250
-            zn[v] = (zn[v]+lamda) * 0.250
-            An[v] = (An[v]+lamda) * 0.250
+        active = active[4.**(-n) * Q[active] > abs(flat[3][active])]
 
     # post convergence calculation
     X = 1. - xn/An
@@ -138,31 +141,37 @@ def carlson_rd(x, y, z, errtol=1e-4):
     -----
     x, y, and z have to be nonnegative and at most x or y is zero.
     """
-    xn = x.copy()
-    yn = y.copy()
-    zn = z.copy()
+    xn = np.array(x)
+    yn = np.array(y)
+    zn = np.array(z)
     A0 = (xn + yn + 3.*zn) / 5.0
     An = A0.copy()
     Q = (errtol/4.) ** (-1/6.) * np.max(np.abs([An - xn, An - yn, An - zn]),
                                         axis=0)
-    sum_term = np.zeros(x.shape, dtype=x.dtype)
-    n = np.zeros(x.shape)
-
-    # Convergence has to be done voxel by voxel
-    index = ndindex(x.shape)
-    for v in index:
+    sum_term = np.zeros(An.shape, dtype=An.dtype)
+    n = np.zeros(An.shape, dtype=An.dtype)
+
+    # All the elements are iterated together, those that have converged are
+    # dropped from the active set
+    active = np.flatnonzero(Q > abs(An))
+    flat = [xn.reshape(-1), yn.reshape(-1), zn.reshape(-1), An.reshape(-1)]
+    flat_sum = sum_term.reshape(-1)
+    flat_n = n.reshape(-1)
+    Q = Q.reshape(-1)
+    while active.size:
+        xa, ya, za, Aa = [arr[active] for arr in flat]
+        na = flat_n[active]
+        xnroot = np.sqrt(xa)
+        ynroot = np.sqrt(ya)
+        znroot = np.sqrt(za)
+        lamda = xnroot*(ynroot + znroot) + ynroot*znroot
+        flat_sum[active] += 4.**(-na) / (znroot * (za+lamda))
+        na = na + 1
+        flat_n[active] = na
+        for arr, val in zip(flat, (xa, ya, za, Aa)):
+            arr[active] = (val+lamda) * 0.250
         # Convergence condition
-        while 4.**(-n[v]) * Q[v] > abs(An[v]):
-            xnroot = np.sqrt(xn[v])
-            ynroot = np.sqrt(yn[v])
-            znroot = np.sqrt(zn[v])
-            lamda = xnroot*(ynroot + znroot) + ynroot*znroot
-            sum_term[v] = sum_term[v] + 4.**(-n[v]) / (znroot * (zn[v]+lamda))
-            n[v] = n[v] + 1
-            xn[v] = (xn[v]+lamda) * 0.250
-            yn[v] = (yn[v]+lamda) * 0.250
-            zn[v] = (zn[v]+lamda) * 0.250
-            An[v] = (An[v]+lamda) * 0.250
+        active = active[4.**(-na) * Q[active] > abs(flat[3][active])]
 
     # post convergence calculation
     X = (A0 - x) / (4.**(n) * An)
@@ -226,7 +235,7 @@ def _F1m(a, b, c):
     er = 2.5e-2
 
     # Initialize F1
-    F1 = np.zeros(a.shape)
+    F1 = np.zeros(a.shape, dtype=a.dtype)
 
     # Only computes F1 in voxels that have all eigenvalues larger than zero
     cond0 = _positive_evals(a, b, c)
@@ -238,8 +247,8 @@ def _F1m(a, b, c):
         L1 = a[cond1]
         L2 = b[cond1]
         L3 = c[cond1]
-        RFm = carlson_rf(L1/L2, L1/L3, np.ones(len(L1)))
-        RDm = carlson_rd(L1/L2, L1/L3, np.ones(len(L1)))
+        RFm = carlson_rf(L1/L2, L1/L3, np.ones_like(L1))
+        RDm = carlson_rd(L1/L2, L1/L3, np.ones_like(L1))
         F1[cond1] = ((L1+L2+L3) ** 2) / (18 * (L1-L2) * (L1-L3)) * \
                     (np.sqrt(L2*L3) / L1 * RFm +
                      (3 * L1**2 - L1*L2 - L1*L3 - L2*L3) /
@@ -313,7 +322,7 @@ def _F2m(a, b, c):
     er = 2.5e-2
 
     # Initialize F2
-    F2 = np.zeros(a.shape)
+    F2 = np.zeros(a.shape, dtype=a.dtype)
 
     # Only computes F2 in voxels that have all eigenvalues larger than zero
     cond0 = _positive_evals(a, b, c)
@@ -324,8 +333,8 @@ def _F2m(a, b, c):
         L1 = a[cond1]
         L2 = b[cond1]
         L3 = c[cond1]
-        RF = carlson_rf(L1/L2, L1/L3, np.ones(len(L1)))
-        RD = carlson_rd(L1/L2, L1/L3, np.ones(len(L1)))
+        RF = carlson_rf(L1/L2, L1/L3, np.ones_like(L1))
+        RD = carlson_rd(L1/L2, L1/L3, np.ones_like(L1))
         F2[cond1] = (((L1+L2+L3) ** 2) / (3. * (L2-L3) ** 2)) * \
                     (((L2+L3) / (np.sqrt(L2*L3))) * RF +
                      ((2.*L1-L2-L3) / (3.*np.sqrt(L2*L3))) * RD - 2.)
@@ -339,12 +348,11 @@ def _F2m(a, b, c):
 
         # Cumpute alfa [1]_
         x = 1. - (L1/L3)
-        alpha = np.zeros(len(L1))
-        for i in range(len(x)):
-            if x[i] > 0:
-                alpha[i] = 1./np.sqrt(x[i]) * np.arctanh(np.sqrt(x[i]))
-            else:
-                alpha[i] = 1./np.sqrt(-x[i]) * np.arctan(np.sqrt(-x[i]))
+        sqrt_x = np.sqrt(abs(x))
+        pos = x > 0
+        alpha = np.arctan(sqrt_x)
+        alpha[pos] = np.arctanh(sqrt_x[pos])
+        alpha = alpha / sqrt_x
 
         F2[cond2] = \
             6. * ((L1 + 2.*L3)**2) / (144. * L3**2 * (L1-L3)**2) * \
@@ -418,44 +426,37 @@ def apparent_kurtosis_coef(dki_params, sphere, min_diffusivity=0,
 
     # Initialize AKC matrix
     V = sphere.vertices
-    AKC = np.zeros((len(kt), len(V)))
+    AKC = np.zeros((len(kt), len(V)), dtype=dki_params.dtype)
 
     # select relevant voxels to process
     rel_i = _positive_evals(evals[..., 0], evals[..., 1], evals[..., 2])
     kt = kt[rel_i]
     evecs = evecs[rel_i]
     evals = evals[rel_i]
-    AKCi = AKC[rel_i]
 
-    # Compute MD
+    # Compute MD and the diffusion tensors of all the relevant voxels
     MD = mean_diffusivity(evals)
-
-    # loop over all relevant voxels
-    for vox in range(len(kt)):
-        R = evecs[vox]
-        dt = lower_triangular(np.dot(np.dot(R, np.diag(evals[vox])), R.T))
-        AKCi[vox] = _directional_kurtosis(dt, MD[vox], kt[vox], V,
-                                          min_diffusivity=min_diffusivity,
-                                          min_kurtosis=min_kurtosis)
-
-    # reshape data according to input data
-    AKC[rel_i] = AKCi
+    dt = lower_triangular(np.einsum('...ij,...j,...kj->...ik', evecs, evals,
+                                    evecs))
+    AKC[rel_i] = _directional_kurtosis(dt, MD, kt, V,
+                                       min_diffusivity=min_diffusivity,
+                                       min_kurtosis=min_kurtosis)
 
     return AKC.reshape((outshape + (len(V),)))
 
 
 def _directional_kurtosis(dt, MD, kt, V, min_diffusivity=0, min_kurtosis=-1):
     r""" Helper function that calculate the apparent kurtosis coefficient (AKC)
-    in each direction of a sphere for a single voxel.
+    in each direction of a sphere for one or several voxels.
 
     Parameters
     ----------
-    dt : array (6,)
-        elements of the diffusion tensor of the voxel.
-    MD : float
-        mean diffusivity of the voxel
-    kt : array (15,)
-        elements of the kurtosis tensor of the voxel.
+    dt : array (6,) or (n, 6)
+        elements of the diffusion tensor of the voxels.
+    MD : float or array (n,)
+        mean diffusivity of the voxels
+    kt : array (15,) or (n, 15)
+        elements of the kurtosis tensor of the voxels.
     V : array (g, 3)
         g directions of a Sphere in Cartesian coordinates
     min_diffusivity : float (optional)
@@ -471,46 +472,30 @@ def _directional_kurtosis(dt, MD, kt, V, min_diffusivity=0, min_kurtosis=-1):
 
     Returns
     --------
-    AKC : ndarray (g,)
+    AKC : ndarray (g,) or (n, g)
         Apparent kurtosis coefficient (AKC) in all g directions of a sphere for
-        a single voxel.
+        each voxel.
 
     See Also
     --------
     apparent_kurtosis_coef
     """
-    ADC = \
-        V[:, 0] * V[:, 0] * dt[0] + \
-        2 * V[:, 0] * V[:, 1] * dt[1] + \
-        V[:, 1] * V[:, 1] * dt[2] + \
-        2 * V[:, 0] * V[:, 2] * dt[3] + \
-        2 * V[:, 1] * V[:, 2] * dt[4] + \
-        V[:, 2] * V[:, 2] * dt[5]
+    x, y, z = np.asarray(V, dtype=np.asarray(kt).dtype).T
+    ADC = np.dot(dt, [x*x, 2*x*y, y*y, 2*x*z, 2*y*z, z*z])
 
     if min_diffusivity is not None:
         ADC = ADC.clip(min=min_diffusivity)
 
-    AKC = \
-        V[:, 0] * V[:, 0] * V[:, 0] * V[:, 0] * kt[0] + \
-        V[:, 1] * V[:, 1] * V[:, 1] * V[:, 1] * kt[1] + \
-        V[:, 2] * V[:, 2] * V[:, 2] * V[:, 2] * kt[2] + \
-        4 * V[:, 0] * V[:, 0] * V[:, 0] * V[:, 1] * kt[3] + \
-        4 * V[:, 0] * V[:, 0] * V[:, 0] * V[:, 2] * kt[4] + \
-        4 * V[:, 0] * V[:, 1] * V[:, 1] * V[:, 1] * kt[5] + \
-        4 * V[:, 1] * V[:, 1] * V[:, 1] * V[:, 2] * kt[6] + \
-        4 * V[:, 0] * V[:, 2] * V[:, 2] * V[:, 2] * kt[7] + \
-        4 * V[:, 1] * V[:, 2] * V[:, 2] * V[:, 2] * kt[8] + \
-        6 * V[:, 0] * V[:, 0] * V[:, 1] * V[:, 1] * kt[9] + \
-        6 * V[:, 0] * V[:, 0] * V[:, 2] * V[:, 2] * kt[10] + \
-        6 * V[:, 1] * V[:, 1] * V[:, 2] * V[:, 2] * kt[11] + \
-        12 * V[:, 0] * V[:, 0] * V[:, 1] * V[:, 2] * kt[12] + \
-        12 * V[:, 0] * V[:, 1] * V[:, 1] * V[:, 2] * kt[13] + \
-        12 * V[:, 0] * V[:, 1] * V[:, 2] * V[:, 2] * kt[14]
+    AKC = np.dot(kt, [x**4, y**4, z**4,
+                      4*x**3*y, 4*x**3*z, 4*x*y**3, 4*y**3*z, 4*x*z**3,
+                      4*y*z**3,
+                      6*x*x*y*y, 6*x*x*z*z, 6*y*y*z*z,
+                      12*x*x*y*z, 12*x*y*y*z, 12*x*y*z*z])
 
     if min_kurtosis is not None:
         AKC = AKC.clip(min=min_kurtosis)
 
-    return (MD/ADC) ** 2 * AKC
+    return (np.asarray(MD)[..., None] / ADC) ** 2 * AKC
 
 
 def mean_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
@@ -537,7 +522,8 @@ def mean_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     Returns
     -------
     mk : array
-        Calculated MK.
+        Calculated MK, of the dtype of `dki_params`. Single precision
+        parameters halve the memory used by large maps.
 
     Notes
     --------
@@ -593,12 +579,17 @@ def mean_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     # Rotate the kurtosis tensor from the standard Cartesian coordinate system
     # to another coordinate system in which the 3 orthonormal eigenvectors of
     # DT are the base coordinate
-    Wxxxx = Wrotate_element(kt, 0, 0, 0, 0, evecs)
-    Wyyyy = Wrotate_element(kt, 1, 1, 1, 1, evecs)
-    Wzzzz = Wrotate_element(kt, 2, 2, 2, 2, evecs)
-    Wxxyy = Wrotate_element(kt, 0, 0, 1, 1, evecs)
-    Wxxzz = Wrotate_element(kt, 0, 0, 2, 2, evecs)
-    Wyyzz = Wrotate_element(kt, 1, 1, 2, 2, evecs)
+    Wpairs = _Wrotate_pairs(kt, evecs)
+    Wxxxx = Wpairs[..., 0, 0]
+    Wyyyy = Wpairs[..., 1, 1]
+    Wzzzz = Wpairs[..., 2, 2]
+    Wxxyy = Wpairs[..., 0, 1]
+    Wxxzz = Wpairs[..., 0, 2]
+    Wyyzz = Wpairs[..., 1, 2]
+
+    # The functions of the eigenvalues are evaluated in double precision,
+    # they are ill-conditioned close to equal eigenvalues
+    evals = evals.astype(np.float64)
 
     # Compute MK
     MK = \
@@ -615,7 +606,7 @@ def mean_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     if max_kurtosis is not None:
         MK = MK.clip(max=max_kurtosis)
 
-    return MK.reshape(outshape)
+    return MK.reshape(outshape).astype(dki_params.dtype, copy=False)
 
 
 def _G1m(a, b, c):
@@ -658,7 +649,7 @@ def _G1m(a, b, c):
     er = np.finfo(a.ravel()[0]).eps * 1e3
 
     # Initialize G1
-    G1 = np.zeros(a.shape)
+    G1 = np.zeros(a.shape, dtype=a.dtype)
 
     # Only computes G1 in voxels that have all eigenvalues larger than zero
     cond0 = _positive_evals(a, b, c)
@@ -720,7 +711,7 @@ def _G2m(a, b, c):
     er = np.finfo(a.ravel()[0]).eps * 1e3
 
     # Initialize G2
-    G2 = np.zeros(a.shape)
+    G2 = np.zeros(a.shape, dtype=a.dtype)
 
     # Only computes G2 in voxels that have all eigenvalues larger than zero
     cond0 = _positive_evals(a, b, c)
@@ -768,7 +759,8 @@ def radial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     Returns
     -------
     rk : array
-        Calculated RK.
+        Calculated RK, of the dtype of `dki_params`. Single precision
+        parameters halve the memory used by large maps.
 
     Notes
     --------
@@ -805,9 +797,14 @@ def radial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     # Rotate the kurtosis tensor from the standard Cartesian coordinate system
     # to another coordinate system in which the 3 orthonormal eigenvectors of
     # DT are the base coordinate
-    Wyyyy = Wrotate_element(kt, 1, 1, 1, 1, evecs)
-    Wzzzz = Wrotate_element(kt, 2, 2, 2, 2, evecs)
-    Wyyzz = Wrotate_element(kt, 1, 1, 2, 2, evecs)
+    Wpairs = _Wrotate_pairs(kt, evecs)
+    Wyyyy = Wpairs[..., 1, 1]
+    Wzzzz = Wpairs[..., 2, 2]
+    Wyyzz = Wpairs[..., 1, 2]
+
+    # The functions of the eigenvalues are evaluated in double precision,
+    # they are ill-conditioned close to equal eigenvalues
+    evals = evals.astype(np.float64)
 
     # Compute RK
     RK = \
@@ -821,7 +818,7 @@ def radial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     if max_kurtosis is not None:
         RK = RK.clip(max=max_kurtosis)
 
-    return RK.reshape(outshape)
+    return RK.reshape(outshape).astype(dki_params.dtype, copy=False)
 
 
 def axial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
@@ -848,7 +845,8 @@ def axial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     Returns
     -------
     ak : array
-        Calculated AK.
+        Calculated AK, of the dtype of `dki_params`. Single precision
+        parameters halve the memory used by large maps.
     """
     # Flat parameters
     outshape = dki_params.shape[:-1]
@@ -858,27 +856,19 @@ def axial_kurtosis(dki_params, min_kurtosis=0, max_kurtosis=3):
     evals, evecs, kt = split_dki_param(dki_params)
 
     # Initialize AK
-    AK = np.zeros(kt.shape[:-1])
+    AK = np.zeros(kt.shape[:-1], dtype=dki_params.dtype)
 
     # select relevant voxels to process
     rel_i = _positive_evals(evals[..., 0], evals[..., 1], evals[..., 2])
     kt = kt[rel_i]
     evecs = evecs[rel_i]
     evals = evals[rel_i]
-    AKi = AK[rel_i]
 
-    # Compute MD
+    # The apparent kurtosis along the first eigenvector, where the apparent
+    # diffusivity is the first eigenvalue
     MD = mean_diffusivity(evals)
-
-    # loop over all voxels
-    for vox in range(len(kt)):
-        R = evecs[vox]
-        dt = lower_triangular(np.dot(np.dot(R, np.diag(evals[vox])), R.T))
-        AKi[vox] = _directional_kurtosis(dt, MD[vox], kt[vox],
-                                         np.array([R[:, 0]]))
-
-    # reshape data according to input data
-    AK[rel_i] = AKi
+    Wxxxx = _Wrotate_pairs(kt, evecs)[..., 0, 0]
+    AK[rel_i] = (MD / evals[..., 0]) ** 2 * Wxxxx.clip(min=-1)
 
     if min_kurtosis is not None:
         AK = AK.clip(min=min_kurtosis)
@@ -1080,6 +1070,8 @@ class DiffusionKurtosisFit(TensorFit):
         """
         TensorFit.__init__(self, model, model_params)
 
+    metric_names = TensorFit.metric_names + ('mk', 'ak', 'rk')
+
     @property
     def kt(self):
         """
@@ -1313,7 +1305,7 @@ class DiffusionKurtosisFit(TensorFit):
         return dki_prediction(self.model_params, gtab, S0)
 
 
-def ols_fit_dki(design_matrix, data):
+def ols_fit_dki(design_matrix, data, step=None, memory_budget=None):
     r""" Computes ordinary least squares (OLS) fit to calculate the diffusion
     tensor and kurtosis tensor using a linear regression diffusion kurtosis
     model [1]_.
@@ -1326,6 +1318,12 @@ def ols_fit_dki(design_matrix, data):
     data : array (N, g)
         Data or response variables holding the data. Note that the last
         dimension should contain the data. It makes no copies of data.
+    step : int, optional
+        Number of voxels fit at once. By default, it is derived from
+        `memory_budget` by `dipy.reconst.dti.fit_chunk_size`.
+    memory_budget : int, optional
+        Memory, in bytes, available for the temporary arrays of each chunk
+        of voxels when `step` is not given.
 
     Returns
     -------
@@ -1358,10 +1356,12 @@ def ols_fit_dki(design_matrix, data):
     min_diffusivity = tol / -design_matrix.min()
     inv_design = np.linalg.pinv(design_matrix)
 
-    # lopping OLS solution on all data voxels
-    for vox in range(len(data_flat)):
-        dki_params[vox] = _ols_iter(inv_design, data_flat[vox],
-                                    min_diffusivity)
+    if step is None:
+        step = fit_chunk_size(design_matrix, memory_budget)
+    for i in range(0, len(data_flat), step):
+        result = np.einsum('...ij,...j', inv_design,
+                           np.log(data_flat[i:i + step]))
+        dki_params[i:i + step] = _dki_params(result, min_diffusivity)
 
     # Reshape data according to the input data shape
     dki_params = dki_params.reshape((data.shape[:-1]) + (27,))
@@ -1369,54 +1369,7 @@ def ols_fit_dki(design_matrix, data):
     return dki_params
 
 
-def _ols_iter(inv_design, sig, min_diffusivity):
-    """ Helper function used by ols_fit_dki - Applies OLS fit of the diffusion
-    kurtosis model to single voxel signals.
-
-    Parameters
-    ----------
-    inv_design : array (g, 22)
-        Inverse of the design matrix holding the covariants used to solve for
-        the regression coefficients.
-    sig : array (g,)
-        Diffusion-weighted signal for a single voxel data.
-    min_diffusivity : float
-        Because negative eigenvalues are not physical and small eigenvalues,
-        much smaller than the diffusion weighting, cause quite a lot of noise
-        in metrics such as fa, diffusivity values smaller than
-        `min_diffusivity` are replaced with `min_diffusivity`.
-
-    Returns
-    -------
-    dki_params : array (27,)
-        All parameters estimated from the diffusion kurtosis model.
-        Parameters are ordered as follows:
-            1) Three diffusion tensor's eigenvalues
-            2) Three lines of the eigenvector matrix each containing the first,
-               second and third coordinates of the eigenvector
-            3) Fifteen elements of the kurtosis tensor
-    """
-    # DKI ordinary linear least square solution
-    log_s = np.log(sig)
-    result = np.dot(inv_design, log_s)
-
-    # Extracting the diffusion tensor parameters from solution
-    DT_elements = result[:6]
-    evals, evecs = decompose_tensor(from_lower_triangular(DT_elements),
-                                    min_diffusivity=min_diffusivity)
-
-    # Extracting kurtosis tensor parameters from solution
-    MD_square = (evals.mean(0))**2
-    KT_elements = result[6:21] / MD_square
-
-    # Write output
-    dki_params = np.concatenate((evals, evecs[0], evecs[1], evecs[2],
-                                 KT_elements), axis=0)
-
-    return dki_params
-
-
-def wls_fit_dki(design_matrix, data):
+def wls_fit_dki(design_matrix, data, step=None, memory_budget=None):
     r""" Computes weighted linear least squares (WLS) fit to calculate
     the diffusion tensor and kurtosis tensor using a weighted linear
     regression diffusion kurtosis model [1]_.
@@ -1429,9 +1382,12 @@ def wls_fit_dki(design_matrix, data):
     data : array (N, g)
         Data or response variables holding the data. Note that the last
         dimension should contain the data. It makes no copies of data.
-    min_signal : default = 1
-        All values below min_signal are repalced with min_signal. This is done
-        in order to avoid taking log(0) durring the tensor fitting.
+    step : int, optional
+        Number of voxels fit at once. By default, it is derived from
+        `memory_budget` by `dipy.reconst.dti.fit_chunk_size`.
+    memory_budget : int, optional
+        Memory, in bytes, available for the temporary arrays of each chunk
+        of voxels when `step` is not given.
 
     Returns
     -------
@@ -1444,6 +1400,12 @@ def wls_fit_dki(design_matrix, data):
                second and third coordinates of the eigenvector
             3) Fifteen elements of the kurtosis tensor
 
+    Notes
+    -----
+    The weights are the squares of the signals predicted by an OLS fit. The
+    weighted normal equations of all the voxels of a chunk are solved at
+    once by `dipy.reconst.dti.wls_solve`.
+
     References
     ----------
        [1] Veraart, J., Sijbers, J., Sunaert, S., Leemans, A., Jeurissen, B.,
@@ -1459,14 +1421,19 @@ def wls_fit_dki(design_matrix, data):
     data_flat = data.reshape((-1, data.shape[-1]))
     dki_params = np.empty((len(data_flat), 27))
 
-    # inverting design matrix and defining minimun diffusion aloud
+    # defining minimun diffusion aloud and the matrix projecting the log
+    # signals on their OLS prediction
     min_diffusivity = tol / -design_matrix.min()
-    inv_design = np.linalg.pinv(design_matrix)
+    ols_fit = np.dot(design_matrix, np.linalg.pinv(design_matrix))
 
-    # lopping WLS solution on all data voxels
-    for vox in range(len(data_flat)):
-        dki_params[vox] = _wls_iter(design_matrix, inv_design, data_flat[vox],
-                                    min_diffusivity)
+    if step is None:
+        step = fit_chunk_size(design_matrix, memory_budget)
+    for i in range(0, len(data_flat), step):
+        log_s = np.log(data_flat[i:i + step])
+        # Define weights as yn**2
+        w = np.exp(2 * np.einsum('...ij,...j', ols_fit, log_s))
+        result = wls_solve(design_matrix, log_s, w)
+        dki_params[i:i + step] = _dki_params(result, min_diffusivity)
 
     # Reshape data according to the input data shape
     dki_params = dki_params.reshape((data.shape[:-1]) + (27,))
@@ -1474,19 +1441,16 @@ def wls_fit_dki(design_matrix, data):
     return dki_params
 
 
-def _wls_iter(design_matrix, inv_design, sig, min_diffusivity):
-    """ Helper function used by wls_fit_dki - Applies WLS fit of the diffusion
-    kurtosis model to single voxel signals.
+def _dki_params(result, min_diffusivity):
+    """ Helper function used by ols_fit_dki and wls_fit_dki - Converts the
+    solutions of the linear DKI fit of many voxels to model parameters.
 
     Parameters
     ----------
-    design_matrix : array (g, 22)
-        Design matrix holding the covariants used to solve for the regression
-        coefficients
-    inv_design : array (g, 22)
-        Inverse of the design matrix.
-    sig : array (g, )
-        Diffusion-weighted signal for a single voxel data.
+    result : array (N, 22)
+        Solutions of the linear regression, the six diffusion tensor
+        elements followed by the fifteen kurtosis tensor elements multiplied
+        by the square of the mean diffusivity, and the log of S0.
     min_diffusivity : float
         Because negative eigenvalues are not physical and small eigenvalues,
         much smaller than the diffusion weighting, cause quite a lot of noise
@@ -1495,7 +1459,7 @@ def _wls_iter(design_matrix, inv_design, sig, min_diffusivity):
 
     Returns
     -------
-    dki_params : array (27, )
+    dki_params : array (N, 27)
         All parameters estimated from the diffusion kurtosis model.
         Parameters are ordered as follows:
             1) Three diffusion tensor's eigenvalues
@@ -1503,34 +1467,16 @@ def _wls_iter(design_matrix, inv_design, sig, min_diffusivity):
                second and third coordinates of the eigenvector
             3) Fifteen elements of the kurtosis tensor
     """
-    A = design_matrix
-
-    # DKI ordinary linear least square solution
-    log_s = np.log(sig)
-    ols_result = np.dot(inv_design, log_s)
-
-    # Define weights as diag(yn**2)
-    W = np.diag(np.exp(2 * np.dot(A, ols_result)))
-
-    # DKI weighted linear least square solution
-    inv_AT_W_A = np.linalg.pinv(np.dot(np.dot(A.T, W), A))
-    AT_W_LS = np.dot(np.dot(A.T, W), log_s)
-    wls_result = np.dot(inv_AT_W_A, AT_W_LS)
-
     # Extracting the diffusion tensor parameters from solution
-    DT_elements = wls_result[:6]
-    evals, evecs = decompose_tensor(from_lower_triangular(DT_elements),
+    evals, evecs = decompose_tensor(from_lower_triangular(result[:, :6]),
                                     min_diffusivity=min_diffusivity)
 
     # Extracting kurtosis tensor parameters from solution
-    MD_square = (evals.mean(0))**2
-    KT_elements = wls_result[6:21] / MD_square
+    MD_square = evals.mean(-1) ** 2
+    KT_elements = result[:, 6:21] / MD_square[:, None]
 
-    # Write output
-    dki_params = np.concatenate((evals, evecs[0], evecs[1], evecs[2],
-                                 KT_elements), axis=0)
-
-    return dki_params
+    return np.concatenate((evals, evecs.reshape(-1, 9), KT_elements),
+                          axis=-1)
 
 
 def Wrotate(kt, Basis):
@@ -1539,21 +1485,16 @@ def Wrotate(kt, Basis):
 
     Parameters
     ----------
-    kt : (15,)
+    kt : array (15,) or (..., 15)
         Vector with the 15 independent elements of the kurtosis tensor
-    Basis : array (3, 3)
+    Basis : array (3, 3) or (..., 3, 3)
         Vectors of the basis column-wise oriented
-    inds : array(m, 4) (optional)
-        Array of vectors containing the four indexes of m specific elements of
-        the rotated kurtosis tensor. If not specified all 15 elements of the
-        rotated kurtosis tensor are computed.
 
     Returns
     --------
-    Wrot : array (m,) or (15,)
-        Vector with the m independent elements of the rotated kurtosis tensor.
-        If 'indices' is not specified all 15 elements of the rotated kurtosis
-        tensor are computed.
+    Wrot : array (15,) or (..., 15)
+        Vector with the 15 independent elements of the rotated kurtosis
+        tensor.
     Note
     ------
     KT elements are assumed to be ordered as follows:
@@ -1579,13 +1520,14 @@ def Wrotate(kt, Basis):
                      [0, 0, 1, 1], [0, 0, 2, 2], [1, 1, 2, 2],
                      [0, 0, 1, 2], [0, 1, 1, 2], [0, 1, 2, 2]])
 
-    Wrot = np.zeros(kt.shape)
-
-    for e in range(len(inds)):
-        Wrot[..., e] = Wrotate_element(kt, inds[e][0], inds[e][1], inds[e][2],
-                                       inds[e][3], Basis)
+    def rotate(W, B):
+        # Each contraction moves the rotated index to the end, after the four
+        # of them the indices are back in order
+        for _ in range(4):
+            W = np.einsum('...ijkl,...ia->...jkla', W, B)
+        return W[..., inds[:, 0], inds[:, 1], inds[:, 2], inds[:, 3]]
 
-    return Wrot
+    return _rotate_chunks(rotate, kt, Basis, (15,))
 
 # Defining keys to select a kurtosis tensor element with indexes (i, j, k, l)
 # on a kt vector that contains only the 15 independent elements of the kurtosis
@@ -1598,6 +1540,15 @@ def Wrotate(kt, Basis):
 ind_ele = {1: 0, 16: 1, 81: 2, 2: 3, 3: 4, 8: 5, 24: 6, 27: 7, 54: 8, 4: 9,
            9: 10, 36: 11, 6: 12, 12: 13, 18: 14}
 
+# Index on the kt vector of each element of the full 4D kurtosis tensor
+_kt_full_index = np.array([ind_ele[(i+1) * (j+1) * (k+1) * (l+1)]
+                           for i, j, k, l in np.ndindex(3, 3, 3, 3)])
+_kt_full_index = _kt_full_index.reshape((3, 3, 3, 3))
+
+# Number of voxels whose full 4D kurtosis tensors are expanded at once by the
+# rotations
+_ROTATION_CHUNK = 2 ** 14
+
 
 def Wrotate_element(kt, indi, indj, indk, indl, B):
     r""" Computes the the specified index element of a kurtosis tensor rotated
@@ -1615,12 +1566,12 @@ def Wrotate_element(kt, indi, indj, indk, indl, B):
         Rotated kurtosis tensor element index k (0 for x, 1 for y, 2 for z)
     indl: int
         Rotated kurtosis tensor element index l (0 for x, 1 for y, 2 for z)
-    B: array (x, y, z, 3, 3) or (n, 15)
+    B: array (x, y, z, 3, 3) or (n, 3, 3)
         Vectors of the basis column-wise oriented
 
     Returns
     -------
-    Wre : float
+    Wre : float or ndarray (x, y, z) or (n,)
           rotated kurtosis tensor element of index ind_i, ind_j, ind_k, ind_l
 
     Note
@@ -1634,20 +1585,71 @@ def Wrotate_element(kt, indi, indj, indk, indl, B):
     characterization of neural tissues using directional diffusion kurtosis
     analysis. Neuroimage 42(1): 122-34
     """
+    def rotate(W, B):
+        return np.einsum('...ijkl,...i,...j,...k,...l->...', W,
+                         B[..., indi], B[..., indj], B[..., indk],
+                         B[..., indl])
+
+    return _rotate_chunks(rotate, kt, B, ())
+
+
+def _Wrotate_pairs(kt, B):
+    r""" Computes the elements $\hat{W}_{iijj}$ of a kurtosis tensor rotated
+    to the coordinate system basis B, which are all the rotated elements
+    required by the kurtosis standard measures.
+
+    Parameters
+    ----------
+    kt : ndarray (..., 15)
+        Array containing the 15 independent elements of the kurtosis tensor
+    B: array (..., 3, 3)
+        Vectors of the basis column-wise oriented
+
+    Returns
+    -------
+    Wpairs : array (..., 3, 3)
+        Symmetric matrices of the rotated elements, Wpairs[..., i, j] being
+        the rotated element of index i, i, j, j.
+    """
+    def rotate(W, B):
+        P = np.einsum('...ia,...ja->...aij', B, B)
+        WP = np.einsum('...ijkl,...bkl->...bij', W, P)
+        return np.einsum('...aij,...bij->...ab', P, WP)
 
-    Wre = 0
+    return _rotate_chunks(rotate, kt, B, (3, 3))
 
-    xyz = [0, 1, 2]
-    for il in xyz:
-        for jl in xyz:
-            for kl in xyz:
-                for ll in xyz:
-                    key = (il+1) * (jl+1) * (kl+1) * (ll+1)
-                    multiplyB = \
-                        B[..., il, indi] * B[..., jl, indj] * \
-                        B[..., kl, indk] * B[..., ll, indl]
-                    Wre = Wre + multiplyB * kt[..., ind_ele[key]]
-    return Wre
+
+def _rotate_chunks(rotate, kt, B, shape):
+    """ Apply a rotation function to the full 4D kurtosis tensors of blocks
+    of voxels, so that at most `_ROTATION_CHUNK` of them are expanded at
+    once.
+
+    Parameters
+    ----------
+    rotate : callable
+        ``rotate(W, B)`` returns the rotated elements, of shape (n,) + `shape`,
+        of the kurtosis tensors W (n, 3, 3, 3, 3) given the bases B (n, 3, 3).
+    kt : ndarray (..., 15)
+        Array containing the 15 independent elements of the kurtosis tensor
+    B: array (..., 3, 3)
+        Bases passed to `rotate`.
+    shape : tuple
+        Shape of the rotated elements of one voxel.
+    """
+    kt = np.asarray(kt)
+    B = np.asarray(B)
+    outshape = kt.shape[:-1]
+    kt = kt.reshape((-1, 15))
+    B = B.reshape((-1, 3, 3))
+    # Single precision inputs are rotated in double precision, one chunk at
+    # a time
+    dtype = np.promote_types(np.result_type(kt, B), np.float64)
+    Wrot = np.empty((len(kt),) + shape, dtype=dtype)
+    for start in range(0, len(kt), _ROTATION_CHUNK):
+        chunk = slice(start, start + _ROTATION_CHUNK)
+        Wrot[chunk] = rotate(Wcons(kt[chunk]).astype(dtype),
+                             B[chunk].astype(dtype))
+    return Wrot.reshape(outshape + shape)
 
 
 def Wcons(k_elements):
@@ -1656,7 +1658,7 @@ def Wcons(k_elements):
 
     Parameters
     ----------
-    k_elements : (15,)
+    k_elements : (15,) or (..., 15)
         elements of the kurtosis tensor in the following order:
 
         .. math::
@@ -1670,20 +1672,10 @@ def Wcons(k_elements):
 
     Returns
     -------
-    W : array(3, 3, 3, 3)
+    W : array(3, 3, 3, 3) or (..., 3, 3, 3, 3)
         Full 4D kurtosis tensor
     """
-    W = np.zeros((3, 3, 3, 3))
-
-    xyz = [0, 1, 2]
-    for ind_i in xyz:
-        for ind_j in xyz:
-            for ind_k in xyz:
-                for ind_l in xyz:
-                    key = (ind_i+1) * (ind_j+1) * (ind_k+1) * (ind_l+1)
-                    W[ind_i][ind_j][ind_k][ind_l] = k_elements[ind_ele[key]]
-
-    return W
+    return np.asarray(k_elements)[..., _kt_full_index]
 
 
 def split_dki_param(dki_params):
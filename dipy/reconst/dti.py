@@ -8,15 +8,14 @@ import functools
 
 import numpy as np
 
-import scipy.optimize as opt
-
 from dipy.utils.six.moves import range
-from dipy.utils.arrfuncs import pinv, eigh
+from dipy.utils.arrfuncs import eigh, cholesky_solve
 from dipy.data import get_sphere
 from ..core.gradients import gradient_table
 from ..core.geometry import vector_norm
 from ..core.sphere import Sphere
 from .vec_val_sum import vec_val_vect
+from ..core.optimize import levenberg_marquardt
 from ..core.onetime import auto_attr
 from .base import ReconstModel
 
@@ -734,6 +733,9 @@ class TensorModel(ReconstModel):
 
         Example : In :func:`iter_fit_tensor` we have a default step value of 1e4            
 
+        The WLS fit uses a step derived from the `memory_budget` key-word
+        argument (in bytes) by :func:`fit_chunk_size` unless `step` is given.
+
         References
         ----------
         .. [1] Basser, P.J., Mattiello, J., LeBihan, D., 1994. Estimation of
@@ -868,7 +870,7 @@ class TensorFit(object):
         evecs = self.model_params[..., 3:12]
         return evecs.reshape(self.shape + (3, 3))
 
-    @property
+    @auto_attr
     def quadratic_form(self):
         """Calculates the 3x3 diffusion tensor for each voxel"""
         # do `evecs * evals * evecs.T` where * is matrix multiply
@@ -899,7 +901,11 @@ class TensorFit(object):
         """
         Tensor mode calculated from cached eigenvalues.
         """
-        return mode(self.quadratic_form)
+        # The deviatoric part of the tensor shares its eigenvectors, its
+        # determinant and norm follow from the shifted eigenvalues
+        dev = self.evals - self.evals.mean(-1)[..., None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 3 * np.sqrt(6) * dev.prod(-1) / (dev * dev).sum(-1) ** 1.5
 
     @auto_attr
     def md(self):
@@ -1061,6 +1067,101 @@ class TensorFit(object):
         """
         return sphericity(self.evals)
 
+    #: Names of the maps computed by `metrics`
+    metric_names = ('fa', 'ga', 'md', 'rd', 'ad', 'trace', 'mode',
+                    'linearity', 'planarity', 'sphericity', 'color_fa')
+
+    # Shape of the value of one voxel for the maps that are not scalar
+    _metric_shapes = {'color_fa': (3,)}
+
+    @auto_attr
+    def _metric_cache(self):
+        return {}
+
+    def metrics(self, names=None, out=None, step=2 ** 14):
+        """ Compute several maps in a single pass over the voxels
+
+        Parameters
+        ----------
+        names : sequence of str, optional
+            Maps to compute, among `metric_names`. Default: all of them.
+        out : dict, optional
+            C contiguous arrays in which some of the maps are written, by
+            name, for instance single precision arrays or `np.memmap`
+            instances. Their shape is ``self.shape``, or ``self.shape +
+            (3,)`` for color_fa.
+        step : int, optional
+            Number of voxels processed at once.
+
+        Returns
+        -------
+        maps : dict
+            The arrays of the maps, by name.
+
+        Notes
+        -----
+        The voxels are processed by blocks of `step` voxels, the maps of
+        a block being computed together from its eigenvalues while they are
+        in cache. Maps that are not written to `out` are cached: they are
+        returned again by the next calls and by the attributes of the same
+        name, such as `fa`. Slicing the fit gives a fit with an empty cache.
+
+        Kurtosis maps of `DiffusionKurtosisFit` are computed with the
+        default bounds of their methods.
+        """
+        if names is None:
+            names = self.metric_names
+        unknown = [name for name in names if name not in self.metric_names]
+        if unknown:
+            raise ValueError("Unknown metrics: %s" % ", ".join(unknown))
+        out = {} if out is None else out
+        cache = self._metric_cache
+
+        maps = {}
+        todo = []
+        for name in names:
+            value = cache.get(name, self.__dict__.get(name))
+            if value is None:
+                todo.append(name)
+            elif name in out:
+                out[name][...] = value
+                maps[name] = out[name]
+            else:
+                maps[name] = value
+
+        params = self.model_params.reshape((-1, self.model_params.shape[-1]))
+        flat = {}
+        for name in todo:
+            shape = self.shape + self._metric_shapes.get(name, ())
+            if name in out:
+                maps[name] = out[name]
+                if maps[name].shape != shape:
+                    raise ValueError("The output of %s must have shape %s"
+                                     % (name, shape))
+                if not maps[name].flags.c_contiguous:
+                    raise ValueError("The output of %s must be C contiguous"
+                                     % name)
+            else:
+                maps[name] = np.empty(shape, dtype=params.dtype)
+            flat[name] = maps[name].reshape((len(params),) + shape[len(
+                self.shape):])
+
+        for start in range(0, len(params) if todo else 0, step):
+            block = type(self)(self.model, params[start:start + step])
+            for name in todo:
+                value = getattr(block, name)
+                flat[name][start:start + step] = value() if callable(value) \
+                    else value
+
+        for name in todo:
+            if name in out:
+                continue
+            cache[name] = maps[name]
+            if name in TensorFit.metric_names:
+                # Attributes computed on first access
+                setattr(self, name, maps[name])
+        return maps
+
     def odf(self, sphere):
         """
         The diffusion orientation distribution function (dODF). This is an
@@ -1192,6 +1293,86 @@ class TensorFit(object):
         return predict.reshape(shape + (gtab.bvals.shape[0], ))
 
 
+#: Memory, in bytes, that the temporary arrays of the linear tensor fits can
+#: use for each chunk of voxels when no explicit `step` is given
+FIT_MEMORY_BUDGET = 2 ** 27
+
+
+def fit_chunk_size(design_matrix, memory_budget=None):
+    """Number of voxels that a linear fit can process at once
+
+    The temporary arrays of `wls_solve` and of the eigen decomposition of
+    the tensors take about ``4 * g + 2 * p ** 2 + 24`` floats per voxel for
+    a design matrix of shape (g, p).
+
+    Parameters
+    ----------
+    design_matrix : array (g, p)
+        Design matrix of the fit.
+    memory_budget : int, optional
+        Memory available for the temporary arrays, in bytes. Default:
+        `FIT_MEMORY_BUDGET`.
+
+    Returns
+    -------
+    step : int
+        Chunk size, as a number of voxels, at least 1.
+    """
+    if memory_budget is None:
+        memory_budget = FIT_MEMORY_BUDGET
+    g, p = design_matrix.shape
+    voxel_size = 8 * (4 * g + 2 * p * p + 24)
+    return max(int(memory_budget // voxel_size), 1)
+
+
+def wls_solve(design_matrix, y, weights):
+    r"""Weighted linear least squares solutions of many voxels at once
+
+    Solves the normal equations $(X^T W X) \beta = X^T W y$ of all the
+    voxels with one matrix product to form them and a batched Cholesky
+    factorization to solve them, instead of a pseudo-inverse of each
+    weighted design matrix.
+
+    Parameters
+    ----------
+    design_matrix : array (g, p)
+        Design matrix X, shared by all voxels.
+    y : array (..., g)
+        Response variables, for instance the log of the signal.
+    weights : array (..., g)
+        Diagonal of the weight matrix W of each voxel.
+
+    Returns
+    -------
+    beta : array (..., p)
+        Regression coefficients.
+
+    Notes
+    -----
+    The columns of the design matrix are scaled to unit norm before the
+    normal equations are formed, as the b-values and the constant term
+    have very different magnitudes and would otherwise make the normal
+    matrices badly conditioned.
+
+    The sums are computed the same way for every voxel, so that the
+    solution of a voxel does not depend on the other voxels of the chunk.
+    """
+    X = np.asarray(design_matrix, dtype=float)
+    y = np.asarray(y)
+    g, p = X.shape
+    scale = np.sqrt((X * X).sum(0))
+    scale[scale == 0] = 1
+    X = X / scale
+    weights = np.reshape(weights, (-1, g))
+    # Products of the columns of X, so that all the X^T W X are a single
+    # matrix product with the weights
+    outer = (X[:, :, None] * X[:, None, :]).reshape(g, p * p)
+    XtWX = np.einsum('ng,gk->nk', weights, outer).reshape(-1, p, p)
+    XtWy = np.einsum('ng,gk->nk', weights * y.reshape(-1, g), X)
+    beta = cholesky_solve(XtWX, XtWy) / scale
+    return beta.reshape(y.shape[:-1] + (p, ))
+
+
 def iter_fit_tensor(step=1e4):
     """Wrap a fit_tensor func and iterate over chunks of data with given length
 
@@ -1203,8 +1384,10 @@ def iter_fit_tensor(step=1e4):
 
     Parameters
     ----------
-    step : int
+    step : int or None
         The chunk size as a number of voxels. Optional parameter with default value 10,000.
+        If None, the chunk size is derived from a memory budget by
+        `fit_chunk_size`.
 
         In order to increase speed of processing, tensor fitting is done simultaneously
         over many voxels. This parameter sets the number of voxels that will be fit at 
@@ -1237,16 +1420,23 @@ def iter_fit_tensor(step=1e4):
             data : array ([X, Y, Z, ...], g)
                 Data or response variables holding the data. Note that the last
                 dimension should contain the data. It makes no copies of data.
-            step : int
+            step : int or None
                 The chunk size as a number of voxels. Overrides `step` value
-                of `iter_fit_tensor`.
+                of `iter_fit_tensor`. If None, it is derived from
+                `memory_budget`.
+            memory_budget : int, optional
+                Memory, in bytes, available for the temporary arrays of each
+                chunk when `step` is None. Default: `FIT_MEMORY_BUDGET`.
             args : {list,tuple}
                 Any extra optional positional arguments passed to `fit_tensor`.
             kwargs : dict
                 Any extra optional keyword arguments passed to `fit_tensor`.
             """
+            memory_budget = kwargs.pop('memory_budget', None)
             shape = data.shape[:-1]
             size = np.prod(shape)
+            if step is None:
+                step = fit_chunk_size(design_matrix, memory_budget)
             step = int(step) or size
             if step >= size:
                 return fit_tensor(design_matrix, data, *args, **kwargs)
@@ -1262,7 +1452,7 @@ def iter_fit_tensor(step=1e4):
     return iter_decorator
 
 
-@iter_fit_tensor()
+@iter_fit_tensor(step=None)
 def wls_fit_tensor(design_matrix, data):
     r"""
     Computes weighted least squares (WLS) fit to calculate self-diffusion
@@ -1315,6 +1505,10 @@ def wls_fit_tensor(design_matrix, data):
         W = \mathrm{diag}((X \hat{\beta}_\mathrm{OLS})^2),
         \mathrm{where} \hat{\beta}_\mathrm{OLS} = (X^T X)^{-1} X^T y
 
+    The normal equations of all the voxels are solved at once by
+    `wls_solve`, in chunks whose size is set by `fit_chunk_size` unless a
+    `step` is given.
+
     References
     ----------
     .. [1] Chung, SW., Lu, Y., Henry, R.G., 2006. Comparison of bootstrap
@@ -1327,9 +1521,7 @@ def wls_fit_tensor(design_matrix, data):
     log_s = np.log(data)
     w = np.exp(np.einsum('...ij,...j', ols_fit, log_s))
     return eig_from_lo_tri(
-        np.einsum('...ij,...j',
-                  pinv(design_matrix * w[..., None]),
-                  w * log_s),
+        wls_solve(design_matrix, log_s, w * w),
         min_diffusivity=tol / -design_matrix.min(),
     )
 
@@ -1413,13 +1605,14 @@ def _nlls_err_func(tensor, design_matrix, data, weighting=None,
 
     Parameters
     ----------
-    tensor : array (3,3)
-        The 3-by-3 tensor matrix
+    tensor : array (7, ) or (N, 7)
+        The six lower triangular tensor elements followed by -log(S0), of
+        one or N voxels
 
     design_matrix : array
         The design matrix
 
-    data : array
+    data : array (g, ) or (N, g)
         The voxel signal in all gradient directions
 
     weighting : str (optional).
@@ -1460,7 +1653,7 @@ def _nlls_err_func(tensor, design_matrix, data, weighting=None,
     estimation of tensors by outlier rejection. MRM, 53: 1088-95.
     """
     # This is the predicted signal given the params:
-    y = np.exp(np.dot(design_matrix, tensor))
+    y = np.exp(np.dot(tensor, design_matrix.T))
 
     # Compute the residuals
     residuals = data - y
@@ -1470,6 +1663,30 @@ def _nlls_err_func(tensor, design_matrix, data, weighting=None,
         # And we return the SSE:
         return residuals
     se = residuals ** 2
+    w = _nlls_weights(residuals, weighting, sigma)
+
+    # Return the weighted residuals:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return np.sqrt(w * se)
+
+
+def _nlls_weights(residuals, weighting, sigma=None):
+    """Weights of the squared residuals of the non-linear tensor fits
+
+    Parameters
+    ----------
+    residuals : array (..., g)
+        Residuals of one or several voxels.
+    weighting : str
+        'sigma' or 'gmm', see `_nlls_err_func`.
+    sigma : float or float array (optional)
+        Noise level, needed by the 'sigma' weighting, see `_nlls_err_func`.
+
+    Returns
+    -------
+    w : float or array (..., g)
+    """
     # If the user provided a sigma (e.g 1.5267 * std(background_noise), as
     # suggested by Chang et al.) we will use it:
     if weighting == 'sigma':
@@ -1477,22 +1694,23 @@ def _nlls_err_func(tensor, design_matrix, data, weighting=None,
             e_s = "Must provide sigma value as input to use this weighting"
             e_s += " method"
             raise ValueError(e_s)
-        w = 1 / (sigma**2)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return 1 / (np.asarray(sigma, dtype=float) ** 2)
 
     elif weighting == 'gmm':
         # We use the Geman McClure M-estimator to compute the weights on the
         # residuals:
-        C = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        median = np.median(residuals, axis=-1)[..., None]
+        C = 1.4826 * np.median(np.abs(residuals - median), axis=-1)[..., None]
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            w = 1 / (se + C**2)
+            w = 1 / (residuals ** 2 + C**2)
             # The weights are normalized to the mean weight (see p. 1089):
-            w = w / np.mean(w)
+            return w / np.mean(w, axis=-1)[..., None]
 
-    # Return the weighted residuals:
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        return np.sqrt(w * se)
+    raise ValueError('"%s" is not a known weighting, use "sigma" or "gmm"'
+                     % weighting)
 
 
 def _nlls_jacobian_func(tensor, design_matrix, data, *arg, **kwargs):
@@ -1509,12 +1727,75 @@ def _nlls_jacobian_func(tensor, design_matrix, data, *arg, **kwargs):
         methods of estimation in diffusion tensor imaging. MRM 182, 115-25.
 
     """
-    pred = np.exp(np.dot(design_matrix, tensor))
-    return -pred[:, None] * design_matrix
+    pred = np.exp(np.dot(tensor, design_matrix.T))
+    return -pred[..., None] * design_matrix
+
+
+def _nlls_problem(design_matrix, data, weighting=None, sigma=None,
+                  jac=True):
+    """Residuals and Jacobian functions of the non-linear tensor fit of many
+    voxels, as used by `dipy.core.optimize.levenberg_marquardt`
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (N, g)
+        Signals of the voxels.
+    weighting : str, optional
+        None, 'sigma' or 'gmm', see `_nlls_err_func`.
+    sigma : float or float array (g, ) or (N, g), optional
+        Noise level of the 'sigma' weighting. Infinite values remove data
+        points from the fit.
+    jac : bool
+        Whether to return the analytic Jacobian function, or None for a
+        Jacobian estimated by forward differences.
+
+    Returns
+    -------
+    residuals : callable ``residuals(tensor, index)``
+        Weighted residuals of the voxels `index` for the parameters `tensor`
+        of shape (n, 7). Unlike `_nlls_err_func`, their sign is kept.
+    jacobian : callable ``jacobian(tensor, index)`` or None
+        Jacobian of the weighted residuals, from `_nlls_jacobian_func`.
+    """
+    if weighting == 'sigma' and np.ndim(sigma) == 2:
+        voxel_sigma = True
+    else:
+        voxel_sigma = False
+
+    def weights(residuals, index):
+        if voxel_sigma:
+            return np.sqrt(_nlls_weights(residuals, weighting, sigma[index]))
+        return np.sqrt(_nlls_weights(residuals, weighting, sigma))
+
+    def residuals(tensor, index):
+        res = _nlls_err_func(tensor, design_matrix, data[index])
+        if weighting is None:
+            return res
+        return weights(res, index) * res
+
+    def jacobian(tensor, index):
+        J = _nlls_jacobian_func(tensor, design_matrix, data[index])
+        if weighting is None:
+            return J
+        res = _nlls_err_func(tensor, design_matrix, data[index])
+        return weights(res, index)[..., None] * J
+
+    return residuals, jacobian if jac else None
+
+
+def _nlls_params(tensor, start_params):
+    """Eigen-values and eigen-vectors of the tensors fit by the non-linear
+    methods, falling back to the starting tensors where the fit failed"""
+    failed = ~np.isfinite(tensor).all(-1)
+    tensor[failed] = start_params[failed]
+    return eig_from_lo_tri(tensor[..., :6])
 
 
 def nlls_fit_tensor(design_matrix, data, weighting=None,
-                    sigma=None, jac=True):
+                    sigma=None, jac=True, step=1e4):
     """
     Fit the tensor params using non-linear least-squares.
 
@@ -1542,62 +1823,44 @@ def nlls_fit_tensor(design_matrix, data, weighting=None,
     jac : bool
         Use the Jacobian? Default: True
 
+    step : int
+        The chunk size as a number of voxels. All the voxels of a chunk are
+        fit at once.
+
     Returns
     -------
     nlls_params: the eigen-values and eigen-vectors of the tensor in each
         voxel.
 
+    Notes
+    -----
+    The Levenberg-Marquardt iterations of all the voxels of a chunk are done
+    together by `dipy.core.optimize.levenberg_marquardt`.
+
     """
     # Flatten for the iteration over voxels:
     flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-
-    # Flatten for the iteration over voxels:
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
+    if np.any(np.all(flat_data == 0, axis=-1)):
+        raise ValueError("The data in this voxel contains only zeros")
     # 12 parameters per voxel (evals + evecs):
     dti_params = np.empty((flat_data.shape[0], 12))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do the optimization in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma))
-
-        # The parameters are the evals and the evecs:
-        try:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(this_tensor[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-        # If leastsq failed to converge and produced nans, we'll resort to the
-        # OLS solution in this voxel:
-        except np.linalg.LinAlgError:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(start_params[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
+    step = int(step)
+    for i in range(0, flat_data.shape[0], step):
+        chunk = flat_data[i:i + step]
+        # Use the OLS method parameters as the starting point for the
+        # optimization:
+        start_params = _ols_params(design_matrix, chunk)
+        residuals, jacobian = _nlls_problem(design_matrix, chunk, weighting,
+                                            sigma, jac)
+        tensor, converged = levenberg_marquardt(residuals, start_params,
+                                                jacobian)
+        dti_params[i:i + step] = _nlls_params(tensor, start_params)
 
     dti_params.shape = data.shape[:-1] + (12,)
     return dti_params
 
 
-def restore_fit_tensor(design_matrix, data, sigma=None, jac=True):
+def restore_fit_tensor(design_matrix, data, sigma=None, jac=True, step=1e4):
     """
     Use the RESTORE algorithm [Chang2005]_ to calculate a robust tensor fit
 
@@ -1622,6 +1885,10 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True):
         optimization procedure used to fit the tensor paramters (see also
         :func:`nlls_fit_tensor`). Default: True
 
+    step : int, optional
+        The chunk size as a number of voxels. All the voxels of a chunk are
+        fit at once.
+
 
     Returns
     -------
@@ -1632,105 +1899,76 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True):
     Chang, L-C, Jones, DK and Pierpaoli, C (2005). RESTORE: robust estimation
     of tensors by outlier rejection. MRM, 53: 1088-95.
 
+    Each stage of the algorithm is done for all the voxels of a chunk at
+    once, the second and third stages only on the voxels that still have
+    outliers. Outliers are removed from the last fit by giving them a null
+    weight.
+
     """
     # Flatten for the iteration over voxels:
     flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
+    if np.any(np.all(flat_data == 0, axis=-1)):
+        raise ValueError("The data in this voxel contains only zeros")
     # 12 parameters per voxel (evals + evecs):
     dti_params = np.empty((flat_data.shape[0], 12))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do nlls using sigma weighting in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma))
-
-        # Get the residuals:
-        pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-        residuals = flat_data[vox] - pred_sig
+    step = int(step)
+    for i in range(0, flat_data.shape[0], step):
+        chunk = flat_data[i:i + step]
+        # Use the OLS method parameters as the starting point for the
+        # optimization:
+        start_params = _ols_params(design_matrix, chunk)
+        # Do nlls using sigma weighting in all voxels:
+        residuals, jacobian = _nlls_problem(design_matrix, chunk, 'sigma',
+                                            sigma, jac)
+        tensor, converged = levenberg_marquardt(residuals, start_params,
+                                                jacobian)
+
         # If any of the residuals are outliers (using 3 sigma as a criterion
-        # following Chang et al., e.g page 1089):
-        if np.any(np.abs(residuals) > 3 * sigma):
-            # Do nlls with GMM-weighting:
-            if jac:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'),
-                                                  Dfun=_nlls_jacobian_func)
-            else:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'))
+        # following Chang et al., e.g page 1089), do nlls with GMM-weighting:
+        outliers = _restore_outliers(design_matrix, chunk, tensor, sigma)
+        redo = np.flatnonzero(outliers.any(-1))
+        if len(redo):
+            residuals, jacobian = _nlls_problem(design_matrix, chunk[redo],
+                                                'gmm', jac=jac)
+            tensor[redo], converged = levenberg_marquardt(
+                residuals, start_params[redo], jacobian)
 
             # How are you doin' on those residuals?
-            pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-            residuals = flat_data[vox] - pred_sig
-            if np.any(np.abs(residuals) > 3 * sigma):
-                # If you still have outliers, refit without those outliers:
-                non_outlier_idx = np.where(np.abs(residuals) <= 3 * sigma)
-                clean_design = design_matrix[non_outlier_idx]
-                clean_sig = flat_data[vox][non_outlier_idx]
-                if np.iterable(sigma):
-                    this_sigma = sigma[non_outlier_idx]
-                else:
-                    this_sigma = sigma
-
-                if jac:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma),
-                                                      Dfun=_nlls_jacobian_func)
-                else:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma))
-
-        # The parameters are the evals and the evecs:
-        try:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(this_tensor[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-        # If leastsq failed to converge and produced nans, we'll resort to the
-        # OLS solution in this voxel:
-        except np.linalg.LinAlgError:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(start_params[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
+            outliers = _restore_outliers(design_matrix, chunk[redo],
+                                         tensor[redo], sigma)
+            still = outliers.any(-1)
+            redo = redo[still]
+        if len(redo):
+            # If you still have outliers, refit without those outliers:
+            this_sigma = np.empty(outliers[still].shape)
+            this_sigma[:] = sigma
+            this_sigma[outliers[still]] = np.inf
+            residuals, jacobian = _nlls_problem(design_matrix, chunk[redo],
+                                                'sigma', this_sigma, jac)
+            tensor[redo], converged = levenberg_marquardt(
+                residuals, start_params[redo], jacobian)
+
+        dti_params[i:i + step] = _nlls_params(tensor, start_params)
 
     dti_params.shape = data.shape[:-1] + (12,)
     restore_params = dti_params
     return restore_params
 
 
+def _restore_outliers(design_matrix, data, tensor, sigma):
+    """Data points with residuals larger than 3 sigma, as used by RESTORE"""
+    with np.errstate(invalid='ignore', over='ignore'):
+        residuals = _nlls_err_func(tensor, design_matrix, data)
+        return np.abs(residuals) > 3 * np.asarray(sigma)
+
+
+def _ols_params(design_matrix, data):
+    """OLS estimates of the tensor elements and -log(S0), used as starting
+    point of the non-linear fits"""
+    inv_design = np.linalg.pinv(design_matrix)
+    return np.dot(np.log(data), inv_design.T)
+
+
 _lt_indices = np.array([[0, 1, 3],
                         [1, 2, 4],
                         [3, 4, 5]])
@@ -11,12 +11,14 @@ import scipy.optimize as opt
 from dipy.reconst.base import ReconstModel
 
 from dipy.reconst.dti import (TensorFit, design_matrix, decompose_tensor,
-                              from_lower_triangular, lower_triangular)
+                              from_lower_triangular, lower_triangular,
+                              _nlls_weights)
 from dipy.reconst.dki import _positive_evals
 
 from dipy.reconst.vec_val_sum import vec_val_vect
 from dipy.core.ndindex import ndindex
 from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.core.optimize import levenberg_marquardt
 
 
 def fwdti_prediction(params, gtab, S0=1, Diso=3.0e-3):
@@ -135,7 +137,6 @@ class FreeWaterTensorModel(ReconstModel):
             mes = "fwdti fit requires data for at least 2 non zero b-values"
             raise ValueError(mes)
 
-    @multi_voxel_fit
     def fit(self, data, mask=None):
         """ Fit method of the free water elimination DTI model class
 
@@ -146,7 +147,21 @@ class FreeWaterTensorModel(ReconstModel):
         mask : array
             A boolean array used to mark the coordinates in the data that
             should be analyzed that has the shape data.shape[:-1]
+
+        Notes
+        -----
+        The non-linear fits of all the voxels are done at once by
+        `nls_fit_tensor`, other fit methods are applied voxel by voxel.
         """
+        if self.fit_method is nls_iter:
+            kwargs = dict(zip(_nls_iter_params, self.args), **self.kwargs)
+            fwdti_params = nls_fit_tensor(self.gtab, data, mask, **kwargs)
+            return FreeWaterTensorFit(self, fwdti_params)
+        return self._voxel_fit(data, mask)
+
+    @multi_voxel_fit
+    def _voxel_fit(self, data, mask=None):
+        """ Fits `fit_method` to each voxel of data """
         S0 = np.mean(data[self.gtab.b0s_mask])
         fwdti_params = self.fit_method(self.design_matrix, data, S0,
                                        *self.args, **self.kwargs)
@@ -440,19 +455,19 @@ def _nls_err_func(tensor_elements, design_matrix, data, Diso=3e-3,
         See fwdti.nls_fit_tensor
         Default: True
     """
-    tensor = np.copy(tensor_elements)
+    tensor = np.array(tensor_elements, dtype=float)
     if cholesky:
-        tensor[:6] = cholesky_to_lower_triangular(tensor[:6])
+        tensor[..., :6] = cholesky_to_lower_triangular(tensor[..., :6])
 
     if f_transform:
-        f = 0.5 * (1 + np.sin(tensor[7] - np.pi/2))
+        f = 0.5 * (1 + np.sin(tensor[..., 7] - np.pi/2))
     else:
-        f = tensor[7]
+        f = tensor[..., 7]
+    f = np.asarray(f)[..., None]
 
     # This is the predicted signal given the params:
-    y = (1-f) * np.exp(np.dot(design_matrix, tensor[:7])) + \
-        f * np.exp(np.dot(design_matrix,
-                          np.array([Diso, 0, Diso, 0, 0, Diso, tensor[6]])))
+    y = (1-f) * np.exp(np.dot(tensor[..., :7], design_matrix.T)) + \
+        f * np.exp(np.dot(_free_water_tensor(tensor, Diso), design_matrix.T))
 
     # Compute the residuals
     residuals = data - y
@@ -462,24 +477,7 @@ def _nls_err_func(tensor_elements, design_matrix, data, Diso=3e-3,
         # And we return the SSE:
         return residuals
     se = residuals ** 2
-    # If the user provided a sigma (e.g 1.5267 * std(background_noise), as
-    # suggested by Chang et al.) we will use it:
-    if weighting == 'sigma':
-        if sigma is None:
-            e_s = "Must provide sigma value as input to use this weighting"
-            e_s += " method"
-            raise ValueError(e_s)
-        w = 1/(sigma**2)
-
-    elif weighting == 'gmm':
-        # We use the Geman McClure M-estimator to compute the weights on the
-        # residuals:
-        C = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            w = 1/(se + C**2)
-            # The weights are normalized to the mean weight (see p. 1089):
-            w = w/np.mean(w)
+    w = _nlls_weights(residuals, weighting, sigma)
 
     # Return the weighted residuals:
     with warnings.catch_warnings():
@@ -487,6 +485,15 @@ def _nls_err_func(tensor_elements, design_matrix, data, Diso=3e-3,
         return np.sqrt(w * se)
 
 
+def _free_water_tensor(tensor, Diso):
+    """ Parameters of the free water compartment, an isotropic tensor of
+    diffusivity Diso with the S0 of `tensor` """
+    fw = np.zeros(tensor.shape[:-1] + (7, ))
+    fw[..., [0, 2, 5]] = Diso
+    fw[..., 6] = tensor[..., 6]
+    return fw
+
+
 def _nls_jacobian_func(tensor_elements, design_matrix, data, Diso=3e-3,
                        weighting=None, sigma=None, cholesky=False,
                        f_transform=False):
@@ -512,24 +519,23 @@ def _nls_jacobian_func(tensor_elements, design_matrix, data, Diso=3e-3,
         See fwdti.nls_fit_tensor
         Default: True
     """
-    tensor = np.copy(tensor_elements)
+    tensor = np.asarray(tensor_elements, dtype=float)
     if f_transform:
-        f = 0.5 * (1 + np.sin(tensor[7] - np.pi/2))
+        f = 0.5 * (1 + np.sin(tensor[..., 7] - np.pi/2))
     else:
-        f = tensor[7]
+        f = tensor[..., 7]
+    f = np.asarray(f)[..., None]
 
-    t = np.exp(np.dot(design_matrix, tensor[:7]))
-    s = np.exp(np.dot(design_matrix,
-                      np.array([Diso, 0, Diso, 0, 0, Diso, tensor[6]])))
-    T = (f-1.0) * t[:, None] * design_matrix
-    S = np.zeros(design_matrix.shape)
-    S[:, 6] = f * s
+    t = np.exp(np.dot(tensor[..., :7], design_matrix.T))
+    s = np.exp(np.dot(_free_water_tensor(tensor, Diso), design_matrix.T))
+    T = ((f-1.0) * t)[..., None] * design_matrix
+    T[..., 6] -= f * s
 
     if f_transform:
-        df = (t-s) * (0.5*np.cos(tensor[7]-np.pi/2))
+        df = (t-s) * (0.5*np.cos(tensor[..., 7, None]-np.pi/2))
     else:
         df = (t-s)
-    return np.concatenate((T - S, df[:, None]), axis=1)
+    return np.concatenate((T, df[..., None]), axis=-1)
 
 
 def nls_iter(design_matrix, sig, S0, Diso=3e-3, mdreg=2.7e-3,
@@ -641,6 +647,12 @@ def nls_iter(design_matrix, sig, S0, Diso=3e-3, mdreg=2.7e-3,
     return params
 
 
+# Names of the arguments of nls_iter following S0, which nls_fit_tensor
+# takes in another order
+_nls_iter_params = ('Diso', 'mdreg', 'min_signal', 'cholesky', 'f_transform',
+                    'jac', 'weighting', 'sigma')
+
+
 def nls_fit_tensor(gtab, data, mask=None, Diso=3e-3, mdreg=2.7e-3,
                    min_signal=1.0e-6, f_transform=True, cholesky=False,
                    jac=False, weighting=None, sigma=None):
@@ -701,6 +713,12 @@ def nls_fit_tensor(gtab, data, mask=None, Diso=3e-3, mdreg=2.7e-3,
             2) Three lines of the eigenvector matrix each containing the
                first, second and third coordinates of the eigenvector
             3) The volume fraction of the free water compartment
+
+    Notes
+    -----
+    The initial guesses are given by `wls_iter`. The non-linear fits of all
+    the voxels with significant signal from tissue are then done at once by
+    `dipy.core.optimize.levenberg_marquardt`.
     """
     fw_params = np.zeros(data.shape[:-1] + (13,))
     W = design_matrix(gtab)
@@ -714,32 +732,120 @@ def nls_fit_tensor(gtab, data, mask=None, Diso=3e-3, mdreg=2.7e-3,
         mask = np.array(mask, dtype=bool, copy=False)
 
     # Prepare S0
-    S0 = np.mean(data[:, :, :, gtab.b0s_mask], axis=-1)
+    S0 = np.mean(data[..., gtab.b0s_mask], axis=-1)
 
+    # Initial guess
     index = ndindex(mask.shape)
     for v in index:
         if mask[v]:
-            params = nls_iter(W, data[v], S0[v], Diso=Diso, mdreg=mdreg,
-                              min_signal=min_signal, f_transform=f_transform,
-                              cholesky=cholesky, jac=jac, weighting=weighting,
-                              sigma=sigma)
-            fw_params[v] = params
+            fw_params[v] = wls_iter(W, data[v], S0[v], min_signal=min_signal,
+                                    Diso=Diso, mdreg=mdreg)
+
+    # Voxels with significant signal from tissue are processed all at once
+    tissue = mask & (fw_params[..., 12] < 0.99)
+    tissue &= (np.mean(data, axis=-1) > min_signal) & (S0 > min_signal)
+    if not np.any(tissue):
+        return fw_params
+    sig = data[tissue]
+    params = fw_params[tissue]
+
+    # converting evals and evecs to diffusion tensor elements
+    evals = params[:, :3]
+    evecs = params[:, 3:12].reshape((-1, 3, 3))
+    dt = lower_triangular(vec_val_vect(evecs, evals))
+
+    # Cholesky decomposition if requested
+    if cholesky:
+        dt = lower_triangular_to_cholesky(dt)
+
+    # f transformation if requested
+    if f_transform:
+        f = np.arcsin(2*params[:, 12] - 1) + np.pi/2
+    else:
+        f = params[:, 12]
+
+    start_params = np.concatenate((dt, -np.log(S0[tissue])[:, None],
+                                   f[:, None]), axis=-1)
+    residuals, jacobian = _nls_problem(W, sig, Diso, weighting, sigma,
+                                       cholesky, f_transform, jac)
+    this_tensor, converged = levenberg_marquardt(residuals, start_params,
+                                                 jacobian)
+    # Voxels where the fit diverged keep their initial guess
+    failed = ~np.isfinite(this_tensor).all(axis=-1)
+    this_tensor[failed] = start_params[failed]
+
+    # Invert the cholesky decomposition if this was requested
+    if cholesky:
+        this_tensor[:, :6] = cholesky_to_lower_triangular(this_tensor[:, :6])
+
+    # Invert f transformation if this was requested
+    if f_transform:
+        this_tensor[:, 7] = 0.5 * (1 + np.sin(this_tensor[:, 7] - np.pi/2))
 
+    # The parameters are the evals and the evecs:
+    evals, evecs = decompose_tensor(from_lower_triangular(this_tensor[:, :6]))
+    fw_params[tissue] = np.concatenate((evals, evecs.reshape((-1, 9)),
+                                        this_tensor[:, 7:8]), axis=-1)
     return fw_params
 
 
+def _nls_problem(design_matrix, data, Diso=3e-3, weighting=None, sigma=None,
+                 cholesky=False, f_transform=False, jac=False):
+    """ Residuals and Jacobian functions of the non-linear free water fit of
+    many voxels, as used by `dipy.core.optimize.levenberg_marquardt`
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        The design matrix
+    data : array (N, g)
+        The signals of the voxels
+    Diso, weighting, sigma, cholesky, f_transform : see `_nls_err_func`
+    jac : bool
+        Whether to return the analytic Jacobian function, or None for a
+        Jacobian estimated by forward differences.
+
+    Returns
+    -------
+    residuals : callable ``residuals(params, index)``
+        Weighted residuals of the voxels `index` for the parameters `params`
+        of shape (n, 8). Unlike `_nls_err_func`, their sign is kept.
+    jacobian : callable ``jacobian(params, index)`` or None
+        Jacobian of the weighted residuals, from `_nls_jacobian_func`.
+    """
+    def errors(params, index):
+        return _nls_err_func(params, design_matrix, data[index], Diso,
+                             cholesky=cholesky, f_transform=f_transform)
+
+    def residuals(params, index):
+        res = errors(params, index)
+        if weighting is None:
+            return res
+        return np.sqrt(_nlls_weights(res, weighting, sigma)) * res
+
+    def jacobian(params, index):
+        J = _nls_jacobian_func(params, design_matrix, data[index], Diso,
+                               cholesky=cholesky, f_transform=f_transform)
+        if weighting is None:
+            return J
+        w = _nlls_weights(errors(params, index), weighting, sigma)
+        return np.sqrt(w)[..., None] * J
+
+    return residuals, jacobian if jac else None
+
+
 def lower_triangular_to_cholesky(tensor_elements):
     """ Perfoms Cholesky decomposition of the diffusion tensor
 
     Parameters
     ----------
-    tensor_elements : array (6,)
+    tensor_elements : array (..., 6)
         Array containing the six elements of diffusion tensor's lower
         triangular.
 
     Returns
     -------
-    cholesky_elements : array (6,)
+    cholesky_elements : array (..., 6)
         Array containing the six Cholesky's decomposition elements
         (R0, R1, R2, R3, R4, R5) [1]_.
 
@@ -750,14 +856,16 @@ def lower_triangular_to_cholesky(tensor_elements):
            tensor-derived quantities in diffusion tensor imaging. Magnetic
            Resonance in Medicine, 55(4), 930-936. doi:10.1002/mrm.20832
     """
-    R0 = np.sqrt(tensor_elements[0])
-    R3 = tensor_elements[1] / R0
-    R1 = np.sqrt(tensor_elements[2] - R3**2)
-    R5 = tensor_elements[3] / R0
-    R4 = (tensor_elements[4] - R3*R5) / R1
-    R2 = np.sqrt(tensor_elements[5] - R4**2 - R5**2)
+    tensor_elements = np.asarray(tensor_elements)
+    R0 = np.sqrt(tensor_elements[..., 0])
+    R3 = tensor_elements[..., 1] / R0
+    R1 = np.sqrt(tensor_elements[..., 2] - R3**2)
+    R5 = tensor_elements[..., 3] / R0
+    R4 = (tensor_elements[..., 4] - R3*R5) / R1
+    R2 = np.sqrt(tensor_elements[..., 5] - R4**2 - R5**2)
 
-    return np.array([R0, R1, R2, R3, R4, R5])
+    R = np.array([R0, R1, R2, R3, R4, R5])
+    return np.rollaxis(R, 0, R.ndim)
 
 
 def cholesky_to_lower_triangular(R):
@@ -765,13 +873,13 @@ def cholesky_to_lower_triangular(R):
 
     Parameters
     ----------
-    R : array (6,)
+    R : array (..., 6)
         Array containing the six Cholesky's decomposition elements
         (R0, R1, R2, R3, R4, R5) [1]_.
 
     Returns
     -------
-    tensor_elements : array (6,)
+    tensor_elements : array (..., 6)
         Array containing the six elements of diffusion tensor's lower
         triangular.
 
@@ -782,13 +890,15 @@ def cholesky_to_lower_triangular(R):
            tensor-derived quantities in diffusion tensor imaging. Magnetic
            Resonance in Medicine, 55(4), 930-936. doi:10.1002/mrm.20832
     """
+    R = np.rollaxis(np.asarray(R), -1)
     Dxx = R[0]**2
     Dxy = R[0]*R[3]
     Dyy = R[1]**2 + R[3]**2
     Dxz = R[0]*R[5]
     Dyz = R[1]*R[4] + R[3]*R[5]
     Dzz = R[2]**2 + R[4]**2 + R[5]**2
-    return np.array([Dxx, Dxy, Dyy, Dxz, Dyz, Dzz])
+    D = np.array([Dxx, Dxy, Dyy, Dxz, Dyz, Dzz])
+    return np.rollaxis(D, 0, D.ndim)
 
 
 common_fit_methods = {'WLLS': wls_iter,
@@ -3,7 +3,7 @@ import numpy as np
 from .odf import OdfModel, OdfFit, gfa
 from .cache import Cache
 import warnings
-from .multi_voxel import multi_voxel_fit
+from .multi_voxel import batch_voxel_fit
 from .recspeed import local_maxima, remove_similar_vertices
 
 
@@ -78,7 +78,7 @@ class GeneralizedQSamplingModel(OdfModel, Cache):
         b_vector = gradsT * tmp # element-wise product
         self.b_vector = b_vector.T
 
-    @multi_voxel_fit
+    @batch_voxel_fit
     def fit(self, data):
         return GeneralizedQSamplingFit(self, data)
 
@@ -92,8 +92,9 @@ class GeneralizedQSamplingFit(OdfFit):
         ----------
         model : object,
             DiffusionSpectrumModel
-        data : 1d ndarray,
-            signal values
+        data : ndarray,
+            signal values, of a single voxel or of a stack of voxels with
+            the signal along the last axis
 
         """
         OdfFit.__init__(self, model, data)
@@ -103,6 +104,11 @@ class GeneralizedQSamplingFit(OdfFit):
         self._peak_indices = None
         self._qa = None
 
+    def __getitem__(self, index):
+        """Select the fit of some of the voxels stacked along the first axis
+        of the data"""
+        return GeneralizedQSamplingFit(self.model, self.data[index])
+
     def odf(self, sphere):
         """ Calculates the discrete ODF for a given discrete sphere.
         """
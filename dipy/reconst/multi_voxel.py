@@ -1,4 +1,7 @@
 """Tools to easily make multi voxel models"""
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 
@@ -17,14 +20,7 @@ def multi_voxel_fit(single_voxel_fit):
         if data.ndim == 1:
             return single_voxel_fit(self, data)
 
-        # Make a mask if mask is None
-        if mask is None:
-            shape = data.shape[:-1]
-            strides = (0,) * len(shape)
-            mask = as_strided(np.array(True), shape=shape, strides=strides)
-        # Check the shape of the mask if mask is not None
-        elif mask.shape != data.shape[:-1]:
-            raise ValueError("mask and data shape do not match")
+        mask = _check_mask(data, mask)
 
         # Fit data where mask is True
         fit_array = np.empty(data.shape[:-1], dtype=object)
@@ -35,6 +31,41 @@ def multi_voxel_fit(single_voxel_fit):
     return new_fit
 
 
+def batch_voxel_fit(batch_fit):
+    """Method decorator to turn a batched model fit definition into a multi
+    voxel model fit definition
+
+    The decorated method is called once with a 2D array of shape ``(N, K)``
+    holding the signal of the N voxels to fit, and must return a single fit
+    object for all of them. The parameters of that fit are stored as dense
+    arrays with the voxels along their first axis, so its array attributes
+    and the results of its methods must also have N as their first
+    dimension. The fit object must support indexing along that axis, which
+    is used to select single voxels or sub-volumes.
+    """
+    def new_fit(self, data, mask=None):
+        """Fit method for all voxels in data at once"""
+        # If only one voxel fit it as a batch of one
+        if data.ndim == 1:
+            return batch_fit(self, data[None])[0]
+
+        mask = _check_mask(data, mask)
+        mask = np.array(mask, dtype=bool)
+        return BatchVoxelFit(self, batch_fit(self, data[mask]), mask)
+    return new_fit
+
+
+def _check_mask(data, mask):
+    """Make a mask if mask is None, otherwise check its shape"""
+    if mask is None:
+        shape = data.shape[:-1]
+        strides = (0,) * len(shape)
+        mask = as_strided(np.array(True), shape=shape, strides=strides)
+    elif mask.shape != data.shape[:-1]:
+        raise ValueError("mask and data shape do not match")
+    return mask
+
+
 class MultiVoxelFit(ReconstFit):
     """Holds an array of fits and allows access to their attributes and
     methods"""
@@ -108,3 +139,302 @@ class CallableArray(np.ndarray):
             if item is not None:
                 result[ijk] = item(*args, **kwargs)
         return _squash(result)
+
+
+class BatchVoxelFit(ReconstFit):
+    """Holds a single fit of all the voxels in a mask and allows access to
+    its attributes and methods as volumes
+
+    Parameters
+    ----------
+    model : ReconstModel
+        The model that produced the fit.
+    batch_fit : object
+        Fit of the N voxels where `mask` is True. Array attributes of
+        `batch_fit`, and arrays returned by its methods, with N rows have
+        these voxels along their first axis, other values are returned
+        unchanged.
+    mask : array, dtype=bool
+        Volume of voxels covered by `batch_fit`, in C order.
+    """
+    def __init__(self, model, batch_fit, mask):
+        self.model = model
+        self.batch_fit = batch_fit
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def _to_volume(self, value):
+        """Scatter per-voxel values back into the volume, zero elsewhere
+
+        Values that are not arrays with one row per fitted voxel, such as
+        parameters shared by all voxels, are returned unchanged.
+        """
+        if (not isinstance(value, np.ndarray) or value.ndim == 0 or
+                value.shape[0] != np.count_nonzero(self.mask)):
+            return value
+        result = np.zeros(self.mask.shape + value.shape[1:], dtype=value.dtype)
+        result[self.mask] = value
+        return result
+
+    def __getattr__(self, attr):
+        if attr == 'batch_fit':
+            # Not set yet, as happens while unpickling
+            raise AttributeError(attr)
+        value = getattr(self.batch_fit, attr)
+        if not callable(value):
+            return self._to_volume(value)
+
+        def method(*args, **kwargs):
+            return self._to_volume(value(*args, **kwargs))
+        return method
+
+    def __getitem__(self, index):
+        rows = np.empty(self.mask.shape, dtype=np.intp)
+        rows.fill(-1)
+        rows[self.mask] = np.arange(self.mask.sum())
+        rows = rows[index]
+        if rows.ndim == 0:
+            return None if rows < 0 else self.batch_fit[rows]
+        new_mask = rows >= 0
+        return BatchVoxelFit(self.model, self.batch_fit[rows[new_mask]],
+                             new_mask)
+
+    def predict(self, *args, **kwargs):
+        """
+        Predict for the multi-voxel object using the batch fit's prediction
+        API, with S0 provided from an array.
+        """
+        if not hasattr(self.model, 'predict'):
+            msg = "This model does not have prediction implemented yet"
+            raise NotImplementedError(msg)
+
+        S0 = kwargs.get('S0', 1.)
+        if isinstance(S0, np.ndarray) and S0.shape == self.mask.shape:
+            kwargs['S0'] = S0[self.mask]
+        return self._to_volume(self.batch_fit.predict(*args, **kwargs))
+
+
+# Models fitted by parallel_fit, sent once to each worker rather than with
+# every chunk
+_shared_models = {}
+
+
+def _share_model(key, model):
+    """Pool initializer storing the model of parallel_fit in the worker"""
+    _shared_models[key] = model
+
+
+def _fit_chunk(args):
+    """Fit one chunk of voxels, at module level so it can be pickled"""
+    key, data = args
+    return _shared_models[key].fit(data)
+
+
+def parallel_fit(model, data, mask=None, num_workers=None, chunk_size=10000,
+                 use_processes=False):
+    """Fit a model to the voxels of data in chunks, using a pool of workers
+
+    Parameters
+    ----------
+    model : ReconstModel
+        Any model whose fit method accepts a 2D array of shape ``(N, K)``
+        holding the signal of N voxels.
+    data : array, shape (..., K)
+        The signal, with the diffusion weighted volumes along the last axis.
+    mask : array, dtype=bool, optional
+        Only the voxels where `mask` is True are fitted.
+    num_workers : int, optional
+        Number of threads or processes. By default one per CPU. With one
+        worker the chunks are fit serially in the calling thread.
+    chunk_size : int, optional
+        Number of voxels handed to the model's fit method at once.
+    use_processes : bool, optional
+        Fit in a pool of processes instead of a pool of threads. Threads
+        share the data and the fitted parameters without copies and are
+        enough for models that spend their time in numpy and scipy routines
+        releasing the GIL, processes suit models with Python loops over
+        voxels but require a picklable model and fit.
+
+    Returns
+    -------
+    fit : ChunkedVoxelFit
+        The fits of the chunks, in the C order of the voxels in `mask`,
+        whatever the number of workers.
+    """
+    mask = np.array(_check_mask(data, mask), dtype=bool)
+    index = np.flatnonzero(mask)
+    chunk_size = max(int(chunk_size), 1)
+    bounds = [(start, min(start + chunk_size, len(index)))
+              for start in range(0, len(index), chunk_size)]
+    # Only the voxels of each chunk are copied out of data
+    data = data.reshape((-1, data.shape[-1]))
+    key = id(model)
+    chunks = ((key, data[index[start:stop]]) for start, stop in bounds)
+
+    if num_workers is None:
+        num_workers = cpu_count()
+    # Threads and forked processes see the model of the calling process,
+    # other processes receive it once, through the pool initializer
+    _shared_models[key] = model
+    try:
+        if num_workers < 2 or len(bounds) < 2:
+            chunk_fits = [_fit_chunk(args) for args in chunks]
+        else:
+            if use_processes:
+                pool = Pool(num_workers, _share_model, (key, model))
+            else:
+                pool = ThreadPool(num_workers)
+            try:
+                # imap keeps the chunk order, unlike imap_unordered
+                chunk_fits = list(pool.imap(_fit_chunk, chunks))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        del _shared_models[key]
+    template = None
+    if len(index) == 0:
+        # Nothing to fit, a fit of one voxel gives the shape and type of the
+        # volumes of zeros
+        template = model.fit(data[:1])
+    return ChunkedVoxelFit(model, chunk_fits, bounds, mask, template)
+
+
+class ChunkedVoxelFit(ReconstFit):
+    """Holds the fits of consecutive chunks of the voxels in a mask and
+    allows access to their attributes and methods as volumes
+
+    Parameters
+    ----------
+    model : ReconstModel
+        The model that produced the fits.
+    chunk_fits : list
+        One fit per chunk, each holding its voxels along the first axis of
+        its array attributes, like the fit returned by ``model.fit`` for a
+        2D array of signals.
+    bounds : list of tuples
+        The ``(start, stop)`` positions of the voxels of each chunk among the
+        voxels in `mask`, in C order.
+    mask : array, dtype=bool
+        Volume of voxels covered by the chunks.
+    template : object, optional
+        Fit of a single voxel, required when there is no voxel in `mask`
+        and thus no chunk. Its attributes and the results of its methods
+        give the shape and type of the volumes, which are then all zeros.
+    """
+    def __init__(self, model, chunk_fits, bounds, mask, template=None):
+        if len(chunk_fits) == 0 and template is None:
+            raise ValueError("A template fit is needed without chunks")
+        self.model = model
+        self.chunk_fits = chunk_fits
+        self.bounds = bounds
+        self.mask = mask
+        self.template = template
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def _fits(self):
+        """The fits of the chunks, or the template fit without chunks"""
+        return self.chunk_fits or [self.template]
+
+    def _to_volume(self, values):
+        """Write the per-chunk values in place into a volume, zero
+        elsewhere
+
+        Values that are not arrays with one row per voxel of their chunk,
+        such as parameters shared by all voxels, are returned unchanged.
+        """
+        if self.chunk_fits:
+            sizes = [stop - start for start, stop in self.bounds]
+        else:
+            # The template fit has a single voxel
+            sizes = [1]
+        if not all(isinstance(value, np.ndarray) and value.ndim > 0 and
+                   value.shape[0] == size
+                   for value, size in zip(values, sizes)):
+            return values[0]
+        dtype = np.result_type(*values)
+        tail = values[0].shape[1:]
+        result = np.zeros(self.mask.shape + tail, dtype=dtype)
+        flat_result = result.reshape((-1,) + tail)
+        index = np.flatnonzero(self.mask)
+        for (start, stop), value in zip(self.bounds, values):
+            flat_result[index[start:stop]] = value
+        return result
+
+    def __getattr__(self, attr):
+        if attr in ('chunk_fits', 'template'):
+            # Not set yet, as happens while unpickling
+            raise AttributeError(attr)
+        values = [getattr(fit, attr) for fit in self._fits()]
+        if not callable(values[0]):
+            return self._to_volume(values)
+
+        def method(*args, **kwargs):
+            return self._to_volume([value(*args, **kwargs)
+                                    for value in values])
+        return method
+
+    def __getitem__(self, index):
+        rows = np.empty(self.mask.shape, dtype=np.intp)
+        rows.fill(-1)
+        rows[self.mask] = np.arange(self.mask.sum())
+        rows = rows[index]
+        starts = np.array([start for start, stop in self.bounds])
+        if rows.ndim == 0:
+            if rows < 0:
+                return None
+            chunk = np.searchsorted(starts, rows, 'right') - 1
+            return self.chunk_fits[chunk][rows - starts[chunk]]
+
+        new_mask = rows >= 0
+        rows = rows[new_mask]
+        chunks = np.searchsorted(starts, rows, 'right') - 1
+        # Split the selected voxels into runs falling in the same chunk
+        splits = np.flatnonzero(np.diff(chunks)) + 1
+        chunk_fits = []
+        bounds = []
+        start = 0
+        for run in np.split(np.arange(len(rows)), splits):
+            if len(run) == 0:
+                continue
+            chunk = chunks[run[0]]
+            chunk_fits.append(self.chunk_fits[chunk][rows[run] -
+                                                     starts[chunk]])
+            bounds.append((start, start + len(run)))
+            start += len(run)
+        template = None
+        if len(chunk_fits) == 0:
+            template = self._fits()[0][np.zeros(1, dtype=np.intp)]
+        return ChunkedVoxelFit(self.model, chunk_fits, bounds, new_mask,
+                               template)
+
+    def predict(self, *args, **kwargs):
+        """
+        Predict for the multi-voxel object using each chunk's prediction
+        API, with S0 provided from an array.
+        """
+        if not hasattr(self.model, 'predict'):
+            msg = "This model does not have prediction implemented yet"
+            raise NotImplementedError(msg)
+
+        S0 = kwargs.get('S0', 1.)
+        if not self.chunk_fits:
+            if isinstance(S0, np.ndarray) and S0.shape == self.mask.shape:
+                kwargs['S0'] = 1.
+            return self._to_volume([self.template.predict(*args, **kwargs)])
+        if isinstance(S0, np.ndarray) and S0.shape == self.mask.shape:
+            S0 = S0[self.mask]
+        else:
+            S0 = None
+        values = []
+        for (start, stop), fit in zip(self.bounds, self.chunk_fits):
+            if S0 is not None:
+                kwargs['S0'] = S0[start:stop]
+            values.append(fit.predict(*args, **kwargs))
+        return self._to_volume(values)
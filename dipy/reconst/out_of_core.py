@@ -0,0 +1,117 @@
+""" Reconstruction of volumes larger than memory
+
+The diffusion weighted volume is read slab by slab, each slab is fitted with
+any reconstruction model and the requested attributes of its fit are written
+to NIfTI files mapped to memory, so that neither the signal nor the results
+of the whole volume are ever held in memory.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import nibabel as nib
+
+from dipy.io.image import iter_nifti_slabs, nifti_memmap
+from dipy.utils.six import string_types
+
+# Models hold a few float64 copies of the signal of the voxels they fit at
+# once: the data, the log signal, the weights, the predicted signal...
+_WORKING_COPIES = 4
+
+
+def slab_thickness(shape, memory_budget, working_copies=_WORKING_COPIES):
+    """ Number of slices of the slabs fitted within a memory budget
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the diffusion weighted volume (x, y, z, g).
+    memory_budget : int
+        Memory available for the signal of a slab, in bytes.
+    working_copies : int, optional
+        Number of float64 copies of the signal used by the fit.
+
+    Returns
+    -------
+    nb_slices : int
+        Number of slices along the third axis, at least one.
+    """
+    slice_bytes = 8 * working_copies * int(np.prod(shape[:2])) * \
+        int(np.prod(shape[3:]))
+    return int(min(max(memory_budget // max(slice_bytes, 1), 1), shape[2]))
+
+
+def fit_out_of_core(model, dwi, outputs, mask=None, memory_budget=2 ** 30,
+                    dtype=np.float32):
+    """ Fit a model to a diffusion weighted volume, one slab at a time
+
+    Parameters
+    ----------
+    model : ReconstModel
+        The model fitted to each slab, with ``model.fit(data, mask=mask)``.
+    dwi : str or nibabel image
+        The 4D diffusion weighted volume, or its file name. An uncompressed
+        NIfTI file is read much faster.
+    outputs : dict
+        File names ('.nii') of the volumes to create, by attribute of the
+        fits to store in them, for instance ``{'model_params':
+        'tensors.nii', 'fa': 'fa.nii'}``. Attributes that are methods are
+        called without arguments.
+    mask : str, nibabel image or array, optional
+        Voxels of the volume to fit. Slabs without any voxel in the mask,
+        but the first one, are not fitted and their outputs are left to
+        zero.
+    memory_budget : int, optional
+        Memory, in bytes, used for the signal of the slab being fitted. The
+        thickness of the slabs is chosen accordingly. Default: 1 GB.
+    dtype : dtype, optional
+        Data type of the outputs. Default: float32.
+
+    Returns
+    -------
+    volumes : dict
+        The outputs, as arrays mapped to their files, by attribute.
+
+    Examples
+    --------
+    >>> from nibabel.tmpdirs import InTemporaryDirectory
+    >>> from dipy.data import get_data
+    >>> from dipy.core.gradients import gradient_table
+    >>> from dipy.reconst.dti import TensorModel
+    >>> fdata, fbvals, fbvecs = get_data('small_25')
+    >>> model = TensorModel(gradient_table(fbvals, fbvecs))
+    >>> with InTemporaryDirectory():
+    ...     volumes = fit_out_of_core(model, fdata, {'fa': 'fa.nii'},
+    ...                               memory_budget=10 ** 5)
+    ...     print(volumes['fa'].shape)
+    (10, 8, 2)
+    """
+    if not hasattr(dwi, 'dataobj'):
+        dwi = nib.load(dwi)
+    if isinstance(mask, string_types):
+        mask = nib.load(mask)
+    if hasattr(mask, 'dataobj'):
+        mask = mask.dataobj
+    nb_slices = slab_thickness(dwi.shape, memory_budget)
+
+    volumes = {}
+    for slab, data in iter_nifti_slabs(dwi, nb_slices):
+        slab_mask = None
+        if mask is not None:
+            slab_mask = np.asanyarray(mask[:, :, slab]).astype(bool)
+            if volumes and not slab_mask.any():
+                continue
+        if slab_mask is None:
+            fit = model.fit(data)
+        else:
+            fit = model.fit(data, mask=slab_mask)
+        del data
+        for name, fname in outputs.items():
+            value = getattr(fit, name)
+            value = np.asarray(value() if callable(value) else value)
+            if name not in volumes:
+                shape = dwi.shape[:3] + value.shape[3:]
+                volumes[name] = nifti_memmap(fname, shape, dtype,
+                                             dwi.affine)
+            volumes[name][:, :, slab] = value
+            volumes[name].flush()
+    return volumes
@@ -34,6 +34,7 @@ import dipy.data as dpd
 from dipy.reconst.base import ReconstModel, ReconstFit
 from dipy.reconst.cache import Cache
 from dipy.core.onetime import auto_attr
+from dipy.utils.parallel import map_chunks
 
 lm, has_sklearn, _ = optional_package('sklearn.linear_model')
 
@@ -291,6 +292,86 @@ def sfm_design_matrix(gtab, sphere, response, mode='signal'):
     return mat
 
 
+def _is_elastic_net(solver):
+    """Whether `solver` is an sklearn ElasticNet that `elastic_net_batch`
+    can fit in its place"""
+    if not has_sklearn or type(solver) not in (lm.ElasticNet, lm.Lasso):
+        return False
+    # Older versions of sklearn may scale the columns of the design matrix
+    return getattr(solver, 'normalize', False) in (False, 'deprecated')
+
+
+def elastic_net_batch(solver, X, y, num_workers=1, chunk_size=None):
+    """Fit an sklearn ElasticNet to many voxels sharing a design matrix
+
+    ``solver.fit(X, y[i])`` centers the design matrix and runs coordinate
+    descent on it again for every voxel. Here the design matrix is centered
+    and its Gram matrix computed once, the correlations of the design matrix
+    with the signals of a chunk of voxels are computed in a single product,
+    and the coordinate descent of sklearn runs on these precomputed
+    matrices. This minimizes the same objective as the solver, so the
+    coefficients are the same up to its tolerance.
+
+    Parameters
+    ----------
+    solver : sklearn.linear_model.ElasticNet
+        The solver whose parameters (alpha, l1_ratio, fit_intercept,
+        positive, tol, max_iter, selection, warm_start) are used.
+    X : array (n, p)
+        The design matrix.
+    y : array (N, n)
+        The signal of the N voxels.
+    num_workers : int, optional
+        Number of threads fitting chunks of voxels in parallel, None for one
+        per CPU. The coordinate descent releases the GIL. Default: 1.
+    chunk_size : int, optional
+        Maximum number of voxels of a chunk. Default: as many as fit in
+        `dipy.reconst.dti.FIT_MEMORY_BUDGET`.
+
+    Returns
+    -------
+    coef : array (N, p)
+        The coefficients of each voxel.
+
+    Notes
+    -----
+    When the solver has ``warm_start`` set, the coordinate descent of each
+    voxel starts from the coefficients of the previous voxel of its chunk,
+    which is a spatial neighbor for voxels in C order. Each chunk starts
+    from zeros, so that the coefficients do not depend on which thread
+    fitted the previous chunk.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if solver.fit_intercept:
+        X = X - X.mean(0)
+        y = y - y.mean(-1)[:, None]
+    X = np.asfortranarray(X)
+    y = np.ascontiguousarray(y)
+    gram = np.ascontiguousarray(np.dot(X.T, X))
+    coef = np.zeros((y.shape[0], X.shape[1]))
+    if chunk_size is None:
+        chunk_size = dti.FIT_MEMORY_BUDGET // (8 * X.shape[1])
+
+    def fit_chunk(chunk):
+        Xy = np.dot(y[chunk], X)
+        w = None
+        for i, vox in enumerate(chunk):
+            w = lm.enet_path(X, y[vox], l1_ratio=solver.l1_ratio,
+                             alphas=[solver.alpha], precompute=gram,
+                             Xy=Xy[i], coef_init=w, positive=solver.positive,
+                             tol=solver.tol, max_iter=solver.max_iter,
+                             selection=solver.selection,
+                             random_state=solver.random_state,
+                             check_input=False)[1][:, 0]
+            coef[vox] = w
+            if not solver.warm_start:
+                w = None
+
+    map_chunks(fit_chunk, np.arange(y.shape[0]), chunk_size, num_workers)
+    return coef
+
+
 class SparseFascicleModel(ReconstModel, Cache):
     def __init__(self, gtab, sphere=None, response=[0.0015, 0.0005, 0.0005],
                  solver='ElasticNet', l1_ratio=0.5, alpha=0.001, isotropic=None):
@@ -379,7 +460,7 @@ class SparseFascicleModel(ReconstModel, Cache):
         return sfm_design_matrix(self.gtab, self.sphere, self.response,
                                  'signal')
 
-    def fit(self, data, mask=None):
+    def fit(self, data, mask=None, num_workers=1):
         """
         Fit the SparseFascicleModel object to data.
 
@@ -393,10 +474,19 @@ class SparseFascicleModel(ReconstModel, Cache):
             should be analyzed. Has the shape `data.shape[:-1]`. Default: None,
             which implies that all points should be analyzed.
 
+        num_workers : int, optional
+            Number of threads fitting chunks of voxels in parallel with an
+            ElasticNet solver, None for one per CPU. Default: 1.
+
         Returns
         -------
         SparseFascicleFit object
 
+        Notes
+        -----
+        With an ElasticNet (or Lasso) solver, all voxels are fitted in a
+        batch sharing the Gram matrix of the design matrix, see
+        `elastic_net_batch`. Other solvers are fitted voxel by voxel.
         """
         if mask is None:
             # Flatten it to 2D either way:
@@ -417,11 +507,18 @@ class SparseFascicleModel(ReconstModel, Cache):
                                 self.design_matrix.shape[-1]))
 
         isopredict = isotropic.predict()
-        for vox, vox_data in enumerate(flat_S):
-            # In voxels in which S0 is 0, we just want to keep the
-            # parameters at all-zeros, and avoid nasty sklearn errors:
-            if not (np.any(~np.isfinite(vox_data)) or np.all(vox_data == 0)):
-                fit_it = vox_data - isopredict[vox]
+        # In voxels in which S0 is 0, we just want to keep the
+        # parameters at all-zeros, and avoid nasty sklearn errors:
+        valid = ~(np.any(~np.isfinite(flat_S), -1) | np.all(flat_S == 0, -1))
+        if _is_elastic_net(self.solver):
+            flat_params[valid] = elastic_net_batch(self.solver,
+                                                   self.design_matrix,
+                                                   flat_S[valid] -
+                                                   isopredict[valid],
+                                                   num_workers=num_workers)
+        else:
+            for vox in np.flatnonzero(valid):
+                fit_it = flat_S[vox] - isopredict[vox]
                 flat_params[vox] = self.solver.fit(self.design_matrix,
                                                    fit_it).coef_
 
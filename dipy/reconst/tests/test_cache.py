@@ -1,7 +1,17 @@
-from dipy.reconst.cache import Cache
-from dipy.core.sphere import Sphere
+import copy
+import os
 
-from numpy.testing import assert_, assert_equal, run_module_suite
+import numpy as np
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from dipy.reconst.cache import Cache, DiskCache, content_hash
+from dipy.core.sphere import Sphere, unit_icosahedron
+from dipy.core.gradients import gradient_table
+from dipy.data import get_data, get_sphere
+from dipy.reconst.shm import QballModel
+
+from numpy.testing import (assert_, assert_equal, assert_array_equal,
+                           run_module_suite)
 
 
 class TestModel(Cache):
@@ -24,5 +34,110 @@ def test_basic_cache():
     assert_(t.cache_get("design_matrix", s) is None)
 
 
+def test_content_hash():
+    s1 = Sphere(xyz=unit_icosahedron.vertices)
+    s2 = Sphere(xyz=unit_icosahedron.vertices.copy())
+    assert_equal(content_hash(s1), content_hash(s2))
+    # Lazily computed attributes are ignored
+    s1.faces, s1.edges
+    assert_equal(content_hash(s1), content_hash(s2))
+    s3 = Sphere(xyz=unit_icosahedron.vertices[::-1])
+    assert_(content_hash(s1) != content_hash(s3))
+
+    assert_equal(content_hash({'a': (1, 2.), 'b': [np.ones(3)]}),
+                 content_hash({'b': [np.ones(3)], 'a': (1, 2.)}))
+    assert_(content_hash((1, 2)) != content_hash([1, 2]))
+    assert_(content_hash(np.ones(3)) != content_hash(np.ones((3, 1))))
+    # Objects without content to hash have no persistent hash
+    assert_(content_hash((1, object())) is None)
+
+
+def test_disk_cache():
+    with InTemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_size=3000)
+        assert_(cache.get('a') is None)
+        assert_equal(cache.misses, 1)
+        cache.set('a', np.zeros(100))
+        cache.set('b', np.ones(100))
+        assert_array_equal(cache.get('a'), np.zeros(100))
+        assert_equal(cache.hits, 1)
+        assert_equal(len(cache), 2)
+
+        # A third value exceeds max_size and evicts the least recently used
+        cache.set('c', np.ones(100) * 2)
+        assert_equal(len(cache), 2)
+        assert_(cache.size <= 3000)
+        assert_(cache.get('b') is None)
+        assert_array_equal(cache.get('c'), np.ones(100) * 2)
+
+        # Values too large for the cache are not stored
+        cache.set('d', np.ones(1000))
+        assert_(cache.get('d') is None)
+
+        # Another cache on the same directory sees the values
+        other = DiskCache(tmpdir, max_size=3000)
+        assert_equal(len(other), 2)
+        assert_array_equal(other.get('a'), np.zeros(100))
+
+        # max_size holds for the values stored by both caches
+        other.set('e', np.ones(100) * 3)
+        cache.set('f', np.ones(100) * 4)
+        assert_equal(len(os.listdir(tmpdir)), 2)
+        assert_(cache.get('a') is None)
+        assert_array_equal(cache.get('e'), np.ones(100) * 3)
+
+        cache.clear()
+        assert_equal(len(cache), 0)
+        assert_equal(os.listdir(tmpdir), [])
+
+
+def test_cache_backend():
+    _, fbvals, fbvecs = get_data('small_64D')
+    bvals, bvecs = np.load(fbvals), np.load(fbvecs)
+    sphere = get_sphere('symmetric362')
+    with InTemporaryDirectory() as tmpdir:
+        backend = DiskCache(tmpdir)
+        try:
+            Cache.cache_backend = backend
+            model = QballModel(gradient_table(bvals, bvecs), 6)
+            B = model.sampling_matrix(sphere)
+            assert_equal(backend.misses, 1)
+            assert_equal(len(backend), 1)
+
+            # An equal model and sphere, built separately, hit the backend
+            model = QballModel(gradient_table(bvals, bvecs), 6)
+            sphere2 = copy.deepcopy(sphere)
+            assert_array_equal(model.sampling_matrix(sphere2), B)
+            assert_equal(backend.hits, 1)
+            # Then the value is found in the model itself
+            model.sampling_matrix(sphere2)
+            assert_equal(backend.hits, 1)
+
+            # Arguments passed by name or left to their default, and values
+            # set on the model, do not change the key
+            model = QballModel(gradient_table(bvals, bvecs), sh_order=6,
+                               smooth=0.006)
+            model.cache_set('other', sphere, 0)
+            assert_array_equal(model.sampling_matrix(sphere), B)
+            assert_equal(backend.hits, 2)
+
+            # Different parameters do not
+            model = QballModel(gradient_table(bvals, bvecs), 4)
+            assert_equal(model.sampling_matrix(sphere).shape[1], 15)
+            assert_equal(backend.misses, 2)
+
+            # Keys without a content hash are only kept in the model
+            key = object()
+            nb_values = len(backend)
+            model.cache_set('matrix', key, B)
+            assert_equal(len(backend), nb_values)
+            assert_(model.cache_get('matrix', key) is B)
+            model = QballModel(gradient_table(bvals, bvecs), 4)
+            assert_(model.cache_get('matrix', key) is None)
+            assert_equal(backend.misses, 2)
+        finally:
+            Cache.cache_backend = None
+
+
 if __name__ == "__main__":
     run_module_suite()
@@ -4,7 +4,7 @@ import numpy as np
 import numpy.testing as npt
 from numpy.testing import (assert_, assert_equal, assert_almost_equal,
                            assert_array_almost_equal, run_module_suite,
-                           assert_array_equal)
+                           assert_array_equal, assert_raises)
 from dipy.data import get_sphere, get_data, default_sphere, small_sphere
 from dipy.sims.voxel import (multi_tensor,
                              single_tensor,
@@ -13,19 +13,25 @@ from dipy.sims.voxel import (multi_tensor,
 from dipy.core.gradients import gradient_table
 from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    ConstrainedSDTModel,
+                                   csdeconv,
+                                   csdeconv_batch,
                                    forward_sdeconv_mat,
+                                   forward_sdt_deconv_mat,
                                    odf_deconv,
+                                   odf_deconv_batch,
                                    odf_sh_to_sharp,
                                    auto_response,
                                    recursive_response,
-                                   response_from_mask)
+                                   response_from_mask,
+                                   _axially_symmetric_sh)
 from dipy.direction.peaks import peak_directions
 from dipy.core.sphere_stats import angular_similarity
 from dipy.reconst.dti import TensorModel, fractional_anisotropy
 from dipy.reconst.shm import (CsaOdfModel, QballModel, sf_to_sh, sh_to_sf,
-                              real_sym_sh_basis, sph_harm_ind_list)
+                              real_sym_sh_basis, sph_harm_ind_list,
+                              real_sph_harm)
 from dipy.reconst.shm import lazy_index
-from dipy.core.geometry import cart2sphere
+from dipy.core.geometry import cart2sphere, vec2vec_rotmat
 import dipy.reconst.dti as dti
 from dipy.reconst.dti import fractional_anisotropy
 from dipy.core.sphere import Sphere
@@ -106,6 +112,42 @@ def test_recursive_response_calibration():
     FA_gt = fractional_anisotropy(evals)
     assert_almost_equal(FA, FA_gt, 1)
 
+    # The fits and peaks of the serial and parallel calibrations are equal
+    response2, timing = recursive_response(gtab, data, mask=None, sh_order=8,
+                                           peak_thr=0.01, init_fa=0.05,
+                                           init_trace=0.0021, iter=8,
+                                           convergence=0.001, parallel=True,
+                                           nbr_processes=2, return_timing=True)
+    assert_array_almost_equal(response2.dwi_response, response.dwi_response)
+    assert_almost_equal(response2.S0, response.S0)
+    assert_(1 <= len(timing) <= 8)
+    assert_(all(t >= 0 for t in timing))
+
+
+def test_axially_symmetric_sh():
+    _, fbvals, fbvecs = get_data('small_64D')
+    gtab = gradient_table(np.load(fbvals), np.load(fbvecs))
+    where_dwi = lazy_index(~gtab.b0s_mask)
+    gradients = gtab.gradients[where_dwi]
+    gradients = gradients / np.sqrt((gradients ** 2).sum(-1))[:, None]
+    n = np.arange(0, 9, 2)
+    np.random.seed(3)
+    dirs = np.random.randn(4, 3)
+    dirs /= np.sqrt((dirs ** 2).sum(-1))[:, None]
+    dirs[0] = [0, 0, -1]
+    signal = np.random.random((4, len(gradients)))
+
+    # Same as the least squares fit in the frames of the rotated gradients
+    expected = np.empty((4, len(n)))
+    for i in range(4):
+        rotmat = vec2vec_rotmat(dirs[i], np.array([0, 0, 1]))
+        x, y, z = np.dot(rotmat, gradients.T)
+        r, theta, phi = cart2sphere(x, y, z)
+        B_dwi = real_sph_harm(0, n, theta[:, None], phi[:, None])
+        expected[i] = np.linalg.lstsq(B_dwi, signal[i], rcond=-1)[0]
+    assert_array_almost_equal(_axially_symmetric_sh(signal, dirs, gradients,
+                                                    n, step=3), expected)
+
 
 def test_response_from_mask():
     fdata, fbvals, fbvecs = get_data('small_64D')
@@ -310,6 +352,51 @@ def test_odf_sh_to_sharp():
     assert_equal(directions2.shape[0], 2)
 
 
+def test_odf_deconv_batch():
+    _, fbvals, fbvecs = get_data('small_64D')
+    bvals = np.load(fbvals)
+    bvecs = np.load(fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    np.random.seed(2)
+    S = np.empty((4, 5, len(bvals)))
+    for i, j in np.ndindex(*S.shape[:-1]):
+        angles = [(0, 0), (np.random.uniform(0, 90), 0)]
+        S[i, j], _ = multi_tensor(gtab, mevals, 1., angles=angles,
+                                  fractions=[50, 50], snr=20)
+    odfs_sh = QballModel(gtab, sh_order=8, assume_normed=True).fit(S).shm_coeff
+    odfs_sh /= np.sqrt((odfs_sh ** 2).sum(-1))[..., None]
+    odfs_sh[0, 0] = np.nan
+
+    sphere = get_sphere('symmetric362')
+    B_reg, m, n = real_sym_sh_basis(8, sphere.theta, sphere.phi)
+    R, _ = forward_sdt_deconv_mat(3 / 15., n)
+    lambda_ = R.shape[0] * R[0, 0] / B_reg.shape[0]
+
+    # Same coefficients and iterations as the single voxel deconvolution
+    expected = np.zeros(odfs_sh.shape)
+    expected_it = np.zeros(odfs_sh.shape[:-1], dtype=int)
+    for ijk in np.ndindex(*odfs_sh.shape[:-1]):
+        expected[ijk], expected_it[ijk] = odf_deconv(odfs_sh[ijk], R, B_reg,
+                                                     lambda_, tau=0.1)
+    fodf_sh, num_it = odf_deconv_batch(odfs_sh, R, B_reg, lambda_, tau=0.1)
+    assert_array_almost_equal(fodf_sh, expected)
+    assert_array_equal(num_it, expected_it)
+
+    # The whole volume is sharpened in chunks, whatever the number of threads
+    mask = np.random.random(odfs_sh.shape[:-1]) > .3
+    for num_workers in [1, 2]:
+        sharp = odf_sh_to_sharp(odfs_sh, sphere, basis=None, ratio=3 / 15.,
+                                mask=mask, num_workers=num_workers,
+                                memory_budget=10 ** 5)
+        assert_array_almost_equal(sharp, expected * mask[..., None])
+    assert_array_almost_equal(odf_sh_to_sharp(odfs_sh[1, 2], sphere),
+                              expected[1, 2])
+    assert_raises(ValueError, odf_sh_to_sharp, odfs_sh, sphere,
+                  mask=mask[0])
+
+
 def test_forward_sdeconv_mat():
     m, n = sph_harm_ind_list(4)
     mat = forward_sdeconv_mat(np.array([0, 2, 4]), n)
@@ -449,6 +536,46 @@ def test_csd_predict_multi():
     npt.assert_array_almost_equal(pred_multi, multi_S)
 
 
+def test_csd_batch():
+    _, fbvals, fbvecs = get_data('small_64D')
+    bvals = np.load(fbvals)
+    bvecs = np.load(fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    np.random.seed(1)
+    S = np.empty((4, 5, len(bvals)))
+    for i, j in np.ndindex(*S.shape[:-1]):
+        angles = [(0, 0), (np.random.uniform(0, 90), 0)]
+        S[i, j], _ = multi_tensor(gtab, mevals, 1., angles=angles,
+                                  fractions=[50, 50], snr=20)
+    S[0, 0] = 0
+    response = (np.array([0.0015, 0.0003, 0.0003]), 1.)
+    csd = ConstrainedSphericalDeconvModel(gtab, response)
+    dwi = S[..., ~gtab.b0s_mask]
+
+    # Same coefficients and iterations as the single voxel deconvolution
+    expected = np.zeros(S.shape[:-1] + (45,))
+    expected_it = np.zeros(S.shape[:-1], dtype=int)
+    for ijk in np.ndindex(*S.shape[:-1]):
+        expected[ijk], expected_it[ijk] = csdeconv(dwi[ijk], csd._X,
+                                                   csd.B_reg, csd.tau)
+    fodf_sh, num_it = csdeconv_batch(dwi, csd._X, csd.B_reg, csd.tau)
+    assert_array_almost_equal(fodf_sh, expected)
+    assert_array_equal(num_it, expected_it)
+
+    # The fit writes the coefficients of the voxels in the mask into a
+    # dense array, whatever the number of threads
+    mask = np.random.random(S.shape[:-1]) > .3
+    for num_workers in [1, 2]:
+        csd_fit = csd.fit(S, mask=mask, num_workers=num_workers)
+        assert_equal(csd_fit.shm_coeff.shape, S.shape[:-1] + (45,))
+        assert_array_almost_equal(csd_fit.shm_coeff,
+                                  expected * mask[..., None])
+    assert_array_almost_equal(csd.fit(S[1, 2]).shm_coeff, expected[1, 2])
+    assert_raises(ValueError, csd.fit, S, mask=mask[0])
+
+
 def test_sphere_scaling_csdmodel():
     """Check that mirroring regularization sphere does not change the result of
     the model"""
@@ -123,6 +123,15 @@ def test_dki_fits():
     dkiF_multi = dki_wlsM.fit(DWI)
     assert_array_almost_equal(dkiF_multi.model_params, multi_params)
 
+    # testing the fits of the voxels by chunks
+    design = dkiM.design_matrix
+    for fit_dki in (dki.ols_fit_dki, dki.wls_fit_dki):
+        params = fit_dki(design, DWI)
+        assert_array_almost_equal(params, multi_params)
+        assert_array_almost_equal(fit_dki(design, DWI, step=3), params)
+        assert_array_almost_equal(fit_dki(design, DWI, memory_budget=1),
+                                  params)
+
 
 def test_apparent_kurtosis_coef():
     """ Apparent kurtosis coeficients are tested for a spherical kurtosis
@@ -242,6 +251,19 @@ def test_carlson_rd():
     assert_array_almost_equal(RD, RD_ref)
 
 
+def test_carlson_elementwise():
+    # Elements that need very different numbers of iterations to converge
+    # are computed together, the results must not depend on the others
+    x = np.array([1e-3, 1.0, 0.5, 100.0, 2.0])
+    y = np.array([2.0, 1.0, 1e3, 0.1, 3.0])
+    z = np.array([1.0, 1.0, 1.0, 1.0, 4.0])
+    RF = carlson_rf(x, y, z)
+    RD = carlson_rd(x, y, z)
+    for i in range(len(x)):
+        assert_array_equal(RF[i], carlson_rf(x[i:i+1], y[i:i+1], z[i:i+1]))
+        assert_array_equal(RD[i], carlson_rd(x[i:i+1], y[i:i+1], z[i:i+1]))
+
+
 def test_Wrotate_single_fiber():
 
     # Rotate the kurtosis tensor of single fiber simulate to the diffusion
@@ -309,6 +331,26 @@ def test_Wrotate_crossing_fibers():
     assert_array_almost_equal(kt_rotated, kt_ref)
 
 
+def test_Wrotate_multi_voxel():
+    # Rotations of several voxels at once match the element wise rotations
+    # of each voxel
+    kt = np.random.uniform(-1, 1, (4, 5, 15))
+    R = np.array([np.linalg.qr(A)[0]
+                  for A in np.random.randn(20, 3, 3)]).reshape((4, 5, 3, 3))
+    kt_rotated = dki.Wrotate(kt, R)
+    assert_array_equal(kt_rotated.shape, (4, 5, 15))
+    assert_array_almost_equal(kt_rotated[2, 3], dki.Wrotate(kt[2, 3],
+                                                            R[2, 3]))
+    assert_array_almost_equal(kt_rotated[..., 13],
+                              dki.Wrotate_element(kt, 0, 1, 1, 2, R))
+    W_rotated = dki.Wcons(kt_rotated)
+    Wpairs = dki._Wrotate_pairs(kt, R)
+    for i in range(3):
+        for j in range(3):
+            assert_array_almost_equal(Wpairs[..., i, j],
+                                      W_rotated[..., i, i, j, j])
+
+
 def test_Wcons():
 
     # Construct the 4D kurtosis tensor manualy from the crossing fiber kt
@@ -415,6 +457,30 @@ def test_spherical_dki_statistics():
     assert_array_almost_equal(AK_multi, MRef)
 
 
+def test_dki_statistics_float32():
+    # Metrics of single precision parameters are returned in single
+    # precision, but computed with the accuracy of double precision ones
+    params = np.tile(crossing_ref, (3, 1))
+    params[1, :3] = [0.0012, 0.0004, 0.00039]
+    params[2, :3] = 0
+    params32 = params.astype(np.float32)
+    for metric in (mean_kurtosis, radial_kurtosis, axial_kurtosis):
+        k32 = metric(params32)
+        assert_array_equal(k32.dtype, np.float32)
+        assert_array_almost_equal(k32, metric(params32.astype(float)),
+                                  decimal=5)
+        assert_array_almost_equal(k32, metric(params), decimal=1)
+
+
+def test_dki_fit_metrics():
+    dkiF = dki.DiffusionKurtosisFit(None, multi_params)
+    maps = dkiF.metrics(['md', 'mk', 'ak', 'rk'])
+    assert_array_almost_equal(maps['md'], dkiF.md)
+    assert_array_almost_equal(maps['mk'], dkiF.mk())
+    assert_array_almost_equal(maps['ak'], dkiF.ak())
+    assert_array_almost_equal(maps['rk'], dkiF.rk())
+
+
 def test_compare_MK_method():
     # tests if analytical solution of MK is equal to the average of directional
     # kurtosis sampled from a sphere
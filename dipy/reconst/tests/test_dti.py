@@ -211,6 +211,37 @@ def test_indexing_on_tensor_fit():
     assert_raises(IndexError, fit.__getitem__, (0, 0, 0, 0))
 
 
+def test_tensor_fit_metrics():
+    data, gtab = dsi_voxels()
+    fit = dti.TensorModel(gtab).fit(data)
+    names = ('fa', 'md', 'mode', 'color_fa')
+    maps = fit.metrics(names, step=7)
+    # Same maps as the attributes of a fresh fit
+    ref = dti.TensorFit(fit.model, fit.model_params)
+    for name in names:
+        assert_array_almost_equal(maps[name], getattr(ref, name))
+    assert_array_almost_equal(maps['mode'], dti.mode(ref.quadratic_form))
+    # The maps are cached, but not in the slices of the fit
+    assert_true(fit.fa is maps['fa'])
+    assert_true(fit.metrics(['md'])['md'] is maps['md'])
+    assert_true('fa' not in fit[0].__dict__)
+    assert_array_almost_equal(fit[0].metrics()['fa'], maps['fa'][0])
+
+    # Maps are written to preallocated outputs
+    out = {'fa': np.empty(fit.shape, dtype=np.float32),
+           'sphericity': np.zeros(fit.shape, dtype=np.float32)}
+    maps = fit.metrics(['fa', 'sphericity', 'ad'], out=out)
+    assert_true(maps['fa'] is out['fa'])
+    assert_true(maps['sphericity'] is out['sphericity'])
+    assert_array_almost_equal(out['fa'], ref.fa)
+    assert_array_almost_equal(out['sphericity'], ref.sphericity)
+    assert_array_almost_equal(maps['ad'], ref.ad)
+
+    assert_raises(ValueError, fit.metrics, ['fa', 'foo'])
+    assert_raises(ValueError, fit.metrics, ['rd'],
+                  {'rd': np.empty(fit.shape[1:])})
+
+
 def test_fa_of_zero():
     evals = np.zeros((4, 3))
     fa = fractional_anisotropy(evals)
@@ -370,6 +401,33 @@ def test_wls_and_ls_fit():
     assert_array_almost_equal(tensor_est.sphericity, sphericity(evals))
 
 
+def test_wls_solve():
+    bvec, bval = read_bvec_file(get_data('55dir_grad.bvec'))
+    X = dti.design_matrix(grad.gradient_table(bval, bvec))
+    y = np.random.randn(4, 3, X.shape[0])
+    w = np.random.rand(4, 3, X.shape[0]) + 0.1
+    beta = dti.wls_solve(X, y, w)
+    assert_equal(beta.shape, (4, 3, 7))
+    for i in range(4):
+        for j in range(3):
+            sqrt_w = np.sqrt(w[i, j])
+            expected = np.linalg.lstsq(X * sqrt_w[:, None], y[i, j] * sqrt_w,
+                                       rcond=-1)[0]
+            assert_array_almost_equal(beta[i, j], expected)
+
+    # The chunks of voxels fit in the memory budget
+    voxel_size = 8 * (4 * X.shape[0] + 2 * 49 + 24)
+    assert_equal(dti.fit_chunk_size(X, voxel_size * 10), 10)
+    assert_equal(dti.fit_chunk_size(X, 1), 1)
+    D = np.array([1., 0., 1., 0., 0., 1., -np.log(1000.) * 1000.]) / 1000.
+    D = D + np.random.rand(4, 3, 7) * 1e-4
+    Y = np.exp(np.dot(D, X.T)) * (1 + 0.01 * np.random.rand(*y.shape))
+    params = dti.wls_fit_tensor(X, Y)
+    assert_array_almost_equal(dti.wls_fit_tensor(X, Y, memory_budget=10000),
+                              params)
+    assert_array_almost_equal(dti.wls_fit_tensor(X, Y, step=5), params)
+
+
 def test_masked_array_with_tensor():
     data = np.ones((2, 4, 56))
     mask = np.array([[True, False, False, True],
@@ -566,6 +624,15 @@ def test_nlls_fit_tensor():
     tensor_model = dti.TensorModel(gtab, fit_method='NLLS', weighting='sigma')
     npt.assert_raises(ValueError, tensor_model.fit, Y)
 
+    # All the voxels are fit at once, in chunks of `step` voxels
+    noisy_Y = Y * (1 + 0.02 * np.random.RandomState(0).randn(10, Y.shape[-1]))
+    params = dti.nlls_fit_tensor(X, noisy_Y)
+    assert_array_almost_equal(dti.nlls_fit_tensor(X, noisy_Y, step=3),
+                              params)
+    for i in range(10):
+        assert_array_almost_equal(dti.nlls_fit_tensor(X, noisy_Y[i])[:3],
+                                  params[i, :3])
+
     # Use NLLS with some actual 4D data:
     data, bvals, bvecs = get_data('small_25')
     gtab = grad.gradient_table(bvals, bvecs)
@@ -618,6 +685,16 @@ def test_restore():
     tensor_model = dti.TensorModel(gtab, fit_method='restore', sigma=0.0001)
     tensor_model.fit(Y.copy())
 
+    # Voxels with and without outliers are fit together
+    multi_y = np.repeat(Y, 6, axis=0)
+    multi_y[np.arange(1, 6), np.arange(1, 6) * 7] = 1.0
+    for jac in [True, False]:
+        tensor_model = dti.TensorModel(gtab, fit_method='restore', jac=jac,
+                                       sigma=67.0, step=4)
+        tensor_est = tensor_model.fit(multi_y)
+        assert_array_almost_equal(tensor_est.evals,
+                                  np.tile(evals, (6, 1)), decimal=3)
+
 
 def test_adc():
     """
@@ -149,6 +149,30 @@ def test_fwdti_multi_voxel():
     assert_almost_equal(MDfwe, MDref)
 
 
+def test_fwdti_nls_voxelwise():
+    # The model's NLS fit of all voxels at once matches the fits of each
+    # voxel with nls_iter
+    rng = np.random.RandomState(2016)
+    data = DWI + rng.randn(*DWI.shape)
+    mask = np.ones(DWI.shape[:-1], dtype=bool)
+    mask[0, 0, 1] = False
+    W = fwdti.design_matrix(gtab_2s)
+    for kwargs in [{}, {'cholesky': True}, {'jac': True},
+                   {'f_transform': False}]:
+        fwdm = fwdti.FreeWaterTensorModel(gtab_2s, 'NLS', **kwargs)
+        fwefit = fwdm.fit(data, mask=mask)
+        expected = np.zeros(data.shape[:-1] + (13,))
+        for ijk in np.ndindex(*mask.shape):
+            if mask[ijk]:
+                S0 = np.mean(data[ijk][gtab_2s.b0s_mask])
+                expected[ijk] = fwdti.nls_iter(W, data[ijk], S0, **kwargs)
+        assert_array_almost_equal(fwefit.f, expected[..., 12], decimal=4)
+        assert_array_almost_equal(fwefit.evals, expected[..., :3])
+        assert_array_almost_equal(fwefit.fa,
+                                  fractional_anisotropy(expected[..., :3]),
+                                  decimal=4)
+
+
 def test_fwdti_predictions():
     # single voxel case
     gtf = 0.50  # ground truth volume fraction
@@ -237,6 +261,12 @@ def test_cholesky_functions():
     tensor = cholesky_to_lower_triangular(R)
     assert_array_almost_equal(dt, tensor)
 
+    # Arrays of tensors
+    dts = np.array([dt, dt * 2, dt * 3])
+    R = lower_triangular_to_cholesky(dts)
+    assert_array_almost_equal(R[1], lower_triangular_to_cholesky(dt * 2))
+    assert_array_almost_equal(cholesky_to_lower_triangular(R), dts)
+
 
 def test_fwdti_jac_multi_voxel():
     fwdm = fwdti.FreeWaterTensorModel(gtab_2s, 'WLS')
@@ -72,6 +72,16 @@ def test_mvoxel_gqi():
     directions, values, indices = peak_directions(odf, sphere, .35, 25)
     assert_equal(directions.shape[0], 2)
 
+    # The batched fit matches fitting each voxel on its own
+    assert_almost_equal(gq.fit(data[1, 0, 0]).odf(sphere),
+                        all_odfs[1, 0, 0])
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[0, 0, 0] = mask[-1, -1, -1] = True
+    masked_odfs = gq.fit(data, mask).odf(sphere)
+    assert_almost_equal(masked_odfs[mask], all_odfs[mask])
+    assert_equal(masked_odfs[~mask], 0)
+    assert_almost_equal(gqfit[-1, -1, -1].odf(sphere), all_odfs[-1, -1, -1])
+
 
 if __name__ == "__main__":
     run_module_suite()
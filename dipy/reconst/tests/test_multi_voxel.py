@@ -5,8 +5,16 @@ from functools import reduce
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.multi_voxel import _squash, multi_voxel_fit, CallableArray
+from dipy.reconst.multi_voxel import (_squash, multi_voxel_fit,
+                                     batch_voxel_fit, parallel_fit,
+                                     CallableArray)
+from dipy.reconst.dti import TensorModel
+from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
 from dipy.core.sphere import unit_icosahedron
+from dipy.core.gradients import gradient_table
+from dipy.data import get_data
+from dipy.io.gradients import read_bvals_bvecs
+from dipy.sims.voxel import single_tensor
 
 
 def test_squash():
@@ -178,3 +186,153 @@ def test_multi_voxel_fit():
     # Test indexing into a fit
     npt.assert_equal(type(fit[0, 0, 0]), SillyFit)
     npt.assert_equal(fit[:2, :2, :2].shape, (2, 2, 2))
+
+
+def test_batch_voxel_fit():
+
+    class SillyModel(object):
+
+        @batch_voxel_fit
+        def fit(self, data):
+            return SillyFit(model, data)
+
+        def predict(self, S0):
+            return np.ones(10) * S0
+
+    class SillyFit(object):
+
+        def __init__(self, model, data):
+            self.model = model
+            self.data = data
+
+        model_attr = 2.
+        shared_array = np.arange(3.)
+
+        def __getitem__(self, index):
+            return SillyFit(self.model, self.data[index])
+
+        def odf(self, sphere):
+            return np.ones(self.data.shape[:-1] + (len(sphere.phi),))
+
+        @property
+        def mean_signal(self):
+            return self.data.mean(-1)
+
+        def predict(self, S0):
+            return np.ones(self.data.shape) * np.asarray(S0)[..., None]
+
+    # Test the single voxel case
+    model = SillyModel()
+    single_voxel = np.arange(64.)
+    fit = model.fit(single_voxel)
+    npt.assert_equal(type(fit), SillyFit)
+    npt.assert_array_equal(fit.data, single_voxel)
+
+    # Test without a mask
+    many_voxels = np.ones((2, 3, 4, 64))
+    fit = model.fit(many_voxels)
+    npt.assert_equal(fit.model_attr, 2.)
+    npt.assert_array_equal(fit.mean_signal, np.ones((2, 3, 4)))
+    expected = np.ones((2, 3, 4, 12))
+    npt.assert_array_equal(fit.odf(unit_icosahedron), expected)
+    S0 = 100.
+    npt.assert_equal(fit.predict(S0=S0), np.ones(many_voxels.shape) * S0)
+
+    # Test with a mask
+    mask = np.zeros((3, 3, 3)).astype('bool')
+    mask[0, 0] = 1
+    mask[1, 1] = 1
+    mask[2, 2] = 1
+    data = np.ones((3, 3, 3, 64))
+    data[mask] = np.arange(64.)
+    fit = model.fit(data, mask)
+    npt.assert_equal(fit.batch_fit.data.shape, (9, 64))
+    # Arrays not holding one row per voxel are not scattered
+    npt.assert_array_equal(fit.shared_array, np.arange(3.))
+    expected = np.zeros((3, 3, 3))
+    expected[mask] = 31.5
+    npt.assert_array_equal(fit.mean_signal, expected)
+    odf = fit.odf(unit_icosahedron)
+    npt.assert_equal(odf.shape, (3, 3, 3, 12))
+    npt.assert_array_equal(odf[~mask], 0)
+    npt.assert_array_equal(odf[mask], 1)
+    predicted = np.zeros(data.shape)
+    predicted[mask] = S0
+    npt.assert_equal(fit.predict(S0=S0), predicted)
+    S0 = np.arange(27.).reshape(3, 3, 3)
+    predicted[mask] = S0[mask][:, None]
+    npt.assert_equal(fit.predict(S0=S0), predicted)
+
+    # Test fit.shape
+    npt.assert_equal(fit.shape, (3, 3, 3))
+
+    # Test indexing into a fit
+    npt.assert_equal(type(fit[0, 0, 0]), SillyFit)
+    npt.assert_array_equal(fit[0, 0, 0].data, np.arange(64.))
+    npt.assert_equal(fit[0, 1, 0], None)
+    sub_fit = fit[:2, :2, :2]
+    npt.assert_equal(sub_fit.shape, (2, 2, 2))
+    npt.assert_array_equal(sub_fit.mean_signal, expected[:2, :2, :2])
+
+
+def test_parallel_fit():
+    gtab = gradient_table(*read_bvals_bvecs(*get_data('small_64D')[1:]))
+    evals = np.array([0.0015, 0.0003, 0.0003])
+    rng = np.random.RandomState(2016)
+    data = np.empty((4, 5, 3, len(gtab.bvals)))
+    for ijk in np.ndindex(*data.shape[:-1]):
+        evecs = np.linalg.qr(rng.randn(3, 3))[0]
+        data[ijk] = single_tensor(gtab, 100, evals * rng.uniform(0.5, 1.5),
+                                  evecs, snr=None)
+    mask = rng.rand(*data.shape[:-1]) > 0.3
+
+    model = TensorModel(gtab)
+    fit = model.fit(data, mask)
+    for num_workers, use_processes in [(1, False), (3, False), (2, True)]:
+        pfit = parallel_fit(model, data, mask, num_workers=num_workers,
+                            chunk_size=7, use_processes=use_processes)
+        npt.assert_equal(len(pfit.chunk_fits), int(np.ceil(mask.sum() / 7.)))
+        npt.assert_equal(pfit.shape, mask.shape)
+        npt.assert_array_almost_equal(pfit.fa, fit.fa)
+        npt.assert_array_almost_equal(pfit.evecs, fit.evecs)
+        npt.assert_array_almost_equal(pfit.odf(unit_icosahedron),
+                                      fit.odf(unit_icosahedron))
+        S0 = np.ones(mask.shape) * 100
+        npt.assert_array_almost_equal(pfit.predict(gtab, S0=S0),
+                                      fit.predict(gtab, S0=S0) *
+                                      mask[..., None])
+
+    # Indexing into the chunks
+    pfit = model.parallel_fit(data, mask, num_workers=2, chunk_size=4)
+    ijk = tuple(np.argwhere(mask)[10])
+    npt.assert_array_almost_equal(pfit[ijk].evals, fit[ijk].evals)
+    npt.assert_equal(pfit[tuple(np.argwhere(~mask)[0])], None)
+    npt.assert_array_almost_equal(pfit[1:3, ::-1].fa, fit[1:3, ::-1].fa)
+
+    # Models fitting one voxel at a time are chunked as well
+    response = (evals, 100)
+    csd = ConstrainedSphericalDeconvModel(gtab, response, sh_order=4)
+    pfit = parallel_fit(csd, data, mask, num_workers=2, chunk_size=10)
+    npt.assert_array_almost_equal(pfit.shm_coeff,
+                                  csd.fit(data, mask).shm_coeff)
+
+    # Selecting only voxels outside of the mask gives volumes of zeros
+    empty = pfit[~mask]
+    npt.assert_equal(len(empty.chunk_fits), 0)
+    npt.assert_array_equal(empty.shm_coeff,
+                           np.zeros((np.sum(~mask),) +
+                                    pfit.shm_coeff.shape[-1:]))
+
+    # So does an empty mask, with the shapes of a fit with voxels
+    mask = np.zeros(mask.shape, dtype=bool)
+    for num_workers, use_processes in [(1, False), (2, True)]:
+        pfit = parallel_fit(model, data, mask, num_workers=num_workers,
+                            use_processes=use_processes)
+        npt.assert_equal(len(pfit.chunk_fits), 0)
+        npt.assert_array_equal(pfit.fa, np.zeros(mask.shape))
+        npt.assert_array_equal(pfit.evecs, np.zeros(mask.shape + (3, 3)))
+        npt.assert_array_equal(pfit.odf(unit_icosahedron),
+                               np.zeros(mask.shape +
+                                        (len(unit_icosahedron.vertices),)))
+        npt.assert_array_equal(pfit.predict(gtab, S0=np.ones(mask.shape)),
+                               np.zeros(mask.shape + (len(gtab.bvals),)))
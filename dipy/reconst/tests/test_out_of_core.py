@@ -0,0 +1,60 @@
+""" Testing the reconstruction of volumes by slabs """
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import nibabel as nib
+from nibabel.tmpdirs import InTemporaryDirectory
+from numpy.testing import (assert_array_almost_equal, assert_array_equal,
+                           assert_equal, run_module_suite)
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_data
+from dipy.reconst.dti import TensorModel
+from dipy.reconst.out_of_core import fit_out_of_core, slab_thickness
+
+
+def test_slab_thickness():
+    shape = (10, 10, 20, 5)
+    assert_equal(slab_thickness(shape, 0), 1)
+    assert_equal(slab_thickness(shape, 8 * 4 * 500 * 3), 3)
+    assert_equal(slab_thickness(shape, 8 * 500 * 3, working_copies=1), 3)
+    assert_equal(slab_thickness(shape, 2 ** 30), 20)
+
+
+def test_fit_out_of_core():
+    fdata, fbvals, fbvecs = get_data('small_25')
+    img = nib.load(fdata)
+    data = img.get_data()
+    model = TensorModel(gradient_table(fbvals, fbvecs))
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[2:8, 1:5, 1] = True
+    ref = model.fit(data, mask=mask)
+
+    with InTemporaryDirectory():
+        # An uncompressed volume, read one slice at a time
+        nib.save(img, 'dwi.nii')
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine),
+                 'mask.nii')
+        volumes = fit_out_of_core(model, 'dwi.nii',
+                                  {'model_params': 'params.nii',
+                                   'fa': 'fa.nii'},
+                                  mask='mask.nii', memory_budget=1)
+        assert_equal(volumes['model_params'].dtype, np.float32)
+        assert_array_almost_equal(volumes['model_params'],
+                                  ref.model_params, decimal=5)
+        params = nib.load('params.nii')
+        assert_array_equal(params.shape, data.shape[:3] + (12,))
+        assert_array_equal(params.affine, img.affine)
+        assert_array_almost_equal(params.get_data(), ref.model_params,
+                                  decimal=5)
+        assert_array_almost_equal(nib.load('fa.nii').get_data(), ref.fa)
+        del volumes, params
+
+        # A single slab, with double precision outputs
+        volumes = fit_out_of_core(model, img, {'md': 'md.nii'}, mask=mask,
+                                  dtype=np.float64)
+        assert_array_almost_equal(volumes['md'], ref.md)
+
+
+if __name__ == '__main__':
+    run_module_suite()
@@ -72,6 +72,35 @@ def test_predict():
     npt.assert_(xval.coeff_of_determination(new_pred, S[::2]) > 97)
 
 
+@npt.dec.skipif(not sfm.has_sklearn)
+def test_elastic_net_batch():
+    fdata, fbvals, fbvecs = dpd.get_data()
+    data = nib.load(fdata).get_data()[:3, :3, :3]
+    gtab = grad.gradient_table(fbvals, fbvecs)
+    sfmodel = sfm.SparseFascicleModel(gtab)
+    X = sfmodel.design_matrix
+    S = data[..., ~gtab.b0s_mask].reshape((-1, X.shape[0]))
+    y = S / data[..., gtab.b0s_mask].mean(-1).reshape((-1, 1))
+    y = y - y.mean(-1)[:, None]
+    for warm_start in [True, False]:
+        solver = sfm.lm.ElasticNet(l1_ratio=0.5, alpha=0.001, positive=True,
+                                   warm_start=warm_start)
+        coef = np.array([solver.fit(X, vox).coef_.copy() for vox in y])
+        for num_workers in [1, 2]:
+            coef_batch = sfm.elastic_net_batch(solver, X, y,
+                                               num_workers=num_workers,
+                                               chunk_size=10)
+            npt.assert_equal(coef_batch.shape, coef.shape)
+            npt.assert_(np.all(coef_batch >= 0))
+            npt.assert_almost_equal(coef_batch, coef, decimal=2)
+
+    # The fit of the model goes through the batch, in threads or not
+    sffit1 = sfmodel.fit(data)
+    sffit2 = sfmodel.fit(data, num_workers=2)
+    npt.assert_almost_equal(sffit1.predict(gtab), sffit2.predict(gtab),
+                            decimal=2)
+
+
 def test_sfm_background():
     fdata, fbvals, fbvecs = dpd.get_data()
     data = nib.load(fdata).get_data()
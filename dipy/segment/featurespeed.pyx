@@ -5,6 +5,7 @@ import numpy as np
 cimport numpy as cnp
 
 from cythonutils cimport tuple2shape, shape2tuple, shape_from_memview
+from dipy.tracking.arraysequence import ArraySequence
 from dipy.tracking.streamlinespeed cimport c_set_number_of_points, c_length
 
 
@@ -333,6 +334,13 @@ cdef class VectorOfEndpointsFeature(CythonFeature):
             out[0, d] = datum[N-1, d] - datum[0, d]
 
 
+cdef float32_sequence(data):
+    """ Return the `ArraySequence` `data` with a float32 buffer """
+    if data.dtype != np.float32:
+        return data.astype(np.float32)
+    return data
+
+
 cpdef infer_shape(Feature feature, data):
     """ Infers shape of the features extracted from data.
 
@@ -340,7 +348,7 @@ cpdef infer_shape(Feature feature, data):
     ----------
     feature : `Feature` object
         Tells how to infer shape of the features.
-    data : list of 2D arrays
+    data : list of 2D arrays or ArraySequence
         List of sequences of N-dimensional points.
 
     Returns
@@ -348,6 +356,23 @@ cpdef infer_shape(Feature feature, data):
     list of tuples
         Shapes of the features inferred from `data`.
     """
+    cdef:
+        int i
+        Data2D buffer
+        cnp.npy_intp[:] offsets, lengths
+    if isinstance(data, ArraySequence):
+        data = float32_sequence(data)
+        if len(data) == 0:
+            return []
+        buffer = data._data
+        offsets = data.offsets
+        lengths = data.lengths
+        shapes = []
+        for i in range(len(data)):
+            shapes.append(shape2tuple(feature.c_infer_shape(
+                buffer[offsets[i]:offsets[i] + lengths[i]])))
+        return shapes
+
     single_datum = False
     if type(data) is np.ndarray:
         single_datum = True
@@ -357,7 +382,6 @@ cpdef infer_shape(Feature feature, data):
         return []
 
     shapes = []
-    cdef int i
     for i in range(0, len(data)):
         datum = data[i] if data[i].flags.writeable else data[i].astype(np.float32)
         shapes.append(shape2tuple(feature.c_infer_shape(datum)))
@@ -375,14 +399,33 @@ cpdef extract(Feature feature, data):
     ----------
     feature : `Feature` object
         Tells how to extract features from the data.
-    datum : list of 2D arrays
-        List of sequence of N-dimensional points.
+    datum : list of 2D arrays or ArraySequence
+        List of sequence of N-dimensional points. The features of an
+        `ArraySequence` are extracted directly from its buffer.
 
     Returns
     -------
     list of 2D arrays
         List of features extracted from `data`.
     """
+    cdef:
+        int i
+        Data2D buffer
+        cnp.npy_intp[:] offsets, lengths
+    if isinstance(data, ArraySequence):
+        data = float32_sequence(data)
+        shapes = infer_shape(feature, data)
+        features = [np.empty(shape, dtype=np.float32) for shape in shapes]
+        if len(data) == 0:
+            return features
+        buffer = data._data
+        offsets = data.offsets
+        lengths = data.lengths
+        for i in range(len(data)):
+            feature.c_extract(buffer[offsets[i]:offsets[i] + lengths[i]],
+                              features[i])
+        return features
+
     single_datum = False
     if type(data) is np.ndarray:
         single_datum = True
@@ -394,7 +437,6 @@ cpdef extract(Feature feature, data):
     shapes = infer_shape(feature, data)
     features = [np.empty(shape, dtype=np.float32) for shape in shapes]
 
-    cdef int i
     for i in range(len(data)):
         datum = data[i] if data[i].flags.writeable else data[i].astype(np.float32)
         feature.c_extract(datum, features[i])
@@ -1,7 +1,8 @@
 import sys
 import numpy as np
 import dipy.segment.metric as dipymetric
-from dipy.segment.featurespeed import extract
+from dipy.segment.featurespeed import extract, infer_shape
+from dipy.tracking.arraysequence import ArraySequence
 
 from nose.tools import assert_true, assert_false, assert_equal
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
@@ -265,6 +266,17 @@ def test_feature_extract():
         s.setflags(write=False)
     features = extract(feature, streamlines)
 
+    # Features of packed streamlines are extracted from their buffer
+    packed = ArraySequence(streamlines, dtype=np.float64)[::2]
+    for feature in (dipymetric.ResampleFeature(nb_points=10),
+                    dipymetric.CenterOfMassFeature(), ArcLengthFeature()):
+        assert_equal(infer_shape(feature, packed),
+                     infer_shape(feature, streamlines[::2]))
+        features = extract(feature, packed)
+        for f1, f2 in zip(features, extract(feature, streamlines[::2])):
+            assert_array_almost_equal(f1, f2, 4)
+    assert_equal(extract(feature, ArraySequence()), [])
+
 
 def test_subclassing_feature():
     class EmptyFeature(dipymetric.Feature):
@@ -0,0 +1,314 @@
+""" Packed storage for sequences of arrays, such as streamlines
+
+A tractogram of millions of streamlines stored as a list of small arrays
+spends most of its memory on the array headers and forces every operation
+to loop over Python objects. `ArraySequence` keeps all the points in one
+contiguous buffer together with the offset and the length of each sequence
+in it, so that the Cython kernels of dipy can walk through the buffer
+directly.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numbers
+
+import numpy as np
+
+
+class ArraySequence(object):
+    """ Sequence of 2D arrays sharing the same number of columns, stored in
+    a single buffer
+
+    Parameters
+    ----------
+    iterable : iterable of array-like of shape (N, D), optional
+        Sequences to store, for instance a list of streamlines or an
+        `ArraySequence`, whose points are copied.
+    dtype : dtype, optional
+        Data type of the buffer. Default: float32.
+    buffer_size : int, optional
+        Number of points the buffer is grown by when the sequences do not
+        fit, when they are appended one at a time. Default: 1024.
+
+    Notes
+    -----
+    Indexing with an integer returns a view of the points of one sequence.
+    Indexing with a slice, a boolean mask or an array of indices returns a
+    new `ArraySequence` sharing the buffer of the original one: no points
+    are copied, only the offsets and the lengths. Use `copy` to obtain a
+    compact, independent sequence.
+
+    Examples
+    --------
+    >>> streamlines = ArraySequence([np.zeros((2, 3)), np.ones((4, 3))])
+    >>> len(streamlines), streamlines.total_nb_rows
+    (2, 6)
+    >>> streamlines.append(np.ones((3, 3)))
+    >>> streamlines[2].shape
+    (3, 3)
+    >>> [len(s) for s in streamlines[streamlines.lengths > 2]]
+    [4, 3]
+    """
+    def __init__(self, iterable=None, dtype=np.float32, buffer_size=1024):
+        self._data = np.empty((0, 0), dtype=dtype)
+        self._offsets = np.zeros(0, dtype=np.intp)
+        self._lengths = np.zeros(0, dtype=np.intp)
+        # Number of points of the buffer, and of entries of the offsets and
+        # lengths, used by the sequences. Views do not own their buffer, they
+        # have to be compacted before growing.
+        self._used = 0
+        self._nb_sequences = 0
+        self._is_view = False
+        self.buffer_size = buffer_size
+        if iterable is not None:
+            self.extend(iterable)
+
+    @classmethod
+    def from_arrays(cls, data, lengths, offsets=None):
+        """ Wrap an existing buffer of points without copying it
+
+        Parameters
+        ----------
+        data : ndarray of shape (P, D)
+            Points of all the sequences.
+        lengths : array-like of int of shape (N,)
+            Number of points of each sequence.
+        offsets : array-like of int of shape (N,), optional
+            Index in `data` of the first point of each sequence. By default
+            the sequences follow each other in `data`.
+
+        Returns
+        -------
+        seq : ArraySequence
+        """
+        data = np.asarray(data)
+        if data.ndim != 2:
+            raise ValueError("The points must be stored in a 2D array.")
+        lengths = np.asarray(lengths, dtype=np.intp)
+        if offsets is None:
+            offsets = np.zeros(len(lengths), dtype=np.intp)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        offsets = np.asarray(offsets, dtype=np.intp)
+        if len(offsets) != len(lengths):
+            raise ValueError("There must be one offset per length.")
+        if len(lengths) and (offsets + lengths).max() > len(data):
+            raise ValueError("The sequences do not fit in the buffer.")
+        seq = cls(dtype=data.dtype)
+        seq._data = data
+        seq._offsets = offsets
+        seq._lengths = lengths
+        seq._used = len(data)
+        seq._nb_sequences = len(lengths)
+        seq._is_view = True
+        return seq
+
+    @property
+    def data(self):
+        """ Buffer holding the points of the sequences """
+        return self._data[:self._used]
+
+    @property
+    def offsets(self):
+        """ Index in `data` of the first point of each sequence """
+        return self._offsets[:self._nb_sequences]
+
+    @property
+    def lengths(self):
+        """ Number of points of each sequence """
+        return self._lengths[:self._nb_sequences]
+
+    @property
+    def common_shape(self):
+        """ Number of columns shared by all the sequences """
+        return self._data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def total_nb_rows(self):
+        """ Total number of points of the sequences """
+        return int(self.lengths.sum())
+
+    def is_compact(self):
+        """ Whether the sequences follow each other in the buffer, without
+        gaps, starting from its first point """
+        if self._used != self.total_nb_rows:
+            return False
+        offsets, lengths = self.offsets, self.lengths
+        return len(self) == 0 or (offsets[0] == 0 and np.all(
+            offsets[1:] == (offsets + lengths)[:-1]))
+
+    def _reserve(self, nb_rows, dim):
+        """ Make sure `nb_rows` more points fit at the end of the buffer """
+        if self._is_view:
+            self._become_owner()
+        if self._data.shape[1:] != (dim,):
+            if self._used:
+                raise ValueError("All the sequences must have %d columns."
+                                 % self._data.shape[1])
+            self._data = np.empty((0, dim), dtype=self._data.dtype)
+        needed = self._used + nb_rows
+        if needed > len(self._data):
+            size = max(needed, len(self._data) + self.buffer_size,
+                       2 * len(self._data))
+            data = np.empty((size, dim), dtype=self._data.dtype)
+            data[:self._used] = self._data[:self._used]
+            self._data = data
+
+    def _become_owner(self):
+        """ Replace a shared buffer by a compact copy of the sequences """
+        compact = self.copy()
+        self._data = compact._data
+        self._offsets = compact._offsets
+        self._lengths = compact._lengths
+        self._used = compact._used
+        self._nb_sequences = compact._nb_sequences
+        self._is_view = False
+
+    def _grow_index(self, nb_sequences):
+        """ Make sure `nb_sequences` more sequences fit at the end of the
+        offsets and lengths """
+        needed = self._nb_sequences + nb_sequences
+        if needed > len(self._offsets):
+            size = max(needed, 2 * len(self._offsets), 16)
+            offsets = np.zeros(size, dtype=np.intp)
+            lengths = np.zeros(size, dtype=np.intp)
+            offsets[:self._nb_sequences] = self.offsets
+            lengths[:self._nb_sequences] = self.lengths
+            self._offsets = offsets
+            self._lengths = lengths
+
+    def append(self, element):
+        """ Append a sequence of points, in place
+
+        Parameters
+        ----------
+        element : array-like of shape (N, D)
+        """
+        element = np.asarray(element)
+        if element.ndim != 2:
+            raise ValueError("Only 2D arrays can be appended.")
+        self._reserve(len(element), element.shape[1])
+        self._data[self._used:self._used + len(element)] = element
+        self._grow_index(1)
+        self._offsets[self._nb_sequences] = self._used
+        self._lengths[self._nb_sequences] = len(element)
+        self._used += len(element)
+        self._nb_sequences += 1
+
+    def extend(self, elements):
+        """ Append several sequences of points, in place
+
+        Parameters
+        ----------
+        elements : iterable of array-like of shape (N, D) or ArraySequence
+        """
+        if isinstance(elements, ArraySequence):
+            if len(elements) == 0:
+                return
+            elements = elements.copy()
+            self._reserve(elements._used, elements.common_shape[0])
+            self._grow_index(len(elements))
+            new = slice(self._nb_sequences, self._nb_sequences + len(elements))
+            self._offsets[new] = elements.offsets + self._used
+            self._lengths[new] = elements.lengths
+            self._data[self._used:self._used + elements._used] = \
+                elements._data[:elements._used]
+            self._used += elements._used
+            self._nb_sequences += len(elements)
+            return
+        if not isinstance(elements, (list, tuple)):
+            # Generators can only be read once
+            for element in elements:
+                self.append(element)
+            return
+        elements = [np.asarray(element) for element in elements]
+        if len(elements) == 0:
+            return
+        if any(element.ndim != 2 for element in elements):
+            raise ValueError("Only 2D arrays can be appended.")
+        lengths = np.array([len(element) for element in elements],
+                           dtype=np.intp)
+        self._reserve(int(lengths.sum()), elements[0].shape[1])
+        self._grow_index(len(elements))
+        new = slice(self._nb_sequences, self._nb_sequences + len(elements))
+        offsets = self._offsets[new]
+        offsets[0] = self._used
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        offsets[1:] += self._used
+        self._lengths[new] = lengths
+        for offset, element in zip(offsets, elements):
+            self._data[offset:offset + len(element)] = element
+        self._used += int(lengths.sum())
+        self._nb_sequences += len(elements)
+
+    def copy(self):
+        """ Compact copy of the sequences, owning its buffer """
+        seq = ArraySequence(dtype=self._data.dtype,
+                            buffer_size=self.buffer_size)
+        total = self.total_nb_rows
+        seq._data = np.empty((total,) + self.common_shape,
+                             dtype=self._data.dtype)
+        seq._lengths = self.lengths.copy()
+        seq._offsets = np.zeros(len(self), dtype=np.intp)
+        np.cumsum(seq._lengths[:-1], out=seq._offsets[1:])
+        if self.is_compact():
+            seq._data[:] = self._data[:total]
+        else:
+            for src, dst, n in zip(self.offsets, seq._offsets,
+                                   seq._lengths):
+                seq._data[dst:dst + n] = self._data[src:src + n]
+        seq._used = total
+        seq._nb_sequences = len(self)
+        return seq
+
+    def astype(self, dtype):
+        """ Compact copy of the sequences with a buffer of type `dtype` """
+        if self.is_compact():
+            seq = ArraySequence.from_arrays(
+                self._data[:self._used].astype(dtype), self.lengths.copy(),
+                self.offsets.copy())
+            seq._is_view = False
+            return seq
+        seq = self.copy()
+        seq._data = seq._data.astype(dtype)
+        return seq
+
+    def __len__(self):
+        return self._nb_sequences
+
+    def __iter__(self):
+        for offset, length in zip(self.offsets, self.lengths):
+            yield self._data[offset:offset + length]
+
+    def __getitem__(self, index):
+        if isinstance(index, numbers.Integral):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("ArraySequence index out of range")
+            start = self._offsets[index]
+            return self._data[start:start + self._lengths[index]]
+        if isinstance(index, slice) or isinstance(index, (list, np.ndarray)):
+            index = np.asarray(index) if isinstance(index, list) else index
+            if (isinstance(index, np.ndarray) and index.dtype != bool and
+                    not np.issubdtype(index.dtype, np.integer) and
+                    index.size):
+                raise TypeError("Only integer or boolean arrays can be used "
+                                "as indices.")
+            seq = ArraySequence(dtype=self._data.dtype,
+                                buffer_size=self.buffer_size)
+            seq._data = self._data
+            seq._offsets = self.offsets[index]
+            seq._lengths = self.lengths[index]
+            seq._used = self._used
+            seq._nb_sequences = len(seq._offsets)
+            seq._is_view = True
+            return seq
+        raise TypeError("Index must be an int, a slice or an array, not %s"
+                        % type(index).__name__)
+
+    def __repr__(self):
+        return "ArraySequence(%d sequences, %d points)" % (len(self),
+                                                           self.total_nb_rows)
@@ -10,6 +10,12 @@ cimport cython
 import time
 import numpy as np
 cimport numpy as cnp
+from cython.parallel import parallel, prange
+
+from omp_threads cimport determine_num_threads
+
+from dipy.tracking.arraysequence import ArraySequence
+from dipy.utils.arrfuncs import NUMPY_LESS_1_8
 
 
 cdef extern from "dpy_math.h" nogil:
@@ -457,98 +463,235 @@ def most_similar_track_mam(tracks,metric='avg'):
         track2others[j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
     return si, track2others
 
+def _packed_tracks(tracks):
+    """ Points of `tracks` in one contiguous float32 buffer, with the offset
+    and the number of points of each track in it
+
+    An `ArraySequence` with a float32 buffer is used as is, without copying
+    its points.
+    """
+    if not isinstance(tracks, ArraySequence):
+        tracks = ArraySequence(tracks, dtype=f32_dt)
+    elif tracks.dtype != f32_dt:
+        tracks = tracks.astype(f32_dt)
+    if len(tracks) and tracks.common_shape != (3,):
+        raise ValueError('Tracks must be arrays of shape (N, 3)')
+    data = np.ascontiguousarray(tracks.data, dtype=f32_dt)
+    if len(data) == 0:
+        # Keep a valid pointer to the buffer
+        data = np.zeros((1, 3), dtype=f32_dt)
+    return (data, np.asarray(tracks.offsets, dtype=np.intp),
+            np.asarray(tracks.lengths, dtype=np.intp))
+
+
+ctypedef fused distance_t:
+    cnp.float32_t
+    cnp.float64_t
+
+
+# Tracks are compared by blocks of DISTANCE_BLOCK x DISTANCE_BLOCK pairs, so
+# that the tracks of a block stay in cache
+DEF DISTANCE_BLOCK = 64
+
+
+cdef void _distance_rows(cnp.float32_t *A_ptr, cnp.npy_intp[:] offsetsA,
+                         cnp.npy_intp[:] lengthsA, cnp.float32_t *B_ptr,
+                         cnp.npy_intp[:] offsetsB, cnp.npy_intp[:] lengthsB,
+                         cnp.npy_intp a0, int metric_type,
+                         cnp.npy_intp buffer_len, int num_threads,
+                         distance_t[:, ::1] out) nogil:
+    ''' Distances between the tracks ``a0`` to ``a0 + out.shape[0]`` of A and
+    all the tracks of B, the blocks of rows being shared between threads.
+
+    ``metric_type`` is -1 for the MDF distance and the type of the MAM
+    distance, as for `czhang`, otherwise.
+    '''
+    cdef:
+        cnp.npy_intp nb_rows = out.shape[0], lentB = out.shape[1]
+        cnp.npy_intp nb_blocks = (nb_rows + DISTANCE_BLOCK - 1) / DISTANCE_BLOCK
+        cnp.npy_intp block, i, j, j0, i_end, j_end
+        cnp.float32_t *min_buffer
+        cnp.float32_t *d
+
+    with parallel(num_threads=num_threads):
+        # Thread local buffers
+        min_buffer = <cnp.float32_t *> malloc((buffer_len + 2) *
+                                              sizeof(cnp.float32_t))
+        d = min_buffer + buffer_len
+        for block in prange(nb_blocks, schedule='dynamic'):
+            i_end = min((block + 1) * DISTANCE_BLOCK, nb_rows)
+            for j0 in range(0, lentB, DISTANCE_BLOCK):
+                j_end = min(j0 + DISTANCE_BLOCK, lentB)
+                for i in range(block * DISTANCE_BLOCK, i_end):
+                    for j in range(j0, j_end):
+                        if metric_type < 0:
+                            track_direct_flip_dist(
+                                A_ptr + 3 * offsetsA[a0 + i],
+                                B_ptr + 3 * offsetsB[j],
+                                lengthsA[a0 + i], d)
+                            out[i, j] = min(d[0], d[1])
+                        else:
+                            out[i, j] = czhang(
+                                lengthsA[a0 + i],
+                                A_ptr + 3 * offsetsA[a0 + i],
+                                lengthsB[j], B_ptr + 3 * offsetsB[j],
+                                min_buffer, metric_type)
+        free(min_buffer)
+
+
+def _metric_type(metric):
+    if metric == 'avg':
+        return 0
+    elif metric == 'min':
+        return 1
+    elif metric == 'max':
+        return 2
+    raise ValueError('Metric should be one of avg, min, max')
+
+
+class _PackedPair(object):
+    ''' Packed tracks A and B ready for `_distance_rows` '''
+    def __init__(self, tracksA, tracksB, metric_type):
+        self.dataA, self.offsetsA, self.lengthsA = _packed_tracks(tracksA)
+        self.dataB, self.offsetsB, self.lengthsB = _packed_tracks(tracksB)
+        self.metric_type = metric_type
+        lengths = np.concatenate([self.lengthsA, self.lengthsB])
+        if metric_type < 0 and len(lengths) and np.any(lengths != lengths[0]):
+            raise ValueError('All tracks need to have the same number of '
+                             'points')
+        # The MAM distance needs room for the points of two tracks
+        self.buffer_len = 2 * max(lengths.max() if len(lengths) else 1, 1)
+
+    def rows(self, a0, out, num_threads):
+        ''' Fill `out` with the distances of tracks a0, a0+1... of A '''
+        cdef:
+            cnp.ndarray[cnp.float32_t, ndim=2] dataA = self.dataA
+            cnp.ndarray[cnp.float32_t, ndim=2] dataB = self.dataB
+            cnp.float32_t *A_ptr = <cnp.float32_t *> dataA.data
+            cnp.float32_t *B_ptr = <cnp.float32_t *> dataB.data
+            cnp.npy_intp[:] offsetsA = self.offsetsA
+            cnp.npy_intp[:] lengthsA = self.lengthsA
+            cnp.npy_intp[:] offsetsB = self.offsetsB
+            cnp.npy_intp[:] lengthsB = self.lengthsB
+            cnp.npy_intp start = a0, buffer_len = self.buffer_len
+            int metric_type = self.metric_type
+            int threads = determine_num_threads(num_threads)
+            cnp.float32_t[:, ::1] out32
+            cnp.float64_t[:, ::1] out64
+        if out.size == 0:
+            return out
+        if out.dtype == np.float32:
+            out32 = out
+            with nogil:
+                _distance_rows(A_ptr, offsetsA, lengthsA, B_ptr, offsetsB,
+                               lengthsB, start, metric_type, buffer_len,
+                               threads, out32)
+        else:
+            out64 = out
+            with nogil:
+                _distance_rows(A_ptr, offsetsA, lengthsA, B_ptr, offsetsB,
+                               lengthsB, start, metric_type, buffer_len,
+                               threads, out64)
+        return out
+
+    def neighbors(self, k, threshold, num_threads, block_size):
+        ''' Closest tracks of B for each track of A, computed by blocks of
+        tracks of A '''
+        if k is None and threshold is None:
+            raise ValueError('At least one of k or threshold must be given')
+        if k is not None and k < 1:
+            raise ValueError('k must be at least 1')
+        lentA = len(self.lengthsA)
+        lentB = len(self.lengthsB)
+        nb_rows = max(1, block_size // max(lentB, 1))
+        counts = np.zeros(lentA, dtype=np.intp)
+        indices = []
+        distances = []
+        block = np.empty((min(nb_rows, lentA), lentB), dtype=np.float32)
+        for a0 in range(0, lentA, nb_rows):
+            dist = self.rows(a0, block[:min(nb_rows, lentA - a0)],
+                             num_threads)
+            rows = np.arange(len(dist))[:, None]
+            if k is not None and k < lentB and NUMPY_LESS_1_8:
+                idx = np.argsort(dist, axis=1)[:, :k]
+            elif k is not None and k < lentB:
+                idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            else:
+                idx = np.tile(np.arange(lentB), (len(dist), 1))
+            dist = dist[rows, idx]
+            order = np.argsort(dist, axis=1, kind='mergesort')
+            idx = idx[rows, order]
+            dist = dist[rows, order]
+            keep = np.ones(dist.shape, dtype=bool)
+            if threshold is not None:
+                keep = dist <= threshold
+            counts[a0:a0 + len(dist)] = keep.sum(axis=1)
+            indices.append(idx[keep])
+            distances.append(dist[keep])
+        indptr = np.zeros(lentA + 1, dtype=np.intp)
+        np.cumsum(counts, out=indptr[1:])
+        if lentA == 0:
+            return (indptr, np.zeros(0, dtype=np.intp),
+                    np.zeros(0, dtype=np.float32))
+        return (indptr, np.concatenate(indices).astype(np.intp),
+                np.concatenate(distances))
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def bundles_distances_mam(tracksA, tracksB, metric='avg'):
+def bundles_distances_mam(tracksA, tracksB, metric='avg', num_threads=None,
+                          dtype=np.double):
     ''' Calculate distances between list of tracks A and list of tracks B
 
     Parameters
     ----------
-    tracksA : sequence
+    tracksA : sequence or ArraySequence
        of tracks as arrays, shape (N1,3) .. (Nm,3)
-    tracksB : sequence
+    tracksB : sequence or ArraySequence
        of tracks as arrays, shape (N1,3) .. (Nm,3)
     metric : str
        'avg', 'min', 'max'
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used. Only used if dipy was built with OpenMP.
+    dtype : {np.float64, np.float32}, optional
+        Type of the distance matrix. float32 halves its memory.
 
     Returns
     -------
     DM : array, shape (len(tracksA), len(tracksB))
         distances between tracksA and tracksB according to metric
 
-    '''
-    cdef:
-        size_t i, j, lentA, lentB
-        int metric_type
-    if metric=='avg':
-        metric_type = 0
-    elif metric == 'min':
-        metric_type = 1
-    elif metric == 'max':
-        metric_type = 2
-    else:
-        raise ValueError('Metric should be one of avg, min, max')
-    # preprocess tracks
-    cdef:
-        size_t longest_track_len = 0, track_len
-        size_t longest_track_lenA = 0, longest_track_lenB = 0
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout, find longest track
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-        track_len = tracksA32[i].shape[0]
-        if track_len > longest_track_lenA:
-            longest_track_lenA = track_len
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-        track_len = tracksB32[i].shape[0]
-        if track_len > longest_track_lenB:
-            longest_track_lenB = track_len
-    if longest_track_lenB > longest_track_lenA:
-        longest_track_lenA = longest_track_lenB
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=1] distances_buffer
-        cnp.float32_t *t1_ptr, *t2_ptr, *min_buffer
-    distances_buffer = np.zeros((longest_track_lenA*2,), dtype=np.float32)
-    min_buffer = <cnp.float32_t *> distances_buffer.data
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        size_t t1_len, t2_len
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        t1_len = t1.shape[0]
-        t1_ptr = <cnp.float32_t *>t1.data
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            t2_len = t2.shape[0]
-            t2_ptr = <cnp.float32_t *>t2.data
-            DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
+    See Also
+    --------
+    bundles_neighbors_mam : closest tracks without the full matrix
 
-    return DM
+    '''
+    tracks = _PackedPair(tracksA, tracksB, _metric_type(metric))
+    DM = np.zeros((len(tracks.lengthsA), len(tracks.lengthsB)),
+                  dtype=_distance_dtype(dtype))
+    return tracks.rows(0, DM, num_threads)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def bundles_distances_mdf(tracksA, tracksB):
+def bundles_distances_mdf(tracksA, tracksB, num_threads=None,
+                          dtype=np.double):
     ''' Calculate distances between list of tracks A and list of tracks B
 
     All tracks need to have the same number of points
 
     Parameters
     ----------
-    tracksA : sequence
+    tracksA : sequence or ArraySequence
        of tracks as arrays, [(N,3) .. (N,3)]
-    tracksB : sequence
+    tracksB : sequence or ArraySequence
        of tracks as arrays, [(N,3) .. (N,3)]
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used. Only used if dipy was built with OpenMP.
+    dtype : {np.float64, np.float32}, optional
+        Type of the distance matrix. float32 halves its memory.
 
     Returns
     -------
@@ -558,52 +701,113 @@ def bundles_distances_mdf(tracksA, tracksB):
     See Also
     ---------
     dipy.metrics.downsample
+    bundles_neighbors_mdf : closest tracks without the full matrix
 
     '''
-    cdef:
-        size_t i, j, lentA, lentB
-    # preprocess tracks
-    cdef:
-        size_t longest_track_len = 0, track_len
-        longest_track_lenA, longest_track_lenB
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.float32_t *t1_ptr, *t2_ptr, *min_buffer
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        size_t t1_len, t2_len
-        float d[2]
-    t_len = tracksA32[0].shape[0]
+    tracks = _PackedPair(tracksA, tracksB, -1)
+    DM = np.zeros((len(tracks.lengthsA), len(tracks.lengthsB)),
+                  dtype=_distance_dtype(dtype))
+    return tracks.rows(0, DM, num_threads)
 
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        #t1_len = t1.shape[0]
-        t1_ptr = <cnp.float32_t *>t1.data
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            #t2_len = t2.shape[0]
-            t2_ptr = <cnp.float32_t *>t2.data
-            #DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
-            track_direct_flip_dist(t1_ptr, t2_ptr,t_len,<float *>d)
-            if d[0]<d[1]:
-                DM[i,j]=d[0]
-            else:
-                DM[i,j]=d[1]
-    return DM
+
+def _distance_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype != np.float32 and dtype != np.float64:
+        raise ValueError('Distances can only be computed as float32 or '
+                         'float64')
+    return dtype
+
+
+def bundles_neighbors_mam(tracksA, tracksB, metric='avg', k=None,
+                          threshold=None, num_threads=None,
+                          block_size=2**24):
+    ''' Closest tracks of B for each track of A, with the MAM distance
+
+    The distances are computed by blocks of tracks of A, the full distance
+    matrix is never allocated.
+
+    Parameters
+    ----------
+    tracksA : sequence or ArraySequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    tracksB : sequence or ArraySequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    metric : str
+       'avg', 'min', 'max'
+    k : int, optional
+        Maximum number of neighbors of each track of A.
+    threshold : float, optional
+        Maximum distance of the neighbors. At least one of `k` and
+        `threshold` must be given.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used. Only used if dipy was built with OpenMP.
+    block_size : int, optional
+        Number of distances computed between two selections of neighbors.
+
+    Returns
+    -------
+    indptr : array, shape (len(tracksA) + 1,)
+    indices : array of int
+    distances : array of float32
+        The neighbors of track ``i`` of A are the tracks
+        ``indices[indptr[i]:indptr[i + 1]]`` of B, sorted by increasing
+        distance, and their distances are
+        ``distances[indptr[i]:indptr[i + 1]]``. This is the layout of a
+        ``scipy.sparse.csr_matrix``.
+
+    '''
+    tracks = _PackedPair(tracksA, tracksB, _metric_type(metric))
+    return tracks.neighbors(k, threshold, num_threads, block_size)
+
+
+def bundles_neighbors_mdf(tracksA, tracksB, k=None, threshold=None,
+                          num_threads=None, block_size=2**24):
+    ''' Closest tracks of B for each track of A, with the MDF distance
+
+    All tracks need to have the same number of points. The distances are
+    computed by blocks of tracks of A, the full distance matrix is never
+    allocated.
+
+    Parameters
+    ----------
+    tracksA : sequence or ArraySequence
+       of tracks as arrays, [(N,3) .. (N,3)]
+    tracksB : sequence or ArraySequence
+       of tracks as arrays, [(N,3) .. (N,3)]
+    k : int, optional
+        Maximum number of neighbors of each track of A.
+    threshold : float, optional
+        Maximum distance of the neighbors. At least one of `k` and
+        `threshold` must be given.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used. Only used if dipy was built with OpenMP.
+    block_size : int, optional
+        Number of distances computed between two selections of neighbors.
+
+    Returns
+    -------
+    indptr : array, shape (len(tracksA) + 1,)
+    indices : array of int
+    distances : array of float32
+        The neighbors of track ``i`` of A are the tracks
+        ``indices[indptr[i]:indptr[i + 1]]`` of B, sorted by increasing
+        distance, and their distances are
+        ``distances[indptr[i]:indptr[i + 1]]``. This is the layout of a
+        ``scipy.sparse.csr_matrix``.
+
+    Examples
+    --------
+    >>> A = [np.zeros((3, 3)), np.ones((3, 3))]
+    >>> B = [np.ones((3, 3)) * 0.9, np.ones((3, 3)) * 3]
+    >>> indptr, indices, distances = bundles_neighbors_mdf(A, B, k=1)
+    >>> indptr, indices
+    (array([0, 1, 2]), array([0, 0]))
+
+    '''
+    tracks = _PackedPair(tracksA, tracksB, -1)
+    return tracks.neighbors(k, threshold, num_threads, block_size)
 
 
 
@@ -9,12 +9,16 @@ and statistical inference in living connectomes. Nature Methods 11:
 import numpy as np
 import scipy.sparse as sps
 import scipy.linalg as la
+from scipy.spatial import cKDTree
 
 from dipy.reconst.base import ReconstModel, ReconstFit
 from dipy.utils.six.moves import range
+from dipy.utils.arrfuncs import NUMPY_LESS_1_8
 from dipy.tracking.utils import unique_rows
 from dipy.tracking.streamline import transform_streamlines
-from dipy.tracking.vox2track import _voxel2streamline
+from dipy.tracking.arraysequence import ArraySequence
+from dipy.tracking.vox2track import _voxel2streamline, _life_matrix_data
+from dipy.core.sphere import HemiSphere
 import dipy.data as dpd
 import dipy.core.optimize as opt
 
@@ -75,17 +79,17 @@ def gradient(f):
         slice2[axis] = slice(2, None)
         slice3[axis] = slice(None, -2)
         # 1D equivalent -- out[1:-1] = (f[2:] - f[:-2])/2.0
-        out[slice1] = (f[slice2] - f[slice3])/2.0
+        out[tuple(slice1)] = (f[tuple(slice2)] - f[tuple(slice3)])/2.0
         slice1[axis] = 0
         slice2[axis] = 1
         slice3[axis] = 0
         # 1D equivalent -- out[0] = (f[1] - f[0])
-        out[slice1] = (f[slice2] - f[slice3])
+        out[tuple(slice1)] = (f[tuple(slice2)] - f[tuple(slice3)])
         slice1[axis] = -1
         slice2[axis] = -1
         slice3[axis] = -2
         # 1D equivalent -- out[-1] = (f[-1] - f[-2])
-        out[slice1] = (f[slice2] - f[slice3])
+        out[tuple(slice1)] = (f[tuple(slice2)] - f[tuple(slice3)])
 
         # divide by step size
         outvals.append(out / dx[axis])
@@ -313,6 +317,77 @@ def voxel2streamline(streamline, transformed=False, affine=None,
                              unique_idx.astype(np.intp))
 
 
+# Nodes processed at once by `FiberModel.setup`, which holds a few arrays of
+# shape (nodes, n_bvecs) or (nodes, n_vertices) for them
+_NODES_PER_BLOCK = 2 ** 14
+
+
+def _node_blocks(offsets, nodes_per_block=_NODES_PER_BLOCK):
+    """ The (start, stop) streamlines of consecutive blocks of about
+    `nodes_per_block` nodes, given the offsets of the streamlines followed
+    by their total number of nodes
+    """
+    bounds = np.unique(np.searchsorted(
+        offsets, np.arange(0, offsets[-1], nodes_per_block)))
+    bounds = np.append(bounds[bounds < len(offsets) - 1], len(offsets) - 1)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _packed_gradients(points, offsets):
+    """ `streamline_gradients` of consecutive streamlines at once
+
+    Parameters
+    ----------
+    points : array (N, 3)
+        The nodes of the streamlines, one after the other.
+    offsets : array (S + 1,)
+        The offsets of the streamlines in `points`, followed by N.
+    """
+    grad = np.empty_like(points)
+    # Central differences, but at the ends of the streamlines:
+    grad[1:-1] = (points[2:] - points[:-2]) / 2.0
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    grad[first] = points[first + 1] - points[first]
+    grad[last] = points[last] - points[last - 1]
+    return grad
+
+
+def _tensor_signals(grad, gtab, evals):
+    """ The signals of the tensors `grad_tensor` gives for each of `grad`,
+    as computed in `streamline_signal`, but not demeaned
+    """
+    # The rotations of `grad_tensor`, for all the gradients at once:
+    if NUMPY_LESS_1_8:
+        R = np.array([np.linalg.svd(g[None, :])[2]
+                      for g in grad]).reshape((-1, 3, 3))
+    else:
+        R = np.linalg.svd(grad[:, None, :])[2]
+    tensors = np.einsum('nij,j,nkj->nik', R, np.asarray(evals, dtype=float),
+                        R)
+    bvecs = gtab.bvecs[~gtab.b0s_mask]
+    bvals = gtab.bvals[~gtab.b0s_mask]
+    ADC = np.einsum('gi,nij,gj->ng', bvecs, tensors, bvecs)
+    return np.exp(-bvals * ADC)
+
+
+def _closest_vertices(sphere, tree, xyz):
+    """ `sphere.find_closest` of each of `xyz`
+
+    The vertices with the largest cosine similarity are the nearest ones,
+    found in `tree`, the `cKDTree` of the vertices of `sphere`.
+    """
+    norm = np.sqrt(np.sum(xyz ** 2, -1))
+    unit = xyz / np.where(norm > 0, norm, 1)[:, None]
+    dist, idx = tree.query(unit)
+    if isinstance(sphere, HemiSphere):
+        dist_flip, idx_flip = tree.query(-unit)
+        idx = np.where(dist_flip < dist, idx_flip, idx)
+    # As the argmax of null cosine similarities:
+    idx[norm == 0] = 0
+    return idx.astype(np.intp)
+
+
 class FiberModel(ReconstModel):
     """
     A class for representing and solving predictive models based on
@@ -336,7 +411,8 @@ class FiberModel(ReconstModel):
         # Initialize the super-class:
         ReconstModel.__init__(self, gtab)
 
-    def setup(self, streamline, affine, evals=[0.001, 0, 0], sphere=None):
+    def setup(self, streamline, affine, evals=[0.001, 0, 0], sphere=None,
+              num_threads=None, dtype=np.float64):
         """
         Set up the necessary components for the LiFE model: the matrix of
         fiber-contributions to the DWI signal, and the coordinates of voxels
@@ -344,7 +420,7 @@ class FiberModel(ReconstModel):
 
         Parameters
         ----------
-        streamline : list
+        streamline : list or ArraySequence
             Streamlines, each is an array of shape (n, 3)
         affine : 4 by 4 array
             Mapping from the streamline coordinates to the data
@@ -358,69 +434,106 @@ class FiberModel(ReconstModel):
             gradients along the streamlines to calculate the matrix, instead of
             an approximation. Defaults to use the 724-vertex symmetric sphere
             from :mod:`dipy.data`
-        """
-        if sphere is not False:
-            SignalMaker = LifeSignalMaker(self.gtab,
-                                          evals=evals,
-                                          sphere=sphere)
+        num_threads : int, optional
+            Number of threads summing the signals of the streamlines into the
+            matrix. Default: one per CPU.
+        dtype : dtype, optional
+            Data type of the values of the matrix, float32 halves its memory.
+            Default: float64.
 
+        Returns
+        -------
+        life_matrix : sparse matrix, csc format
+            The signal of each streamline (columns) in each voxel and
+            direction (rows, ``n_bvecs`` per voxel).
+        vox_coords : array (n_voxels, 3)
+            The coordinates of the voxels the streamlines go through, in the
+            order of the rows of `life_matrix`.
+
+        Notes
+        -----
+        The nodes of the streamlines are processed as arrays, by blocks of
+        streamlines, and a compiled kernel sums their signals straight into
+        the buffer of the matrix, which is never converted.
+        """
         if affine is None:
             affine = np.eye(4)
-        streamline = transform_streamlines(streamline, affine)
-        # Assign some local variables, for shorthand:
-        all_coords = np.concatenate(streamline)
-        vox_coords = unique_rows(np.round(all_coords).astype(np.intp))
-        del all_coords
+        if sphere is not False:
+            if sphere is None:
+                sphere = dpd.get_sphere('symmetric724')
+            # Signal of each vertex, as cached by `LifeSignalMaker`:
+            vertex_signal = _tensor_signals(sphere.vertices, self.gtab, evals)
+            vertex_signal -= np.mean(vertex_signal, -1)[:, None]
+            vertex_signal = vertex_signal.astype(dtype)
+            tree = cKDTree(sphere.vertices)
         # We only consider the diffusion-weighted signals:
         n_bvecs = self.gtab.bvals[~self.gtab.b0s_mask].shape[0]
-        v2f, v2fn = voxel2streamline(streamline, transformed=True,
-                                     affine=affine, unique_idx=vox_coords)
-        # How many fibers in each voxel (this will determine how many
-        # components are in the matrix):
-        n_unique_f = len(np.hstack(v2f.values()))
-        # Preallocate these, which will be used to generate the sparse
-        # matrix:
-        f_matrix_sig = np.zeros(n_unique_f * n_bvecs, dtype=np.float)
-        f_matrix_row = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-        f_matrix_col = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-
-        fiber_signal = []
-        for s_idx, s in enumerate(streamline):
+
+        streamline = transform_streamlines(
+            ArraySequence(streamline, dtype=np.float64), affine)
+        points = streamline.data
+        offsets = np.append(streamline.offsets,
+                            streamline.total_nb_rows).astype(np.intp)
+        n_streamlines = len(offsets) - 1
+
+        # The voxels, in the order they are met along the streamlines:
+        node_voxel = np.round(points).astype(np.intp)
+        node_voxel -= node_voxel.min(0)
+        _, first, node_voxel = np.unique(
+            np.ravel_multi_index(node_voxel.T, node_voxel.max(0) + 1),
+            return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        vox_coords = np.round(points[first[order]]).astype(np.intp)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        node_voxel = rank[node_voxel]
+        n_voxels = len(vox_coords)
+        del first, order, rank
+
+        # Each combination of a streamline and a voxel it goes through is a
+        # pair, they are sorted by streamline, then by voxel, which is the
+        # order of the values of the csc matrix:
+        node_streamline = np.repeat(np.arange(n_streamlines),
+                                    np.diff(offsets))
+        pairs, node_pair = np.unique(node_streamline * n_voxels + node_voxel,
+                                     return_inverse=True)
+        node_pair = node_pair.astype(np.intp)
+        del node_streamline, node_voxel
+        pair_indptr = np.zeros(n_streamlines + 1, dtype=np.intp)
+        np.cumsum(np.bincount(pairs // n_voxels, minlength=n_streamlines),
+                  out=pair_indptr[1:])
+        pairs %= n_voxels
+
+        data = np.zeros((len(pairs), n_bvecs), dtype=dtype)
+        for start, stop in _node_blocks(offsets):
+            nodes = slice(offsets[start], offsets[stop])
+            grad = _packed_gradients(points[nodes], offsets[start:stop + 1] -
+                                     offsets[start])
             if sphere is not False:
-                fiber_signal.append(SignalMaker.streamline_signal(s))
+                signals = vertex_signal
+                node_signal = _closest_vertices(sphere, tree, grad)
             else:
-                fiber_signal.append(streamline_signal(s, self.gtab, evals))
-
-        del streamline
-        if sphere is not False:
-            del SignalMaker
-
-        keep_ct = 0
-        range_bvecs = np.arange(n_bvecs).astype(int)
-        # In each voxel:
-        for v_idx in range(vox_coords.shape[0]):
-            mat_row_idx = (range_bvecs + v_idx * n_bvecs).astype(np.intp)
-            # For each fiber in that voxel:
-            for f_idx in v2f[v_idx]:
-                # For each fiber-voxel combination, store the row/column
-                # indices in the pre-allocated linear arrays
-                f_matrix_row[keep_ct:keep_ct+n_bvecs] = mat_row_idx
-                f_matrix_col[keep_ct:keep_ct+n_bvecs] = f_idx
-
-                vox_fiber_sig = np.zeros(n_bvecs)
-                for node_idx in v2fn[f_idx][v_idx]:
-                    # Sum the signal from each node of the fiber in that voxel:
-                    vox_fiber_sig += fiber_signal[f_idx][node_idx]
-                # And add the summed thing into the corresponding rows:
-                f_matrix_sig[keep_ct:keep_ct+n_bvecs] += vox_fiber_sig
-                keep_ct = keep_ct + n_bvecs
-
-        del v2f, v2fn
-        # Allocate the sparse matrix, using the more memory-efficient 'csr'
-        # format:
-        life_matrix = sps.csr_matrix((f_matrix_sig,
-                                     [f_matrix_row, f_matrix_col]))
-
+                signals = _tensor_signals(grad, self.gtab, evals)
+                # Like `streamline_signal`, demeaned over each streamline:
+                lengths = np.diff(offsets[start:stop + 1])
+                means = (np.add.reduceat(signals.sum(-1), lengths.cumsum() -
+                                         lengths) / (lengths * n_bvecs))
+                signals -= np.repeat(means, lengths)[:, None]
+                signals = signals.astype(dtype)
+                node_signal = np.arange(len(signals), dtype=np.intp)
+            _life_matrix_data(signals, node_signal, node_pair[nodes],
+                              offsets[start:stop + 1] - offsets[start],
+                              data, num_threads)
+        del node_pair
+
+        n_rows = n_voxels * n_bvecs
+        index_dtype = np.int32 if n_rows < 2 ** 31 else np.intp
+        indices = (pairs.astype(index_dtype)[:, None] * n_bvecs +
+                   np.arange(n_bvecs, dtype=index_dtype))
+        life_matrix = sps.csc_matrix((data.ravel(), indices.ravel(),
+                                      (pair_indptr * n_bvecs).astype(
+                                          index_dtype)),
+                                     shape=(n_rows, n_streamlines))
         return life_matrix, vox_coords
 
     def _signals(self, data, vox_coords):
@@ -451,7 +564,7 @@ class FiberModel(ReconstModel):
                 vox_data)
 
     def fit(self, data, streamline, affine=None, evals=[0.001, 0, 0],
-            sphere=None):
+            sphere=None, num_threads=None, dtype=np.float64, block_size=None):
         """
         Fit the LiFE FiberModel for data and a set of streamlines associated
         with this data
@@ -479,6 +592,20 @@ class FiberModel(ReconstModel):
             gradients along the streamlines to calculate the matrix, instead of
             an approximation.
 
+        num_threads : int (optional)
+            Number of threads setting up the matrix, and computing its
+            products by blocks of streamlines if `block_size` is set.
+            Default: one per CPU.
+
+        dtype : dtype (optional)
+            Data type of the values of the matrix, float32 halves its memory.
+            Default: float64.
+
+        block_size : int (optional)
+            Number of streamlines of the blocks of the matrix whose products
+            are computed in parallel by the solver. Default: None, the matrix
+            is a single block.
+
         Returns
         -------
         FiberFit class instance
@@ -486,10 +613,12 @@ class FiberModel(ReconstModel):
         if affine is None:
             affine = np.eye(4)
         life_matrix, vox_coords = \
-            self.setup(streamline, affine, evals=evals, sphere=sphere)
+            self.setup(streamline, affine, evals=evals, sphere=sphere,
+                       num_threads=num_threads, dtype=dtype)
         (to_fit, weighted_signal, b0_signal, relative_signal, mean_sig,
          vox_data) = self._signals(data, vox_coords)
-        beta = opt.sparse_nnls(to_fit, life_matrix)
+        beta = opt.sparse_nnls(to_fit, life_matrix, block_size=block_size,
+                               num_threads=num_threads)
         return FiberFit(self, life_matrix, vox_coords, to_fit, beta,
                         weighted_signal, b0_signal, relative_signal, mean_sig,
                         vox_data, streamline, affine, evals)
@@ -1,8 +1,13 @@
+from itertools import count, islice
+from multiprocessing import cpu_count
+from warnings import warn
+
 import numpy as np
 
 from .localtrack import local_tracker
 from dipy.align import Bunch
 from dipy.tracking import utils
+from dipy.utils.parallel import fork_context
 
 # enum TissueClass (tissue_classifier.pxd) is not accessible
 # from here. To be changed when minimal cython version > 0.21.
@@ -10,6 +15,17 @@ from dipy.tracking import utils
 # https://github.com/cython/cython/commit/50133b5a91eea348eddaaad22a606a7fa1c7c457
 TissueTypes = Bunch(OUTSIDEIMAGE=-1, INVALIDPOINT=0, TRACKPOINT=1, ENDPOINT=2)
 
+# Trackers used by the worker processes, set before the pool forks so that
+# their direction getters and tissue classifiers need not be pickled
+_shared_trackers = {}
+
+
+def _track_chunk(args):
+    """Track the seeds of one chunk in a worker process"""
+    key, chunk = args
+    tracker = _shared_trackers[key]
+    return list(tracker._generate_chunk(chunk))
+
 
 class LocalTracking(object):
     """A streamline generator for local tracking methods"""
@@ -34,7 +50,8 @@ class LocalTracking(object):
 
     def __init__(self, direction_getter, tissue_classifier, seeds, affine,
                  step_size, max_cross=None, maxlen=500, fixedstep=True,
-                 return_all=True):
+                 return_all=True, num_workers=1, chunk_size=1000,
+                 random_seed=None, ordered=True):
         """Creates streamlines by using local fiber-tracking.
 
         Parameters
@@ -43,9 +60,10 @@ class LocalTracking(object):
             Used to get directions for fiber tracking.
         tissue_classifier : instance of TissueClassifier
             Identifies endpoints and invalid points to inform tracking.
-        seeds : array (N, 3)
+        seeds : array (N, 3) or iterable of points
             Points to seed the tracking. Seed points should be given in point
-            space of the track (see ``affine``).
+            space of the track (see ``affine``). They are read lazily, one
+            chunk at a time.
         affine : array (4, 4)
             Coordinate space for the streamline point with respect to voxel
             indices of input data. This affine can contain scaling, rotational,
@@ -67,6 +85,28 @@ class LocalTracking(object):
         return_all : bool
             If true, return all generated streamlines, otherwise only
             streamlines reaching end points or exiting the image.
+        num_workers : int or None
+            Number of processes tracking the seeds. Each process tracks
+            chunks of `chunk_size` seeds and sends their streamlines back.
+            The processes are forked, so that the direction getter and the
+            tissue classifier are shared rather than copied. By default one
+            process tracks all the seeds, None uses one per CPU.
+        chunk_size : int
+            Number of seeds tracked at once by a process.
+        random_seed : int or None
+            If given, the global numpy random generator, used by
+            probabilistic direction getters, is seeded with
+            ``(random_seed, i)`` before tracking the i-th chunk of seeds. The
+            streamlines then only depend on `random_seed` and `chunk_size`,
+            not on `num_workers` nor on the order in which chunks are
+            tracked. If None and several workers are used, the random state
+            of each chunk is seeded with a number drawn from the global
+            generator of the calling process, so that the workers do not
+            repeat the random numbers of the state they inherit.
+        ordered : bool
+            If true, streamlines are returned in the order of the seeds.
+            Otherwise, with several workers, the streamlines of each chunk
+            are returned as soon as it is tracked.
         """
         self.direction_getter = direction_getter
         self.tissue_classifier = tissue_classifier
@@ -80,14 +120,84 @@ class LocalTracking(object):
         self.max_cross = max_cross
         self.maxlen = maxlen
         self.return_all = return_all
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.random_seed = random_seed
+        self.ordered = ordered
 
     def __iter__(self):
         # Make tracks, move them to point space and return
-        track = self._generate_streamlines()
+        num_workers = self.num_workers
+        if num_workers is None:
+            num_workers = cpu_count()
+        if num_workers > 1 and fork_context() is None:
+            warn("Processes cannot be forked, tracking with one process.")
+            num_workers = 1
+        if num_workers > 1:
+            track = self._generate_streamlines_parallel(num_workers)
+        elif self.random_seed is not None:
+            track = self._generate_streamlines_seeded()
+        else:
+            track = self._generate_streamlines()
         return utils.move_streamlines(track, self.affine)
 
-    def _generate_streamlines(self):
+    def _chunks(self):
+        """Seed of the random state, or None, and seeds of each chunk of
+        seeds"""
+        seeds = iter(self.seeds)
+        for i in count():
+            chunk = np.asarray(list(islice(seeds, self.chunk_size)))
+            if len(chunk) == 0:
+                return
+            if self.random_seed is None:
+                yield None, chunk
+            else:
+                yield [self.random_seed, i], chunk
+
+    def _generate_chunk(self, chunk):
+        """Streamlines of a chunk of seeds, with the seeded random state"""
+        random_seed, seeds = chunk
+        if random_seed is not None:
+            np.random.seed(random_seed)
+        return self._generate_streamlines(seeds)
+
+    def _generate_streamlines_seeded(self):
+        """A streamline generator reseeding the random state per chunk"""
+        for chunk in self._chunks():
+            for streamline in self._generate_chunk(chunk):
+                yield streamline
+
+    def _generate_streamlines_parallel(self, num_workers):
+        """A streamline generator tracking chunks in worker processes"""
+        key = id(self)
+        _shared_trackers[key] = self
+        try:
+            pool = fork_context().Pool(num_workers)
+        finally:
+            # The workers have their own copy by now
+            del _shared_trackers[key]
+        try:
+            imap = pool.imap if self.ordered else pool.imap_unordered
+
+            def tasks():
+                for random_seed, seeds in self._chunks():
+                    if random_seed is None:
+                        # The forked workers all start from the random state
+                        # of this process
+                        random_seed = np.random.randint(2 ** 31)
+                    yield key, (random_seed, seeds)
+            for streamlines in imap(_track_chunk, tasks()):
+                for streamline in streamlines:
+                    yield streamline
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _generate_streamlines(self, seeds=None):
         """A streamline generator"""
+        if seeds is None:
+            seeds = self.seeds
         N = self.maxlen
         dg = self.direction_getter
         tc = self.tissue_classifier
@@ -103,7 +213,7 @@ class LocalTracking(object):
 
         F = np.empty((N + 1, 3), dtype=float)
         B = F.copy()
-        for s in self.seeds:
+        for s in seeds:
             s = np.dot(lin, s) + offset
             directions = dg.initial_direction(s)
             if directions.size == 0 and self.return_all:
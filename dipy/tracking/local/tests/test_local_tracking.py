@@ -275,6 +275,83 @@ def test_ProbabilisticOdfWeightedTracker():
     for sl in streamlines:
         npt.assert_(np.allclose(sl, expected[1]))
 
+def test_parallel_tracking():
+    """Tracking with several processes and seeded random states gives the
+    same streamlines, in the same order, as tracking with one process.
+    """
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    pmf_lookup = np.array([[0., 0., 1.],
+                           [1., 0., 0.],
+                           [0., 1., 0.],
+                           [.6, .4, 0.]])
+    simple_image = np.array([[0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 3, 2, 2, 2, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             ])
+    simple_image = simple_image[..., None]
+    pmf = pmf_lookup[simple_image]
+    seeds = np.array([[1., 1., 0.]] * 50 + [[2., 3., 0.]] * 20)
+    # Streamlines are moved to point space, scaled by the affine
+    affine = np.diag([2., 2., 2., 1.])
+
+    mask = (simple_image > 0).astype(float)
+    tc = ThresholdTissueClassifier(mask, .5)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+
+    serial = list(LocalTracking(dg, tc, seeds * 2, affine, 1.,
+                                chunk_size=7, random_seed=42))
+    npt.assert_equal(len(serial), 70)
+    # Different paths are taken from the crossing
+    npt.assert_(len(set(len(sl) for sl in serial[:50])) > 1)
+
+    for num_workers in [2, 3]:
+        parallel = list(LocalTracking(dg, tc, seeds * 2, affine, 1.,
+                                      num_workers=num_workers, chunk_size=7,
+                                      random_seed=42))
+        npt.assert_equal(len(parallel), len(serial))
+        for sl, expected in zip(parallel, serial):
+            npt.assert_array_almost_equal(sl, expected)
+
+    unordered = list(LocalTracking(dg, tc, seeds * 2, affine, 1.,
+                                   num_workers=3, chunk_size=7,
+                                   random_seed=42, ordered=False))
+    npt.assert_equal(sorted(sl.tostring() for sl in unordered),
+                     sorted(sl.tostring() for sl in serial))
+
+    # Seeds can be given by an iterator
+    parallel = list(LocalTracking(dg, tc, iter(seeds * 2), affine, 1.,
+                                  num_workers=2, chunk_size=7,
+                                  random_seed=42))
+    npt.assert_equal(len(parallel), len(serial))
+    for sl, expected in zip(parallel, serial):
+        npt.assert_array_almost_equal(sl, expected)
+
+    # Without random seed, each chunk is tracked with a random state seeded
+    # from the one of the calling process
+    crossing = seeds[:10] * 2
+    np.random.seed(2016)
+    chunk_seeds = np.random.randint(2 ** 31, size=len(crossing))
+    expected = []
+    for chunk_seed, seed in zip(chunk_seeds, crossing):
+        np.random.seed(chunk_seed)
+        expected.extend(LocalTracking(dg, tc, [seed], affine, 1.))
+    np.random.seed(2016)
+    parallel = list(LocalTracking(dg, tc, crossing, affine, 1.,
+                                  num_workers=2, chunk_size=1))
+    npt.assert_equal(len(parallel), len(expected))
+    for sl, expected_sl in zip(parallel, expected):
+        npt.assert_array_almost_equal(sl, expected_sl)
+
+    # Another random seed gives other streamlines
+    other = list(LocalTracking(dg, tc, seeds * 2, affine, 1., chunk_size=7,
+                               random_seed=43))
+    npt.assert_(any(len(sl) != len(expected)
+                    for sl, expected in zip(other, serial)))
+
+
 def test_MaximumDeterministicTracker():
     """This tests that the Maximum Deterministic Direction Getter plays nice
     LocalTracking and produces reasonable streamlines in a simple example.
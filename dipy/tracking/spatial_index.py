@@ -0,0 +1,218 @@
+""" Spatial index over the points of a set of streamlines
+
+Virtual dissection asks the same questions many times about the same
+tractogram: which streamlines pass near these coordinates, through this
+mask or through this label. `StreamlineIndex` is built once per tractogram
+and answers them without going through all the points of all the
+streamlines: a k-d tree of the points is used for distance queries and a
+sorted table of the (voxel, streamline) pairs for mask queries.
+
+The functions `dipy.tracking.utils.near_roi`, `dipy.tracking.utils.target`,
+`dipy.tracking.utils.path_length` and
+`dipy.tracking.streamline.select_by_rois` accept an index in place of the
+streamlines.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from dipy.core.onetime import auto_attr
+from dipy.tracking.arraysequence import ArraySequence
+from dipy.tracking._utils import _mapping_to_voxel
+
+
+def _gather_ranges(starts, stops):
+    """Indices of all the ranges ``[starts[i], stops[i])``, concatenated"""
+    lengths = stops - starts
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shift + np.arange(lengths.sum())
+
+
+class StreamlineIndex(object):
+    """Index of the points of streamlines for fast spatial queries
+
+    Parameters
+    ----------
+    streamlines : sequence of arrays of shape (N, 3) or ArraySequence
+        The streamlines to index. They are packed in an `ArraySequence`,
+        kept as `streamlines`.
+    leafsize : int, optional
+        Number of points in the leaves of the k-d tree.
+
+    Notes
+    -----
+    The k-d tree is built on the first distance query and the voxel table
+    of a grid on the first mask query on that grid, they are then reused by
+    all the following queries.
+
+    Examples
+    --------
+    >>> streamlines = [np.array([[0, 0, 0], [1, 0, 0.]]),
+    ...                np.array([[3, 3, 3], [4, 4, 4.]])]
+    >>> index = StreamlineIndex(streamlines)
+    >>> index.near_coords([[1, 0.5, 0]], tol=1)
+    array([ True, False])
+    >>> mask = np.zeros((5, 5, 5), dtype=bool)
+    >>> mask[4, 4, 4] = True
+    >>> index.in_mask(mask)
+    array([False,  True])
+    """
+    def __init__(self, streamlines, leafsize=16):
+        if not isinstance(streamlines, ArraySequence):
+            streamlines = ArraySequence(streamlines, dtype=np.float64)
+        self.streamlines = streamlines.copy()
+        self.leafsize = leafsize
+        self._voxel_tables = {}
+
+    def __len__(self):
+        return len(self.streamlines)
+
+    @auto_attr
+    def _tree(self):
+        return cKDTree(self.streamlines.data, leafsize=self.leafsize)
+
+    @auto_attr
+    def _point_streamline(self):
+        """Index of the streamline of each point"""
+        return np.repeat(np.arange(len(self.streamlines)),
+                         self.streamlines.lengths)
+
+    def _selection(self, indices):
+        selected = np.zeros(len(self.streamlines), dtype=bool)
+        selected[indices] = True
+        return selected
+
+    def near_coords(self, coords, tol, mode="any"):
+        """Streamlines passing within a distance of some coordinates
+
+        Parameters
+        ----------
+        coords : array, shape (M, 3)
+            Coordinates, in the space of the streamlines.
+        tol : float
+            Distance (in the units of the streamlines, usually mm).
+        mode : string, optional
+            One of {"any", "all", "either_end", "both_end"}, where a
+            streamline is selected if:
+
+            "any" : any point is within tol from the coordinates. Default.
+
+            "all" : all points are within tol from the coordinates.
+
+            "either_end" : either of the end-points is within tol from the
+            coordinates.
+
+            "both_end" : both end points are within tol from the
+            coordinates.
+
+        Returns
+        -------
+        selected : 1D array of boolean dtype, shape (len(streamlines), )
+            Same as `dipy.tracking.utils.near_roi` with the voxel coordinates
+            of an ROI moved to the space of the streamlines.
+        """
+        if mode not in ("any", "all", "either_end", "both_end"):
+            e_s = "For determining relationship to an array, you can use "
+            e_s += "one of the following modes: 'any', 'all', 'both_end',"
+            e_s += "'either_end', but you entered: %s." % mode
+            raise ValueError(e_s)
+        coords = np.asarray(coords, dtype=float).reshape((-1, 3))
+        if len(coords) == 0 or len(self.streamlines) == 0:
+            return np.zeros(len(self.streamlines), dtype=bool)
+
+        near = self._tree.query_ball_point(coords, tol)
+        near = np.unique(np.concatenate([np.asarray(n, dtype=np.intp)
+                                         for n in near]))
+        candidates, inverse = np.unique(self._point_streamline[near],
+                                        return_inverse=True)
+        counts = np.bincount(inverse)
+        if mode == "any":
+            return self._selection(candidates)
+        if mode == "all":
+            lengths = self.streamlines.lengths[candidates]
+            return self._selection(candidates[counts == lengths])
+
+        first = self.streamlines.offsets[candidates]
+        last = first + self.streamlines.lengths[candidates] - 1
+        first_near = np.in1d(first, near)
+        last_near = np.in1d(last, near)
+        if mode == "either_end":
+            return self._selection(candidates[first_near | last_near])
+        return self._selection(candidates[first_near & last_near])
+
+    def _voxel_table(self, affine):
+        """Voxels holding points of the streamlines, with the streamlines
+        passing through each of them, for the grid of `affine`"""
+        key = None if affine is None else np.asarray(affine, float).tostring()
+        if key in self._voxel_tables:
+            return self._voxel_tables[key]
+
+        lin_T, offset = _mapping_to_voxel(
+            np.eye(4) if affine is None else affine, None)
+        inds = np.dot(self.streamlines.data, lin_T)
+        inds += offset
+        # Points mapping to negative voxel indices are in no mask
+        valid = inds.min(axis=1).round(decimals=6) >= 0
+        voxels = inds[valid].astype(np.int64)
+        streamline_ids = self._point_streamline[valid]
+        dims = voxels.max(axis=0) + 1 if len(voxels) else np.ones(3, int)
+
+        nb_streamlines = max(len(self.streamlines), 1)
+        pairs = np.ravel_multi_index(voxels.T, dims).astype(np.int64)
+        pairs = np.unique(pairs * nb_streamlines + streamline_ids)
+        voxel_keys, starts = np.unique(pairs // nb_streamlines,
+                                       return_index=True)
+        stops = np.append(starts[1:], len(pairs))
+        table = (dims, voxel_keys, starts, stops, pairs % nb_streamlines)
+        self._voxel_tables[key] = table
+        return table
+
+    def in_mask(self, mask, affine=None):
+        """Streamlines with points in the voxels of a mask
+
+        Parameters
+        ----------
+        mask : array-like, 3D
+            Non-zero values are considered to be within the region.
+        affine : array (4, 4), optional
+            The affine transform from voxel indices to streamline points.
+            Default: identity.
+
+        Returns
+        -------
+        selected : 1D array of boolean dtype, shape (len(streamlines), )
+            Same as the streamlines kept by `dipy.tracking.utils.target`,
+            except that points outside of the mask are ignored instead of
+            raising an error.
+        """
+        dims, voxel_keys, starts, stops, streamline_ids = \
+            self._voxel_table(affine)
+        voxels = np.array(np.nonzero(mask))
+        voxels = voxels[:, np.all(voxels < dims[:, None], axis=0)]
+        keys = np.ravel_multi_index(voxels, dims)
+        pos = np.searchsorted(voxel_keys, keys)
+        found = pos < len(voxel_keys)
+        found[found] = voxel_keys[pos[found]] == keys[found]
+        pos = pos[found]
+        return self._selection(
+            streamline_ids[_gather_ranges(starts[pos], stops[pos])])
+
+    def in_label(self, label_volume, label, affine=None):
+        """Streamlines with points in the voxels of a label
+
+        Parameters
+        ----------
+        label_volume : ndarray, 3D
+            Volume of integer labels.
+        label : int
+            The label to select.
+        affine : array (4, 4), optional
+            The affine transform from voxel indices to streamline points.
+            Default: identity.
+
+        Returns
+        -------
+        selected : 1D array of boolean dtype, shape (len(streamlines), )
+        """
+        return self.in_mask(np.asarray(label_volume) == label, affine)
@@ -6,21 +6,26 @@ from scipy.spatial.distance import cdist
 import numpy as np
 from nibabel.affines import apply_affine
 
+from dipy.tracking.arraysequence import ArraySequence
 from dipy.tracking.streamlinespeed import set_number_of_points
 from dipy.tracking.streamlinespeed import length
 from dipy.tracking.streamlinespeed import compress_streamlines
 import dipy.tracking.utils as ut
 from dipy.tracking.utils import streamline_near_roi
+from dipy.tracking.spatial_index import StreamlineIndex
 from dipy.core.geometry import dist_to_corner
 import dipy.align.vector_fields as vfu
 
+#: Packed container of streamlines, see `ArraySequence`
+Streamlines = ArraySequence
+
 
 def unlist_streamlines(streamlines):
     """ Return the streamlines not as a list but as an array and an offset
 
     Parameters
     ----------
-    streamlines: sequence
+    streamlines: sequence or ArraySequence
 
     Returns
     -------
@@ -28,6 +33,10 @@ def unlist_streamlines(streamlines):
     offsets : array
 
     """
+    if isinstance(streamlines, ArraySequence):
+        streamlines = streamlines.copy()
+        return (streamlines.data,
+                (streamlines.offsets + streamlines.lengths).astype('i8'))
 
     points = np.concatenate(streamlines, axis=0)
     offsets = np.zeros(len(streamlines), dtype='i8')
@@ -73,17 +82,23 @@ def center_streamlines(streamlines):
 
     Parameters
     ----------
-    streamlines : list
+    streamlines : list or ArraySequence
         List of 2D ndarrays of shape[-1]==3
 
     Returns
     -------
-    new_streamlines : list
+    new_streamlines : list or ArraySequence
         List of 2D ndarrays of shape[-1]==3
     inv_shift : ndarray
         Translation in x,y,z to go back in the initial position
 
     """
+    if isinstance(streamlines, ArraySequence):
+        streamlines = streamlines.copy()
+        center = np.mean(streamlines.data, axis=0)
+        streamlines.data[:] -= center
+        return streamlines, center
+
     center = np.mean(np.concatenate(streamlines, axis=0), axis=0)
     return [s - center for s in streamlines], center
 
@@ -93,16 +108,21 @@ def transform_streamlines(streamlines, mat):
 
     Parameters
     ----------
-    streamlines : list
+    streamlines : list or ArraySequence
         List of 2D ndarrays of shape[-1]==3
     mat : array, (4, 4)
         transformation matrix
 
     Returns
     -------
-    new_streamlines : list
-        List of the transformed 2D ndarrays of shape[-1]==3
+    new_streamlines : list or ArraySequence
+        List of the transformed 2D ndarrays of shape[-1]==3. The points of
+        an `ArraySequence` are transformed at once.
     """
+    if isinstance(streamlines, ArraySequence):
+        streamlines = streamlines.copy()
+        streamlines.data[:] = apply_affine(mat, streamlines.data)
+        return streamlines
     return [apply_affine(mat, s) for s in streamlines]
 
 
@@ -121,6 +141,7 @@ def select_random_set_of_streamlines(streamlines, select):
     Returns
     -------
     selected_streamlines : list
+        An `ArraySequence` sharing the points of `streamlines` if it is one.
 
     Notes
     -----
@@ -128,6 +149,8 @@ def select_random_set_of_streamlines(streamlines, select):
     """
     len_s = len(streamlines)
     index = np.random.choice(len_s, min(select, len_s), replace=False)
+    if isinstance(streamlines, ArraySequence):
+        return streamlines[index]
     return [streamlines[i] for i in index]
 
 
@@ -139,8 +162,9 @@ def select_by_rois(streamlines, rois, include, mode=None, affine=None,
 
     Parameters
     ----------
-    streamlines : list
-        A list of candidate streamlines for selection
+    streamlines : list or StreamlineIndex
+        A list of candidate streamlines for selection. A `StreamlineIndex`
+        only looks at the streamlines near the ROIs.
     rois : list or ndarray
         A list of 3D arrays, each with shape (x, y, z) corresponding to the
         shape of the brain volume, or a 4D array with shape (n_rois, x, y,
@@ -251,6 +275,12 @@ def select_by_rois(streamlines, rois, include, mode=None, affine=None,
 
     if mode is None:
         mode = "any"
+    if isinstance(streamlines, StreamlineIndex):
+        selected = streamlines.near_coords(x_include_roi_coords, tol, mode)
+        selected &= ~streamlines.near_coords(x_exclude_roi_coords, tol, mode)
+        for sl in streamlines.streamlines[selected]:
+            yield sl
+        return
     for sl in streamlines:
         include = streamline_near_roi(sl, x_include_roi_coords, tol=tol,
                                       mode=mode)
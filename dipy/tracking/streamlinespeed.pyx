@@ -7,6 +7,8 @@ import cython
 
 from libc.math cimport sqrt
 
+from dipy.tracking.arraysequence import ArraySequence
+
 cdef extern from "dpy_math.h" nogil:
     bint dpy_isnan(double x)
 
@@ -40,8 +42,9 @@ def length(streamlines):
 
     Parameters
     ------------
-    streamlines : one or a list of array-like shape (N,3)
-       array representing x,y,z of N points in a streamline
+    streamlines : one or a list of array-like shape (N,3), or ArraySequence
+       array representing x,y,z of N points in a streamline. The lengths of
+       the streamlines of an `ArraySequence` are computed from its buffer.
 
     Returns
     ---------
@@ -67,6 +70,9 @@ def length(streamlines):
     0.0
 
     '''
+    if isinstance(streamlines, ArraySequence):
+        return _packed_length(streamlines)
+
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
         only_one_streamlines = True
@@ -129,6 +135,38 @@ def length(streamlines):
         return streamlines_length
 
 
+def _float_sequence(streamlines):
+    """ Return `streamlines` with a float32 or float64 buffer """
+    if streamlines.dtype == np.float32 or streamlines.dtype == np.float64:
+        return streamlines
+    dtype = np.float64 if streamlines.dtype.itemsize > 4 else np.float32
+    return streamlines.astype(dtype)
+
+
+cdef void c_packed_length(Streamline data, np.npy_intp[:] offsets,
+                          np.npy_intp[:] lengths, double[:] out) nogil:
+    cdef np.npy_intp i
+    for i in range(offsets.shape[0]):
+        out[i] = c_length(data[offsets[i]:offsets[i] + lengths[i]])
+
+
+def _packed_length(streamlines):
+    """ Lengths of the streamlines of an `ArraySequence`, computed from its
+    buffer without creating an array per streamline """
+    streamlines = _float_sequence(streamlines)
+    streamlines_length = np.zeros(len(streamlines), dtype=np.float64)
+    if len(streamlines) == 0:
+        return streamlines_length
+
+    if streamlines.dtype == np.float32:
+        c_packed_length[float2d](streamlines._data, streamlines.offsets,
+                                 streamlines.lengths, streamlines_length)
+    else:
+        c_packed_length[double2d](streamlines._data, streamlines.offsets,
+                                  streamlines.lengths, streamlines_length)
+    return streamlines_length
+
+
 cdef void c_arclengths(Streamline streamline, double* out) nogil:
     cdef np.npy_intp i = 0
     cdef double dn
@@ -200,7 +238,7 @@ def set_number_of_points(streamlines, nb_points=3):
 
     Parameters
     ----------
-    streamlines : one or a list of array-like shape (N,3)
+    streamlines : one or a list of array-like shape (N,3), or ArraySequence
        array representing x,y,z of N points in a streamline
     nb_points : int
        integer representing number of points wanted along the curve.
@@ -209,6 +247,7 @@ def set_number_of_points(streamlines, nb_points=3):
     -------
     modified_streamlines : one or a list of array-like shape (`nb_points`,3)
        array representing x,y,z of `nb_points` points that were interpolated.
+       An `ArraySequence` is returned when `streamlines` is one.
 
     Examples
     --------
@@ -232,6 +271,9 @@ def set_number_of_points(streamlines, nb_points=3):
     [10, 10]
 
     '''
+    if isinstance(streamlines, ArraySequence):
+        return _packed_set_number_of_points(streamlines, nb_points)
+
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
         only_one_streamlines = True
@@ -313,6 +355,45 @@ def set_number_of_points(streamlines, nb_points=3):
         return modified_streamlines
 
 
+cdef void c_packed_set_number_of_points(Streamline data,
+                                        np.npy_intp[:] offsets,
+                                        np.npy_intp[:] lengths,
+                                        Streamline out) nogil:
+    cdef:
+        np.npy_intp i
+        np.npy_intp nb_points = out.shape[0] // offsets.shape[0]
+    for i in range(offsets.shape[0]):
+        c_set_number_of_points(data[offsets[i]:offsets[i] + lengths[i]],
+                               out[i * nb_points:(i + 1) * nb_points])
+
+
+def _packed_set_number_of_points(streamlines, nb_points):
+    """ Resample the streamlines of an `ArraySequence` into a new one """
+    if nb_points < 2:
+        raise ValueError("nb_points must be at least 2")
+
+    streamlines = _float_sequence(streamlines)
+    if np.any(streamlines.lengths < 2):
+        raise ValueError("All streamlines must have at least 2 points.")
+
+    nb_streamlines = len(streamlines)
+    out = np.empty((nb_streamlines * nb_points,) + streamlines.common_shape,
+                   dtype=streamlines.dtype)
+    if nb_streamlines:
+        if streamlines.dtype == np.float32:
+            c_packed_set_number_of_points[float2d](
+                streamlines._data, streamlines.offsets, streamlines.lengths,
+                out)
+        else:
+            c_packed_set_number_of_points[double2d](
+                streamlines._data, streamlines.offsets, streamlines.lengths,
+                out)
+
+    lengths = np.empty(nb_streamlines, dtype=np.intp)
+    lengths.fill(nb_points)
+    return ArraySequence.from_arrays(out, lengths)
+
+
 cdef double c_norm_of_cross_product(double bx, double by, double bz,
                                     double cx, double cy, double cz) nogil:
     """ Computes the norm of the cross-product in 3D. """
@@ -436,7 +517,7 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
 
     Parameters
     ----------
-    streamlines : one or a list of array-like of shape (N,3)
+    streamlines : one or a list of array-like of shape (N,3), or ArraySequence
         Array representing x,y,z of N points in a streamline.
     tol_error : float (optional)
         Tolerance error in mm (default: 0.01). A rule of thumb is to set it
@@ -449,7 +530,8 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     Returns
     -------
     compressed_streamlines : one or a list of array-like
-        Results of the linearization process.
+        Results of the linearization process. An `ArraySequence` is returned
+        when `streamlines` is one.
 
     Examples
     --------
@@ -487,6 +569,10 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     .. [Houde15] Houde J.-C. et al. How to Avoid Biased Streamlines-Based
                  Metrics for Streamlines with Variable Step Sizes, ISMRM, 2015.
     """
+    if isinstance(streamlines, ArraySequence):
+        return _packed_compress_streamlines(streamlines, tol_error,
+                                            max_segment_length)
+
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
         only_one_streamlines = True
@@ -528,3 +614,52 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
         return compressed_streamlines[0]
     else:
         return compressed_streamlines
+
+
+cdef np.npy_intp c_packed_compress_streamlines(Streamline data,
+                                               np.npy_intp[:] offsets,
+                                               np.npy_intp[:] lengths,
+                                               Streamline out,
+                                               np.npy_intp[:] out_lengths,
+                                               double tol_error,
+                                               double max_segment_length) nogil:
+    cdef:
+        np.npy_intp i, d, k, start, N
+        np.npy_intp pos = 0
+
+    for i in range(offsets.shape[0]):
+        start = offsets[i]
+        N = lengths[i]
+        if N <= 2:
+            for k in range(N):
+                for d in range(data.shape[1]):
+                    out[pos + k, d] = data[start + k, d]
+            out_lengths[i] = N
+        else:
+            out_lengths[i] = c_compress_streamline(
+                data[start:start + N], out[pos:pos + N], tol_error,
+                max_segment_length)
+        pos += out_lengths[i]
+
+    return pos
+
+
+def _packed_compress_streamlines(streamlines, tol_error, max_segment_length):
+    """ Compress the streamlines of an `ArraySequence` into a new one """
+    streamlines = _float_sequence(streamlines)
+    nb_streamlines = len(streamlines)
+    out = np.empty((streamlines.total_nb_rows,) + streamlines.common_shape,
+                   dtype=streamlines.dtype)
+    out_lengths = np.zeros(nb_streamlines, dtype=np.intp)
+    nb_points = 0
+    if nb_streamlines:
+        if streamlines.dtype == np.float32:
+            nb_points = c_packed_compress_streamlines[float2d](
+                streamlines._data, streamlines.offsets, streamlines.lengths,
+                out, out_lengths, tol_error, max_segment_length)
+        else:
+            nb_points = c_packed_compress_streamlines[double2d](
+                streamlines._data, streamlines.offsets, streamlines.lengths,
+                out, out_lengths, tol_error, max_segment_length)
+
+    return ArraySequence.from_arrays(out[:nb_points].copy(), out_lengths)
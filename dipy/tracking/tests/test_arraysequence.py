@@ -0,0 +1,125 @@
+import pickle
+
+import numpy as np
+import numpy.testing as npt
+from nose.tools import assert_true, assert_false, assert_equal
+
+from dipy.tracking.arraysequence import ArraySequence
+
+
+def _random_streamlines(rng, nb_streamlines=10):
+    return [rng.rand(rng.randint(2, 20), 3) for i in range(nb_streamlines)]
+
+
+def check_sequence(seq, expected):
+    assert_equal(len(seq), len(expected))
+    assert_equal(seq.total_nb_rows, sum(len(e) for e in expected))
+    for s, e in zip(seq, expected):
+        npt.assert_array_almost_equal(s, e, decimal=6)
+
+
+def test_arraysequence():
+    rng = np.random.RandomState(42)
+    streamlines = _random_streamlines(rng)
+
+    seq = ArraySequence(streamlines)
+    assert_equal(seq.dtype, np.float32)
+    assert_equal(seq.common_shape, (3,))
+    assert_true(seq.is_compact())
+    check_sequence(seq, streamlines)
+    check_sequence(ArraySequence(iter(streamlines)), streamlines)
+    check_sequence(ArraySequence(seq), streamlines)
+    assert_equal(ArraySequence(streamlines, dtype=np.float64).dtype,
+                 np.float64)
+
+    empty = ArraySequence()
+    assert_equal(len(empty), 0)
+    assert_equal(empty.total_nb_rows, 0)
+    assert_equal(list(empty), [])
+
+    # Indexing with an integer returns a view of the buffer
+    npt.assert_array_almost_equal(seq[-1], streamlines[-1])
+    seq[0][0] = 0
+    assert_equal(seq.data[0, 0], 0)
+    npt.assert_raises(IndexError, seq.__getitem__, len(seq))
+    npt.assert_raises(TypeError, seq.__getitem__, 'a')
+    npt.assert_raises(TypeError, seq.__getitem__, np.array([0.5]))
+    seq = ArraySequence(streamlines)
+
+    # Slices, masks and indices share the buffer
+    for index in (slice(2, 8, 3), seq.lengths > 10, [5, 1, 5],
+                  np.array([], dtype=int)):
+        sub = seq[index]
+        assert_true(np.shares_memory(sub.data, seq.data))
+        check_sequence(sub, [streamlines[i] for i in
+                             np.arange(len(streamlines))[index]])
+    check_sequence(seq[::-1][1:3], streamlines[::-1][1:3])
+
+    # The copy is compact and independent
+    sub = seq[::2]
+    assert_false(sub.is_compact())
+    compact = sub.copy()
+    assert_true(compact.is_compact())
+    check_sequence(compact, streamlines[::2])
+    compact[0][:] = 1
+    npt.assert_array_almost_equal(seq[0], streamlines[0])
+
+    # Changing the type of the buffer compacts the sequence
+    check_sequence(sub.astype(np.float64), streamlines[::2])
+    assert_equal(seq.astype(np.float64).dtype, np.float64)
+
+    # Pickling
+    check_sequence(pickle.loads(pickle.dumps(sub)), streamlines[::2])
+
+
+def test_arraysequence_append():
+    rng = np.random.RandomState(1234)
+    streamlines = _random_streamlines(rng, 50)
+
+    seq = ArraySequence(buffer_size=8)
+    for s in streamlines:
+        seq.append(s)
+    check_sequence(seq, streamlines)
+    # The buffer grows geometrically, not once per streamline
+    assert_true(len(seq._data) < 2 * seq.total_nb_rows + 8)
+    # So do the offsets and lengths, which are trimmed on access
+    assert_true(len(seq._offsets) < 2 * len(seq) + 16)
+    assert_equal(len(seq.offsets), len(streamlines))
+    assert_equal(len(seq.lengths), len(streamlines))
+
+    seq.extend(iter(streamlines[:3]))
+    seq.extend(streamlines[:5])
+    seq.extend(ArraySequence(streamlines[5:10])[::-1])
+    check_sequence(seq, streamlines + streamlines[:3] + streamlines[:5] +
+                   streamlines[5:10][::-1])
+
+    # Appending to a view does not modify the original sequence
+    seq = ArraySequence(streamlines)
+    sub = seq[:3]
+    sub.append(streamlines[-1])
+    check_sequence(sub, streamlines[:3] + streamlines[-1:])
+    check_sequence(seq, streamlines)
+
+    npt.assert_raises(ValueError, seq.append, np.zeros((3, 2)))
+    npt.assert_raises(ValueError, seq.append, np.zeros(3))
+
+
+def test_arraysequence_from_arrays():
+    data = np.arange(30, dtype=np.float32).reshape((10, 3))
+    seq = ArraySequence.from_arrays(data, [2, 5, 3])
+    npt.assert_array_equal(seq.offsets, [0, 2, 7])
+    npt.assert_array_equal(seq[1], data[2:7])
+    assert_true(np.shares_memory(seq.data, data))
+
+    seq = ArraySequence.from_arrays(data, [2, 2], offsets=[8, 0])
+    npt.assert_array_equal(seq[0], data[8:])
+    npt.assert_array_equal(seq.copy().data, np.concatenate([data[8:],
+                                                            data[:2]]))
+    npt.assert_raises(ValueError, ArraySequence.from_arrays, data, [11])
+    npt.assert_raises(ValueError, ArraySequence.from_arrays, data, [1, 1],
+                      [0])
+    npt.assert_raises(ValueError, ArraySequence.from_arrays, data[0], [1])
+
+
+if __name__ == '__main__':
+    npt.run_module_suite()
@@ -3,10 +3,11 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 import nose
 from nose.tools import (assert_true, assert_false, assert_equal,
-                        assert_almost_equal)
+                        assert_almost_equal, assert_raises)
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from dipy.tracking import metrics as tm
 from dipy.tracking import distances as pf
+from dipy.tracking.arraysequence import ArraySequence
 
 
 def test_LSCv2():
@@ -122,6 +123,15 @@ def test_bundles_distances_mam():
     tracksB = [xyz1B, xyz1A, xyz2A]
     for metric in ('avg', 'min', 'max'):
         DM2 = pf.bundles_distances_mam(tracksA, tracksB, metric=metric)
+        DM = np.array([[pf.mam_distances(a, b, metric) for b in tracksB]
+                       for a in tracksA])
+        assert_array_almost_equal(DM, DM2, 5)
+        # Packed tracks are read from their buffer
+        DM3 = pf.bundles_distances_mam(ArraySequence(tracksA),
+                                       ArraySequence(tracksA + tracksB)[2:],
+                                       metric=metric)
+        assert_array_almost_equal(DM2, DM3)
+    assert_equal(pf.bundles_distances_mam([], tracksB).shape, (0, 3))
 
 
 def test_bundles_distances_mdf():
@@ -164,6 +174,87 @@ def test_bundles_distances_mdf():
 
     assert_array_almost_equal(DM, DM2, 4)
 
+    DM3 = pf.bundles_distances_mdf(ArraySequence(tracksA, dtype=np.float64),
+                                   ArraySequence([xyz1B] + tracksB)[1:])
+    assert_array_almost_equal(DM2, DM3)
+    assert_equal(pf.bundles_distances_mdf(tracksA, []).shape, (2, 0))
+
+
+def test_bundles_distances_threads():
+    rng = np.random.RandomState(42)
+    tracksA = [rng.rand(rng.randint(2, 20), 3) for i in range(150)]
+    tracksB = [rng.rand(rng.randint(2, 20), 3) for i in range(70)]
+    for metric in ('avg', 'min', 'max'):
+        DM = pf.bundles_distances_mam(tracksA, tracksB, metric=metric,
+                                      num_threads=1)
+        assert_equal(DM.dtype, np.float64)
+        DM32 = pf.bundles_distances_mam(tracksA, tracksB, metric=metric,
+                                        num_threads=3, dtype=np.float32)
+        assert_equal(DM32.dtype, np.float32)
+        assert_array_almost_equal(DM, DM32)
+    assert_raises(ValueError, pf.bundles_distances_mam, tracksA, tracksB,
+                  metric='none')
+    assert_raises(ValueError, pf.bundles_distances_mam, tracksA, tracksB,
+                  dtype=np.int32)
+
+    tracksA = [rng.rand(10, 3) for i in range(150)]
+    tracksB = [rng.rand(10, 3) for i in range(70)]
+    DM = pf.bundles_distances_mdf(tracksA, tracksB, num_threads=1)
+    assert_array_almost_equal(pf.bundles_distances_mdf(tracksA, tracksB,
+                                                       num_threads=2),
+                              DM)
+    assert_array_almost_equal(pf.bundles_distances_mdf(
+        tracksA, tracksB, dtype=np.float32), DM)
+    # MDF is only defined between tracks with the same number of points
+    assert_raises(ValueError, pf.bundles_distances_mdf, tracksA,
+                  [rng.rand(5, 3)])
+    assert_raises(ValueError, pf.bundles_distances_mdf, tracksA, tracksB,
+                  num_threads=0)
+
+
+def test_bundles_neighbors():
+    rng = np.random.RandomState(1234)
+    tracksA = [rng.rand(8, 3) for i in range(90)]
+    tracksB = [rng.rand(8, 3) for i in range(40)]
+    DM = pf.bundles_distances_mdf(tracksA, tracksB)
+    threshold = np.percentile(DM, 5)
+
+    for block_size in [1, 100, 2**24]:
+        indptr, indices, distances = pf.bundles_neighbors_mdf(
+            tracksA, tracksB, k=3, block_size=block_size)
+        assert_array_equal(indptr, 3 * np.arange(len(tracksA) + 1))
+        assert_array_almost_equal(distances.reshape((-1, 3)),
+                                  np.sort(DM, axis=1)[:, :3])
+        assert_array_equal(indices.reshape((-1, 3))[:, 0], DM.argmin(axis=1))
+
+        indptr, indices, distances = pf.bundles_neighbors_mdf(
+            tracksA, tracksB, threshold=threshold, block_size=block_size)
+        for i in range(len(tracksA)):
+            expected = np.flatnonzero(DM[i] <= threshold)
+            row = indices[indptr[i]:indptr[i + 1]]
+            assert_array_equal(np.sort(row), expected)
+            assert_true(np.all(np.diff(distances[indptr[i]:indptr[i + 1]])
+                               >= 0))
+
+    # Both criteria together, more neighbors than tracks
+    indptr, indices, distances = pf.bundles_neighbors_mdf(
+        tracksA, tracksB, k=100, threshold=threshold)
+    assert_array_equal(np.diff(indptr), (DM <= threshold).sum(axis=1))
+
+    tracksA = [rng.rand(rng.randint(2, 10), 3) for i in range(30)]
+    DM = pf.bundles_distances_mam(tracksA, tracksB, metric='max')
+    indptr, indices, distances = pf.bundles_neighbors_mam(
+        tracksA, tracksB, metric='max', k=1, block_size=50)
+    assert_array_equal(indices, DM.argmin(axis=1))
+    assert_array_almost_equal(distances, DM.min(axis=1))
+
+    indptr, indices, distances = pf.bundles_neighbors_mam([], tracksB, k=1)
+    assert_array_equal(indptr, [0])
+    assert_equal(len(indices), 0)
+    assert_raises(ValueError, pf.bundles_neighbors_mam, tracksA, tracksB)
+    assert_raises(ValueError, pf.bundles_neighbors_mdf, tracksB, tracksB,
+                  k=0)
+
 
 def test_mam_distances():
     xyz1 = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 0, 0]])
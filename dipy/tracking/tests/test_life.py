@@ -125,6 +125,27 @@ def test_FiberModel_init():
         npt.assert_equal(fiber_matrix.shape, (len(vox_coords) * 64,
                                               len(streamline)))
 
+        # The signal of each voxel is the sum of the signals of its nodes:
+        if sphere is False:
+            sig = [life.streamline_signal(s, gtab) for s in streamline]
+        else:
+            signal_maker = life.LifeSignalMaker(gtab, sphere=sphere)
+            sig = [signal_maker.streamline_signal(s) for s in streamline]
+        for s_idx in range(len(streamline)):
+            expected = np.zeros((len(vox_coords), 64))
+            expected[:len(streamline[s_idx])] = sig[s_idx]
+            npt.assert_almost_equal(
+                fiber_matrix[:, s_idx].toarray().reshape((-1, 64)), expected)
+
+        # Neither the number of threads, nor float32 change the matrix:
+        fiber_matrix32, vox_coords32 = FM.setup(streamline, affine,
+                                                sphere=sphere, num_threads=2,
+                                                dtype=np.float32)
+        npt.assert_equal(fiber_matrix32.dtype, np.float32)
+        npt.assert_array_equal(vox_coords32, vox_coords)
+        npt.assert_almost_equal(fiber_matrix32.toarray(),
+                                fiber_matrix.toarray(), decimal=6)
+
 
 def test_FiberFit():
     data_file, bval_file, bvec_file = dpd.get_data('small_64D')
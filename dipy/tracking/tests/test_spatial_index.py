@@ -0,0 +1,94 @@
+import numpy as np
+import numpy.testing as npt
+from nose.tools import assert_equal, assert_raises
+
+from dipy.tracking.spatial_index import StreamlineIndex
+from dipy.tracking.streamline import Streamlines, select_by_rois
+from dipy.tracking.utils import near_roi, target, path_length
+
+
+def _random_streamlines(rng, nb_streamlines=60, size=10):
+    streamlines = []
+    for i in range(nb_streamlines):
+        start = rng.rand(3) * size
+        steps = rng.randn(rng.randint(1, 20), 3) * 0.7
+        streamlines.append(np.clip(start + np.cumsum(steps, axis=0), 0,
+                                   size - 1))
+    return streamlines
+
+
+def test_near_coords():
+    rng = np.random.RandomState(42)
+    streamlines = _random_streamlines(rng)
+    index = StreamlineIndex(streamlines)
+    assert_equal(len(index), len(streamlines))
+
+    affine = np.diag([1., 1.5, 1., 1.])
+    roi = np.zeros((10, 10, 10), dtype=bool)
+    roi[2:4, 5, 1:6] = True
+    for mode in ["any", "all", "either_end", "both_end"]:
+        for tol in [1., 2.5]:
+            expected = near_roi(streamlines, roi, affine, tol, mode)
+            npt.assert_array_equal(near_roi(index, roi, affine, tol, mode),
+                                   expected)
+        npt.assert_array_equal(index.near_coords(np.zeros((0, 3)), 1, mode),
+                               np.zeros(len(streamlines), dtype=bool))
+    assert_raises(ValueError, index.near_coords, [[0, 0, 0]], 1, "none")
+
+    # Same answers for packed float32 streamlines
+    packed = StreamlineIndex(Streamlines(streamlines))
+    npt.assert_array_equal(near_roi(packed, roi, affine, 2.),
+                           near_roi(streamlines, roi, affine, 2.))
+
+    rois = [roi, np.roll(roi, 3, axis=0)]
+    for include in [[True, True], [True, False], [False, True]]:
+        for mode in ["any", "both_end"]:
+            expected = list(select_by_rois(streamlines, rois, include,
+                                           mode=mode, tol=1.5))
+            selected = list(select_by_rois(index, rois, include, mode=mode,
+                                           tol=1.5))
+            assert_equal(len(selected), len(expected))
+            for s1, s2 in zip(selected, expected):
+                npt.assert_array_almost_equal(s1, s2)
+
+
+def test_in_mask():
+    rng = np.random.RandomState(1234)
+    streamlines = _random_streamlines(rng)
+    index = StreamlineIndex(streamlines)
+
+    affine = np.diag([0.5, 0.5, 1., 1.])
+    affine[:3, 3] = [0.2, 0, -0.1]
+    mask = np.zeros((22, 22, 12), dtype=bool)
+    mask[3:10, 8:16, 2:8] = True
+    for include in [True, False]:
+        expected = list(target(streamlines, mask, affine, include))
+        selected = list(target(index, mask, affine, include))
+        assert_equal(len(selected), len(expected))
+        for s1, s2 in zip(selected, expected):
+            npt.assert_array_equal(s1, s2)
+
+    # The voxel table is built once per grid
+    assert_equal(len(index._voxel_tables), 1)
+    npt.assert_array_equal(index.in_mask(np.zeros((3, 3, 3))),
+                           np.zeros(len(streamlines), dtype=bool))
+    assert_equal(len(index._voxel_tables), 2)
+
+    labels = np.zeros(mask.shape, dtype=int)
+    labels[mask] = 3
+    labels[0:4, 0:4, 0:4] = 1
+    npt.assert_array_equal(index.in_label(labels, 3, affine),
+                           index.in_mask(mask, affine))
+    expected = [np.any(labels[tuple(np.dot(s - affine[:3, 3],
+                                           np.linalg.inv(affine[:3, :3]).T)
+                                    .round().astype(int).T)] == 1)
+                for s in streamlines]
+    npt.assert_array_equal(index.in_label(labels, 1, affine), expected)
+
+    # Path lengths only depend on the streamlines passing through the aoi
+    npt.assert_array_almost_equal(path_length(index, mask, affine),
+                                  path_length(streamlines, mask, affine))
+
+
+if __name__ == '__main__':
+    npt.run_module_suite()
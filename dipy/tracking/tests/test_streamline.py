@@ -22,7 +22,8 @@ from dipy.tracking.streamline import (set_number_of_points,
                                       compress_streamlines,
                                       select_by_rois,
                                       orient_by_rois,
-                                      values_from_volume)
+                                      values_from_volume,
+                                      Streamlines)
 
 
 streamline = np.array([[82.20181274,  91.36505890,  43.15737152],
@@ -468,6 +469,58 @@ def test_unlist_relist_streamlines():
         assert_array_equal(streamlines[i], streamlines2[i])
 
 
+def test_packed_streamlines():
+    rng = np.random.RandomState(42)
+    streamlines = [rng.rand(rng.randint(2, 30), 3) * 10 for i in range(20)]
+    packed = Streamlines(streamlines)
+
+    # The kernels run on the buffer and give the same results as on lists
+    assert_array_almost_equal(ds_length(packed), ds_length(streamlines), 4)
+    assert_array_almost_equal(ds_length(packed[::3]),
+                              ds_length(streamlines[::3]), 4)
+    assert_array_almost_equal(ds_length(Streamlines(streamlines,
+                                                    dtype=np.int32)),
+                              ds_length([s.astype(np.int32)
+                                         for s in streamlines]))
+    assert_array_equal(ds_length(Streamlines()), [])
+
+    resampled = set_number_of_points(packed[::-1], 12)
+    assert_true(isinstance(resampled, Streamlines))
+    assert_equal(resampled.dtype, np.float32)
+    assert_equal(resampled.total_nb_rows, 12 * len(packed))
+    for s1, s2 in zip(resampled,
+                      set_number_of_points(list(packed)[::-1], 12)):
+        assert_array_almost_equal(s1, s2, 5)
+    assert_raises(ValueError, set_number_of_points, packed, 1)
+    short = Streamlines([np.zeros((1, 3))])
+    assert_raises(ValueError, set_number_of_points, short, 3)
+
+    compressed = compress_streamlines(packed, tol_error=0.1)
+    assert_true(isinstance(compressed, Streamlines))
+    for s1, s2 in zip(compressed,
+                      compress_streamlines(list(packed), tol_error=0.1)):
+        assert_array_equal(s1, s2)
+
+    points, offsets = unlist_streamlines(packed[::2])
+    assert_array_equal(points, np.concatenate(list(packed[::2])))
+    assert_array_equal(offsets, np.cumsum(packed.lengths[::2]))
+
+    affine = np.diag([2., 3., 4., 1.])
+    affine[:3, 3] = [1, 2, 3]
+    transformed = transform_streamlines(packed[1::2], affine)
+    assert_true(isinstance(transformed, Streamlines))
+    for s1, s2 in zip(transformed,
+                      transform_streamlines(list(packed[1::2]), affine)):
+        assert_array_almost_equal(s1, s2, 4)
+    centered, center = center_streamlines(packed)
+    assert_array_almost_equal(center, np.mean(packed.data, axis=0))
+    assert_array_almost_equal(centered.data, packed.data - center)
+
+    selected = select_random_set_of_streamlines(packed, 5)
+    assert_true(isinstance(selected, Streamlines))
+    assert_equal(len(selected), 5)
+
+
 def test_center_and_transform():
     A = np.array([[1, 2, 3], [1, 2, 3.]])
     streamlines = [A for i in range(10)]
@@ -64,6 +64,7 @@ from numpy import (asarray, ceil, dot, empty, eye, sqrt)
 from dipy.io.bvectxt import ornt_mapping
 from dipy.tracking import metrics
 from .vox2track import _streamlines_in_mask
+from .spatial_index import StreamlineIndex
 
 # Import helper functions shared with vox2track
 from ._utils import (_mapping_to_voxel, _to_voxel_coordinates)
@@ -555,9 +556,11 @@ def target(streamlines, target_mask, affine, include=True):
 
     Parameters
     ----------
-    streamlines : iterable
+    streamlines : iterable or StreamlineIndex
         A sequence of streamlines. Each streamline should be a (N, 3) array,
-        where N is the length of the streamline.
+        where N is the length of the streamline. With a `StreamlineIndex`,
+        only the streamlines with points in the voxels of `target_mask` are
+        looked at.
     target_mask : array-like
         A mask used as a target. Non-zero values are considered to be within
         the target region.
@@ -576,6 +579,7 @@ def target(streamlines, target_mask, affine, include=True):
     ------
     ValueError
         When the points of the streamlines lie outside of the `target_mask`.
+        Points outside of the mask are ignored with a `StreamlineIndex`.
 
     See Also
     --------
@@ -584,6 +588,13 @@ def target(streamlines, target_mask, affine, include=True):
     """
     target_mask = np.array(target_mask, dtype=bool, copy=True)
     lin_T, offset = _mapping_to_voxel(affine, voxel_size=None)
+    if isinstance(streamlines, StreamlineIndex):
+        selected = streamlines.in_mask(target_mask, affine) == include
+        streamlines = streamlines.streamlines[selected]
+        yield
+        for sl in streamlines:
+            yield sl
+        return
     yield
     # End of initialization
 
@@ -708,9 +719,10 @@ def near_roi(streamlines, region_of_interest, affine=None, tol=None,
 
     Parameters
     ----------
-    streamlines : list or generator
+    streamlines : list, generator or StreamlineIndex
         A sequence of streamlines. Each streamline should be a (N, 3) array,
-        where N is the length of the streamline.
+        where N is the length of the streamline. A `StreamlineIndex` answers
+        without looking at the streamlines far from the ROI.
     region_of_interest : ndarray
         A mask used as a target. Non-zero values are considered to be within
         the target region.
@@ -756,6 +768,9 @@ def near_roi(streamlines, region_of_interest, affine=None, tol=None,
     roi_coords = np.array(np.where(region_of_interest)).T
     x_roi_coords = apply_affine(affine, roi_coords)
 
+    if isinstance(streamlines, StreamlineIndex):
+        return streamlines.near_coords(x_roi_coords, tol, mode=mode)
+
     # If it's already a list, we can save time by preallocating the output
     if isinstance(streamlines, list):
         out = np.zeros(len(streamlines), dtype=bool)
@@ -1098,9 +1113,10 @@ def path_length(streamlines, aoi, affine, fill_value=-1):
 
     Parameters
     ----------
-    streamlines : seq of (N, 3) arrays
+    streamlines : seq of (N, 3) arrays or StreamlineIndex
         A sequence of streamlines, path length is given in mm along the curve
-        of the streamline.
+        of the streamline. With a `StreamlineIndex`, only the streamlines
+        passing through `aoi` are looked at.
     aoi : array, 3d
         A mask (binary array) of voxels from which to start computing distance.
     affine : array (4, 4)
@@ -1116,6 +1132,9 @@ def path_length(streamlines, aoi, affine, fill_value=-1):
         along the path of a streamline.
     """
     aoi = np.asarray(aoi, dtype=bool)
+    if isinstance(streamlines, StreamlineIndex):
+        # Streamlines not passing through aoi do not change the map
+        streamlines = streamlines.streamlines[streamlines.in_mask(aoi, affine)]
 
     # path length map
     plm = np.empty(aoi.shape, dtype=float)
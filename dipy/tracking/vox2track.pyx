@@ -3,11 +3,14 @@
 implemented in cython.
 """
 import cython
+from cython.parallel import prange
 
 from libc.math cimport ceil, fmin, floor, fabs, sqrt
 
 import numpy as np
 cimport numpy as cnp
+
+from omp_threads cimport determine_num_threads
 from ._utils import _mapping_to_voxel, _to_voxel_coordinates
 
 from ..utils.six.moves import xrange
@@ -74,6 +77,62 @@ def _voxel2streamline(sl,
     return v2f ,v2fn
 
 
+ctypedef fused life_t:
+    cnp.float32_t
+    cnp.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _life_matrix_data(life_t[:, ::1] signals,
+                      cnp.npy_intp[::1] node_signal,
+                      cnp.npy_intp[::1] node_pair,
+                      cnp.npy_intp[::1] offsets,
+                      life_t[:, ::1] out,
+                      num_threads=None):
+    """ Sums the signals of the nodes of streamlines in each of their voxels,
+    for setting up the LiFE equations matrix
+
+    Parameters
+    ----------
+    signals : array (M, n_bvecs)
+        The signals that the nodes are given.
+    node_signal : array (N,)
+        The row of `signals` of each node.
+    node_pair : array (N,)
+        The row of `out` of each node, that is of the combination of its
+        streamline and of its voxel.
+    offsets : array (S + 1,)
+        The nodes of the streamline ``s`` are ``offsets[s]`` to
+        ``offsets[s + 1]``.
+    out : array (P, n_bvecs)
+        The signal of each combination of a streamline and of a voxel, the
+        signals of its nodes are added to it. A row must only be shared by
+        the nodes of a single streamline.
+    num_threads : int, optional
+        Number of threads the streamlines are spread over. Default: one per
+        processor if OpenMP is available.
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = offsets.shape[0] - 1
+        cnp.npy_intp n_bvecs = out.shape[1]
+        cnp.npy_intp s, i, k, pair, sig
+        int threads = determine_num_threads(num_threads)
+
+    if signals.shape[1] != n_bvecs:
+        raise ValueError('signals and out must have as many columns')
+    # The rows of out of different streamlines are disjoint, the threads
+    # never write to the same row
+    with nogil:
+        for s in prange(nb_streamlines, num_threads=threads,
+                        schedule='guided'):
+            for i in range(offsets[s], offsets[s + 1]):
+                pair = node_pair[i]
+                sig = node_signal[i]
+                for k in range(n_bvecs):
+                    out[pair, k] += signals[sig, k]
+
+
 def streamline_mapping(streamlines, voxel_size=None, affine=None,
                        mapping_as_streamlines=False):
     """Creates a mapping from voxel indices to streamlines.
@@ -126,3 +126,55 @@ def eigh(a, UPLO='L'):
         return (evals.reshape(shape + (a.shape[1], )),
                 evecs.reshape(shape + (a.shape[1], a.shape[1])))
     return np.linalg.eigh(a, UPLO)
+
+
+def cholesky_solve(a, b):
+    """Solve stacks of symmetric positive definite linear systems
+
+    Each system ``a[..., :, :] x[..., :] = b[..., :]`` is solved through the
+    Cholesky factorization of ``a``, which is about twice as fast as a
+    general solver and much faster than a pseudo-inverse. If any of the
+    matrices is not positive definite, all the systems are solved with
+    `pinv` instead, giving their least squares solution.
+
+    Parameters
+    ----------
+    a : array_like (..., M, M)
+        Symmetric positive definite matrices.
+    b : array_like (..., M)
+        Right-hand sides.
+
+    Returns
+    -------
+    x : ndarray (..., M)
+        Solutions of the systems.
+
+    See Also
+    --------
+    np.linalg.cholesky
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    try:
+        if a.ndim > 2 and NUMPY_LESS_1_8:
+            L = np.empty(a.shape)
+            for index in np.ndindex(*a.shape[:-2]):
+                L[index] = np.linalg.cholesky(a[index])
+        else:
+            L = np.linalg.cholesky(a)
+    except np.linalg.LinAlgError:
+        # Singular or indefinite matrices
+        return np.einsum('...ij,...j', pinv(a), b)
+
+    # Forward substitution with L, then back substitution with L.T, each
+    # step being done for all the systems at once
+    x = np.empty(L.shape[:-1], dtype=L.dtype)
+    x[...] = b
+    n = a.shape[-1]
+    for i in range(n):
+        x[..., i] -= np.einsum('...j,...j', L[..., i, :i], x[..., :i])
+        x[..., i] /= L[..., i, i]
+    for i in range(n - 1, -1, -1):
+        x[..., i] -= np.einsum('...j,...j', L[..., i + 1:, i], x[..., i + 1:])
+        x[..., i] /= L[..., i, i]
+    return x
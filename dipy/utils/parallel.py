@@ -0,0 +1,63 @@
+""" Utilities to run work in pools of processes sharing memory """
+
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+
+def fork_context():
+    """Multiprocessing context whose processes are forked
+
+    Forked processes inherit the memory of their parent, so objects that
+    cannot be pickled, or that are too large to be, can be shared with them
+    by setting them before the pool is created.
+
+    Returns
+    -------
+    context : multiprocessing context or None
+        Has the same ``Pool`` and ``Process`` API as the `multiprocessing`
+        module. None if processes cannot be forked on this platform.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    if not hasattr(multiprocessing, 'get_context'):
+        # Python 2 always forks where it can
+        return multiprocessing
+    return multiprocessing.get_context('fork')
+
+
+def map_chunks(func, index, step, num_workers):
+    """Call `func` on consecutive chunks of the voxels in `index`
+
+    The chunks have at most `step` voxels, but there are enough of them to
+    keep `num_workers` threads busy. numpy and scipy release the GIL in the
+    linear algebra, so the threads run on several cores and `func` can write
+    its results straight into arrays they share.
+
+    Parameters
+    ----------
+    func : callable
+        Called with each chunk, a slice of `index`.
+    index : array
+        Indices of the voxels to process.
+    step : int
+        Maximum number of voxels of a chunk.
+    num_workers : int or None
+        Number of threads. None uses one per CPU. With one worker the chunks
+        are processed serially in the calling thread.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    step = max(min(step, -(-len(index) // max(num_workers, 1))), 1)
+    chunks = [index[start:start + step]
+              for start in range(0, len(index), step)]
+    if num_workers < 2 or len(chunks) < 2:
+        for chunk in chunks:
+            func(chunk)
+        return
+    pool = ThreadPool(num_workers)
+    try:
+        pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
@@ -5,7 +5,7 @@ import sys
 
 import numpy as np
 
-from dipy.utils.arrfuncs import as_native_array, pinv, eigh
+from dipy.utils.arrfuncs import as_native_array, pinv, eigh, cholesky_solve
 
 from numpy.testing import (assert_array_almost_equal,
                            assert_array_equal)
@@ -56,3 +56,24 @@ def test_eigh():
                 evals_vox, evecs_vox = np.linalg.eigh(arr[i, j, k])
                 assert_array_almost_equal(evals[i, j, k], evals_vox)
                 assert_array_almost_equal(evecs[i, j, k], evecs_vox)
+
+
+def test_cholesky_solve():
+    arr = np.random.randn(4, 5, 9, 7)
+    spd = np.einsum('...ki,...kj', arr, arr)
+    b = np.random.randn(4, 5, 7)
+    x = cholesky_solve(spd, b)
+    for i in range(4):
+        for j in range(5):
+            assert_array_almost_equal(x[i, j],
+                                      np.linalg.solve(spd[i, j], b[i, j]))
+
+    # A single system, with a right-hand side shared by all the systems
+    assert_array_almost_equal(cholesky_solve(spd[0, 0], b[0, 0]), x[0, 0])
+    assert_array_almost_equal(cholesky_solve(spd[0], b[0, 0])[0], x[0, 0])
+
+    # Singular systems have their least squares solution
+    spd[1, 2] = 0
+    x = cholesky_solve(spd, b)
+    assert_array_equal(x[1, 2], 0)
+    assert_array_almost_equal(x[0, 0], np.linalg.solve(spd[0, 0], b[0, 0]))
@@ -8,10 +8,7 @@ import nibabel as nib
 
 from dipy.core.gradients import gradient_table
 from dipy.io.gradients import read_bvals_bvecs
-from dipy.reconst.dti import (TensorModel, color_fa, fractional_anisotropy,
-                              geodesic_anisotropy, mean_diffusivity,
-                              axial_diffusivity, radial_diffusivity,
-                              lower_triangular, mode as get_mode)
+from dipy.reconst.dti import TensorModel, lower_triangular
 from dipy.workflows.workflow import Workflow
 
 
@@ -104,9 +101,23 @@ class ReconstDtiFlow(Workflow):
                 save_metrics = ['fa', 'md', 'rd', 'ad', 'ga', 'rgb', 'mode',
                                 'evec', 'eval', 'tensor']
 
-            FA = fractional_anisotropy(tenfit.evals)
-            FA[np.isnan(FA)] = 0
-            FA = np.clip(FA, 0, 1)
+            # All the scalar maps are computed in a single pass, straight
+            # into the single precision arrays that are saved
+            names = {'fa': 'fa', 'ga': 'ga', 'rgb': 'color_fa', 'md': 'md',
+                     'ad': 'ad', 'rd': 'rd', 'mode': 'mode'}
+            out = {}
+            for metric in save_metrics:
+                if metric in names:
+                    shape = tenfit.shape
+                    if metric == 'rgb':
+                        shape = shape + (3,)
+                    out[names[metric]] = np.empty(shape, dtype=np.float32)
+            tenfit.metrics(list(out), out=out)
+
+            if 'fa' in save_metrics:
+                FA = out['fa']
+                FA[np.isnan(FA)] = 0
+                np.clip(FA, 0, 1, out=FA)
 
             if 'tensor' in save_metrics:
                 tensor_vals = lower_triangular(tenfit.quadratic_form)
@@ -117,37 +128,33 @@ class ReconstDtiFlow(Workflow):
                 nib.save(fiber_tensors, otensor)
 
             if 'fa' in save_metrics:
-                fa_img = nib.Nifti1Image(FA.astype(np.float32), affine)
+                fa_img = nib.Nifti1Image(FA, affine)
                 nib.save(fa_img, ofa)
 
             if 'ga' in save_metrics:
-                GA = geodesic_anisotropy(tenfit.evals)
-                ga_img = nib.Nifti1Image(GA.astype(np.float32), affine)
+                ga_img = nib.Nifti1Image(out['ga'], affine)
                 nib.save(ga_img, oga)
 
             if 'rgb' in save_metrics:
-                RGB = color_fa(FA, tenfit.evecs)
+                RGB = out['color_fa']
+                RGB[np.isnan(RGB)] = 0
                 rgb_img = nib.Nifti1Image(np.array(255 * RGB, 'uint8'), affine)
                 nib.save(rgb_img, orgb)
 
             if 'md' in save_metrics:
-                MD = mean_diffusivity(tenfit.evals)
-                md_img = nib.Nifti1Image(MD.astype(np.float32), affine)
+                md_img = nib.Nifti1Image(out['md'], affine)
                 nib.save(md_img, omd)
 
             if 'ad' in save_metrics:
-                AD = axial_diffusivity(tenfit.evals)
-                ad_img = nib.Nifti1Image(AD.astype(np.float32), affine)
+                ad_img = nib.Nifti1Image(out['ad'], affine)
                 nib.save(ad_img, oad)
 
             if 'rd' in save_metrics:
-                RD = radial_diffusivity(tenfit.evals)
-                rd_img = nib.Nifti1Image(RD.astype(np.float32), affine)
+                rd_img = nib.Nifti1Image(out['rd'], affine)
                 nib.save(rd_img, orad)
 
             if 'mode' in save_metrics:
-                MODE = get_mode(tenfit.quadratic_form)
-                mode_img = nib.Nifti1Image(MODE.astype(np.float32), affine)
+                mode_img = nib.Nifti1Image(out['mode'], affine)
                 nib.save(mode_img, omode)
 
             if 'evec' in save_metrics:
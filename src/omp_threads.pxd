@@ -0,0 +1,15 @@
+cimport safe_openmp as openmp
+from safe_openmp cimport have_openmp
+
+
+cdef inline int determine_num_threads(num_threads) except -1:
+    """ Number of threads to use: `num_threads`, or one per processor if
+    None and OpenMP is available, one otherwise. Raises ValueError if
+    `num_threads` is below 1.
+    """
+    if num_threads is not None:
+        if num_threads < 1:
+            raise ValueError("num_threads must be at least 1, got %r"
+                             % (num_threads,))
+        return num_threads
+    return openmp.omp_get_num_procs() if have_openmp else 1